@@ -54,23 +54,33 @@
 #    the mirrors
 
 
+import asyncio
+import concurrent.futures
 import copy
 import errno
 import gzip
+import http.client
 import os
 import json
+import lzma
+import mmap
 import pprint
+import queue
 import random
 import re
+import ssl
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import traceback
 import time
 import gc
+import zlib
 
 from io import BytesIO
+from urllib.parse import urlsplit, urljoin
 
 try:
     import func_timeout
@@ -94,6 +104,26 @@ except ImportError:
     sys.stderr.write('WARNING: Cannot import python module cmp_version - not installed?\nWARNING: Cannot compare versions. Will assume all != versions are >.\n')
     canCompareVersions = False
 
+# zstd - Packages are compressed with zstd (.pkg.tar.zst) since early 2020. Use the stdlib module if present (python 3.14+),
+#   otherwise the "zstandard" module.
+try:
+    from compression import zstd as zstd_mod
+    canDecodeZstd = True
+except ImportError:
+    try:
+        import zstandard as zstd_mod
+        canDecodeZstd = True
+    except ImportError:
+        sys.stderr.write('WARNING: Cannot import python module zstandard - not installed?\nWARNING: Cannot decode .pkg.tar.zst packages, only older .pkg.tar.xz packages.\n')
+        zstd_mod = None
+        canDecodeZstd = False
+
+try:
+    import pacmanProvidesDB
+except ImportError:
+    sys.stderr.write('ERROR: Cannot import pacmanProvidesDB (part of pacman-utils) - not installed? See install.sh\n')
+    sys.exit(1)
+
 try:
     PermissionError
 except NameError:
@@ -107,13 +137,33 @@ __version_tuple__ = (1, 1, 0)
 ################
 
 global LATEST_FILE_FORMAT
-LATEST_FILE_FORMAT = '0.2'
+LATEST_FILE_FORMAT = pacmanProvidesDB.DB_FORMAT_VERSION
 
-SUPPORTED_DATABASE_VERSIONS = ('0.1', '0.2')
+SUPPORTED_DATABASE_VERSIONS = ('0.1', '0.2', '0.3')
 
 global PROVIDES_DB_LOCATION
 PROVIDES_DB_LOCATION = "/var/lib/pacman/.providesDB"
 
+# KEEP_COMPRESSION - Value of PROVIDES_DB_COMPRESSION to compress the database the same way as the existing one
+KEEP_COMPRESSION = 'keep'
+
+# PROVIDES_DB_COMPRESSION - How to compress the database when it is written ( --compress ), as returned by
+#   pacmanProvidesDB.parseCompression , or KEEP_COMPRESSION
+PROVIDES_DB_COMPRESSION = KEEP_COMPRESSION
+
+# COMPRESS_THREADS - Number of threads compressing the database ( --compress-threads ), None for the number of cpus
+COMPRESS_THREADS = None
+
+# PACMAN_SYNC_DIR - Where pacman keeps the sync databases ( $repo.db ), which list each package's filename
+PACMAN_SYNC_DIR = "/var/lib/pacman/sync"
+
+# PACMAN_CONF - pacman's config. Its repo sections are in order of precedence (the first repo with a package wins)
+PACMAN_CONF = "/etc/pacman.conf"
+
+# PACKAGE_METADATA_FILES - Files in the top of a package, which the .MTREE lists, but pacman does not install
+#   (so the files databases and the local database do not list them). Not included in the files a package provides.
+PACKAGE_METADATA_FILES = frozenset( ('/.BUILDINFO', '/.CHANGELOG', '/.INSTALL', '/.MTREE', '/.PKGINFO') )
+
 
 # USE_ARCH - Package arch to use. TODO: Allow others
 #   NOTE: If this arch is not found, "any" will be tried
@@ -126,10 +176,39 @@ USE_ARCH = "x86_64"
 ################
 
 
-DEFAULT_SUBPROCESS_BUFSIZE = 1024 * 500 # 500K Bufsize
+# DEFAULT_FETCH_CHUNK_SIZE - Number of bytes to read from the network at a time
+DEFAULT_FETCH_CHUNK_SIZE = 1024 * 16
+
+# HTTP_CONNECT_TIMEOUT - Socket timeout (in seconds) for the native http fetcher.
+#   The overall per-package timeouts are SHORT_TIMEOUT/LONG_TIMEOUT
+HTTP_CONNECT_TIMEOUT = 30
+
+# HTTP_MAX_IDLE_PER_MIRROR - Max number of idle keep-alive connections to hold open per mirror
+HTTP_MAX_IDLE_PER_MIRROR = 4
+
+# HTTP_MAX_DRAIN_SIZE - When a transfer is stopped early, if no more than this many bytes remain
+#   of the response, read them so the connection can be reused. Otherwise, the connection is closed.
+HTTP_MAX_DRAIN_SIZE = 1024 * 64
+
+# HTTP_MAX_REDIRECTS - Max number of redirects to follow for a single fetch
+HTTP_MAX_REDIRECTS = 5
+
+# DEFAULT_DECODE_STEP_SIZE - Number of compressed bytes to feed to the decoder at a time.
+#   Decoding stops as soon as the .MTREE has been read, so this is the granularity of that stop.
+DEFAULT_DECODE_STEP_SIZE = 1024 * 4
 
 DEFAULT_SHORT_FETCH_SIZE = 1024 * 200 # Try to fetch first 200K to find MTREE
 
+# MAX_SHORT_FETCH_SIZE - If the .MTREE is not found within the short fetch, the fetch size is doubled
+#   (continuing from where the last fetch ended) until it is found, or this size is reached.
+#   After this, we fall back to a full fetch.
+MAX_SHORT_FETCH_SIZE = 1024 * 1024 * 4
+
+# MTREE_OFFSET_MARGIN - When we know from the prior database where the .MTREE ended (compressed offset)
+#   in the last version of a package, we fetch exactly that much plus this margin (or 1/8th of the offset, whichever is larger),
+#   as the new version's offset will have shifted a bit.
+MTREE_OFFSET_MARGIN = 1024 * 8
+
 
 # MAX_THREADS - Max number of threads
 MAX_THREADS = 6
@@ -138,13 +217,44 @@ MAX_THREADS = 6
 SHORT_TIMEOUT = 15
 LONG_TIMEOUT = ( 60 * 8 )
 
-# Max extra urls added to each thread.
-#  Normally, a repo is assigned to a thread, but if any are extra
-#  up to this many will be made available to each thread.
-global MAX_EXTRA_URLS
-MAX_EXTRA_URLS = 3
+# MAX_PER_MIRROR - Max number of packages being fetched from any one mirror at a time.
+#   Threads pick whichever mirror has a free slot, so the number of threads
+#   can be up to (number of mirrors * MAX_PER_MIRROR)
+global MAX_PER_MIRROR
+MAX_PER_MIRROR = 1
+
+# ASYNC_MAX_TASKS - For the asyncio engine, max number of packages in flight at once
+ASYNC_MAX_TASKS = 256
+
+# ASYNC_MAX_PER_MIRROR - For the asyncio engine, max number of in-flight fetches per mirror
+ASYNC_MAX_PER_MIRROR = 16
+
+# LOCAL_READ_STEP_SIZE - When indexing local packages ( --from-dir ), number of bytes of the
+#   mapped package to hand to the decoder at a time, until the .MTREE is found
+LOCAL_READ_STEP_SIZE = 1024 * 64
 
-MAX_REPOS = MAX_THREADS + MAX_EXTRA_URLS
+# PIPELINE_DECODE_QUEUE_FACTOR - For the pipeline engine, by default allow this many fetched packages
+#   per decode process to wait for decoding, before the fetch threads wait.
+PIPELINE_DECODE_QUEUE_FACTOR = 4
+
+# PIPELINE_REPORT_INTERVAL - For the pipeline engine, in verbose mode, print the queue depths this often (in seconds)
+PIPELINE_REPORT_INTERVAL = 10
+
+# MIRROR_BREAKER_THRESHOLD - Number of failures in a row (timeouts, missing data, network errors)
+#   after which a mirror is not used for a cool-down period
+MIRROR_BREAKER_THRESHOLD = 5
+
+# MIRROR_BREAKER_COOLDOWN / MIRROR_BREAKER_MAX_COOLDOWN - Seconds a failing mirror is not used for.
+#   Doubles each time the mirror fails again after cooling down, up to the max.
+MIRROR_BREAKER_COOLDOWN = 60
+MIRROR_BREAKER_MAX_COOLDOWN = 60 * 10
+
+# MIRROR_HEALTH_WEIGHT - Weight of each new fetch in a mirror's moving averages (duration, throughput, failure rate)
+MIRROR_HEALTH_WEIGHT = 0.2
+
+# MAX_REPOS - Max number of mirrors to read from /etc/pacman.d/mirrorlist
+#   Mirrors beyond the number of threads provide spare capacity and are used for retries
+MAX_REPOS = MAX_THREADS + 3
 
 
 ####################
@@ -162,29 +272,21 @@ else:
 isStrType = lambda arg : issubclass(arg.__class__, ALL_STR_TYPES)
 isDecodedStrType = lambda arg : issubclass(arg.__class__, ALL_DECODED_STR_TYPES)
 
+# TAR_BLOCK_SIZE - Tar headers and data are aligned to this many bytes
+TAR_BLOCK_SIZE = 512
 
+# PACKAGE_MAGICS - Magic bytes at the start of a package for each supported compression
+PACKAGE_MAGICS = (
+    ('zst', b'\x28\xb5\x2f\xfd'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('gz', b'\x1f\x8b'),
+)
+PACKAGE_MAGIC_SIZE = max( len(magic) for (compression, magic) in PACKAGE_MAGICS )
 
-# Try to use shared memory slot, if available
-global USE_TEMP_DIR
-USE_TEMP_DIR = None
-def getUseTempDir():
-    '''
-        getUseTempDir - Get the directory that should be used for
-            short-term temp files.
-
-          We prefer to use /dev/shm (directly in memory), if available.
-          Otherwise, fall back to system temp dir ( /tmp )
-
-        @return <str> Temporary directory name to use
-    '''
-    global USE_TEMP_DIR
-    if USE_TEMP_DIR is None:
-        if os.path.exists('/dev/shm') and os.access('/dev/shm', os.W_OK):
-            USE_TEMP_DIR = '/dev/shm'
-        else:
-            USE_TEMP_DIR = tempfile.gettmpdir()
+# PACKAGE_EXTENSIONS - Package file extensions, newest first. Packages not listed in the sync databases
+#   ( @see getPackageFilenames ) are tried as the first, and then the others ( @see getAlternatePackageUrls )
+PACKAGE_EXTENSIONS = ('.pkg.tar.zst', '.pkg.tar.xz')
 
-    return USE_TEMP_DIR
 
 class FailedToConvertDatabaseException(ValueError):
     '''
@@ -193,211 +295,579 @@ class FailedToConvertDatabaseException(ValueError):
     '''
     pass
 
-def convertOldDatabase(oldVersion, data):
+def convertOldRecord(pkgRecord):
     '''
-        convertOldDatabase - Convert providesDB from an older format to the current format
+        convertOldRecord - Convert a package record from an older providesDB format to the current format
 
-        @param oldVersion <str> - The old database format version
+          0.1 records are a list of files, or a string on error. 0.2 records are the same as 0.3,
+            just stored as json.
 
-        @param data <dict> - The old database dict
+        @param pkgRecord <list/str/dict> - The old record
+
+        @return <dict> - The record in the current format
 
         @raises - FailedToConvertDatabaseException if failure to convert
     '''
-    global LATEST_FILE_FORMAT
+    if issubclass(pkgRecord.__class__, dict):
+        return pkgRecord
+
+    if isStrType(pkgRecord.__class__):
+        # If string, was an error
+        return {
+            'files'   : [],   # No files
+            'version' : '',   # Unknown version
+            'error'   : pkgRecord, # Error string
+        }
+    elif issubclass(pkgRecord.__class__, (list, tuple)): # Should be list, but test tuple too for some reason..
+        return {
+            'files'    : list(pkgRecord), # The list of files
+            'version'  : '',              # Unknown version
+            'error'    : None,            # No error
+        }
+
+    raise FailedToConvertDatabaseException('Failed to convert old data to latest version: %s' %(LATEST_FILE_FORMAT, ))
+
+def iterDatabaseRecords(filename, packageNames=None):
+    '''
+        iterDatabaseRecords - Read the records of a providesDB, in any supported format, one at a time
 
-    if oldVersion == LATEST_FILE_FORMAT:
+          @param filename <str> - Path to the providesDB
+
+          @param packageNames <None/set<str>> default None - If provided, only read these packages
+
+          @return generator< tuple( pkgName<str>, pkgRecord<dict> ) > - Each package and its record, converted to the current format
+    '''
+    if pacmanProvidesDB.isBinaryProvidesDB(filename):
+        with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+            for (pkgName, pkgRecord) in providesDB.iterRecords():
+                if packageNames is None or pkgName in packageNames:
+                    yield (pkgName, pkgRecord)
         return
 
-    if oldVersion == '0.1':
-        for key in list(data.keys()):
-            if key == '__vers': # Not in version 0.1, but whatever..
-                continue
+    # Older, gzip'd json formats
+    for (pkgName, pkgRecord) in pacmanProvidesDB.iterLegacyProvidesDB(filename):
+        if pkgName == '__vers':
+            continue
+        if packageNames is None or pkgName in packageNames:
+            yield ( pkgName, convertOldRecord(pkgRecord) )
 
-            oldData = data[key]
-            if isStrType(oldData.__class__):
-                # If string, was an error
-                newData = { 
-                    'files'   : [],   # No files
-                    'version' : '',   # Unknown version
-                    'error'   : oldData, # Error string
-                }
-                data[key] = newData
-            elif issubclass(oldData.__class__, (list, tuple)): # Should be list, but test tuple too for some reason..
-                newData = {
-                    'files'    : copy.copy(oldData), # Copy the data ( list of files ). Probably not required to copy, but simplifies GC
-                    'version'  : '',                 # Unknown version
-                    'error'    : None,               # No error
-                }
-                data[key] = newData
-            else:
-                raise FailedToConvertDatabaseException('Failed to convert old data (version %s) to latest version: %s' %(oldVersion, LATEST_FILE_FORMAT))
-    else:
-        raise FailedToConvertDatabaseException('Old database version "%s" is not supported for update.' %(oldVersion, ))
+def readDatabase(filename):
+    '''
+        readDatabase - Read the packages in a providesDB, in any supported format, without their files
+
+          The records are read one at a time, so the whole database is never in memory. Use iterDatabaseRecords
+            to read the files.
+
+          @param filename <str> - Path to the providesDB
+
+          @return tuple( version<str>, packages<dict> ) - The database version, and package name -> record
+            of { 'version' : ..., 'error' : ... [, 'mtreeOffset' : ... ] } (in the current format)
+    '''
+    packages = {}
 
-    data['__vers'] = LATEST_FILE_FORMAT
+    if pacmanProvidesDB.isBinaryProvidesDB(filename):
+        with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+            for (pkgName, version, error, mtreeOffset) in providesDB.iterPackages():
+                packages[pkgName] = { 'version' : version, 'error' : error }
+                if mtreeOffset:
+                    packages[pkgName]['mtreeOffset'] = mtreeOffset
 
-    # No return - data modified inline
+            return ( providesDB.version, packages )
 
-def writeDatabase(results):
+    # Older, gzip'd json formats
+    # TEMP: Assume for now old version is 0.1 if it does not have a __vers marker.
+    #   TODO: In a later version of extractedMtree, remove this assumption
+    oldVersion = '0.1'
+
+    for (pkgName, pkgRecord) in pacmanProvidesDB.iterLegacyProvidesDB(filename):
+        if pkgName == '__vers':
+            oldVersion = pkgRecord
+            continue
+
+        pkgRecord = convertOldRecord(pkgRecord)
+        pkgRecord.pop('files', None)
+        packages[pkgName] = pkgRecord
+
+    return ( oldVersion, packages )
+
+def iterResultsToWrite(results, unchangedPackageNames=None):
+    '''
+        iterResultsToWrite - Iterate over the records for a full write of the database: those in #results ,
+          and the unchanged packages, read one at a time from the old database
+
+          @param results <dict> - The results ( see writeDatabase )
+
+          @param unchangedPackageNames <None/set<str>> default None - Packages to read from the old database
+
+          @return generator< tuple( pkgName<str>, pkgRecord<dict> ) >
+    '''
+    global PROVIDES_DB_LOCATION
+
+    for (pkgName, pkgRecord) in results.items():
+        if pkgName != '__vers' and ( not unchangedPackageNames or pkgName not in unchangedPackageNames ):
+            yield (pkgName, pkgRecord)
+
+    if unchangedPackageNames:
+        for (pkgName, pkgRecord) in iterDatabaseRecords(PROVIDES_DB_LOCATION, unchangedPackageNames):
+            yield (pkgName, pkgRecord)
+
+def writeDatabase(results, unchangedPackageNames=None, oldPackageNames=None):
     '''
-        writeDatabase - Writes the database to disk
+        writeDatabase - Writes the database to disk, in the binary (memory-mappable) format
 
-          First, it will try to write to
+          First, it will try to write to PROVIDES_DB_LOCATION
 
           @param results <dict> - The dict to write
 
             MUST BE IN CURRENT DATABASE FORMAT!
 
+          @param unchangedPackageNames <None/set<str>> default None - The names of the packages which are unchanged from the
+            old database at PROVIDES_DB_LOCATION . Their records in #results need not have files - if the whole database
+            is written, they are read one at a time from the old database.
+
+          @param oldPackageNames <None/set<str>> default None - The names of all packages in the old database.
+            If provided (with #unchangedPackageNames ), and the old database is in the current format, just the changed
+              and removed packages are appended as a segment, instead of rewriting the whole database.
+              See pacmanProvidesDB.appendProvidesDBSegment
+
 
-         NOTE: Garbage collector runs at the end of this function.
+          If --compress was given, the whole database is written, compressed that way. Otherwise it is compressed
+            the same way as the old database.
 
          NOTE: If we fail to write to PROVIDES_DB_LOCATION, we will write to
            a tempfile which will be printed to stderr
     '''
     global PROVIDES_DB_LOCATION
+    global PROVIDES_DB_COMPRESSION
+    global COMPRESS_THREADS
 
     wroteTo = PROVIDES_DB_LOCATION
 
-    compressed = gzip.compress( json.dumps(results).encode('utf-8') )
-
+    if PROVIDES_DB_COMPRESSION == KEEP_COMPRESSION:
+        compression = pacmanProvidesDB.getProvidesDBCompression(PROVIDES_DB_LOCATION)
+    else:
+        compression = PROVIDES_DB_COMPRESSION
 
     try:
-        with open(PROVIDES_DB_LOCATION, 'wb') as f:
-            f.write( compressed )
+        if PROVIDES_DB_COMPRESSION == KEEP_COMPRESSION and unchangedPackageNames is not None and oldPackageNames is not None and pacmanProvidesDB.isBinaryProvidesDB(PROVIDES_DB_LOCATION):
+            changedResults = { pkgName : pkgRecord for (pkgName, pkgRecord) in results.items() if pkgName != '__vers' and pkgName not in unchangedPackageNames }
+            removedPackageNames = [ pkgName for pkgName in oldPackageNames if pkgName not in results ]
+
+            numSegments = pacmanProvidesDB.appendProvidesDBSegment(PROVIDES_DB_LOCATION, changedResults, removedPackageNames)
+            sys.stdout.write('Appended %d changed and %d removed packages as segment %d.\n' %(len(changedResults), len(removedPackageNames), numSegments))
+            del changedResults
+
+            if numSegments > pacmanProvidesDB.MAX_SEGMENTS:
+                startBackgroundCompaction()
+        else:
+            pacmanProvidesDB.writeProvidesDB(PROVIDES_DB_LOCATION, iterResultsToWrite(results, unchangedPackageNames), compression=compression, compressThreads=COMPRESS_THREADS)
     except Exception as exc:
         tempFile = tempfile.NamedTemporaryFile(mode='wb', delete=False)
-        sys.stderr.write('\nFailed to open "%s" for writing ( %s ). Dumping to tempfile:\n%s\n' %(PROVIDES_DB_LOCATION, str(exc), tempFile.name, ))
-        tempFile.write( compressed )
         tempFile.close()
+        sys.stderr.write('\nFailed to open "%s" for writing ( %s ). Dumping to tempfile:\n%s\n' %(PROVIDES_DB_LOCATION, str(exc), tempFile.name, ))
+        pacmanProvidesDB.writeProvidesDB(tempFile.name, iterResultsToWrite(results, unchangedPackageNames), compression=compression, compressThreads=COMPRESS_THREADS)
 
         wroteTo = tempFile.name
 
-    # Force this now - it's big!
-    del compressed
-    gc.collect()
-
     return wroteTo
 
+def startBackgroundCompaction():
+    '''
+        startBackgroundCompaction - Fold the segments of PROVIDES_DB_LOCATION into its base ( extractMtree.py --compact )
+          in a background process, which keeps going after we exit.
+    '''
+    global PROVIDES_DB_LOCATION
+    global COMPRESS_THREADS
+
+    sys.stdout.write('Compacting "%s" in the background.\n' %(PROVIDES_DB_LOCATION, ))
+
+    compactArgs = [ '--compact', '--db-file=' + PROVIDES_DB_LOCATION ]
+    if COMPRESS_THREADS is not None:
+        compactArgs.append( '--compress-threads=%d' %(COMPRESS_THREADS, ) )
+
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen( [ sys.executable, os.path.abspath(__file__) ] + compactArgs, shell=False,
+            stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True, close_fds=True )
+
 
-def decompressDataSubprocess(data, cmd, bufSize=DEFAULT_SUBPROCESS_BUFSIZE):
+def decompressZlib(data):
     '''
-        decompressDataSubprocess - Decompress given compressed #data, using
-            a provided decompression command, #cmd
+        decompressZlib - Decompress zlib/gz/DEFLATE data in-process
 
-         Likely this will use /dev/shm as an intermediary (if available) @see getUseTempDir
+          A gzip header is detected automatically, so either gzip or raw zlib streams may be passed.
 
-         This is used in lieu of the builtin python modules for speed sake
-            (several orders of magnitude faster)
+        @param data <bytes> - Compressed data
+
+        @return data <bytes> - Decompressed data
+
+    '''
+    # 32 + MAX_WBITS - Auto-detect gzip vs zlib header
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    return decompressor.decompress(data) + decompressor.flush()
+
+def decompressXz(data):
+    '''
+        decompressXz - Decompress lzma/xz data in-process
+
+          Truncated input (as in a short-read) is allowed, and will return
+           as much data as could be decoded.
 
         @param data <bytes> - Compressed data
 
-        @param cmd  list<str> - Decompression command. Will NOT use a whell to launch,
-            so first element should be a fully-resolved command, followed by
-            args to decompress, read from stdin, write to stdout
+        @return data <bytes> - Decompressed data
 
-        @param bufSize <int> default DEFAULT_SUBPROCESS_BUFSIZE - Number of bytes to use for buffers
-        
-        @return <bytes> - Decompressed data
+    '''
+    decompressor = lzma.LZMADecompressor()
 
+    try:
+        return decompressor.decompress(data)
+    except lzma.LZMAError:
+        # Corrupt or not xz data. Callers treat no data as a bad mirror / bad file.
+        return b''
 
-        NOTE: If FunctionTimedOut is raised while this method is being called,
-            such as if this is called from a func_timeout function or StoppableThread,
-            it will clean up and then raise that exception after cleanup.
 
+def createZstdDecompressor():
     '''
+        createZstdDecompressor - Create an incremental zstd decompressor
+
+          @return <object> - An object implementing .decompress(data) , like lzma.LZMADecompressor
 
-    useTempDir = getUseTempDir()
+          @raises RetryWithNextMirrorException - If zstd is not supported (module not installed)
+    '''
+    if not canDecodeZstd:
+        raise RetryWithNextMirrorException('Cannot decode zstd package, python module zstandard is not installed.')
 
-    fte = None
-    tempFile = None
+    if hasattr(zstd_mod.ZstdDecompressor, 'decompressobj'):
+        # zstandard module
+        return zstd_mod.ZstdDecompressor().decompressobj()
 
-    devnull = open(os.devnull, 'w')
+    return zstd_mod.ZstdDecompressor()
+
+def decompressZstd(data):
+    '''
+        decompressZstd - Decompress zstd data in-process
+
+          Truncated input (as in a short-read) is allowed, and will return
+           as much data as could be decoded.
+
+        @param data <bytes> - Compressed data
+
+        @return data <bytes> - Decompressed data
+    '''
+    decompressor = createZstdDecompressor()
 
-    # Short delay to ensure everything is init'd and ready to go
-    time.sleep(.002)
     try:
+        return decompressor.decompress(data)
+    except Exception:
+        # Corrupt or not zstd data. Callers treat no data as a bad mirror / bad file.
+        return b''
 
+def openZstdFile(filename):
+    '''
+        openZstdFile - Open a zstd compressed file, to be decompressed as it is read
 
-        tempFile = tempfile.NamedTemporaryFile(mode='w+b', buffering=bufSize, dir=useTempDir, prefix='mtree_', delete=True)
-        tempFile.write(data)
-        tempFile.flush()
-        tempFile.seek(0)
+          @param filename <str> - The compressed file
 
-        pipe = subprocess.Popen(cmd, shell=False, stdin=tempFile, stdout=subprocess.PIPE, stderr=devnull, close_fds=True, bufsize=bufSize)
-        time.sleep(.01)
+          @return <file> - A file object to .read() the decompressed data from (e.x. by tarfile with mode="r|").
+            Closing it closes the file.
 
-        result = pipe.stdout.read()
-        nextResult = True
-        while True:
-            time.sleep(.005)
-            nextResult = pipe.stdout.read()
-            if nextResult != b'':
-                result += nextResult
-            else:
-                break
+          @raises ValueError - If zstd is not supported (module not installed)
+    '''
+    if not canDecodeZstd:
+        raise ValueError('Cannot decode zstd data, python module zstandard is not installed.')
 
-        pipe.wait()
+    if hasattr(zstd_mod.ZstdDecompressor, 'decompressobj'):
+        # zstandard module
+        return zstd_mod.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True)
 
-    except func_timeout.FunctionTimedOut as _fte:
-        result = None
-        fte = _fte
-        if pipe.poll() is None:
-            try:
-                pipe.terminate()
-            except:
-                pass
-            time.sleep(.2)
-            if pipe.poll() is None:
-                try:
-                    pipe.kill()
-                except:
-                    pass
-            pipe.wait()
+    return zstd_mod.ZstdFile(filename)
 
-    devnull.close()
-    if tempFile is not None:
-        try:
-            tempFile.close()
-        except:
-            pass
+def getPackageCompression(data):
+    '''
+        getPackageCompression - Detect the compression of package data by its magic bytes
 
-    if fte:
-        raise_exception( [fte] )
+          @param data <bytes> - The start of the package (at least PACKAGE_MAGIC_SIZE bytes)
 
-    return result
+          @return <str/None> - "zst", "xz", "gz", or None if not recognized
+    '''
+    for (compression, magic) in PACKAGE_MAGICS:
+        if data.startswith(magic):
+            return compression
 
-def decompressZlib(data, bufSize=DEFAULT_SUBPROCESS_BUFSIZE):
+    return None
+
+def createDecompressorForData(data):
     '''
-        decompressZlib - Decompress zlib/gz/DEFLATE data using external executable
+        createDecompressorForData - Create an incremental decompressor for package data, based on the magic bytes
 
-          @see decompressDataSubprocess
-        
-        @param data <bytes> - Compressed data
+          @param data <bytes> - The start of the package (at least PACKAGE_MAGIC_SIZE bytes)
 
-        @param bufSize <int> default DEFAULT_SUBPROCESS_BUFSIZE - Number of bytes to use for buffer size
+          @return <object> - An object implementing .decompress(data)
 
-        @return data <bytes> - Decompressed data
+          @raises RetryWithNextMirrorException - If the compression is not recognized (not a package?) or not supported
+    '''
+    compression = getPackageCompression(data)
+    if compression == 'zst':
+        return createZstdDecompressor()
+    elif compression == 'xz':
+        return lzma.LZMADecompressor()
+    elif compression == 'gz':
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    raise RetryWithNextMirrorException('Unknown package compression ( starts with %s )' %(repr(bytes(data[ : PACKAGE_MAGIC_SIZE])), ))
 
+def decompressPackageData(data):
     '''
-    # -dnc - Decompress to stdout and don't worry about file
-    return decompressDataSubprocess(data, ['/usr/bin/gzip', '-dnc'], bufSize)
+        decompressPackageData - Decompress a package ( zstd, xz, or gzip, detected by magic bytes )
 
-def decompressXz(data, bufSize=DEFAULT_SUBPROCESS_BUFSIZE):
+          @param data <bytes> - Compressed data
+
+          @return <bytes> - Decompressed data, or b'' if not recognized / could not be decompressed
     '''
-        decompressXz - Decompress lzma/xz data using external executable
+    compression = getPackageCompression(data)
+    if compression == 'zst':
+        return decompressZstd(data)
+    elif compression == 'xz':
+        return decompressXz(data)
+    elif compression == 'gz':
+        try:
+            return decompressZlib(data)
+        except zlib.error:
+            return b''
 
-          @see decompressDataSubprocess
-        
-        @param data <bytes> - Compressed data
+    return b''
 
-        @param bufSize <int> default DEFAULT_SUBPROCESS_BUFSIZE - Number of bytes to use for buffer size
 
-        @return data <bytes> - Decompressed data
+def parseTarHeader(header):
+    '''
+        parseTarHeader - Parse the fields we care about from a single 512-byte tar header block
+
+          @param header <bytes> - The 512-byte header block
+
+          @return tuple< str(name), str(typeflag), int(size) > - The member name, the type flag,
+            and the size of the data which follows the header.
+
+            If this is an end-of-archive (all NULL) block, None is returned.
+
+          Supports ustar prefixes and base-256 encoded sizes. pax and GNU long-name
+           members are returned as-is (with their typeflag), and handled by the caller.
+    '''
+    if header.count(b'\0') == TAR_BLOCK_SIZE:
+        return None
+
+    name = header[0 : 100].split(b'\0', 1)[0]
+    if header[257 : 262] == b'ustar':
+        prefix = header[345 : 500].split(b'\0', 1)[0]
+        if prefix:
+            name = prefix + b'/' + name
+
+    typeflag = header[156 : 157].decode('ascii', 'replace')
+
+    sizeField = header[124 : 136]
+    if sizeField[0:1] == b'\x80':
+        # GNU base-256 encoding for large sizes
+        size = int.from_bytes(sizeField[1:], 'big')
+    else:
+        size = getFileSizeFromTarHeader(header)
+
+    return (name.decode('utf-8', 'replace'), typeflag, size)
+
+
+class MtreeStreamDecoder(object):
+    '''
+        MtreeStreamDecoder - Incrementally decodes the start of a compressed package (tar) archive,
+            stopping as soon as the .MTREE member has been fully read.
+
+          Feed the compressed data as it arrives via #feed. Once it returns True,
+           the (still gzip-compressed) .MTREE contents are available as #mtreeData ,
+           and no further data needs to be fetched.
 
+          Tar headers are walked properly (including pax and GNU long-name extensions),
+           and the data of members before .MTREE is discarded as it is decoded.
     '''
-    # -dnc - Decompress to stdout and don't worry about file
-    # -dc - Decompress to stdout
-    return decompressDataSubprocess(data, ['/usr/bin/xz', '-dc'], bufSize)
+
+    def __init__(self, decompressor=None, decodeStepSize=DEFAULT_DECODE_STEP_SIZE):
+        '''
+            __init__ - Create an MtreeStreamDecoder
+
+              @param decompressor <None/object> default None - An incremental decompressor object
+                (implementing .decompress(data) ), or None to pick one by the magic bytes
+                of the data ( @see createDecompressorForData )
+
+              @param decodeStepSize <int> default DEFAULT_DECODE_STEP_SIZE - Max number of compressed bytes
+                to decode at a time. Smaller means we stop closer to the end of the .MTREE
+        '''
+        self.decompressor = decompressor
+        self.decodeStepSize = decodeStepSize
+
+        # compressedBytesFed - Number of compressed bytes consumed so far
+        self.compressedBytesFed = 0
+        # mtreeData - The gzip'd .MTREE contents, once found
+        self.mtreeData = None
+
+        self.isDone = False
+
+        self._buffer = bytearray()
+        # _magicBuffer - Start of the data, held until we have enough to detect the compression
+        self._magicBuffer = b''
+        self._skipRemaining = 0
+        self._currentMember = None
+        self._currentData = None
+        self._nextName = None
+        self._nextSize = None
+
+    def feed(self, data):
+        '''
+            feed - Feed the next chunk of compressed data
+
+              @param data <bytes> - Compressed data, following all previously fed data
+
+              @return <bool> - True if the .MTREE has been found and fully read (see #mtreeData ),
+                otherwise False and more data is required.
+
+              @raises RetryWithFullTarException - If the end of the archive is reached without finding .MTREE,
+                or the header could not be parsed.
+
+              @raises RetryWithNextMirrorException - If the data could not be decompressed (corrupt or not a package)
+        '''
+        if self.isDone:
+            return True
+
+        if self.decompressor is None:
+            self._magicBuffer += data
+            if len(self._magicBuffer) < PACKAGE_MAGIC_SIZE:
+                return False
+
+            data = self._magicBuffer
+            self._magicBuffer = b''
+            self.decompressor = createDecompressorForData(data)
+
+        decodeStepSize = self.decodeStepSize
+        dataLen = len(data)
+        idx = 0
+        while idx < dataLen:
+            step = data[idx : idx + decodeStepSize]
+            idx += len(step)
+            self.compressedBytesFed += len(step)
+
+            try:
+                decoded = self.decompressor.decompress(step)
+            except EOFError:
+                # Already at end of compressed stream
+                decoded = b''
+            except Exception as e:
+                raise RetryWithNextMirrorException('Failed to decompress data ( %s ): %s' %(e.__class__.__name__, str(e)))
+
+            if decoded and self._consume(decoded):
+                self.isDone = True
+                return True
+
+        return False
+
+    def _consume(self, decoded):
+        '''
+            _consume - Walk the tar structure over newly decoded data
+
+              @param decoded <bytes> - Newly decompressed data
+
+              @return <bool> - True if .MTREE has been fully read
+        '''
+        buf = self._buffer
+        buf += decoded
+
+        while True:
+            if self._skipRemaining:
+                numSkip = min(self._skipRemaining, len(buf))
+                del buf[ : numSkip]
+                self._skipRemaining -= numSkip
+                if self._skipRemaining:
+                    return False
+
+            if self._currentMember is not None:
+                (memberName, memberType, memberSize) = self._currentMember
+                if len(buf) < memberSize:
+                    return False
+
+                memberData = bytes(buf[ : memberSize])
+                del buf[ : memberSize]
+                self._currentMember = None
+                self._skipRemaining = ( TAR_BLOCK_SIZE - (memberSize % TAR_BLOCK_SIZE) ) % TAR_BLOCK_SIZE
+
+                if memberType in ('x', 'L'):
+                    self._handleExtendedHeader(memberType, memberData)
+                else:
+                    self.mtreeData = memberData
+                    return True
+                continue
+
+            if len(buf) < TAR_BLOCK_SIZE:
+                return False
+
+            header = bytes(buf[ : TAR_BLOCK_SIZE])
+            del buf[ : TAR_BLOCK_SIZE]
+
+            try:
+                parsed = parseTarHeader(header)
+            except Exception as e:
+                raise RetryWithFullTarException('Failed to parse tar header ( %s ): %s' %(e.__class__.__name__, str(e)))
+
+            if parsed is None:
+                raise RetryWithFullTarException('Reached end of archive without finding .MTREE')
+
+            (memberName, memberType, memberSize) = parsed
+
+            if self._nextName is not None:
+                memberName = self._nextName
+            if self._nextSize is not None:
+                memberSize = self._nextSize
+
+            if memberType not in ('x', 'L'):
+                self._nextName = None
+                self._nextSize = None
+
+            while memberName.startswith('./'):
+                memberName = memberName[2:]
+
+            if memberType in ('x', 'L') or memberName == '.MTREE':
+                self._currentMember = (memberName, memberType, memberSize)
+            else:
+                # Some other member (or a global pax header), skip over its data blocks
+                self._skipRemaining = memberSize + ( ( TAR_BLOCK_SIZE - (memberSize % TAR_BLOCK_SIZE) ) % TAR_BLOCK_SIZE )
+
+    def _handleExtendedHeader(self, memberType, memberData):
+        '''
+            _handleExtendedHeader - Apply a pax ( 'x' ) or GNU long name ( 'L' ) header
+                to the following member
+
+              @param memberType <str> - The typeflag, 'x' or 'L'
+
+              @param memberData <bytes> - The data of the extended header member
+        '''
+        if memberType == 'L':
+            self._nextName = memberData.split(b'\0', 1)[0].decode('utf-8', 'replace')
+            return
+
+        # pax records are "%d %s=%s\n" % (length, key, value)
+        idx = 0
+        while idx < len(memberData):
+            spaceIdx = memberData.find(b' ', idx)
+            if spaceIdx == -1:
+                break
+            try:
+                recordLen = int(memberData[idx : spaceIdx])
+            except ValueError:
+                break
+            if recordLen <= 0:
+                break
+            record = memberData[spaceIdx + 1 : idx + recordLen - 1]
+            idx += recordLen
+
+            (key, _, value) = record.partition(b'=')
+            if key == b'path':
+                self._nextName = value.decode('utf-8', 'replace')
+            elif key == b'size':
+                self._nextSize = int(value)
 
 
 def getFileSizeFromTarHeader(header):
@@ -426,7 +896,7 @@ def getFileSizeFromTarHeader(header):
     SIZE_IDX_START = 124
     SIZE_IDX_END = 124 + 12
 
-    trySection = header[SIZE_IDX_START : SIZE_IDX_END]
+    trySection = header[SIZE_IDX_START : SIZE_IDX_END].strip(b' \0')
 
     # Size is octal
     return int(trySection, 8)
@@ -439,6 +909,7 @@ def getFilenamesFromMtree(mtreeContents):
         @param mtreeContents <str> - The .MTREE file extracted from archive
 
         @return list<str> - A list of filenames this package provides.
+            The package's metadata files ( PACKAGE_METADATA_FILES ) are not included.
     '''
     lines = mtreeContents.split('\n')
 
@@ -452,31 +923,70 @@ def getFilenamesFromMtree(mtreeContents):
         if not matchObj:
             # Uh oh..
             continue
-        ret.append(matchObj.groupdict()['filename'])
+        filename = matchObj.groupdict()['filename']
+        if filename in PACKAGE_METADATA_FILES:
+            continue
+        ret.append(filename)
 
     return ret
 
-def fetchFromUrl(url, numBytes, isSuperVerbose=False):
+# _MTREE_SAFE_BYTES - Bytes which bsdtar writes as-is in an .MTREE path. Each other byte (of the utf-8 path)
+#   is written as a backslash and 3 octal digits, e.x. a space is "\\040"
+_MTREE_SAFE_BYTES = frozenset( byte for byte in range(0x21, 0x7f) if byte not in b'#=\\' )
+
+def mtreeEscapePath(path):
     '''
-        fetchFromUrl - Fetches #numBytes bytes of data from a given #url
+        mtreeEscapePath - Escape a path the way it is written in a package's .MTREE
+
+        @param path <str> - The path
+
+        @return <str> - The path, as getFilenamesFromMtree would extract it
+    '''
+    pathBytes = path.encode('utf-8')
+    if all( byte in _MTREE_SAFE_BYTES for byte in pathBytes ):
+        return path
+
+    return ''.join( [ byte in _MTREE_SAFE_BYTES and chr(byte) or '\\%03o' %(byte, ) for byte in pathBytes ] )
+
+def iterFetchFromUrlCurl(url, numBytes, isSuperVerbose=False, chunkSize=DEFAULT_FETCH_CHUNK_SIZE):
+    '''
+        iterFetchFromUrlCurl - Fetches up to #numBytes bytes of data from a given #url using curl,
+            yielding the data as it arrives.
+
+          This is used for urls which are not http or https (e.x. ftp), @see iterFetchFromUrl
 
           @param url <str> - Url to fetch
 
           @param numBytes <None/int> - If None, fetch entire file.
              Otherwise, fetch first N bytes.
-          
+
           @param isSuperVerbose <bool> default False, if True will print curl progress
             This will get messy if numThreads > 1
-          
-          @return <bytes> - File data
+
+          @param chunkSize <int> default DEFAULT_FETCH_CHUNK_SIZE - Max number of bytes to yield at a time
+
+          @return generator<bytes> - Chunks of file data, as they are read
 
         NOTE: This function uses "curl" to best handle ftp vs http vs https
 
-        NOTE: If "isSuperVerbose" is set to True, the curl progress will be output.
-            This will get real ugly when number of threads are > 1
+        NOTE: The transfer is aborted as soon as #numBytes have been read, or if the
+            generator is closed early (i.e. the consumer has all the data it needs).
+
+        NOTE: If the url is not found, the alternate urls will be tried ( @see getAlternatePackageUrls )
     '''
+    for tryUrl in [url] + getAlternatePackageUrls(url):
+        numRead = 0
+        for nextChunk in _iterFetchFromUrlCurl(tryUrl, numBytes, isSuperVerbose, chunkSize):
+            numRead += len(nextChunk)
+            yield nextChunk
 
+        if numRead:
+            return
 
+def _iterFetchFromUrlCurl(url, numBytes, isSuperVerbose=False, chunkSize=DEFAULT_FETCH_CHUNK_SIZE):
+    '''
+        _iterFetchFromUrlCurl - Fetch a single url with curl. @see iterFetchFromUrlCurl
+    '''
     useStderr = None
 
     if not isSuperVerbose:
@@ -485,46 +995,520 @@ def fetchFromUrl(url, numBytes, isSuperVerbose=False):
     else:
         extraArgs = []
 
-    pipe = subprocess.Popen(["/usr/bin/curl", '-k'] + extraArgs + [url],  shell=False, stdout=subprocess.PIPE, stderr=useStderr)
+    # --fail - Do not output the error page on a 404 (or other error), just return non-zero.
+    pipe = subprocess.Popen(["/usr/bin/curl", '-k', '--fail'] + extraArgs + [url],  shell=False, stdout=subprocess.PIPE, stderr=useStderr)
+
+    numRead = 0
+    try:
+        while not numBytes or numRead < numBytes:
+            if numBytes:
+                nextChunk = pipe.stdout.read1( min(chunkSize, numBytes - numRead) )
+            else:
+                nextChunk = pipe.stdout.read1( chunkSize )
+
+            if not nextChunk:
+                break
 
-    if numBytes:
-        urlContents = pipe.stdout.read(numBytes)
+            numRead += len(nextChunk)
+            yield nextChunk
+    finally:
+        # If we are stopping early, don't wait around for the rest of the transfer
+        if pipe.poll() is None:
+            try:
+                pipe.terminate()
+            except:
+                pass
         pipe.stdout.close()
-    else:
-        urlContents = pipe.stdout.read()
+        ret = pipe.wait()
 
-    ret = pipe.wait()
+        if useStderr is not None:
+            useStderr.close()
 
-    if useStderr is not None:
-        useStderr.close()
+class HttpConnectionPool(object):
+    '''
+        HttpConnectionPool - A thread-safe pool of persistent (keep-alive) http/https connections,
+            with a separate set of idle connections for each mirror (scheme, host, port)
+    '''
 
-    if b'404 Not Found' in urlContents and '-x86_64' in url:
-        return fetchFromUrl(url.replace('-x86_64', '-any'), numBytes, isSuperVerbose)
+    def __init__(self, maxIdlePerMirror=HTTP_MAX_IDLE_PER_MIRROR, timeout=HTTP_CONNECT_TIMEOUT):
+        '''
+            __init__ - Create an HttpConnectionPool
 
-    return urlContents
+              @param maxIdlePerMirror <int> default HTTP_MAX_IDLE_PER_MIRROR - Max number of idle connections to keep per mirror
 
+              @param timeout <float> default HTTP_CONNECT_TIMEOUT - Socket timeout for connections
+        '''
+        self.maxIdlePerMirror = maxIdlePerMirror
+        self.timeout = timeout
 
-def refreshPacmanDatabase():
-    '''
-        refreshPacmanDatabase - Refreshes the pacman package database ( -Sy )
+        self._idle = {}
+        self._lock = threading.Lock()
 
-          @return <bool> - True if successful, otherwise False
+        # Like "curl -k" which was used prior, do not fail on mirrors with invalid certificates.
+        #  The package contents are not trusted or installed, only the file list is extracted.
+        sslContext = ssl.create_default_context()
+        sslContext.check_hostname = False
+        sslContext.verify_mode = ssl.CERT_NONE
+        self.sslContext = sslContext
 
-          NOTE: You must be root to refresh the database.
-            You should be root running this script at all though...
-    '''
-    if os.getuid() != 0:
-        sys.stderr.write('WARNING: Cannot refresh pacman database.\n')
-        return False
-    else:
-        ret = subprocess.Popen(['/usr/bin/pacman', '-Sy'], shell=False).wait()
-        if ret != 0:
-            sys.stderr.write('WARNING: pacman -Sy returned non-zero: %d\n' %(ret,))
-            return False
+    def getConnection(self, scheme, netloc, allowReuse=True):
+        '''
+            getConnection - Get a connection to a given mirror, reusing an idle one if available
 
-    return True
+              @param scheme <str> - "http" or "https"
 
-def getAllPackagesInfo():
+              @param netloc <str> - host[:port]
+
+              @param allowReuse <bool> default True - If False, always open a new connection
+
+              @return tuple< http.client.HTTPConnection, bool > - The connection, and True if it was
+                reused from the pool (and thus may have been closed by the server since)
+        '''
+        key = (scheme, netloc)
+        if allowReuse:
+            with self._lock:
+                idleConns = self._idle.get(key)
+                if idleConns:
+                    return (idleConns.pop(), True)
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self.sslContext)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+        return (conn, False)
+
+    def releaseConnection(self, scheme, netloc, conn):
+        '''
+            releaseConnection - Return a connection to the pool after the response has been fully read.
+
+              @param scheme <str> - "http" or "https"
+
+              @param netloc <str> - host[:port]
+
+              @param conn <http.client.HTTPConnection> - The connection
+        '''
+        key = (scheme, netloc)
+        with self._lock:
+            idleConns = self._idle.setdefault(key, [])
+            if len(idleConns) < self.maxIdlePerMirror:
+                idleConns.append(conn)
+                return
+
+        conn.close()
+
+    def closeAll(self):
+        '''
+            closeAll - Close all idle connections
+        '''
+        with self._lock:
+            allIdle = self._idle
+            self._idle = {}
+
+        for idleConns in allIdle.values():
+            for conn in idleConns:
+                try:
+                    conn.close()
+                except:
+                    pass
+
+
+class HttpFetcher(object):
+    '''
+        HttpFetcher - Native http/https fetcher which keeps persistent connections to each mirror,
+            and uses Range requests so that mirrors only send the bytes we actually want.
+
+          Data is streamed to the caller as it arrives, and the transfer can be stopped
+           at any point (see #iterFetch and #fetchToConsumer ).
+    '''
+
+    def __init__(self, pool=None, isSuperVerbose=False):
+        '''
+            __init__ - Create an HttpFetcher
+
+              @param pool <None/HttpConnectionPool> default None - The connection pool to use,
+                or None to create one.
+
+              @param isSuperVerbose <bool> default False - If True, print each request and response status
+        '''
+        if pool is None:
+            pool = HttpConnectionPool()
+
+        self.pool = pool
+        self.isSuperVerbose = isSuperVerbose
+
+    def iterFetch(self, url, numBytes, startByte=0, chunkSize=DEFAULT_FETCH_CHUNK_SIZE):
+        '''
+            iterFetch - Fetch bytes #startByte through #startByte + #numBytes of #url ,
+                yielding the data as it arrives.
+
+              @param url <str> - An http or https url
+
+              @param numBytes <None/int> - Number of bytes to fetch, or None to fetch through the end of the file
+
+              @param startByte <int> default 0 - Offset at which to start
+
+              @param chunkSize <int> default DEFAULT_FETCH_CHUNK_SIZE - Max number of bytes to yield at a time
+
+              @return generator<bytes> - The data. Close the generator to abort the transfer.
+
+                If the file is not found (or the range is past the end of the file), nothing is yielded.
+        '''
+        pool = self.pool
+
+        for redirectNum in range(HTTP_MAX_REDIRECTS + 1):
+            urlParts = urlsplit(url)
+            scheme = urlParts.scheme.lower()
+            netloc = urlParts.netloc
+            path = urlParts.path or '/'
+            if urlParts.query:
+                path += '?' + urlParts.query
+
+            headers = { 'Accept-Encoding' : 'identity' }
+            if numBytes:
+                headers['Range'] = 'bytes=%d-%d' %(startByte, startByte + numBytes - 1)
+            elif startByte:
+                headers['Range'] = 'bytes=%d-' %(startByte, )
+
+            (conn, isReused) = pool.getConnection(scheme, netloc)
+            try:
+                response = self._request(conn, path, headers)
+            except (http.client.HTTPException, ConnectionError, OSError) as e:
+                conn.close()
+                if not isReused:
+                    raise
+                # The server closed the idle connection on us, try again on a fresh one
+                (conn, isReused) = pool.getConnection(scheme, netloc, allowReuse=False)
+                try:
+                    response = self._request(conn, path, headers)
+                except:
+                    conn.close()
+                    raise
+
+            if self.isSuperVerbose:
+                sys.stderr.write('%s %s [%s] -> %d\n' %(url, headers.get('Range', ''), isReused and 'reused' or 'new', response.status))
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                self._finishResponse(scheme, netloc, conn, response)
+                if not location:
+                    return
+                url = urljoin(url, location)
+                continue
+
+            if response.status not in (200, 206):
+                # 404, 416 (range not satisfiable), etc.
+                self._finishResponse(scheme, netloc, conn, response)
+                return
+
+            if response.status == 200 and startByte:
+                # Server ignored our Range, so skip up to the start
+                toSkip = startByte
+                while toSkip:
+                    skipped = response.read( min(toSkip, chunkSize) )
+                    if not skipped:
+                        break
+                    toSkip -= len(skipped)
+
+            # isRangeIgnored - The server is sending the whole file, so reading #numBytes is stopping early
+            isRangeIgnored = bool(response.status == 200 and numBytes)
+
+            numRead = 0
+            isComplete = False
+            try:
+                while not numBytes or numRead < numBytes:
+                    if numBytes:
+                        nextChunk = response.read1( min(chunkSize, numBytes - numRead) )
+                    else:
+                        nextChunk = response.read1( chunkSize )
+
+                    if not nextChunk:
+                        break
+
+                    numRead += len(nextChunk)
+                    yield nextChunk
+
+                isComplete = True
+            finally:
+                if isComplete and not isRangeIgnored:
+                    self._finishResponse(scheme, netloc, conn, response)
+                else:
+                    # Stopped early (consumer has what it needs, or an exception like a timeout).
+                    self._finishResponse(scheme, netloc, conn, response, maxDrainSize=HTTP_MAX_DRAIN_SIZE)
+
+            return
+
+    def fetchToConsumer(self, url, consumer, numBytes, startByte=0):
+        '''
+            fetchToConsumer - Fetch data, passing each chunk to a consumer as it arrives.
+
+              @param url <str> - An http or https url
+
+              @param consumer <callable> - Called with each chunk of data (bytes). Return True to stop the transfer.
+
+              @param numBytes <None/int> - Number of bytes to fetch, or None to fetch through the end of the file
+
+              @param startByte <int> default 0 - Offset at which to start
+
+              @return <int> - Number of bytes which were passed to #consumer
+        '''
+        numFed = 0
+        fetchIter = self.iterFetch(url, numBytes, startByte)
+        try:
+            for nextChunk in fetchIter:
+                numFed += len(nextChunk)
+                if consumer(nextChunk):
+                    break
+        finally:
+            fetchIter.close()
+
+        return numFed
+
+    def _request(self, conn, path, headers):
+        '''
+            _request - Send a GET request and get the response
+
+              @param conn <http.client.HTTPConnection> - Connection
+
+              @param path <str> - Path (and query) to request
+
+              @param headers <dict> - Extra headers
+
+              @return <http.client.HTTPResponse> - The response
+        '''
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+
+    def _finishResponse(self, scheme, netloc, conn, response, maxDrainSize=None):
+        '''
+            _finishResponse - Finish up with a response, and either return the connection to the pool or close it.
+
+              @param scheme <str> - Scheme of connection
+
+              @param netloc <str> - host[:port] of connection
+
+              @param conn <http.client.HTTPConnection> - The connection
+
+              @param response <http.client.HTTPResponse> - The response
+
+              @param maxDrainSize <None/int> default None - Max number of remaining bytes to read in order to
+                reuse the connection. None means read whatever remains.
+        '''
+        try:
+            if not response.isclosed():
+                remaining = response.length
+                if maxDrainSize is not None and ( remaining is None or remaining > maxDrainSize ):
+                    conn.close()
+                    return
+                response.read()
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.pool.releaseConnection(scheme, netloc, conn)
+        except Exception:
+            conn.close()
+
+
+global _HTTP_FETCHER
+_HTTP_FETCHER = None
+_HTTP_FETCHER_LOCK = threading.Lock()
+def getHttpFetcher():
+    '''
+        getHttpFetcher - Get the HttpFetcher shared by all threads, creating it if necessary.
+
+          All threads share one pool, so a connection opened to a mirror by one thread may be reused by another.
+
+        @return <HttpFetcher> - The shared fetcher
+    '''
+    global _HTTP_FETCHER
+    if _HTTP_FETCHER is None:
+        with _HTTP_FETCHER_LOCK:
+            if _HTTP_FETCHER is None:
+                _HTTP_FETCHER = HttpFetcher()
+
+    return _HTTP_FETCHER
+
+
+def iterFetchFromUrl(url, numBytes, isSuperVerbose=False, chunkSize=DEFAULT_FETCH_CHUNK_SIZE, startByte=0):
+    '''
+        iterFetchFromUrl - Fetches up to #numBytes bytes of data from a given #url,
+            yielding the data as it arrives.
+
+          @param url <str> - Url to fetch
+
+          @param numBytes <None/int> - If None, fetch entire file.
+             Otherwise, fetch first N bytes.
+
+          @param isSuperVerbose <bool> default False, if True will print request info (or curl progress)
+            This will get messy if numThreads > 1
+
+          @param chunkSize <int> default DEFAULT_FETCH_CHUNK_SIZE - Max number of bytes to yield at a time
+
+          @param startByte <int> default 0 - Offset in file at which to start.
+
+          @return generator<bytes> - Chunks of file data, as they are read
+
+        NOTE: http and https urls are fetched natively with Range requests over pooled keep-alive connections
+            ( @see HttpFetcher ). Other urls (e.x. ftp) use curl ( @see iterFetchFromUrlCurl ).
+
+        NOTE: The transfer is aborted as soon as #numBytes have been read, or if the
+            generator is closed early (i.e. the consumer has all the data it needs).
+
+        NOTE: If the url is not found, the alternate urls will be tried ( @see getAlternatePackageUrls ), unless
+            #startByte is set: those are other files, so their data can't continue what was read of this one.
+            Nothing is yielded, and the caller should start over.
+    '''
+    if not url.lower().startswith( ('http://', 'https://') ):
+        if startByte:
+            raise ValueError('startByte is only supported for http and https urls. Got: ' + url)
+        for nextChunk in iterFetchFromUrlCurl(url, numBytes, isSuperVerbose, chunkSize):
+            yield nextChunk
+        return
+
+    fetcher = getHttpFetcher()
+    if isSuperVerbose:
+        fetcher = HttpFetcher(fetcher.pool, isSuperVerbose=True)
+
+    alternateUrls = None
+
+    while True:
+        # One Range request for all of it. Closing the generator stops the transfer early
+        #  ( @see HttpFetcher.iterFetch ), so the mirror doesn't send much past what is read.
+        numRead = 0
+        fetchIter = fetcher.iterFetch(url, numBytes, startByte, chunkSize)
+        try:
+            for nextChunk in fetchIter:
+                numRead += len(nextChunk)
+                yield nextChunk
+        finally:
+            fetchIter.close()
+
+        if numRead == 0 and not startByte:
+            if alternateUrls is None:
+                alternateUrls = getAlternatePackageUrls(url)
+            if alternateUrls:
+                url = alternateUrls.pop(0)
+                continue
+
+        break
+
+
+def getMtreeFromFullTar(tarContents):
+    '''
+        getMtreeFromFullTar - Extract the .MTREE from a fully fetched package, using the tar module
+            (which supports every tar format extension)
+
+          @param tarContents <bytes> - The full (compressed) package
+
+          @return tuple< bytes, int/None > - The (still gzip'd) .MTREE contents, and the compressed offset
+            at which the .MTREE ended (or None if the stream decoder could not find it)
+
+          @raises RetryWithNextMirrorException - If no data could be decompressed (mirror out of date? file corrupt?)
+    '''
+    mtreeOffset = None
+
+    # Record where the .MTREE ended (if the stream decoder can find it at all),
+    #   so the next version of this package can use a sized short fetch
+    try:
+        decoder = MtreeStreamDecoder()
+        if decoder.feed(tarContents):
+            mtreeOffset = decoder.compressedBytesFed
+    except Exception:
+        pass
+
+    data = decompressPackageData(tarContents)
+
+    if not data:
+        raise RetryWithNextMirrorException('No data could be decompressed')
+
+    bio = BytesIO(data)
+
+    tf = tarfile.open(fileobj=bio)
+
+    extractedMtreeFile = tf.extractfile('.MTREE')
+    compressedData = extractedMtreeFile.read()
+    try:
+        extractedMtreeFile.close()
+    except:
+        pass
+
+    return (compressedData, mtreeOffset)
+
+def getFilenamesFromCompressedMtree(compressedData):
+    '''
+        getFilenamesFromCompressedMtree - Decompress a .MTREE as found in the package,
+            and extract all the "provides" filenames
+
+          @param compressedData <bytes> - The gzip'd .MTREE
+
+          @return list<str> - A list of filenames this package provides.
+
+          @see getFilenamesFromMtree
+    '''
+    mtreeData = decompressZlib(compressedData).decode('utf-8')
+
+    return getFilenamesFromMtree(mtreeData)
+
+def fetchFromUrl(url, numBytes, isSuperVerbose=False):
+    '''
+        fetchFromUrl - Fetches #numBytes bytes of data from a given #url
+
+          @param url <str> - Url to fetch
+
+          @param numBytes <None/int> - If None, fetch entire file.
+             Otherwise, fetch first N bytes.
+
+          @param isSuperVerbose <bool> default False, if True will print curl progress
+            This will get messy if numThreads > 1
+
+          @return <bytes> - File data
+
+          @see iterFetchFromUrl
+    '''
+    return b''.join( iterFetchFromUrl(url, numBytes, isSuperVerbose) )
+
+
+def refreshPacmanDatabase():
+    '''
+        refreshPacmanDatabase - Refreshes the pacman package database ( -Sy )
+
+          @return <bool> - True if successful, otherwise False
+
+          NOTE: You must be root to refresh the database.
+            You should be root running this script at all though...
+    '''
+    if os.getuid() != 0:
+        sys.stderr.write('WARNING: Cannot refresh pacman database.\n')
+        return False
+    else:
+        ret = subprocess.Popen(['/usr/bin/pacman', '-Sy'], shell=False).wait()
+        if ret != 0:
+            sys.stderr.write('WARNING: pacman -Sy returned non-zero: %d\n' %(ret,))
+            return False
+
+    return True
+
+def refreshPacmanFilesDatabase():
+    '''
+        refreshPacmanFilesDatabase - Refreshes the pacman files database ( -Fy )
+
+          @return <bool> - True if successful, otherwise False
+
+          @see refreshPacmanDatabase
+    '''
+    if os.getuid() != 0:
+        sys.stderr.write('WARNING: Cannot refresh pacman files database.\n')
+        return False
+    else:
+        ret = subprocess.Popen(['/usr/bin/pacman', '-Fy'], shell=False).wait()
+        if ret != 0:
+            sys.stderr.write('WARNING: pacman -Fy returned non-zero: %d\n' %(ret,))
+            return False
+
+    return True
+
+def getAllPackagesInfo():
     '''
         getAllPackagesInfo - Get the "info" for all packages.
             This includes repo, package name, package version
@@ -548,759 +1532,2567 @@ def getAllPackagesInfo():
 
 
 
-def getRepoUrls(maxRepos=MAX_REPOS):
+def getPacmanRepoNames(pacmanConf=PACMAN_CONF):
     '''
-        getRepoUrls - Extract the repo urls from /etc/pacman.d/mirrorlist
+        getPacmanRepoNames - Get the names of the repos pacman uses, in its order of precedence
 
-          @return list<str> - A list of repos, with "%s" replacing $repo and $arch.
-          
+          Uses pacman-conf (which follows any Include) if it is installed, otherwise reads the sections of #pacmanConf
 
-          TODO: This replace should happen in another function, in case $repo comes AFTER $arch
-            No repos as far as I can tell do this, as they mirror a fixed format, but it IS possible
-    '''
-    global USE_ARCH
+          @param pacmanConf <str> default PACMAN_CONF - pacman's config
 
-    if not maxRepos:
-        gatheredEnough = lambda _repos : False
-    else:
-        gatheredEnough = lambda _repos : len(_repos) >= maxRepos
+          @return list<str> - The repo names. Empty if the config can't be read
+    '''
+    devnull = open(os.devnull, 'w')
+    try:
+        pipe = subprocess.Popen(["pacman-conf", "--config", pacmanConf, "--repo-list"], shell=False, stdout=subprocess.PIPE, stderr=devnull)
+        contents = pipe.communicate()[0]
+        if pipe.returncode == 0:
+            return [ line.strip() for line in contents.decode('utf-8').split('\n') if line.strip() ]
+    except OSError:
+        pass
+    finally:
+        devnull.close()
 
-    nextLine = True
-    repos = []
+    repoNames = []
+    try:
+        with open(pacmanConf, 'rt') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line.startswith('[') and line.endswith(']'):
+                    sectionName = line[1:-1].strip()
+                    if sectionName != 'options' and sectionName not in repoNames:
+                        repoNames.append(sectionName)
+    except (IOError, OSError, UnicodeDecodeError):
+        pass
 
-    repoRE = re.compile('^[ \t]*[sS]erver[ \t]*=[ \t]*(?P<repo_url>[^ \t#]+)[ \t]*([#].*){0,1}$')
+    return repoNames
 
-    with open('/etc/pacman.d/mirrorlist', 'rt') as f:
-        nextLine = f.readline()
-        while nextLine != '' and not gatheredEnough(repos):
-            matchObj = repoRE.match(nextLine.strip())
-            if matchObj:
-                groupDict = matchObj.groupdict()
-                if groupDict['repo_url']:
-                    ret = groupDict['repo_url'].replace('$repo', '%s').replace('$arch', USE_ARCH)
-                    while ret.endswith('/'):
-                        ret = ret[:-1]
 
-                    ret += '/%s'
-                    repos.append(ret)
+def getSyncDatabaseFilenames(syncDir=PACMAN_SYNC_DIR, extension='.db', repoNames=None):
+    '''
+        getSyncDatabaseFilenames - Get the sync database files of a given type
 
-            nextLine = f.readline()
+          @param syncDir <str> default PACMAN_SYNC_DIR - Directory containing the sync databases
 
-    if not repos:
-        raise Exception('Failed to find repo URL from /etc/pacman.d/mirrorlist. Are any not commented?')
-    return repos
+          @param extension <str> default ".db" - ".db" for the package databases ( pacman -Sy ),
+            or ".files" for the file list databases ( pacman -Fy )
 
+          @param repoNames <None/list<str>> default None - The repos, in order of precedence. None to read them
+            from pacman.conf ( @see getPacmanRepoNames )
 
-def shuffleLst(lst):
+          @return list< tuple<str, str> > - List of ( repo name, full path ), in the order of #repoNames , skipping
+            any database of a repo not in #repoNames . If the repos are not known (pacman.conf can't be read),
+            every database, sorted by repo name.
     '''
-        shuffleLst - Randomly sort provided list
+    if repoNames is None:
+        repoNames = getPacmanRepoNames()
 
-          @param lst list - List to be randomly sorted
+    dbRepoNames = [ dbFilename[ : -len(extension)] for dbFilename in sorted(os.listdir(syncDir)) if dbFilename.endswith(extension) ]
+    if repoNames:
+        dbRepoNames = [ repoName for repoName in repoNames if repoName in dbRepoNames ]
 
-          @return randomly sorted list
+    return [ (repoName, os.path.join(syncDir, repoName + extension)) for repoName in dbRepoNames ]
 
-        NOTE: #lst is NOT modified
+
+def parseSyncDatabaseEntry(contents):
     '''
-    if not lst:
-        return list()
+        parseSyncDatabaseEntry - Parse an entry (desc, files) from a sync database
 
-    lstCopy = lst[:]
-    ret = []
+          @param contents <str> - The entry, "%KEY%\nvalue\nvalue\n\n%KEY2%\n..."
 
-    while len(lstCopy) > 1:
-        ret.append( lstCopy.pop( random.randint(0, len(lstCopy)-1) ) )
+          @return dict< str, list<str> > - Map of key (e.x. "%NAME%") -> list of values
+    '''
+    sections = {}
 
-    ret.append( lstCopy.pop() )
+    for section in contents.split('\n\n'):
+        sectionLines = section.strip('\n').split('\n')
+        if sectionLines[0].startswith('%'):
+            sections[sectionLines[0]] = [ line for line in sectionLines[1:] if line ]
 
-    return ret
+    return sections
 
 
-class RefObj(object):
+def iterSyncDatabase(dbFilename):
     '''
-        RefObj - An object that holds a reference to another object
+        iterSyncDatabase - Stream the packages from a sync database ( $repo.db or $repo.files ).
+
+          The database is a (compressed) tar with a directory for each package, holding a "desc" entry
+            and (in .files) a "files" entry.
+
+          @param dbFilename <str> - Path to the database
+
+          @return generator< dict< str, list<str> > > - For each package, all of its entries merged
+            ( @see parseSyncDatabaseEntry ). e.x. result['%NAME%'][0] is the name, and result['%FILES%'] the files
+    '''
+    with open(dbFilename, 'rb') as f:
+        magic = f.read(PACKAGE_MAGIC_SIZE)
+
+    zstdFile = None
+    if getPackageCompression(magic) == 'zst':
+        # tarfile can't do zstd itself, so decompress as tarfile reads
+        zstdFile = openZstdFile(dbFilename)
+        tf = tarfile.open(fileobj=zstdFile, mode='r|')
+    else:
+        tf = tarfile.open(dbFilename, mode='r|*')
+
+    try:
+        currentDir = None
+        currentSections = None
+        for member in tf:
+            if not member.isfile():
+                continue
+
+            memberDir = member.name.rpartition('/')[0]
+            if memberDir != currentDir:
+                if currentSections:
+                    yield currentSections
+                currentDir = memberDir
+                currentSections = {}
+
+            currentSections.update( parseSyncDatabaseEntry( tf.extractfile(member).read().decode('utf-8', 'replace') ) )
+
+        if currentSections:
+            yield currentSections
+    finally:
+        tf.close()
+        if zstdFile is not None:
+            zstdFile.close()
+
+
+def getPackageFilenames(syncDir=PACMAN_SYNC_DIR, repoNames=None):
+    '''
+        getPackageFilenames - Read the package filenames (e.x. "bash-5.0.011-1-x86_64.pkg.tar.zst")
+            from the pacman sync databases, so we know the arch and compression of each package.
+
+          @param syncDir <str> default PACMAN_SYNC_DIR - Directory containing the sync databases
+
+          @param repoNames <None/list<str>> default None - The repos in order ( @see getSyncDatabaseFilenames )
+
+          @return dict<str, str> - Map of package name -> filename
+    '''
+    packageFilenames = {}
+
+    # Later repos are overridden by earlier ones, as the package pacman -Sl lists is from the first
+    for (repoName, dbFilename) in reversed( getSyncDatabaseFilenames(syncDir, '.db', repoNames) ):
+        for sections in iterSyncDatabase(dbFilename):
+            if sections.get('%NAME%') and sections.get('%FILENAME%'):
+                packageFilenames[ sections['%NAME%'][0] ] = sections['%FILENAME%'][0]
+
+    return packageFilenames
+
+
+def getPackagesFromFilesDatabases(syncDir=PACMAN_SYNC_DIR, repoNames=None):
+    '''
+        getPackagesFromFilesDatabases - Read every package, with its version and file list,
+            from the pacman files databases ( /var/lib/pacman/sync/$repo.files , from pacman -Fy )
+
+          This is used by --from-files-db to build the providesDB with no mirror traffic.
+
+          @param syncDir <str> default PACMAN_SYNC_DIR - Directory containing the sync databases
+
+          @param repoNames <None/list<str>> default None - The repos in order of precedence ( @see getSyncDatabaseFilenames )
+
+          @return tuple< list< tuple<str, str, str> >, dict<str, list<str>> > -
+            ( package infos ( repo, name, version ) as from getAllPackagesInfo , map of package name -> files )
+
+            The files are in the same format as extracted from the .MTREE ( @see getFilenamesFromMtree )
+    '''
+    packageInfos = []
+    packageFiles = {}
+
+    for (repoName, dbFilename) in getSyncDatabaseFilenames(syncDir, '.files', repoNames):
+        for sections in iterSyncDatabase(dbFilename):
+            if not sections.get('%NAME%') or not sections.get('%VERSION%'):
+                continue
+
+            packageName = sections['%NAME%'][0]
+            packageVersion = sections['%VERSION%'][0]
+
+            # Like pacman -Sl , if a package is in multiple repos the first one (in pacman.conf order) wins
+            if packageName in packageFiles:
+                continue
+
+            packageInfos.append( (repoName, packageName, packageVersion) )
+            # Files db has "usr/" and "usr/bin/x", the .MTREE gives "/usr" and "/usr/bin/x" (escaped)
+            packageFiles[packageName] = [ '/' + mtreeEscapePath( filename.rstrip('/') ) for filename in sections.get('%FILES%', []) ]
+
+    return (packageInfos, packageFiles)
+
+
+def getPackageFilename(packageName, packageVersion, packageFilenames=None):
+    '''
+        getPackageFilename - Get the filename of a package
+
+          @param packageName <str> - Package name
+
+          @param packageVersion <str> - Package version
+
+          @param packageFilenames <None/dict> default None - Filenames from the sync databases ( @see getPackageFilenames )
+
+          @return <str> - The filename from #packageFilenames if present (and for this version),
+            otherwise guessed as the newest extension and USE_ARCH ( @see getAlternatePackageUrls for the fallbacks)
+    '''
+    if packageFilenames:
+        packageFilename = packageFilenames.get(packageName)
+        if packageFilename and packageFilename.startswith(packageName + '-' + packageVersion + '-'):
+            return packageFilename
+
+    return "%s-%s-%s%s" %(packageName, packageVersion, USE_ARCH, PACKAGE_EXTENSIONS[0])
+
+
+def getAlternatePackageUrls(url):
+    '''
+        getAlternatePackageUrls - Get the urls to try, in order, when a package url is not found.
+
+          This is the "any" arch in place of USE_ARCH, and the other package extensions
+            (e.x. an older package still compressed with xz)
+
+          @param url <str> - The package url
+
+          @return list<str> - Alternate urls (may be empty)
+    '''
+    archStr = '-%s.pkg.tar' %(USE_ARCH, )
+
+    baseUrl = url
+    urlExtension = None
+    for extension in PACKAGE_EXTENSIONS:
+        if url.endswith(extension):
+            baseUrl = url[ : -len(extension)]
+            urlExtension = extension
+            break
+
+    alternateUrls = []
+    if archStr in url:
+        alternateUrls.append( url.replace(archStr, '-any.pkg.tar') )
+
+    if urlExtension is not None:
+        for extension in PACKAGE_EXTENSIONS:
+            if extension == urlExtension:
+                continue
+            alternateUrls.append( baseUrl + extension )
+            if archStr in alternateUrls[-1]:
+                alternateUrls.append( alternateUrls[-1].replace(archStr, '-any.pkg.tar') )
+
+    return alternateUrls
+
+
+def getRepoUrls(maxRepos=MAX_REPOS):
+    '''
+        getRepoUrls - Extract the repo urls from /etc/pacman.d/mirrorlist
+
+          @return list<str> - A list of repos, with "%s" replacing $repo and $arch.
+          
+
+          TODO: This replace should happen in another function, in case $repo comes AFTER $arch
+            No repos as far as I can tell do this, as they mirror a fixed format, but it IS possible
+    '''
+    global USE_ARCH
+
+    if not maxRepos:
+        gatheredEnough = lambda _repos : False
+    else:
+        gatheredEnough = lambda _repos : len(_repos) >= maxRepos
+
+    nextLine = True
+    repos = []
+
+    repoRE = re.compile('^[ \t]*[sS]erver[ \t]*=[ \t]*(?P<repo_url>[^ \t#]+)[ \t]*([#].*){0,1}$')
+
+    with open('/etc/pacman.d/mirrorlist', 'rt') as f:
+        nextLine = f.readline()
+        while nextLine != '' and not gatheredEnough(repos):
+            matchObj = repoRE.match(nextLine.strip())
+            if matchObj:
+                groupDict = matchObj.groupdict()
+                if groupDict['repo_url']:
+                    ret = groupDict['repo_url'].replace('$repo', '%s').replace('$arch', USE_ARCH)
+                    while ret.endswith('/'):
+                        ret = ret[:-1]
+
+                    ret += '/%s'
+                    repos.append(ret)
+
+            nextLine = f.readline()
+
+    if not repos:
+        raise Exception('Failed to find repo URL from /etc/pacman.d/mirrorlist. Are any not commented?')
+    return repos
+
+
+def shuffleLst(lst):
+    '''
+        shuffleLst - Randomly sort provided list
+
+          @param lst list - List to be randomly sorted
+
+          @return randomly sorted list
+
+        NOTE: #lst is NOT modified
+    '''
+    if not lst:
+        return list()
+
+    lstCopy = lst[:]
+    ret = []
+
+    while len(lstCopy) > 1:
+        ret.append( lstCopy.pop( random.randint(0, len(lstCopy)-1) ) )
+
+    ret.append( lstCopy.pop() )
+
+    return ret
+
+
+class RefObj(object):
+    '''
+        RefObj - An object that holds a reference to another object
+
+           Call to retrieve refrence, i.e.   myObj = myRefObj()
+    '''
+
+    def __init__(self, ref):
+        '''
+            __init__ - Create a refObj
+
+              @param ref <object> - An object to hold reference to
+        '''
+        self.ref = ref
+
+    def __call__(self):
+        '''
+            __call__ - Return the reference this object holds
+
+            @return <object> - The object this RefObj is holding
+        '''
+        return self.ref
+
+#REPO_URL = "http://mirrors.acm.wpi.edu/archlinux/%s/os/x86_64/%s"
+#REPO_URLS = [ "http://mirrors.acm.wpi.edu/archlinux/%s/os/x86_64/%s" ]
+
+class RetryWithFullTarException(Exception):
+    '''
+        RetryWithFullTarException - Exception raised when we failed to use
+          a short-read of the tar, to indicate to retry with full fetch
+          and tar module
+    '''
+    pass
+
+class RetryWithNextMirrorException(Exception):
+    '''
+        RetryWithNextMirrorException - Indicate that there is an issue with this package
+          on the selected mirror (such as no data returned), and to try the next mirror
+    '''
+    pass
+
+def getFileData(filename, decodeWith=None):
+    '''
+        getFileData - Read and decode a filename
+
+          @param filename <str> - Filename
+          @param decodeWith <str/None> - codec to decode results in, or None to leave as bytse
+
+          @return <bytes/str> - File data, either decoded with #decodeWith, or bytes if #decodeWith was None
+    '''
+    with open(filename, 'rb') as f:
+        contents = f.read()
+
+    if decodeWith:
+        contents = contents.decode(decodeWith)
+    return contents
+
+
+class MirrorHealth(object):
+    '''
+        MirrorHealth - Tracks how each mirror has been doing, shared by everything fetching from the mirrors
+            (so it carries over between the initial run and the retry runs), and used to route each fetch
+            to the currently best mirror ( @see MirrorPool ).
+
+          For each mirror, this records the number of successes, timeouts, missing / empty data
+           (RetryWithNextMirrorException) and network errors, along with a moving average of
+           fetch duration, throughput, and failure rate.
+
+          A mirror's score is the expected time for a successful fetch ( average duration / success rate ),
+           so lower is better. Mirrors which have not been used yet score 0, so each gets tried.
+
+          Circuit breaker - After MIRROR_BREAKER_THRESHOLD failures in a row, the mirror is "tripped" and not used
+           for a cool-down period (MIRROR_BREAKER_COOLDOWN seconds, doubling each time it trips again up to
+           MIRROR_BREAKER_MAX_COOLDOWN). Once the cool-down passes, it is tried again, and one more failure trips it
+           again. A tripped mirror is still used as a last resort, if a package has already tried every other mirror.
+    '''
+
+    def __init__(self, breakerThreshold=MIRROR_BREAKER_THRESHOLD, breakerCooldown=MIRROR_BREAKER_COOLDOWN, maxBreakerCooldown=MIRROR_BREAKER_MAX_COOLDOWN):
+        '''
+            __init__ - Create a MirrorHealth
+
+              @param breakerThreshold <int> default MIRROR_BREAKER_THRESHOLD - Number of failures in a row to trip a mirror
+
+              @param breakerCooldown <float> default MIRROR_BREAKER_COOLDOWN - Seconds a mirror is not used after first tripping
+
+              @param maxBreakerCooldown <float> default MIRROR_BREAKER_MAX_COOLDOWN - Max cool-down, after repeated trips
+        '''
+        self.breakerThreshold = breakerThreshold
+        self.breakerCooldown = breakerCooldown
+        self.maxBreakerCooldown = maxBreakerCooldown
+
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _getStats(self, repoUrl):
+        '''
+            _getStats - Get the stats dict for a mirror, creating it if needed. Call with _lock held.
+        '''
+        stats = self._stats.get(repoUrl)
+        if stats is None:
+            stats = self._stats[repoUrl] = {
+                'numSuccess' : 0,
+                'numTimeout' : 0,
+                'numMissing' : 0,
+                'numError' : 0,
+                'avgDuration' : None,
+                'avgThroughput' : None,
+                'avgFailure' : None,
+                'consecutiveFailures' : 0,
+                'trippedUntil' : 0,
+                'cooldown' : self.breakerCooldown,
+                'numTrips' : 0,
+            }
+        return stats
+
+    def recordSuccess(self, repoUrl, duration, numBytes):
+        '''
+            recordSuccess - Record a successful fetch from a mirror
+
+              @param repoUrl <str> - The mirror
+
+              @param duration <float> - Seconds the fetch took
+
+              @param numBytes <int> - Number of bytes fetched
+        '''
+        with self._lock:
+            stats = self._getStats(repoUrl)
+            stats['numSuccess'] += 1
+            stats['avgDuration'] = _movingAverage(stats['avgDuration'], duration)
+            if duration > 0:
+                stats['avgThroughput'] = _movingAverage(stats['avgThroughput'], numBytes / duration)
+            stats['avgFailure'] = _movingAverage(stats['avgFailure'], 0.0)
+
+            stats['consecutiveFailures'] = 0
+            stats['cooldown'] = self.breakerCooldown
+
+    def recordFailure(self, repoUrl, failureType, duration=None):
+        '''
+            recordFailure - Record a failed fetch from a mirror
+
+              @param repoUrl <str> - The mirror
+
+              @param failureType <str> - One of "timeout", "missing" (404 or no data), or "error" (network error)
+
+              @param duration <None/float> default None - Seconds spent before failing, if it should count
+                against the mirror's average duration (e.x. a timeout)
+        '''
+        now = time.time()
+        with self._lock:
+            stats = self._getStats(repoUrl)
+            if failureType == 'timeout':
+                stats['numTimeout'] += 1
+            elif failureType == 'missing':
+                stats['numMissing'] += 1
+            else:
+                stats['numError'] += 1
+
+            if duration is not None:
+                stats['avgDuration'] = _movingAverage(stats['avgDuration'], duration)
+            stats['avgFailure'] = _movingAverage(stats['avgFailure'], 1.0)
+
+            stats['consecutiveFailures'] += 1
+            if stats['consecutiveFailures'] >= self.breakerThreshold and now >= stats['trippedUntil']:
+                cooldown = stats['cooldown']
+                stats['trippedUntil'] = now + cooldown
+                stats['cooldown'] = min(cooldown * 2, self.maxBreakerCooldown)
+                stats['numTrips'] += 1
+
+                sys.stderr.write('WARNING: Mirror %s failed %d times in a row ( last: %s ). Not using it for %d seconds.\n' % \
+                    ( repoUrl, stats['consecutiveFailures'], failureType, cooldown )
+                )
+
+    def isTripped(self, repoUrl):
+        '''
+            isTripped - Check if a mirror's circuit breaker is currently tripped (mirror is cooling down)
+
+              @param repoUrl <str> - The mirror
+
+              @return <bool> - True if tripped
+        '''
+        stats = self._stats.get(repoUrl)
+        return stats is not None and time.time() < stats['trippedUntil']
+
+    def getScore(self, repoUrl):
+        '''
+            getScore - Get the score of a mirror. Lower is better.
+
+              @param repoUrl <str> - The mirror
+
+              @return <float> - Expected seconds for a successful fetch, or 0.0 if mirror has not been used.
+        '''
+        stats = self._stats.get(repoUrl)
+        if stats is None or stats['avgFailure'] is None:
+            return 0.0
+
+        # Failures can be instant (e.x. connection refused), so use at least 10ms per fetch
+        return max(stats['avgDuration'] or 0.0, 0.01) / max(1.0 - stats['avgFailure'], 0.05)
+
+    def chooseMirror(self, repoUrls, numActive, maxPerMirror):
+        '''
+            chooseMirror - Pick the best mirror for the next fetch
+
+              @param repoUrls list<str> - Candidate mirrors (i.e. not yet tried for this package), in mirrorlist order
+
+              @param numActive dict<str, int> - Number of fetches currently in flight, per mirror
+
+              @param maxPerMirror <int> - Max fetches in flight per mirror
+
+              @return <str/None> - The mirror with a free slot with the best score (adjusted for how busy it is,
+                then by least busy, then by mirrorlist order), or None if none have a free slot.
+        '''
+        with self._lock:
+            healthyRepoUrls = [ repoUrl for repoUrl in repoUrls if not self.isTripped(repoUrl) ]
+            if not healthyRepoUrls:
+                # Last resort, try the tripped mirrors
+                healthyRepoUrls = repoUrls
+
+            bestRepoUrl = None
+            bestKey = None
+            for repoUrl in healthyRepoUrls:
+                thisActive = numActive[repoUrl]
+                if thisActive >= maxPerMirror:
+                    continue
+
+                thisKey = ( self.getScore(repoUrl) * (1 + thisActive), thisActive )
+                if bestKey is None or thisKey < bestKey:
+                    bestRepoUrl = repoUrl
+                    bestKey = thisKey
+
+            return bestRepoUrl
+
+    def formatReport(self):
+        '''
+            formatReport - Get a summary of each mirror
+
+              @return <str> - One line per mirror which has been used
+        '''
+        lines = []
+        with self._lock:
+            for (repoUrl, stats) in self._stats.items():
+                lines.append( '  %s\n\t%d ok  %d timeouts  %d missing  %d errors  avg %.2fs  %d KB/s  tripped %d times%s\n' % \
+                    ( repoUrl, stats['numSuccess'], stats['numTimeout'], stats['numMissing'], stats['numError'],
+                        stats['avgDuration'] or 0, (stats['avgThroughput'] or 0) // 1024, stats['numTrips'],
+                        self.isTripped(repoUrl) and ' ( currently tripped )' or '',
+                    )
+                )
+
+        return 'Mirror health:\n' + ''.join(lines)
+
+
+def _movingAverage(avg, value):
+    '''
+        _movingAverage - Update an exponential moving average with a new value
+
+          @param avg <None/float> - Current average, or None if no values yet
+
+          @param value <float> - The new value
+
+          @return <float> - Updated average
+    '''
+    if avg is None:
+        return value
+    return avg + MIRROR_HEALTH_WEIGHT * (value - avg)
+
+
+class MirrorPool(object):
+    '''
+        MirrorPool - Hands out mirrors to worker threads, limiting the number of
+            concurrent fetches against any one mirror.
+
+          Any thread may use any mirror. When a thread needs a mirror, it gets the
+           best one ( @see MirrorHealth.chooseMirror ) which has a free slot,
+           and which it has not already tried for the current package.
+    '''
+
+    def __init__(self, repoUrls, maxPerMirror=MAX_PER_MIRROR, mirrorHealth=None):
+        '''
+            __init__ - Create a MirrorPool
+
+              @param repoUrls list<str> - A list of repo urls, ready to be used as a format string
+
+              @param maxPerMirror <int> default MAX_PER_MIRROR - Max number of concurrent fetches on a single mirror
+
+              @param mirrorHealth <None/MirrorHealth> default None - Mirror health tracker to route by, or None to create one
+        '''
+        self.repoUrls = list(repoUrls)
+        self.maxPerMirror = maxPerMirror
+        self.mirrorHealth = mirrorHealth or MirrorHealth()
+
+        self.numActive = { repoUrl : 0 for repoUrl in self.repoUrls }
+
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.repoUrls)
+
+    def acquire(self, excludeRepoUrls=None):
+        '''
+            acquire - Get a mirror to use for a fetch. Will block until one is available.
+
+              @param excludeRepoUrls <None/set<str>> - Mirrors which should not be returned (i.e. already tried)
+
+              @return <str/None> - A repo url, which must be returned with #release ,
+                or None if every mirror is in #excludeRepoUrls
+        '''
+        if not excludeRepoUrls:
+            excludeRepoUrls = ()
+
+        with self._condition:
+            while True:
+                candidates = [ repoUrl for repoUrl in self.repoUrls if repoUrl not in excludeRepoUrls ]
+                if not candidates:
+                    return None
+
+                bestRepoUrl = self.mirrorHealth.chooseMirror(candidates, self.numActive, self.maxPerMirror)
+                if bestRepoUrl is not None:
+                    self.numActive[bestRepoUrl] += 1
+                    return bestRepoUrl
+
+                self._condition.wait(1)
+
+    def release(self, repoUrl):
+        '''
+            release - Return a mirror acquired via #acquire
+
+              @param repoUrl <str> - The repo url
+        '''
+        with self._condition:
+            self.numActive[repoUrl] -= 1
+            self._condition.notify_all()
+
+
+def createPackageQueue(packageInfos):
+    '''
+        createPackageQueue - Create the shared queue of packages which worker threads pull from
+
+          @param packageInfos list< tuple<str, str, str> > - Package infos ( repo, name, version )
+
+          @return <queue.Queue> - A queue containing every package info
+    '''
+    packageQueue = queue.Queue()
+    for packageInfo in packageInfos:
+        packageQueue.put(packageInfo)
+
+    return packageQueue
+
+
+class RunnerWorker(StoppableThread):
+    '''
+        RunnerWorker - A StoppableThread which pulls packages off a shared queue and processes them,
+            until the queue is empty.
+
+          All workers share one queue, so a worker that gets quick packages or a fast mirror
+           just ends up doing more of them.
+
+            @see Runner
+    '''
+
+    def __init__(self, packageQueue, resultsRef, failedPackageInfos, mirrorPool, shortFetchSize=DEFAULT_SHORT_FETCH_SIZE, timeout=SHORT_TIMEOUT, longTimeout=LONG_TIMEOUT, isVerbose=False, isSuperVerbose=False, mtreeOffsets=None, packageFilenames=None):
+        '''
+            __init__ - Create a "RunnerWorker" object
+
+              @see Runner
+
+              @param packageQueue queue.Queue < tuple < str, str, str > > - The queue of package infos shared by all workers
+
+              @param resultsRef RefObj < dict > - Reference to the global results 
+
+              @param failedPackageInfos list - Global list where failed package infos should be appended
+
+              @param mirrorPool <MirrorPool> - The mirrors (shared by all workers)
+
+              @param shortFetchSize <int> default DEFAULT_SHORT_FETCH_SIZE - Number of bytes to fetch for a "short fetch"
+
+              @param timeout <float> Default SHORT_TIMEOUT , The "short"/standard timeout period per package
+
+              @param longTimeout <float> default LONG_TIMEOUT - The "long"/retry timeout period per package
+
+              @param isVerbose <bool> default False - Whether to be verbose or not
+
+              @param isSuperVerbose <bool> default False - Whether to be "super verbose"
+
+              @param mtreeOffsets <None/dict> default None - Map of package name -> compressed offset at which the .MTREE
+                ended in the prior version of the package (from the old database), used to size the short fetch.
+
+              @param packageFilenames <None/dict> default None - Map of package name -> filename, from the sync databases
+                ( @see getPackageFilenames ). Packages not present are guessed ( @see getPackageFilename )
+
+        '''
+        StoppableThread.__init__(self)
+
+
+        self.packageQueue = packageQueue
+        self.resultsRef = resultsRef
+        self.failedPackageInfos = failedPackageInfos
+        self.mirrorPool = mirrorPool
+        self.timeout = timeout
+        self.longTimeout = longTimeout
+        self.shortFetchSize = shortFetchSize
+        self.isVerbose = isVerbose
+        self.isSuperVerbose = isSuperVerbose
+        self.mtreeOffsets = mtreeOffsets or {}
+        self.packageFilenames = packageFilenames or {}
+
+    def getShortFetchSize(self, packageName):
+        '''
+            getShortFetchSize - Get the number of bytes to fetch first for a given package
+
+              If we know where the .MTREE ended in the prior version of this package,
+               this is that offset plus a margin. Otherwise, it is #shortFetchSize
+
+              @param packageName <str> - Package name
+
+              @return <int> - Number of bytes
+        '''
+        mtreeOffset = self.mtreeOffsets.get(packageName)
+        if not mtreeOffset:
+            return self.shortFetchSize
+
+        return min( mtreeOffset + max(MTREE_OFFSET_MARGIN, mtreeOffset // 8), MAX_SHORT_FETCH_SIZE )
+
+    ##############################################
+    ######## doOne - Do a single package
+    ########################################
+    def doOne(self, repoName, packageName, packageVersion, repoUrl, fetchedData=None, useTarMod=False):
+        '''
+            doOne - Do a single package. This is an internal function.
+                Use RunnerWorker.run instead.
+
+                @param repoName <str> - Repo name to use
+
+                @param packageName <str> - Package name to fetch
+
+                @param packageVersion <str> - The package version
+
+                @param repoUrl <str> - Repo url to try
+
+                @param fetchedData <None/bytes> default None - Data that has already been fetched, or None to do fetch
+
+                @param useTarMod <bool> default False - Whether to do a full fetch and use tar module. If False,
+                    will be a "short fetch"
+
+                @return <int> - Number of bytes fetched
+
+                NOTES:
+                    
+                    * May call itself with useTarMod=True if originally useTarMod=False but short-read failed
+        '''
+        
+        isVerbose = self.isVerbose
+        shortFetchSize = self.shortFetchSize
+        resultsRef = self.resultsRef
+
+        if isVerbose and useTarMod is True:
+            print ( "Using full fetch and tar module for %s - %s" %(repoName, packageName) )
+        results = resultsRef()
+
+        finalUrl = repoUrl %( repoName, getPackageFilename(packageName, packageVersion, self.packageFilenames) )
+
+        mtreeOffset = None
+
+        if useTarMod is False:
+            # Short-read path - Decode the data as it arrives, and stop the transfer
+            #   as soon as the .MTREE has been fully read.
+            #
+            #  If not found within the first fetch, double the size and continue from where
+            #   we left off (for http), until MAX_SHORT_FETCH_SIZE, then fall back to full fetch.
+            fetchSize = self.getShortFetchSize(packageName)
+            isLearnedSize = fetchSize != shortFetchSize
+            canResume = finalUrl.lower().startswith( ('http://', 'https://') )
+
+            if fetchedData is None and isVerbose:
+                print ( "Fetching url: %s  ( %d bytes%s )" %(finalUrl, fetchSize, isLearnedSize and ', from prior .MTREE offset' or '') )
+
+            decoder = MtreeStreamDecoder()
+            numFetched = 0
+            while True:
+                if fetchedData is not None:
+                    fetchIter = ( nextChunk for nextChunk in ( fetchedData[numFetched : fetchSize], ) )
+                else:
+                    fetchIter = iterFetchFromUrl(finalUrl, fetchSize - numFetched, startByte=numFetched)
+
+                numFetchedThis = 0
+                try:
+                    for nextChunk in fetchIter:
+                        numFetchedThis += len(nextChunk)
+                        if decoder.feed(nextChunk):
+                            break
+                finally:
+                    fetchIter.close()
+
+                numFetched += numFetchedThis
+
+                if decoder.isDone or numFetched < fetchSize or fetchSize >= MAX_SHORT_FETCH_SIZE:
+                    # Found it, or hit the end of the file / our limit
+                    break
+
+                fetchSize = min(fetchSize * 2, MAX_SHORT_FETCH_SIZE)
+                if isVerbose:
+                    print ( "Did not find .MTREE in first %d bytes of %s - %s, increasing fetch to %d bytes" %(numFetched, repoName, packageName, fetchSize) )
+
+                if not canResume and fetchedData is None:
+                    # curl can't continue where we left off, so start over
+                    decoder = MtreeStreamDecoder()
+                    numFetched = 0
+
+            if decoder.compressedBytesFed == 0:
+                msg = 'Unable to fetch %s from: %s\n' %(packageName, fetchedData is None and finalUrl or '[cached data]')
+                raise RetryWithNextMirrorException(msg)
+
+            # Sometimes we don't find it, maybe format error, maybe didn't fetch
+            #  enough (doTarMod will do a full fetch)
+            if not decoder.isDone:
+                msg = "Could not find .MTREE in %s - %s - %s." %( repoName, packageName, packageVersion )
+                msg += ' retrying with full fetch and tar mod.\n\n'
+                raise RetryWithFullTarException(msg)
+
+            compressedData = decoder.mtreeData
+            mtreeOffset = decoder.compressedBytesFed
+            numBytesFetched = numFetched
+
+        else:
+            # doTarMod is True
+            if fetchedData is None:
+                if isVerbose:
+                    print ( "Fetching url: " + finalUrl )
+                tarContents = fetchFromUrl(finalUrl, None)
+            else:
+                finalUrl = '[cached data]'
+                tarContents = fetchedData
+
+            if len(tarContents) == 0:
+                msg = 'Unable to fetch %s from: %s\n' %(packageName, finalUrl)
+                raise RetryWithNextMirrorException(msg)
+
+            try:
+                (compressedData, mtreeOffset) = getMtreeFromFullTar(tarContents)
+            except RetryWithNextMirrorException:
+                # Bad repo?
+                errorMsg = "WARNING: %s/%s on repo at %s did not return any data (mirror out of date? file corrupt?), " %( repoName, packageName, repoUrl)
+                sys.stderr.write("%s\n\n" %(errorMsg, ))
+                raise RetryWithNextMirrorException(errorMsg)
+
+            numBytesFetched = len(tarContents)
+
+        files = getFilenamesFromCompressedMtree(compressedData)
+
+        results[packageName] = { 'files' : files, 'version' : packageVersion, 'error' : None, 'mtreeOffset' : mtreeOffset }
+        if isVerbose:
+            sys.stdout.write("Got %d files for %s.\n\n" %(len(files), packageName ))
+
+        return numBytesFetched
+
+    # END: doOne
+    
+    ###################################################
+    ######## run -
+    #########    Run through a list of packages
+    #########     on a list of repos
+    #############################################
+    def run(self):
+        '''
+            run - Thread main. Pulls packages off the shared queue, and processes each
+                against the mirrors in the mirror pool, until the queue is empty.
+
+                May be called standalone (i.e. not via thread.start() ) for non-threaded run.
+
+                Uses args from init -
+                    packageQueue
+                    resultsRef
+                    failedPackageInfos
+                    mirrorPool
+                    timeout
+                    longTimeout
+                    isVerbose
+        '''
+        packageQueue = self.packageQueue
+        while True:
+            try:
+                packageInfo = packageQueue.get_nowait()
+            except queue.Empty:
+                break
+
+            self.doPackage(*packageInfo)
+
+    ###################################################
+    ######## doPackage -
+    #########    Process one package, retrying
+    #########     on other mirrors as needed
+    #############################################
+    def doPackage(self, repoName, packageName, packageVersion):
+        '''
+            doPackage - Process a single package, trying each mirror until one succeeds
+                (or they all fail). Results or errors are stored in the results dict.
+
+                @param repoName <str> - Repo name
+
+                @param packageName <str> - Package name
+
+                @param packageVersion <str> - Package version
+        '''
+        resultsRef = self.resultsRef
+        failedPackageInfos = self.failedPackageInfos
+        mirrorPool = self.mirrorPool
+        mirrorHealth = mirrorPool.mirrorHealth
+        # TODO: Rename self.timeout to self.shortTimeout
+        shortTimeout = self.timeout
+        longTimeout = self.longTimeout
+
+        numRepoUrls = len(mirrorPool)
+
+        isVerbose = self.isVerbose
+
+        results = resultsRef()
+
+        if isVerbose:
+            sys.stdout.write("Processing %s - %s: %s" %(repoName, packageName, isVerbose and '\n' or '') )
+            sys.stdout.flush()
+
+        wasSuccessful = False
+        isPackageMarkedFailed = False
+
+        needsFullTar = False
+        useLongTimeout = False
+
+        # triedRepoUrls - Mirrors we have given up on for this package
+        triedRepoUrls = set()
+        useRepoUrl = None
+
+        try:
+            # Keep trying mirrors here, and break at the end of the loop
+            #   if no exception is raised. If we "continue", we will try again (on the same mirror
+            #   if useRepoUrl is still set, otherwise on the next available mirror).
+
+            while True:
+
+                if useRepoUrl is None:
+                    useRepoUrl = mirrorPool.acquire(triedRepoUrls)
+                    if useRepoUrl is None:
+                        # Tried every mirror
+                        break
+
+                if needsFullTar:
+                    # If we got a RetryWithFullTarException once for this package,
+                    #   it means we downloaded the partial and were unable to extract
+                    #   the mtree. This will be true on all other mirrors, so it is per-package info tuple element
+
+                    doOneKwargs = {'useTarMod' : True}
+
+                    # Always use long timeout when doing full tar mode
+                    useTimeout = longTimeout
+                else:
+                    doOneKwargs = {'useTarMod' : False}
+
+                    if useLongTimeout:
+                        useTimeout = longTimeout
+                    else:
+                        useTimeout = shortTimeout
+
+                attemptNum = len(triedRepoUrls) + 1
+
+                # Try to run a fetch
+                startTime = time.time()
+                try:
+                    numBytesFetched = func_timeout.func_timeout(useTimeout, self.doOne, (repoName, packageName, packageVersion, useRepoUrl), kwargs=doOneKwargs)
+                except RetryWithFullTarException as retryWithFullTarException1:
+                    # If RetryWithFullTarException is raised, we could not parse the tar file,
+                    #   so retry with a full read and long timeout
+                    if isVerbose:
+                        sys.stderr.write( "Got RetryWithFullTarException [iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                            (attemptNum, numRepoUrls, packageName, useRepoUrl, str(retryWithFullTarException1) ) 
+                        )
+
+                    if needsFullTar:
+                        sys.stderr.write('UNEXPECTED!! Got a "retry with full tar" but already was trying with full tar on package %s at repo url %s.\n\tGoing to move onto next mirror anyway....\n' %(packageName, useRepoUrl))
+
+                        mirrorPool.release(useRepoUrl)
+                        triedRepoUrls.add(useRepoUrl)
+                        useRepoUrl = None
+                        continue
+                    else:
+                        # Otherwise, DON'T move to the next mirror, instead just set needsFullTar
+                        #  and retry with same mirror. Also set to use longer timeout
+                        needsFullTar = True
+                        useLongTimeout = True
+                        continue
+
+                except RetryWithNextMirrorException as retryNextMirrorException1:
+                    # If RetryWithNextMirrorException is raised, we repeat the effort on the next mirror.
+                    #   so iterate next in loop
+                    if isVerbose:
+                        sys.stderr.write( "Got RetryWithNextMirrorException [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                            (attemptNum, numRepoUrls, packageName, useRepoUrl, str(retryNextMirrorException1) ) 
+                    )
+                    mirrorHealth.recordFailure(useRepoUrl, 'missing')
+                    mirrorPool.release(useRepoUrl)
+                    triedRepoUrls.add(useRepoUrl)
+                    useRepoUrl = None
+                    # Only restore the short timeout if we haven't determined
+                    #   we need the full tar (full tar = long timeout always)
+                    useLongTimeout = needsFullTar
+                    continue
+                except (OSError, http.client.HTTPException) as networkException1:
+                    # Connection refused, reset, socket timeout, bad response, etc. Mirror is having trouble, so try the next.
+                    if isVerbose:
+                        sys.stderr.write( "Got network error %s [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                            (networkException1.__class__.__name__, attemptNum, numRepoUrls, packageName, useRepoUrl, str(networkException1) )
+                    )
+                    mirrorHealth.recordFailure(useRepoUrl, 'error')
+                    mirrorPool.release(useRepoUrl)
+                    triedRepoUrls.add(useRepoUrl)
+                    useRepoUrl = None
+                    useLongTimeout = needsFullTar
+                    continue
+                except func_timeout.FunctionTimedOut as fte:
+                    # Got a func_timeout, if we did the short timeout, move to long timeout.
+                    #    If we did the long timeout, move to next repo.
+                    if isVerbose:
+                        if useLongTimeout:
+                            timeoutTypeStr = "using long timeout (will move onto next repo)"
+                        else:
+                            timeoutTypeStr = "using short timeout (will retry with long timeout)"
+
+                        sys.stderr.write( "Got func_timeout %s [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                            (timeoutTypeStr, attemptNum, numRepoUrls, packageName, useRepoUrl, str(fte) ) 
+                        )
+                    mirrorHealth.recordFailure(useRepoUrl, 'timeout', time.time() - startTime)
+                    if not useLongTimeout:
+                        # We failed on short timeout, so switch to long timeout
+                        useLongTimeout = True
+                        # Do not move to next repo
+                        continue
+                    else:
+                        # We failed on long timeout, switch back to short timeout and
+                        #   move to next repo
+                        mirrorPool.release(useRepoUrl)
+                        triedRepoUrls.add(useRepoUrl)
+                        useRepoUrl = None
+                        useLongTimeout = needsFullTar
+                        continue
+
+                except KeyboardInterrupt as kie:
+                    # If control+c is hit, raise it to be handled higher in stack
+                    raise kie
+                except Exception as e:
+                    if isinstance(e, KeyboardInterrupt):
+                        raise e
+
+                    excInfo = sys.exc_info()
+                    sys.stderr.write("Got unexpected exception %s [ iter %d / %d ] on package %s at repo url %s. %s  %s\n" % \
+                        ( str(type(e)), attemptNum, numRepoUrls, packageName, useRepoUrl, str(type(e)), str(e) )
+                    )
+                    # Unknown exception, mark as failed and set "error" string
+                    isPackageMarkedFailed = True
+                    try:
+                        failedPackageInfos.append ( (repoName, packageName, packageVersion) )
+                        errStr = 'Error processing %s - %s : < %s >: %s\n\n' %(repoName, packageName, e.__class__.__name__, str(e))
+                        sys.stderr.write(errStr)
+                        if isVerbose:
+                            traceback.print_exception(*excInfo)
+                        results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
+                    except:
+                        # Exception setting exception, so unmark isPackageMarkedFailed
+                        isPackageMarkedFailed = False
+                        pass
+
+                    break
+
+                # At this point we have completed, so exit the loop
+                #   (no need to retry on different repo urls)
+                mirrorHealth.recordSuccess(useRepoUrl, time.time() - startTime, numBytesFetched)
+                wasSuccessful = True
+                break
+            # End while True
+
+            # If we weren't successful and didn't already mark package failed
+            if wasSuccessful is False and isPackageMarkedFailed is False:
+                # We failed, and have not already marked as failed.
+                failedPackageInfos.append ( (repoName, packageName, packageVersion) )
+                errStr = 'Error TIMEOUT processing %s - %s : FunctionTimedOut\n\n' %(repoName, packageName )
+                sys.stderr.write(errStr)
+                results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
+
+            # If we were successful, results have been marked by the self.doOne function
+
+        except KeyboardInterrupt as ke:
+            # Keep forwarding keyboard interrupt up the stream
+            raise ke
+        except Exception as eOuter:
+            if isinstance(eOuter, KeyboardInterrupt):
+                raise eOuter
+
+            # Generic outer-exception handler to contain failure to a single package
+            if isVerbose:
+                sys.stderr.write('Got outer exception processing %s on repo url %s. %s  %s\n' % \
+                    ( packageName, useRepoUrl, str(eOuter.__class__.__name__), str(eOuter) )
+                )
+                exc_info = sys.exc_info()
+                traceback.print_exception(*exc_info)
+            try:
+                failedPackageInfos.append ( (repoName, packageName, packageVersion) )
+                errStr = 'Error processing %s - %s : < %s >: %s\n\n' % \
+                    (repoName, packageName, eOuter.__class__.__name__, str(eOuter)
+                )
+                sys.stderr.write(errStr)
+                results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
+            except:
+                pass
+        finally:
+            if useRepoUrl is not None:
+                mirrorPool.release(useRepoUrl)
+
+        #END: def doPackage
+
+
+class Runner(object):
+    
+    def __init__(self, numThreads, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, shortFetchSize=DEFAULT_SHORT_FETCH_SIZE, timeout=SHORT_TIMEOUT, longTimeout=LONG_TIMEOUT, isVerbose=False, isSuperVerbose=False, mtreeOffsets=None, maxPerMirror=MAX_PER_MIRROR, mirrorHealth=None, packageFilenames=None):
+        '''
+            __init__ - Create a Runner. If numThreads > 1, will run as threads. Otherwise,
+                        will run inline in current process.
+
+                @param numThreads <int> - Number of threads to start
+
+                @param allPackageInfos list< tuple< str, str, str > > - List of package infos
+                    (from getAllPackagesInfo )
+
+                @param repoUrls list<str> - A list of repos to use.
+                    Length * #maxPerMirror should be >= numThreads, otherwise some threads will just wait for a free mirror.
+
+                @param resultsRef RefObj<dict> - RefObj to the "results" dict
+
+                @param shortFetchSize <int> default DEFAULT_SHORT_FETCH_SIZE - Number of bytes to fetch for a "short fetch"
+
+                @param failedPackageInfos list - A list used to store failed package infos
+
+                @param timeout <float> Default SHORT_TIMEOUT , The "short"/standard timeout period per package
+
+                @param longTimeout <float> default LONG_TIMEOUT - The "long"/retry timeout period per package
+
+                @param isVerbose <bool> default False, if True, will print more verbose output
+
+                @param isSuperVerbose <bool> default False, if True will print super verbose output
+
+                @param mtreeOffsets <None/dict> default None - Map of package name -> compressed offset at which .MTREE ended
+                    in the prior version ( @see RunnerWorker.__init__ )
+
+                @param maxPerMirror <int> default MAX_PER_MIRROR - Max number of concurrent fetches on any one mirror
+
+                @param mirrorHealth <None/MirrorHealth> default None - Mirror health tracker, to share between runs.
+                    None to create one.
+
+                @param packageFilenames <None/dict> default None - Map of package name -> filename ( @see RunnerWorker.__init__ )
+
+                NOTE: Call .run to begin execution
+        '''
+
+        self.numThreads = numThreads
+        self.allPackageInfos = allPackageInfos
+        self.repoUrls = repoUrls
+        self.resultsRef = resultsRef
+        self.failedPackageInfos = failedPackageInfos
+        self.shortFetchSize = shortFetchSize
+        self.timeout = timeout
+        self.longTimeout = longTimeout
+        self.isVerbose = isVerbose
+        self.isSuperVerbose = isSuperVerbose
+        self.mtreeOffsets = mtreeOffsets
+        self.maxPerMirror = maxPerMirror
+        self.mirrorHealth = mirrorHealth
+        self.packageFilenames = packageFilenames
+
+        self.threads = self._createThreads()
+
+    def run(self):
+        if self.numThreads < len(self.threads):
+            sys.stderr.write ( "WARNING: Problem! numThreads [ %d ] is less than actual len(self.threads) [%d]. Too many threads created.\n" % \
+                ( self.numThreads, len(self.threads) ) 
+            )
+            try:
+                self.threads = self._createThreads()
+            except Exception as e:
+                sys.stderr.write("WARNING: Exception trying to recreate threads. %s  %s\n" %(str(type(e)), str(e)) )
+            if self.numThreads < len(self.threads):
+                sys.stderr.write('WARNING: Still too many threads [ %d ] vs expected. [ %d ]. Proceeding anyway, may be issues.\n' %(len(self.threads), self.numThreads) )
+
+        if self.numThreads > 1:
+            self._startThreads()
+
+            didComplete = self._joinThreads()
+            if not didComplete:
+                sys.exit( errno.EPIPE )
+        elif self.numThreads == 1:
+            
+            if len(self.threads) != 1:
+                sys.stderr.write("WARNING: No thread on this object! Trying to recreate...\nObject is:\n")
+                pprint.pprint(self.__dict__, stream=sys.stderr)
+                sys.stderr.write("\n\n")
+                sys.stderr.flush()
+
+                try:
+                    self.threads = self._createThreads()
+                except Exception as e:
+                    sys.stderr.write("WARNING: Exception trying to recreate threads. %s  %s\n" %(str(type(e)), str(e)) )
+                    return
+
+                if len(self.threads) == 0:
+                    sys.stderr.write("WARNING: Could not recover, got 0 threads back on retry. Aborting.\n")
+                    sys.stderr.flush()
+                    return
+
+            try:
+                self.threads[0].run()
+            except KeyboardInterrupt:
+                sys.exit( errno.EPIPE )
+        else:
+            sys.stderr.write('WARNING: No threads to run!!!\n')
+            sys.stderr.flush()
+
+
+    def _createThreads(self):
+        '''
+            createThreads - Create threads to process package info.
+
+                Uses from init -
+
+                    numThreads, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, etc.
+
+
+                @return list < StoppableThread > - A list of StoppableThreads which will pull
+                    from a shared queue of all of #allPackageInfos
+
+                NOTES:
+
+                    * All threads share one queue of packages, and one pool of mirrors ( @see MirrorPool ).
+                        When a thread finishes a package, it just takes the next one off the queue,
+                        on whichever mirror currently has a free slot.
+
+                    * The threads created by this method have not been started.
+                        Use "startThreads" to start them.
+
+        '''
+        numThreads = self.numThreads
+        allPackageInfos = self.allPackageInfos
+        repoUrls = self.repoUrls
+        resultsRef = self.resultsRef
+        failedPackageInfos = self.failedPackageInfos
+        shortFetchSize = self.shortFetchSize
+
+        timeout = self.timeout
+        longTimeout = self.longTimeout
+        isVerbose = self.isVerbose
+        isSuperVerbose = self.isSuperVerbose
+        mtreeOffsets = self.mtreeOffsets
+
+
+        threads = []
+
+        packageQueue = createPackageQueue(allPackageInfos)
+        mirrorPool = MirrorPool(repoUrls, self.maxPerMirror, self.mirrorHealth)
+
+        if numThreads > 1:
+            numPackages = len(allPackageInfos)
+
+            if numPackages < numThreads:
+                numThreads = max(numPackages, 1)
+                if isVerbose:
+                    print ( "Less packages than threads! Shrinking number of threads to %d.." %(numThreads, ))
+
+            print ( "Starting %d threads for %d packages on %d mirrors...\n" %(numThreads, numPackages, len(repoUrls)))
+        else:
+            print ( "Starting 1 thread for %d packages...\n" %( len(allPackageInfos), ) )
+
+        for i in range(numThreads):
+            thisThread = RunnerWorker(packageQueue, resultsRef, failedPackageInfos, mirrorPool, shortFetchSize=shortFetchSize, timeout=timeout, longTimeout=longTimeout, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose, mtreeOffsets=mtreeOffsets, packageFilenames=self.packageFilenames)
+            threads.append(thisThread)
+
+        return threads
+
+    def _startThreads(self, startOffset=.35):
+        '''
+            startThreads - Start a list of threads, with a given offset between starts.
+                The offset is meant to balance out the network bandwidth requirements,
+                 to ensure that we are maxing bandwidth as much as possible.
+                With short reads, threads would otherwise all be doing network I/O followed
+                  by local I/O at the same time.
+
+              @param threads list<threading.Thread> - Threads to start
+
+              @param startOffset <float> - Offset between thread starts
+
+        '''
+        for thisThread in self.threads:
+            thisThread.start()
+            time.sleep(startOffset)
+
+
+    def _joinThreads(self):
+        '''
+            joinThreads - Wait for all threads to complete, 
+                            or shut them down gracefully following control+c
+
+              @param threads list<threading.Thread> - Threads to join
+
+              @return <bool> - True if threads were joined successfully,
+                                False if KeyboardInterrupt caused them to be
+                                stopped
+              
+              TODO: Handle sigterm as well, same as KeyboardInterrupt
+        '''
+        threads = self.threads
+
+        try:
+            for thread in threads:
+                thread.join()
+
+            return True
+        except KeyboardInterrupt as ke:
+            sys.stderr.write ( "\n\nCAUGHT KEYBOARD INTERRUPT, CLOSING DOWN THREADS...\n\n")
+            sys.stderr.flush()
+            # Raise keyboard interrupt in each thread to make them terminate
+            for thread in threads:
+                thread._stopThread(KeyboardInterrupt)
+
+            # Try real quick to cleanup, they are daemon threads so they will be
+            #   terminated at end of program forcibly if required
+            time.sleep(.1)
+
+            for thread in threads:
+                thread.join(.05)
+
+            return False
+
+
+class AsyncHttpFetcher(object):
+    '''
+        AsyncHttpFetcher - A minimal asyncio http/https client for the asyncio engine,
+            with persistent (keep-alive) connections per mirror and Range requests.
+
+          @see HttpFetcher for the threaded equivalent
+    '''
+
+    def __init__(self, maxIdlePerMirror=ASYNC_MAX_PER_MIRROR, isSuperVerbose=False):
+        '''
+            __init__ - Create an AsyncHttpFetcher
+
+              @param maxIdlePerMirror <int> default ASYNC_MAX_PER_MIRROR - Max number of idle connections to keep per mirror
+
+              @param isSuperVerbose <bool> default False - If True, print each request and response status
+        '''
+        self.maxIdlePerMirror = maxIdlePerMirror
+        self.isSuperVerbose = isSuperVerbose
+
+        self._idle = {}
+
+        # Same as HttpConnectionPool - do not verify certificates (like "curl -k")
+        sslContext = ssl.create_default_context()
+        sslContext.check_hostname = False
+        sslContext.verify_mode = ssl.CERT_NONE
+        self.sslContext = sslContext
+
+    async def _getConnection(self, key, allowReuse=True):
+        '''
+            _getConnection - Get a connection ( reader, writer ) to a mirror
+
+              @param key tuple< str, str, int > - ( scheme, host, port )
+
+              @param allowReuse <bool> default True - If False, always open a new connection
+
+              @return tuple< asyncio.StreamReader, asyncio.StreamWriter, bool > - Connection, and True if reused
+        '''
+        if allowReuse:
+            idleConns = self._idle.get(key)
+            while idleConns:
+                (reader, writer) = idleConns.pop()
+                if not reader.at_eof() and not writer.is_closing():
+                    return (reader, writer, True)
+                writer.close()
+
+        (scheme, host, port) = key
+        (reader, writer) = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=(scheme == 'https' and self.sslContext or None)),
+            HTTP_CONNECT_TIMEOUT,
+        )
+        return (reader, writer, False)
+
+    def _releaseConnection(self, key, reader, writer):
+        '''
+            _releaseConnection - Return a connection to the idle pool (or close it if the pool is full)
+        '''
+        idleConns = self._idle.setdefault(key, [])
+        if len(idleConns) < self.maxIdlePerMirror:
+            idleConns.append( (reader, writer) )
+        else:
+            writer.close()
+
+    def closeAll(self):
+        '''
+            closeAll - Close all idle connections
+        '''
+        for idleConns in self._idle.values():
+            for (reader, writer) in idleConns:
+                writer.close()
+        self._idle = {}
+
+    async def _sendRequest(self, reader, writer, host, path, headers):
+        '''
+            _sendRequest - Send a GET and read the response status and headers
+
+              @return tuple< int, dict<str, str> > - Status code, and headers (lowercase names)
+        '''
+        requestLines = [ 'GET %s HTTP/1.1' %(path, ), 'Host: %s' %(host, ) ]
+        for headerName, headerValue in headers.items():
+            requestLines.append( '%s: %s' %(headerName, headerValue) )
+        writer.write( ('\r\n'.join(requestLines) + '\r\n\r\n').encode('latin-1') )
+        await writer.drain()
+
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionResetError('Connection closed by server')
+
+        status = int(statusLine.split(None, 2)[1])
+
+        responseHeaders = {}
+        while True:
+            headerLine = await reader.readline()
+            if not headerLine:
+                raise ConnectionResetError('Connection closed by server')
+            if headerLine in (b'\r\n', b'\n'):
+                break
+            (headerName, _, headerValue) = headerLine.decode('latin-1').partition(':')
+            responseHeaders[headerName.strip().lower()] = headerValue.strip()
+
+        return (status, responseHeaders)
+
+    async def _iterBody(self, reader, responseHeaders, chunkSize):
+        '''
+            _iterBody - Iterate over the body of a response as it arrives
+
+              @return async generator<bytes> - Body data
+        '''
+        if responseHeaders.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                sizeLine = await reader.readline()
+                chunkLen = int(sizeLine.split(b';', 1)[0].strip() or b'0', 16)
+                if chunkLen == 0:
+                    # Trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while chunkLen:
+                    data = await reader.read( min(chunkLen, chunkSize) )
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', chunkLen)
+                    chunkLen -= len(data)
+                    yield data
+                await reader.readline()
+        elif 'content-length' in responseHeaders:
+            remaining = int(responseHeaders['content-length'])
+            while remaining:
+                data = await reader.read( min(remaining, chunkSize) )
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(data)
+                yield data
+        else:
+            # Read until close
+            while True:
+                data = await reader.read(chunkSize)
+                if not data:
+                    return
+                yield data
+
+    async def fetchToConsumer(self, url, consumer, numBytes, startByte=0, chunkSize=DEFAULT_FETCH_CHUNK_SIZE):
+        '''
+            fetchToConsumer - Fetch bytes #startByte through #startByte + #numBytes of #url ,
+                passing each chunk to #consumer as it arrives.
+
+              @param url <str> - An http or https url
+
+              @param consumer <coroutine function> - Awaited with each chunk of data. Return True to stop the transfer.
+
+              @param numBytes <None/int> - Number of bytes to fetch, or None to fetch through the end of the file
+
+              @param startByte <int> default 0 - Offset at which to start
+
+              @param chunkSize <int> default DEFAULT_FETCH_CHUNK_SIZE - Max number of bytes per chunk
+
+              @return <int> - Number of bytes passed to #consumer . 0 if not found.
+        '''
+        for redirectNum in range(HTTP_MAX_REDIRECTS + 1):
+            urlParts = urlsplit(url)
+            scheme = urlParts.scheme.lower()
+            host = urlParts.hostname
+            port = urlParts.port or (scheme == 'https' and 443 or 80)
+            key = (scheme, host, port)
+            path = urlParts.path or '/'
+            if urlParts.query:
+                path += '?' + urlParts.query
+
+            headers = { 'Accept-Encoding' : 'identity', 'User-Agent' : 'extractMtree/' + __version__ }
+            if numBytes:
+                headers['Range'] = 'bytes=%d-%d' %(startByte, startByte + numBytes - 1)
+            elif startByte:
+                headers['Range'] = 'bytes=%d-' %(startByte, )
+
+            (reader, writer, isReused) = await self._getConnection(key)
+            try:
+                try:
+                    (status, responseHeaders) = await self._sendRequest(reader, writer, urlParts.netloc, path, headers)
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    writer.close()
+                    if not isReused:
+                        raise
+                    # Server closed the idle connection on us, retry on a new one
+                    (reader, writer, isReused) = await self._getConnection(key, allowReuse=False)
+                    (status, responseHeaders) = await self._sendRequest(reader, writer, urlParts.netloc, path, headers)
+            except BaseException:
+                writer.close()
+                raise
+
+            if self.isSuperVerbose:
+                sys.stderr.write('%s %s [%s] -> %d\n' %(url, headers.get('Range', ''), isReused and 'reused' or 'new', status))
+
+            willClose = responseHeaders.get('connection', '').lower() == 'close'
+            if 'content-length' in responseHeaders and responseHeaders.get('transfer-encoding', '').lower() != 'chunked':
+                contentLength = int(responseHeaders['content-length'])
+            else:
+                contentLength = None
+
+            numFed = 0
+            bodyRead = 0
+            isComplete = False
+            try:
+                bodyIter = self._iterBody(reader, responseHeaders, chunkSize)
+                if status in (301, 302, 303, 307, 308) or status not in (200, 206):
+                    async for data in bodyIter:
+                        pass
+                    isComplete = True
+                else:
+                    toSkip = (status == 200 and startByte) or 0
+                    async for data in bodyIter:
+                        bodyRead += len(data)
+                        if toSkip:
+                            if len(data) <= toSkip:
+                                toSkip -= len(data)
+                                continue
+                            data = data[toSkip:]
+                            toSkip = 0
+
+                        if numBytes and numFed + len(data) > numBytes:
+                            data = data[ : numBytes - numFed]
+
+                        numFed += len(data)
+                        if await consumer(data) or (numBytes and numFed >= numBytes):
+                            break
+                    else:
+                        isComplete = True
+
+                    if not isComplete and contentLength is not None and contentLength - bodyRead <= HTTP_MAX_DRAIN_SIZE:
+                        # Stopped early, but little enough is left to read it and keep the connection
+                        async for data in bodyIter:
+                            pass
+                        isComplete = True
+            finally:
+                if isComplete and not willClose:
+                    self._releaseConnection(key, reader, writer)
+                else:
+                    # Stopped early (or an error / timeout). Don't wait on the rest, just drop the connection.
+                    writer.close()
+
+            if status in (301, 302, 303, 307, 308) and responseHeaders.get('location'):
+                url = urljoin(url, responseHeaders['location'])
+                continue
+
+            return numFed
+
+        return 0
+
+
+class AsyncMirrorPool(object):
+    '''
+        AsyncMirrorPool - asyncio version of MirrorPool. Limits the number of in-flight fetches per mirror.
+
+          @see MirrorPool
+    '''
+
+    def __init__(self, repoUrls, maxPerMirror=ASYNC_MAX_PER_MIRROR, mirrorHealth=None):
+        '''
+            __init__ - Create an AsyncMirrorPool. Must be created within the running event loop.
+
+              @param repoUrls list<str> - Repo urls
+
+              @param maxPerMirror <int> default ASYNC_MAX_PER_MIRROR - Max in-flight fetches per mirror
+
+              @param mirrorHealth <None/MirrorHealth> default None - Mirror health tracker to route by, or None to create one
+        '''
+        self.repoUrls = list(repoUrls)
+        self.maxPerMirror = maxPerMirror
+        self.mirrorHealth = mirrorHealth or MirrorHealth()
+        self.numActive = { repoUrl : 0 for repoUrl in self.repoUrls }
+
+        self._condition = asyncio.Condition()
+
+    def __len__(self):
+        return len(self.repoUrls)
+
+    async def acquire(self, excludeRepoUrls=None):
+        '''
+            acquire - Wait for, and return, the best mirror not in #excludeRepoUrls ( @see MirrorHealth.chooseMirror )
+
+              @return <str/None> - Repo url, or None if all mirrors are excluded
+        '''
+        if not excludeRepoUrls:
+            excludeRepoUrls = ()
+
+        async with self._condition:
+            while True:
+                candidates = [ repoUrl for repoUrl in self.repoUrls if repoUrl not in excludeRepoUrls ]
+                if not candidates:
+                    return None
+
+                bestRepoUrl = self.mirrorHealth.chooseMirror(candidates, self.numActive, self.maxPerMirror)
+                if bestRepoUrl is not None:
+                    self.numActive[bestRepoUrl] += 1
+                    return bestRepoUrl
+
+                await self._condition.wait()
+
+    async def release(self, repoUrl):
+        '''
+            release - Return a mirror acquired with #acquire
+        '''
+        async with self._condition:
+            self.numActive[repoUrl] -= 1
+            self._condition.notify_all()
+
+
+class AsyncRunner(object):
+    '''
+        AsyncRunner - Runs all packages using asyncio, keeping many short Range fetches in flight at once
+            (bounded per mirror), with decoding handed off to a bounded pool of threads.
+
+          This is the "--engine=asyncio" alternative to Runner, and has the same retry behaviour:
+            short timeout, then long timeout, then full fetch, then next mirror.
+
+          Only http and https mirrors are supported.
+    '''
+
+    def __init__(self, numTasks, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, shortFetchSize=DEFAULT_SHORT_FETCH_SIZE, timeout=SHORT_TIMEOUT, longTimeout=LONG_TIMEOUT, isVerbose=False, isSuperVerbose=False, mtreeOffsets=None, maxPerMirror=ASYNC_MAX_PER_MIRROR, numDecodeWorkers=None, mirrorHealth=None, packageFilenames=None):
+        '''
+            __init__ - Create an AsyncRunner
+
+                @param numTasks <int> - Max number of packages in flight at once
+
+                @param allPackageInfos list< tuple< str, str, str > > - List of package infos
+
+                @param repoUrls list<str> - A list of repos to use. Non-http(s) repos are skipped.
+
+                @param resultsRef RefObj<dict> - RefObj to the "results" dict
+
+                @param failedPackageInfos list - A list used to store failed package infos
+
+                @param shortFetchSize <int> default DEFAULT_SHORT_FETCH_SIZE - Number of bytes to fetch for a "short fetch"
+
+                @param timeout <float> Default SHORT_TIMEOUT , The "short"/standard deadline per package
+
+                @param longTimeout <float> default LONG_TIMEOUT - The "long"/retry deadline per package
+
+                @param isVerbose <bool> default False, if True, will print more verbose output
+
+                @param isSuperVerbose <bool> default False, if True will print super verbose output
+
+                @param mtreeOffsets <None/dict> default None - @see RunnerWorker.__init__
+
+                @param maxPerMirror <int> default ASYNC_MAX_PER_MIRROR - Max in-flight fetches per mirror
+
+                @param numDecodeWorkers <None/int> default None - Number of threads to decode with. None for number of cpus.
+
+                @param mirrorHealth <None/MirrorHealth> default None - @see Runner.__init__
+
+                @param packageFilenames <None/dict> default None - @see RunnerWorker.__init__
+
+                NOTE: Call .run to begin execution
+        '''
+        self.numTasks = numTasks
+        self.allPackageInfos = allPackageInfos
+        self.resultsRef = resultsRef
+        self.failedPackageInfos = failedPackageInfos
+        self.shortFetchSize = shortFetchSize
+        self.timeout = timeout
+        self.longTimeout = longTimeout
+        self.isVerbose = isVerbose
+        self.isSuperVerbose = isSuperVerbose
+        self.mtreeOffsets = mtreeOffsets or {}
+        self.maxPerMirror = maxPerMirror
+        self.numDecodeWorkers = numDecodeWorkers or os.cpu_count() or 1
+        self.mirrorHealth = mirrorHealth or MirrorHealth()
+        self.packageFilenames = packageFilenames or {}
+
+        self.repoUrls = [ repoUrl for repoUrl in repoUrls if repoUrl.lower().startswith( ('http://', 'https://') ) ]
+        if len(self.repoUrls) != len(repoUrls):
+            sys.stderr.write('WARNING: asyncio engine only supports http and https mirrors. Skipping %d other mirrors.\n' %( len(repoUrls) - len(self.repoUrls), ))
+
+        # These are created within the event loop, in #run
+        self.fetcher = None
+        self.mirrorPool = None
+        self.decodeExecutor = None
+        self.decodeSemaphore = None
+
+    def run(self):
+        '''
+            run - Process all the packages, blocking until complete.
+        '''
+        if not self.repoUrls:
+            sys.stderr.write('WARNING: No usable mirrors for asyncio engine!!!\n')
+            for packageInfo in self.allPackageInfos:
+                self._markFailed(packageInfo, 'Error processing %s - %s : No usable mirrors\n\n' %(packageInfo[0], packageInfo[1]))
+            return
+
+        print ( "Starting asyncio engine for %d packages on %d mirrors ( %d in flight, %d per mirror, %d decode threads )...\n" % \
+            ( len(self.allPackageInfos), len(self.repoUrls), self.numTasks, self.maxPerMirror, self.numDecodeWorkers )
+        )
+
+        try:
+            asyncio.run( self._runAll() )
+        except KeyboardInterrupt:
+            sys.stderr.write ( "\n\nCAUGHT KEYBOARD INTERRUPT, CLOSING DOWN...\n\n")
+            sys.exit( errno.EPIPE )
+
+    async def _runAll(self):
+        '''
+            _runAll - Main coroutine. Starts #numTasks workers which pull from a shared queue.
+        '''
+        self.fetcher = AsyncHttpFetcher(self.maxPerMirror, isSuperVerbose=self.isSuperVerbose)
+        self.mirrorPool = AsyncMirrorPool(self.repoUrls, self.maxPerMirror, self.mirrorHealth)
+        self.decodeExecutor = concurrent.futures.ThreadPoolExecutor(self.numDecodeWorkers)
+        # Allow a little queueing beyond the number of decode threads, but not unbounded
+        self.decodeSemaphore = asyncio.Semaphore(self.numDecodeWorkers * 2)
+
+        packageQueue = asyncio.Queue()
+        for packageInfo in self.allPackageInfos:
+            packageQueue.put_nowait(packageInfo)
+
+        async def worker():
+            while True:
+                try:
+                    packageInfo = packageQueue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self.doPackage(*packageInfo)
+
+        numTasks = max(1, min(self.numTasks, len(self.allPackageInfos)))
+        try:
+            await asyncio.gather( *[ worker() for i in range(numTasks) ] )
+        finally:
+            self.fetcher.closeAll()
+            self.decodeExecutor.shutdown(wait=False)
+
+    async def _decode(self, func, *args):
+        '''
+            _decode - Run some CPU-side work (decompress, parse) on the decode pool
+
+              @param func <callable> - Function to call
+
+              @param args - Arguments to #func
+
+              @return - Return of #func
+        '''
+        async with self.decodeSemaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.decodeExecutor, func, *args)
+
+    async def _fetchInto(self, url, consumer, numBytes, startByte=0):
+        '''
+            _fetchInto - Fetch with the alternate url fallbacks, like iterFetchFromUrl (so not when resuming at #startByte )
+
+              @return tuple< int, str > - Number of bytes fed to #consumer , and the url which worked
+        '''
+        numFed = await self.fetcher.fetchToConsumer(url, consumer, numBytes, startByte)
+        if numFed == 0 and not startByte:
+            for alternateUrl in getAlternatePackageUrls(url):
+                numFed = await self.fetcher.fetchToConsumer(alternateUrl, consumer, numBytes, startByte)
+                if numFed:
+                    return (numFed, alternateUrl)
+
+        return (numFed, url)
+
+    async def doOne(self, repoName, packageName, packageVersion, repoUrl, useTarMod=False):
+        '''
+            doOne - Do a single package on a single mirror. @see RunnerWorker.doOne
+
+              @return <int> - Number of bytes fetched
+
+              @raises RetryWithFullTarException, RetryWithNextMirrorException, etc.
+        '''
+        isVerbose = self.isVerbose
+        results = self.resultsRef()
+
+        finalUrl = repoUrl %( repoName, getPackageFilename(packageName, packageVersion, self.packageFilenames) )
+        mtreeOffset = None
+
+        if useTarMod is False:
+            mtreeOffset = self.mtreeOffsets.get(packageName)
+            if mtreeOffset:
+                fetchSize = min( mtreeOffset + max(MTREE_OFFSET_MARGIN, mtreeOffset // 8), MAX_SHORT_FETCH_SIZE )
+            else:
+                fetchSize = self.shortFetchSize
+
+            decoder = MtreeStreamDecoder()
+
+            async def feedDecoder(data):
+                return await self._decode(decoder.feed, data)
+
+            # As with iterFetchFromUrl, one Range request for the whole size. The transfer
+            #   is stopped ( @see AsyncHttpFetcher.fetchToConsumer ) once the .MTREE is found.
+            numFetched = 0
+            while True:
+                (numFetchedThis, finalUrl) = await self._fetchInto(finalUrl, feedDecoder, fetchSize - numFetched, numFetched)
+                numFetched += numFetchedThis
+
+                if decoder.isDone or numFetched < fetchSize or fetchSize >= MAX_SHORT_FETCH_SIZE:
+                    break
+
+                fetchSize = min(fetchSize * 2, MAX_SHORT_FETCH_SIZE)
+
+            if decoder.compressedBytesFed == 0:
+                raise RetryWithNextMirrorException('Unable to fetch %s from: %s\n' %(packageName, finalUrl))
+
+            if not decoder.isDone:
+                raise RetryWithFullTarException("Could not find .MTREE in %s - %s - %s. retrying with full fetch and tar mod.\n\n" %( repoName, packageName, packageVersion ))
+
+            compressedData = decoder.mtreeData
+            mtreeOffset = decoder.compressedBytesFed
+            numBytesFetched = numFetched
+        else:
+            if isVerbose:
+                print ( "Using full fetch and tar module for %s - %s" %(repoName, packageName) )
+
+            tarContents = bytearray()
+            async def appendData(data):
+                tarContents.extend(data)
+                return False
+
+            await self._fetchInto(finalUrl, appendData, None)
+            if not tarContents:
+                raise RetryWithNextMirrorException('Unable to fetch %s from: %s\n' %(packageName, finalUrl))
+
+            (compressedData, mtreeOffset) = await self._decode(getMtreeFromFullTar, bytes(tarContents))
+            numBytesFetched = len(tarContents)
+
+        files = await self._decode(getFilenamesFromCompressedMtree, compressedData)
+
+        results[packageName] = { 'files' : files, 'version' : packageVersion, 'error' : None, 'mtreeOffset' : mtreeOffset }
+        if isVerbose:
+            sys.stdout.write("Got %d files for %s.\n\n" %(len(files), packageName ))
+
+        return numBytesFetched
+
+    async def doPackage(self, repoName, packageName, packageVersion):
+        '''
+            doPackage - Process a single package, trying each mirror until one succeeds
+                (or they all fail). @see RunnerWorker.doPackage
+        '''
+        isVerbose = self.isVerbose
+        mirrorPool = self.mirrorPool
+        mirrorHealth = self.mirrorHealth
+        numRepoUrls = len(mirrorPool)
+
+        needsFullTar = False
+        useLongTimeout = False
+        triedRepoUrls = set()
+        useRepoUrl = None
+
+        try:
+            while True:
+                if useRepoUrl is None:
+                    useRepoUrl = await mirrorPool.acquire(triedRepoUrls)
+                    if useRepoUrl is None:
+                        break
+
+                useTimeout = (needsFullTar or useLongTimeout) and self.longTimeout or self.timeout
+                attemptNum = len(triedRepoUrls) + 1
+
+                moveToNextRepo = False
+                startTime = time.time()
+                try:
+                    numBytesFetched = await asyncio.wait_for( self.doOne(repoName, packageName, packageVersion, useRepoUrl, useTarMod=needsFullTar), useTimeout )
+                    mirrorHealth.recordSuccess(useRepoUrl, time.time() - startTime, numBytesFetched)
+                    return
+                except RetryWithFullTarException as retryWithFullTarException1:
+                    if isVerbose:
+                        sys.stderr.write( "Got RetryWithFullTarException [iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                            (attemptNum, numRepoUrls, packageName, useRepoUrl, str(retryWithFullTarException1) )
+                        )
+                    if needsFullTar:
+                        moveToNextRepo = True
+                    else:
+                        needsFullTar = True
+                except (RetryWithNextMirrorException, OSError, asyncio.IncompleteReadError, ValueError) as retryNextMirrorException1:
+                    if isVerbose:
+                        sys.stderr.write( "Got %s [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                            (retryNextMirrorException1.__class__.__name__, attemptNum, numRepoUrls, packageName, useRepoUrl, str(retryNextMirrorException1) )
+                        )
+                    if isinstance(retryNextMirrorException1, RetryWithNextMirrorException):
+                        mirrorHealth.recordFailure(useRepoUrl, 'missing')
+                    else:
+                        mirrorHealth.recordFailure(useRepoUrl, 'error')
+                    moveToNextRepo = True
+                except asyncio.TimeoutError:
+                    if isVerbose:
+                        sys.stderr.write( "Got timeout ( %s timeout ) [ iter %d / %d ] on package %s at repo url %s.\n" % \
+                            (useLongTimeout and 'long' or 'short', attemptNum, numRepoUrls, packageName, useRepoUrl)
+                        )
+                    mirrorHealth.recordFailure(useRepoUrl, 'timeout', time.time() - startTime)
+                    if not useLongTimeout and not needsFullTar:
+                        useLongTimeout = True
+                    else:
+                        moveToNextRepo = True
+
+                if moveToNextRepo:
+                    await mirrorPool.release(useRepoUrl)
+                    triedRepoUrls.add(useRepoUrl)
+                    useRepoUrl = None
+                    useLongTimeout = False
+
+            # Tried every mirror
+            self._markFailed( (repoName, packageName, packageVersion), 'Error TIMEOUT processing %s - %s : FunctionTimedOut\n\n' %(repoName, packageName ) )
+
+        except Exception as e:
+            if isVerbose:
+                traceback.print_exception(*sys.exc_info())
+            self._markFailed( (repoName, packageName, packageVersion), 'Error processing %s - %s : < %s >: %s\n\n' %(repoName, packageName, e.__class__.__name__, str(e)) )
+        finally:
+            if useRepoUrl is not None:
+                await mirrorPool.release(useRepoUrl)
 
-           Call to retrieve refrence, i.e.   myObj = myRefObj()
+    def _markFailed(self, packageInfo, errStr):
+        '''
+            _markFailed - Record a package as failed, with an error string
+        '''
+        self.failedPackageInfos.append(packageInfo)
+        sys.stderr.write(errStr)
+        self.resultsRef()[packageInfo[1]] = { 'files' : [], 'version' : packageInfo[2], 'error' : errStr }
+
+def decodePackageData(data, fetchSize=None):
     '''
+        decodePackageData - Extract the file list from fetched package data.
 
-    def __init__(self, ref):
-        '''
-            __init__ - Create a refObj
+          This is the CPU side of processing a package (decompress, walk tar, decompress .MTREE, parse),
+           and is run in a worker process by the pipeline engine ( @see PipelineRunner ).
 
-              @param ref <object> - An object to hold reference to
-        '''
-        self.ref = ref
+          @param data <bytes> - Package data, starting from the beginning of the file
 
-    def __call__(self):
-        '''
-            __call__ - Return the reference this object holds
+          @param fetchSize <None/int> default None - Number of bytes that were requested for a short-read,
+            or None if #data is the complete package.
 
-            @return <object> - The object this RefObj is holding
-        '''
-        return self.ref
+          @return tuple< str, object, int/None > - ( status, value, mtreeOffset )
 
-#REPO_URL = "http://mirrors.acm.wpi.edu/archlinux/%s/os/x86_64/%s"
-#REPO_URLS = [ "http://mirrors.acm.wpi.edu/archlinux/%s/os/x86_64/%s" ]
+            status is one of:
 
-class RetryWithFullTarException(Exception):
-    '''
-        RetryWithFullTarException - Exception raised when we failed to use
-          a short-read of the tar, to indicate to retry with full fetch
-          and tar module
+              "ok"          - value is the list of files
+              "more"        - .MTREE not found within #data , fetch more
+              "fullTar"     - Could not extract from a short-read, retry with full fetch. value is a message.
+              "nextMirror"  - Bad data on this mirror. value is a message.
     '''
-    pass
+    try:
+        if fetchSize is None:
+            (compressedData, mtreeOffset) = getMtreeFromFullTar(data)
+        else:
+            decoder = MtreeStreamDecoder()
+            decoder.feed(data)
 
-class RetryWithNextMirrorException(Exception):
-    '''
-        RetryWithNextMirrorException - Indicate that there is an issue with this package
-          on the selected mirror (such as no data returned), and to try the next mirror
-    '''
-    pass
+            if not decoder.isDone:
+                if len(data) < fetchSize or fetchSize >= MAX_SHORT_FETCH_SIZE:
+                    return ('fullTar', 'Could not find .MTREE in first %d bytes.' %(len(data), ), None)
+                return ('more', None, None)
 
-def getFileData(filename, decodeWith=None):
-    '''
-        getFileData - Read and decode a filename
+            compressedData = decoder.mtreeData
+            mtreeOffset = decoder.compressedBytesFed
 
-          @param filename <str> - Filename
-          @param decodeWith <str/None> - codec to decode results in, or None to leave as bytse
+        files = getFilenamesFromCompressedMtree(compressedData)
 
-          @return <bytes/str> - File data, either decoded with #decodeWith, or bytes if #decodeWith was None
-    '''
-    with open(filename, 'rb') as f:
-        contents = f.read()
+    except RetryWithFullTarException as retryWithFullTarException1:
+        return ('fullTar', str(retryWithFullTarException1), None)
+    except RetryWithNextMirrorException as retryNextMirrorException1:
+        return ('nextMirror', str(retryNextMirrorException1), None)
 
-    if decodeWith:
-        contents = contents.decode(decodeWith)
-    return contents
+    return ('ok', files, mtreeOffset)
 
 
-class RunnerWorker(StoppableThread):
+class PipelineJob(object):
     '''
-        RunnerWorker - A StoppableThread set to run a subset of packages.
+        PipelineJob - The state of a single package as it moves through the stages of the pipeline engine.
 
-            @see createThreads
+          A job is only ever held by one stage at a time, so needs no locking.
     '''
 
-    def __init__(self, doPackages, resultsRef, failedPackageInfos, repoUrls, shortFetchSize=DEFAULT_SHORT_FETCH_SIZE, timeout=SHORT_TIMEOUT, longTimeout=LONG_TIMEOUT, isVerbose=False, isSuperVerbose=False):
-        '''
-            __init__ - Create a "RunnerWorker" object
-
-              @see createThreads
+    __slots__ = ('repoName', 'packageName', 'packageVersion', 'fetchSize', 'data', 'needsFullTar', 'useLongTimeout', 'triedRepoUrls', 'repoUrl')
 
-              @param doPackages list < tuple < str, str, str > > - A list of package infos this thread should process
+    def __init__(self, repoName, packageName, packageVersion, fetchSize):
+        self.repoName = repoName
+        self.packageName = packageName
+        self.packageVersion = packageVersion
 
-              @param resultsRef RefObj < dict > - Reference to the global results 
+        # fetchSize - Number of bytes to short-read ( ignored when needsFullTar )
+        self.fetchSize = fetchSize
+        # data - Data already fetched, when fetching more after "more"
+        self.data = b''
 
-              @param failedPackageInfos list - Global list where failed package infos should be appended
+        self.needsFullTar = False
+        self.useLongTimeout = False
 
-              @param repoUrls list<str> - A list of urls, ready to be used as a format string (contains two %s, "repo" and "arch").
-                First is primary url
+        # triedRepoUrls - Mirrors we have given up on for this package
+        self.triedRepoUrls = set()
+        # repoUrl - The mirror used for the last fetch
+        self.repoUrl = None
 
-              @param shortFetchSize <int> default DEFAULT_SHORT_FETCH_SIZE - Number of bytes to fetch for a "short fetch"
+    def getPackageInfo(self):
+        return (self.repoName, self.packageName, self.packageVersion)
 
-              @param timeout <float> Default SHORT_TIMEOUT , The "short"/standard timeout period per package
+    def moveToNextMirror(self):
+        '''
+            moveToNextMirror - Give up on the current mirror for this package
+        '''
+        if self.repoUrl is not None:
+            self.triedRepoUrls.add(self.repoUrl)
+        self.data = b''
+        # Full tar always uses the long timeout
+        self.useLongTimeout = self.needsFullTar
 
-              @param longTimeout <float> default LONG_TIMEOUT - The "long"/retry timeout period per package
 
-              @param isVerbose <bool> default False - Whether to be verbose or not
+class PipelineRunner(object):
+    '''
+        PipelineRunner - Runs all packages as a staged pipeline, so that decoding never holds up the network:
 
-              @param isSuperVerbose <bool> default False - Whether to be "super verbose"
+            fetch threads -> (bounded) decode queue -> decode worker processes -> merge
 
-        '''
-        StoppableThread.__init__(self)
+          The fetch stage only downloads ( many threads, limited per mirror, @see MirrorPool ).
+          The decode stage decompresses and parses in a pool of processes ( @see decodePackageData ),
+            so it runs on all cores rather than being serialized by the GIL.
+          The merge stage (the calling thread) stores results and decides retries, which go back to the fetch stage.
 
+          This is the "--engine=pipeline" alternative to Runner, and has the same retry behaviour:
+            short timeout, then long timeout, then full fetch, then next mirror.
 
-        self.doPackages = doPackages
-        self.resultsRef = resultsRef
-        self.failedPackageInfos = failedPackageInfos
-        self.repoUrls = repoUrls
-        self.timeout = timeout
-        self.longTimeout = longTimeout
-        self.shortFetchSize = shortFetchSize
-        self.isVerbose = isVerbose
-        self.isSuperVerbose = isSuperVerbose
+          NOTE: Unlike the other engines, the fetch stage does not decode as data arrives, so a short-read
+            fetches its full size rather than stopping once the .MTREE is found. With learned sizes
+            ( @see RunnerWorker.getShortFetchSize ) this is only the margin.
+    '''
 
-    ##############################################
-    ######## doOne - Do a single package
-    ########################################
-    def doOne(self, repoName, packageName, packageVersion, repoUrl, fetchedData=None, useTarMod=False):
+    def __init__(self, numThreads, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, shortFetchSize=DEFAULT_SHORT_FETCH_SIZE, timeout=SHORT_TIMEOUT, longTimeout=LONG_TIMEOUT, isVerbose=False, isSuperVerbose=False, mtreeOffsets=None, maxPerMirror=MAX_PER_MIRROR, numDecodeWorkers=None, decodeQueueSize=None, mirrorHealth=None, packageFilenames=None):
         '''
-            doOne - Do a single package. This is an internal function.
-                Use RunnerWorker.run instead.
-
-                @param repoName <str> - Repo name to use
+            __init__ - Create a PipelineRunner
 
-                @param packageName <str> - Package name to fetch
+                @param numThreads <int> - Number of fetch threads
 
-                @param packageVersion <str> - The package version
+                @param allPackageInfos list< tuple< str, str, str > > - List of package infos
 
-                @param repoUrl <str> - Repo url to try
+                @param repoUrls list<str> - A list of repos to use.
 
-                @param fetchedData <None/bytes> default None - Data that has already been fetched, or None to do fetch
+                @param resultsRef RefObj<dict> - RefObj to the "results" dict
 
-                @param useTarMod <bool> default False - Whether to do a full fetch and use tar module. If False,
-                    will be a "short fetch"
+                @param failedPackageInfos list - A list used to store failed package infos
 
-                NOTES:
-                    
-                    * May call itself with useTarMod=True if originally useTarMod=False but short-read failed
-        '''
-        
-        isVerbose = self.isVerbose
-        shortFetchSize = self.shortFetchSize
-        resultsRef = self.resultsRef
+                @param shortFetchSize <int> default DEFAULT_SHORT_FETCH_SIZE - Number of bytes to fetch for a "short fetch"
 
-        if isVerbose and useTarMod is True:
-            print ( "Using full fetch and tar module for %s - %s" %(repoName, packageName) )
-        results = resultsRef()
+                @param timeout <float> Default SHORT_TIMEOUT , The "short"/standard timeout period per fetch
 
-        if fetchedData is None:
-            finalUrl = repoUrl %( repoName, packageName + "-" + packageVersion + "-x86_64.pkg.tar.xz" )
-            if isVerbose:
-                print ( "Fetching url: " + finalUrl )
+                @param longTimeout <float> default LONG_TIMEOUT - The "long"/retry timeout period per fetch
 
-            if useTarMod is False:
-                maxSize = shortFetchSize
-            else:
-                maxSize = None
+                @param isVerbose <bool> default False, if True, will print more verbose output (including queue depths)
 
-            tarContents = fetchFromUrl(finalUrl, maxSize)
-        else:
-            finalUrl = '[cached data]'
-            tarContents = fetchedData
+                @param isSuperVerbose <bool> default False, if True will print super verbose output
 
+                @param mtreeOffsets <None/dict> default None - @see RunnerWorker.__init__
 
-        if len(tarContents) == 0:
-            msg = 'Unable to fetch %s from: %s\n' %(packageName, finalUrl)
-            raise RetryWithNextMirrorException(msg)
+                @param maxPerMirror <int> default MAX_PER_MIRROR - Max number of concurrent fetches on any one mirror
 
+                @param numDecodeWorkers <None/int> default None - Number of decode processes. None for number of cpus.
 
-        if useTarMod is False:
-            data = decompressXz(tarContents[:shortFetchSize])
+                @param decodeQueueSize <None/int> default None - Max number of fetched packages waiting to be decoded.
+                    When full, the fetch threads wait. None for PIPELINE_DECODE_QUEUE_FACTOR * #numDecodeWorkers
 
-            # Sometimes we don't find it, maybe format error, maybe didn't fetch
-            #  enough (doTarMod will do a full fetch)
-            try:
-                # Try an rindex, as some tar's have an extra section which also contains filenames
-                mtreeIdx = data.rindex(b'.MTREE')
-            except Exception as ex1:
-                if isVerbose is True or useTarMod is False:
-                    msg = "Could not find .MTREE in %s - %s - %s." %( repoName, packageName, packageVersion ) 
-                if useTarMod is False:
-                    msg += ' retrying with full fetch and tar mod.\n\n'
-                    raise RetryWithFullTarException(msg)
-                else:
-                    if isVerbose is True:
-                        msg += '\n\n'
-                        sys.stderr.write(msg)
-                    raise ex1
+                @param mirrorHealth <None/MirrorHealth> default None - @see Runner.__init__
 
+                @param packageFilenames <None/dict> default None - @see RunnerWorker.__init__
 
-            headerStart = data[mtreeIdx:]
+                NOTE: Call .run to begin execution
+        '''
+        self.numThreads = numThreads
+        self.allPackageInfos = allPackageInfos
+        self.repoUrls = repoUrls
+        self.resultsRef = resultsRef
+        self.failedPackageInfos = failedPackageInfos
+        self.shortFetchSize = shortFetchSize
+        self.timeout = timeout
+        self.longTimeout = longTimeout
+        self.isVerbose = isVerbose
+        self.isSuperVerbose = isSuperVerbose
+        self.mtreeOffsets = mtreeOffsets or {}
+        self.packageFilenames = packageFilenames or {}
+        self.maxPerMirror = maxPerMirror
+        self.numDecodeWorkers = numDecodeWorkers or os.cpu_count() or 1
+        self.decodeQueueSize = decodeQueueSize or ( self.numDecodeWorkers * PIPELINE_DECODE_QUEUE_FACTOR )
+
+        self.mirrorPool = MirrorPool(repoUrls, maxPerMirror, mirrorHealth)
+
+        self.fetchQueue = queue.Queue()
+        self.decodeQueue = queue.Queue(self.decodeQueueSize)
+        self.mergeQueue = queue.Queue()
+
+        # numFetching / numDecoding - Number of jobs currently in the fetch / decode stages ( protected by _statsLock )
+        self.numFetching = 0
+        self.numDecoding = 0
+        # maxDepths - Max depth seen of each queue
+        self.maxDepths = { 'fetch' : 0, 'decode' : 0, 'merge' : 0 }
+        self._statsLock = threading.Lock()
+
+    def getShortFetchSize(self, packageName):
+        '''
+            getShortFetchSize - @see RunnerWorker.getShortFetchSize
+        '''
+        mtreeOffset = self.mtreeOffsets.get(packageName)
+        if not mtreeOffset:
+            return self.shortFetchSize
 
-            try:
-                mtreeSize = getFileSizeFromTarHeader(headerStart)
-                compressedData = headerStart[512 : 512 + mtreeSize] # 512 is header size. 
-            except Exception as ex2:
-                # If we failed with the "short fetch", try again with full fetch and tar module
-                if useTarMod is False:
-                    return self.doOne(repoName, packageName, packageVersion, repoUrl, fetchedData, useTarMod=True)
-                raise ex2
+        return min( mtreeOffset + max(MTREE_OFFSET_MARGIN, mtreeOffset // 8), MAX_SHORT_FETCH_SIZE )
 
-        else:
-            # doTarMod is True
-            data = decompressXz(tarContents)
+    def run(self):
+        '''
+            run - Process all the packages, blocking until complete.
+        '''
+        numPackages = len(self.allPackageInfos)
+        if numPackages == 0:
+            return
 
-            if not data:
-                # Bad repo?
-                errorMsg = "WARNING: %s/%s on repo at %s did not return any data (mirror out of date? file corrupt?), " %( repoName, packageName, repoUrl)
-                sys.stderr.write("%s\n\n" %(errorMsg, ))
-                raise RetryWithNextMirrorException(errorMsg)
+        numThreads = max(1, min(self.numThreads, numPackages))
+        numDecodeWorkers = max(1, min(self.numDecodeWorkers, numPackages))
 
-            bio = BytesIO()
-            bio.write(data)
-            bio.seek(0)
+        print ( "Starting pipeline for %d packages on %d mirrors ( %d fetch threads, %d decode processes, decode queue of %d )...\n" % \
+            ( numPackages, len(self.repoUrls), numThreads, numDecodeWorkers, self.decodeQueueSize )
+        )
 
-            tf = tarfile.open(fileobj=bio)
+        # Start the decode processes before any of our threads, so they are not forked while a thread holds a lock
+        decodeExecutor = concurrent.futures.ProcessPoolExecutor(numDecodeWorkers)
+        decodeExecutor.submit(int).result()
 
-            extractedMtreeFile = tf.extractfile('.MTREE')
-            compressedData = extractedMtreeFile.read()
-            try:
-                extractedMtreeFile.close()
-            except:
-                pass
+        for packageInfo in self.allPackageInfos:
+            self.fetchQueue.put( PipelineJob(packageInfo[0], packageInfo[1], packageInfo[2], self.getShortFetchSize(packageInfo[1])) )
 
+        threads = [ threading.Thread(target=self._fetchStage) for i in range(numThreads) ] + \
+            [ threading.Thread(target=self._decodeStage, args=(decodeExecutor, )) for i in range(numDecodeWorkers) ]
 
-        mtreeData = decompressZlib(compressedData).decode('utf-8')
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
 
-        files = getFilenamesFromMtree(mtreeData)
+        try:
+            self._mergeStage(numPackages)
+        except KeyboardInterrupt:
+            sys.stderr.write ( "\n\nCAUGHT KEYBOARD INTERRUPT, CLOSING DOWN...\n\n")
+            decodeExecutor.shutdown(wait=False, cancel_futures=True)
+            sys.exit( errno.EPIPE )
 
-        results[packageName] = { 'files' : files, 'version' : packageVersion, 'error' : None }
-        if isVerbose:
-            sys.stdout.write("Got %d files for %s.\n\n" %(len(files), packageName ))
+        # Stop the stages
+        for i in range(numThreads):
+            self.fetchQueue.put(None)
+        for i in range(numDecodeWorkers):
+            self.decodeQueue.put(None)
+        for thread in threads:
+            thread.join()
 
-    # END: doOne
-    
-    ###################################################
-    ######## run -
-    #########    Run through a list of packages
-    #########     on a list of repos
-    #############################################
-    def run(self):
-        '''
-            run - Thread main. Runs through a list of packages on a list of repos.
+        decodeExecutor.shutdown()
 
-                May be called standalone (i.e. not via thread.start() ) for non-threaded run.
+        print ( "Pipeline complete. Max queue depths:  fetch %(fetch)d  decode %(decode)d  merge %(merge)d\n" %self.maxDepths )
 
-                Uses args from init -
-                    doPackages
-                    resultsRef
-                    failedPackageInfos
-                    repoUrls
-                    timeout
-                    longTimeout
-                    isVerbose
+    def reportQueueDepths(self, numDone, numPackages):
         '''
-        # repoUrls - First is primary, others may or may not be used
-
-        doPackages = self.doPackages
-        resultsRef = self.resultsRef
-        failedPackageInfos = self.failedPackageInfos
-        repoUrls = self.repoUrls
-        # TODO: Rename self.timeout to self.shortTimeout
-        shortTimeout = self.timeout
-        longTimeout = self.longTimeout
+            reportQueueDepths - Print the current depth of each stage, for tuning the worker counts
 
-        numRepoUrls = len(repoUrls)
-        
-        isVerbose = self.isVerbose
+              If the decode queue is always full, add decode workers. If it is always empty, add fetch threads.
+        '''
+        with self._statsLock:
+            numFetching = self.numFetching
+            numDecoding = self.numDecoding
 
-        results = resultsRef()
+        sys.stdout.write( "Pipeline: %d / %d done.  fetch queue %d ( %d fetching )  decode queue %d / %d ( %d decoding )  merge queue %d\n" % \
+            ( numDone, numPackages, self.fetchQueue.qsize(), numFetching, self.decodeQueue.qsize(), self.decodeQueueSize, numDecoding, self.mergeQueue.qsize() )
+        )
+        sys.stdout.flush()
 
-        for repoName, packageName, packageVersion in doPackages:
-            startTime = time.time()
-            gc.collect()
-            endTime = time.time()
-            time.sleep(1.5 - (endTime - startTime))
-            if isVerbose:
-                sys.stdout.write("Processing %s - %s: %s" %(repoName, packageName, isVerbose and '\n' or '') )
-                sys.stdout.flush()
+    def _updateMaxDepths(self):
+        maxDepths = self.maxDepths
+        for (stageName, stageQueue) in ( ('fetch', self.fetchQueue), ('decode', self.decodeQueue), ('merge', self.mergeQueue) ):
+            depth = stageQueue.qsize()
+            if depth > maxDepths[stageName]:
+                maxDepths[stageName] = depth
 
-            wasSuccessful = False
-            isPackageMarkedFailed = False
+    def _fetchStage(self):
+        '''
+            _fetchStage - Fetch thread main. Fetches the data for each job and passes it on to the decode stage.
+                Failures are passed to the merge stage.
+        '''
+        fetchQueue = self.fetchQueue
+        mirrorPool = self.mirrorPool
+        mirrorHealth = mirrorPool.mirrorHealth
 
-            needsFullTar = False
+        while True:
+            job = fetchQueue.get()
+            if job is None:
+                return
 
+            with self._statsLock:
+                self.numFetching += 1
             try:
-                # Iterate through all repo urls here, and break at the end of the loop
-                #   if no exception is raised. If we "continue", we will try using the next repo.
+                repoUrl = mirrorPool.acquire(job.triedRepoUrls)
+                if repoUrl is None:
+                    # Tried every mirror
+                    self.mergeQueue.put( (job, ('failed', None, None)) )
+                    continue
 
-                global repoUrlIdx
-                global useLongTimeout
+                job.repoUrl = repoUrl
+                useTimeout = job.useLongTimeout and self.longTimeout or self.timeout
+                prevSize = len(job.data)
 
-                repoUrlIdx = 0
-                useLongTimeout = False
+                startTime = time.time()
+                try:
+                    data = func_timeout.func_timeout(useTimeout, self._fetchJobData, (job, repoUrl))
+                except func_timeout.FunctionTimedOut:
+                    mirrorHealth.recordFailure(repoUrl, 'timeout', time.time() - startTime)
+                    self.mergeQueue.put( (job, ('timeout', None, None)) )
+                    continue
+                except (OSError, http.client.HTTPException, ValueError) as networkException1:
+                    mirrorHealth.recordFailure(repoUrl, 'error')
+                    self.mergeQueue.put( (job, ('nextMirror', 'Got network error %s: %s' %(networkException1.__class__.__name__, str(networkException1)), None)) )
+                    continue
+                finally:
+                    mirrorPool.release(repoUrl)
 
-                def moveToNextRepo():
-                    '''
-                        moveToNextRepo - Move to the next repo in the below loop.
-                            This increases the iterator index and resets the "useLongTimeout" flag to False
-                    '''
-                    global repoUrlIdx
-                    global useLongTimeout
+                if not data:
+                    mirrorHealth.recordFailure(repoUrl, 'missing')
+                    self.mergeQueue.put( (job, ('nextMirror', 'Unable to fetch %s from: %s' %(job.packageName, repoUrl), None)) )
+                    continue
 
-                    repoUrlIdx += 1
-                    # Only restore the short timeout if we haven't determined
-                    #   we need the full tar (full tar = long timeout always)
-                    if needsFullTar is False:
-                        useLongTimeout = False
-                    else:
-                        useLongTimeout = True
+                mirrorHealth.recordSuccess(repoUrl, time.time() - startTime, max(len(data) - prevSize, 0))
 
+                # Blocks if the decode stage is behind
+                self.decodeQueue.put( (job, data) )
+            except Exception as e:
+                self.mergeQueue.put( (job, ('error', '%s: %s' %(e.__class__.__name__, str(e)), None)) )
+            finally:
+                with self._statsLock:
+                    self.numFetching -= 1
 
-                while repoUrlIdx < numRepoUrls:
+    def _fetchJobData(self, job, repoUrl):
+        '''
+            _fetchJobData - Fetch the data for a job
 
-                    useRepoUrl = repoUrls[repoUrlIdx]
+              @return <bytes> - All the data for the job so far (including any prior data, see PipelineJob.data )
+        '''
+        finalUrl = repoUrl %( job.repoName, getPackageFilename(job.packageName, job.packageVersion, self.packageFilenames) )
 
-                    if needsFullTar:
-                        # If we got a RetryWithFullTarException once for this package,
-                        #   it means we downloaded the partial and were unable to extract
-                        #   the mtree. This will be true on all other mirrors, so it is per-package info tuple element
+        if job.needsFullTar:
+            if self.isVerbose:
+                print ( "Using full fetch and tar module for %s - %s" %(job.repoName, job.packageName) )
+            return fetchFromUrl(finalUrl, None, self.isSuperVerbose)
 
-                        doOneKwargs = {'useTarMod' : True}
+        prevData = job.data
+        if prevData and not finalUrl.lower().startswith( ('http://', 'https://') ):
+            # curl can't continue where we left off, so start over
+            prevData = b''
 
-                        # Always use long timeout when doing full tar mode
-                        useTimeout = useLongTimeout
-                    else:
-                        doOneKwargs = {'useTarMod' : False}
+        if self.isVerbose:
+            print ( "Fetching url: %s  ( %d bytes )" %(finalUrl, job.fetchSize) )
 
-                        if useLongTimeout:
-                            useTimeout = longTimeout
-                        else:
-                            useTimeout = shortTimeout
+        data = b''.join( iterFetchFromUrl(finalUrl, job.fetchSize - len(prevData), self.isSuperVerbose, startByte=len(prevData)) )
+        if not data:
+            return prevData
 
-                    # Try to run a fetch
-                    try:
-                        func_timeout.func_timeout(useTimeout, self.doOne, (repoName, packageName, packageVersion, useRepoUrl), kwargs=doOneKwargs)
-                    except RetryWithFullTarException as retryWithFullTarException1:
-                        # If RetryWithFullTarException is raised, we could not parse the tar file,
-                        #   so retry with a full read and long timeout
-                        if isVerbose:
-                            sys.stderr.write( "Got RetryWithFullTarException [iter %d / %d ] on package %s at repo url %s.  %s\n" % \
-                                (repoUrlIdx + 1, numRepoUrls, packageName, useRepoUrl, str(retryWithFullTarException1) ) 
-                            )
+        return prevData + data
 
-                        if needsFullTar:
-                            sys.stderr.write('UNEXPECTED!! Got a "retry with full tar" but already was trying with full tar on package %s at repo url %s.\n\tGoing to move onto next mirror anyway....\n')
+    def _decodeStage(self, decodeExecutor):
+        '''
+            _decodeStage - Decode thread main. Hands each fetched job to a decode process, and passes the outcome to the merge stage.
 
-                            moveToNextRepo()
-                            continue
-                        else:
-                            # Otherwise, DON'T increment the repoUrlIdx, instead just set needsFullTar
-                            #  and retry with same mirror. Also set to use longer timeout
-                            needsFullTar = True
-                            useLongTimeout = True
-                            continue
-
-                    except RetryWithNextMirrorException as retryNextMirrorException1:
-                        # If RetryWithNextMirrorException is raised, we repeat the effort on the next mirror.
-                        #   so iterate next in loop
-                        if isVerbose:
-                            sys.stderr.write( "Got RetryWithNextMirrorException [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
-                                (repoUrlIdx + 1, numRepoUrls, packageName, useRepoUrl, str(retryNextMirrorException1) ) 
-                        )
-                        moveToNextRepo()
-                        continue
-                    except func_timeout.FunctionTimedOut as fte:
-                        # Got a func_timeout, if we did the short timeout, move to long timeout.
-                        #    If we did the long timeout, move to next repo.
-                        if isVerbose:
-                            if useLongTimeout:
-                                timeoutTypeStr = "using long timeout (will move onto next repo)"
-                            else:
-                                timeoutTypeStr = "using short timeout (will retry with long timeout)"
-
-                            sys.stderr.write( "Got func_timeout %s [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
-                                (timeoutTypeStr, repoUrlIdx + 1, numRepoUrls, packageName, useRepoUrl, str(fte) ) 
-                            )
-                        if not useLongTimeout:
-                            # We failed on short timeout, so switch to long timeout
-                            useLongTimeout = True
-                            # Do not move to next repo
-                            continue
-                        else:
-                            # We failed on long timeout, switch back to short timeout and
-                            #   move to next repo
-                            moveToNextRepo()
-                            continue
-
-                    except KeyboardInterrupt as kie:
-                        # If control+c is hit, raise it to be handled higher in stack
-                        raise kie
-                    except Exception as e:
-                        if isinstance(e, KeyboardInterrupt):
-                            raise e
-
-                        if not isinstance(e, RetryWithFullTarException) and \
-                           not isinstance(e, RetryWithNextMirrorException) and \
-                           not isinstance(e, func_timeout.FunctionTimedOut):
-                            excInfo = sys.exc_info()
-                            sys.stderr.write("Got unexpected exception %s [ iter %d / %d ] on package %s at repo url %s. %s  %s\n" % \
-                                ( str(type(e)), repoUrlIdx + 1, numRepoUrls, packageName, useRepoUrl, str(type(e)), str(e) )
-                            )
-                            # Unknown exception, mark as failed and set "error" string
-                            isPackageMarkedFailed = True
-                            try:
-                                failedPackageInfos.append ( (repoName, packageName, packageVersion) )
-                                errStr = 'Error processing %s - %s : < %s >: %s\n\n' %(repoName, packageName, e.__class__.__name__, str(e))
-                                sys.stderr.write(errStr)
-                                if isVerbose:
-                                    traceback.print_exception(*excInfo)
-                                results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
-                            except:
-                                # Exception setting exception, so unmark isPackageMarkedFailed
-                                isPackageMarkedFailed = False
-                                pass
+              There is one of these threads per decode process.
+        '''
+        decodeQueue = self.decodeQueue
+        mergeQueue = self.mergeQueue
 
-                            break
-                            # Raise exception? Or just continue?
-                            # raise e
-                            # moveToNextRepo()
-                            # continue
-
-                    # At this point we have completed, so exit the for loop
-                    #   (no need to retry on different repo urls)
-                    wasSuccessful = True
-                    break
-                # End while repoUrlIdx < numRepoUrls
-
-                # If we weren't successful and didn't already mark package failed
-                if wasSuccessful is False and isPackageMarkedFailed is False:
-                    # We failed, and have not already marked as failed.
-                    failedPackageInfos.append ( (repoName, packageName, packageVersion) )
-                    errStr = 'Error TIMEOUT processing %s - %s : FunctionTimedOut\n\n' %(repoName, packageName )
-                    sys.stderr.write(errStr)
-                    results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
-
-                # If we were successful, results have been marked by the self.doOne function
-
-            except KeyboardInterrupt as ke:
-                # Keep forwarding keyboard interrupt up the stream
-                raise ke
-            except Exception as eOuter:
-                if isinstance(eOuter, KeyboardInterrupt):
-                    raise eOuter
-
-                # Generic outer-exception handler to contain failure to a single package
-                if isVerbose:
-                    sys.stderr.write('Got outer exception processing %s on repo url %s. %s  %s\n' % \
-                        ( packageName, useRepoUrl, str(eOuter.__class__.__name__), str(eOuter) )
-                    )
-                    exc_info = sys.exc_info()
-                    traceback.print_exception(*exc_info)
-                try:
-                    failedPackageInfos.append ( (repoName, packageName, packageVersion) )
-                    errStr = 'Error processing %s - %s : < %s >: %s\n\n' % \
-                        (repoName, packageName, eOuter.__class__.__name__, str(eOuter)
-                    )
-                    sys.stderr.write(errStr)
-                    results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
-                except:
-                    pass
+        while True:
+            item = decodeQueue.get()
+            if item is None:
+                return
 
-        #END: def runThroughPackages
+            (job, data) = item
+            with self._statsLock:
+                self.numDecoding += 1
+            try:
+                outcome = decodeExecutor.submit(decodePackageData, data, (not job.needsFullTar and job.fetchSize) or None).result()
+                if outcome[0] == 'more':
+                    job.data = data
+            except Exception as e:
+                outcome = ('error', '%s: %s' %(e.__class__.__name__, str(e)), None)
+            finally:
+                with self._statsLock:
+                    self.numDecoding -= 1
 
+            mergeQueue.put( (job, outcome) )
 
-class Runner(object):
-    
-    def __init__(self, numThreads, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, shortFetchSize=DEFAULT_SHORT_FETCH_SIZE, timeout=SHORT_TIMEOUT, longTimeout=LONG_TIMEOUT, isVerbose=False, isSuperVerbose=False):
+    def _mergeStage(self, numPackages):
         '''
-            __init__ - Create a Runner. If numThreads > 1, will run as threads. Otherwise,
-                        will run inline in current process.
+            _mergeStage - Store results as they come out of the decode stage, and send
+                jobs which need a retry back to the fetch stage.
 
-                @param numThreads <int> - Number of threads to start
-
-                @param allPackageInfos list< tuple< str, str, str > > - List of package infos
-                    (from getAllPackagesInfo )
-
-                @param repoUrls list<str> - A list of repos to use.
-                    Length must be >= numThreads
+              Runs in the calling thread, until all #numPackages are done.
+        '''
+        isVerbose = self.isVerbose
+        results = self.resultsRef()
+        mergeQueue = self.mergeQueue
+        fetchQueue = self.fetchQueue
+        numRepoUrls = len(self.mirrorPool)
 
-                @param resultsRef RefObj<dict> - RefObj to the "results" dict
+        numDone = 0
+        lastReportTime = time.time()
 
-                @param shortFetchSize <int> default DEFAULT_SHORT_FETCH_SIZE - Number of bytes to fetch for a "short fetch"
+        while numDone < numPackages:
+            try:
+                (job, (status, value, mtreeOffset)) = mergeQueue.get(timeout=PIPELINE_REPORT_INTERVAL)
+            except queue.Empty:
+                job = None
 
-                @param failedPackageInfos list - A list used to store failed package infos
+            self._updateMaxDepths()
+            if isVerbose and time.time() - lastReportTime >= PIPELINE_REPORT_INTERVAL:
+                self.reportQueueDepths(numDone, numPackages)
+                lastReportTime = time.time()
 
-                @param timeout <float> Default SHORT_TIMEOUT , The "short"/standard timeout period per package
+            if job is None:
+                continue
 
-                @param longTimeout <float> default LONG_TIMEOUT - The "long"/retry timeout period per package
+            (repoName, packageName, packageVersion) = job.getPackageInfo()
+            attemptNum = len(job.triedRepoUrls) + 1
 
-                @param isVerbose <bool> default False, if True, will print more verbose output
+            if status == 'ok':
+                results[packageName] = { 'files' : value, 'version' : packageVersion, 'error' : None, 'mtreeOffset' : mtreeOffset }
+                if isVerbose:
+                    sys.stdout.write("Got %d files for %s.\n\n" %(len(value), packageName ))
+                numDone += 1
+                continue
 
-                @param isSuperVerbose <bool> default False, if True will print super verbose output
+            if status == 'failed':
+                self._markFailed( job, 'Error TIMEOUT processing %s - %s : FunctionTimedOut\n\n' %(repoName, packageName ) )
+                numDone += 1
+                continue
 
-                NOTE: Call .run to begin execution
-        '''
+            if status == 'error':
+                self._markFailed( job, 'Error processing %s - %s : < %s >\n\n' %(repoName, packageName, value) )
+                numDone += 1
+                continue
 
-        self.numThreads = numThreads
-        self.allPackageInfos = allPackageInfos
-        self.repoUrls = repoUrls
-        self.resultsRef = resultsRef
-        self.failedPackageInfos = failedPackageInfos
-        self.shortFetchSize = shortFetchSize
-        self.timeout = timeout
-        self.longTimeout = longTimeout
-        self.isVerbose = isVerbose
-        self.isSuperVerbose = isSuperVerbose
+            if status == 'more':
+                job.fetchSize = min(job.fetchSize * 2, MAX_SHORT_FETCH_SIZE)
+                if isVerbose:
+                    print ( "Did not find .MTREE in first %d bytes of %s - %s, increasing fetch to %d bytes" %(len(job.data), repoName, packageName, job.fetchSize) )
+            elif status == 'fullTar':
+                if isVerbose:
+                    sys.stderr.write( "Got RetryWithFullTarException [iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                        (attemptNum, numRepoUrls, packageName, job.repoUrl, value )
+                    )
+                if job.needsFullTar:
+                    sys.stderr.write('UNEXPECTED!! Got a "retry with full tar" but already was trying with full tar on package %s at repo url %s.\n\tGoing to move onto next mirror anyway....\n' %(packageName, job.repoUrl))
+                    job.moveToNextMirror()
+                else:
+                    job.needsFullTar = True
+                    job.useLongTimeout = True
+                    job.data = b''
+            elif status == 'nextMirror':
+                if isVerbose:
+                    sys.stderr.write( "Got RetryWithNextMirrorException [ iter %d / %d ] on package %s at repo url %s.  %s\n" % \
+                        (attemptNum, numRepoUrls, packageName, job.repoUrl, value )
+                    )
+                job.moveToNextMirror()
+            elif status == 'timeout':
+                if isVerbose:
+                    sys.stderr.write( "Got timeout ( %s timeout ) [ iter %d / %d ] on package %s at repo url %s.\n" % \
+                        (job.useLongTimeout and 'long' or 'short', attemptNum, numRepoUrls, packageName, job.repoUrl)
+                    )
+                if job.useLongTimeout:
+                    job.moveToNextMirror()
+                else:
+                    job.useLongTimeout = True
 
-        self.threads = self._createThreads()
+            fetchQueue.put(job)
 
-    def run(self):
-        if self.numThreads < len(self.threads):
-            sys.stderr.write ( "WARNING: Problem! numThreads [ %d ] is less than actual len(self.threads) [%d]. Too many threads created.\n" % \
-                ( self.numThreads, len(self.threads) ) 
-            )
-            try:
-                self.threads = self._createThreads()
-            except Exception as e:
-                sys.stderr.write("WARNING: Exception trying to recreate threads. %s  %s\n" %(str(type(e)), str(e)) )
-            if self.numThreads < len(self.threads):
-                sys.stderr.write('WARNING: Still too many threads [ %d ] vs expected. [ %d ]. Proceeding anyway, may be issues.\n' %(len(self.threads), self.numThreads) )
+    def _markFailed(self, job, errStr):
+        '''
+            _markFailed - Record a package as failed, with an error string
+        '''
+        self.failedPackageInfos.append(job.getPackageInfo())
+        sys.stderr.write(errStr)
+        self.resultsRef()[job.packageName] = { 'files' : [], 'version' : job.packageVersion, 'error' : errStr }
 
-        if self.numThreads > 1:
-            self._startThreads()
 
-            didComplete = self._joinThreads()
-            if not didComplete:
-                sys.exit( errno.EPIPE )
-        elif self.numThreads == 1:
-            
-            if len(self.threads) != 1:
-                sys.stderr.write("WARNING: No thread on this object! Trying to recreate...\nObject is:\n")
-                pprint.pprint(self.__dict__, stream=sys.stderr)
-                sys.stderr.write("\n\n")
-                sys.stderr.flush()
+def getLocalPackages(localDir, repoName=None):
+    '''
+        getLocalPackages - Find the packages in a local directory (e.x. /var/cache/pacman/pkg , or a repo tree),
+            searching recursively.
 
-                try:
-                    self.threads = self._createThreads()
-                except Exception as e:
-                    sys.stderr.write("WARNING: Exception trying to recreate threads. %s  %s\n" %(str(type(e)), str(e)) )
-                    return
+          If there are multiple versions of a package (as in a package cache), the newest is used.
 
-                if len(self.threads) == 0:
-                    sys.stderr.write("WARNING: Could not recover, got 0 threads back on retry. Aborting.\n")
-                    sys.stderr.flush()
-                    return
+          @param localDir <str> - Directory to search
 
-            try:
-                self.threads[0].run()
-            except KeyboardInterrupt:
-                sys.exit( errno.EPIPE )
-        else:
-            sys.stderr.write('WARNING: No threads to run!!!\n')
-            sys.stderr.flush()
+          @param repoName <None/str> default None - Repo name for the package infos, or None to use the directory name
 
+          @return tuple< list< tuple<str, str, str> >, dict<str, str> > -
+            ( package infos ( repo, name, version ) , map of package name -> package file path )
+    '''
+    if not repoName:
+        repoName = os.path.basename( os.path.abspath(localDir) ) or 'local'
 
-    def _createThreads(self):
-        '''
-            createThreads - Create threads to process package info.
+    packageVersions = {}
+    packagePaths = {}
 
-                @param numThreads <int> - Number of threads to start
+    for (dirPath, dirNames, fileNames) in os.walk(localDir):
+        dirNames.sort()
+        for fileName in sorted(fileNames):
+            if not fileName.endswith( PACKAGE_EXTENSIONS ):
+                continue
 
-                @param allPackageInfos list< tuple< str, str, str > > - List of package infos
-                    (from getAllPackagesInfo )
+            # name-pkgver-pkgrel-arch.pkg.tar.ext , where name may contain dashes
+            nameParts = fileName[ : fileName.index('.pkg.tar')].rsplit('-', 3)
+            if len(nameParts) != 4:
+                continue
 
-                @param repoUrls list<str> - A list of repos to use.
-                    Length must be >= numThreads
+            packageName = nameParts[0]
+            packageVersion = nameParts[1] + '-' + nameParts[2]
 
-                @param resultsRef RefObj<dict> - RefObj to the "results" dict
+            if packageName in packageVersions and canCompareVersions:
+                if VersionString(packageVersion) < VersionString(packageVersions[packageName]):
+                    continue
 
-                @param failedPackageInfos list - A list used to store failed package infos
+            packageVersions[packageName] = packageVersion
+            packagePaths[packageName] = os.path.join(dirPath, fileName)
 
+    packageInfos = [ (repoName, packageName, packageVersion) for (packageName, packageVersion) in sorted(packageVersions.items()) ]
 
-                @return list < StoppableThread > - A list of StoppableThreads set to process
-                    a split subset of #allPackageInfos
+    return (packageInfos, packagePaths)
 
-                NOTES:
-                    
-                    * For each thread, N, it will use #repoUrls[N] as its "primary" repo.
-                        If there are enough repos available, up to #MAX_EXTRA_URLS starting
-                          at #repoUrls[ numThreads + 1 ] will be allocated to each thread
-                          as "backup" urls
 
-                    * The threads created by this method have not been started.
-                        Use "startThreads" to start them.
+def extractFromPackageFile(packagePath):
+    '''
+        extractFromPackageFile - Extract the file list from a local package file.
 
-        '''
-        global MAX_EXTRA_URLS
+          The file is memory-mapped, and only the leading compressed blocks are decoded,
+           until the end of the .MTREE ( @see MtreeStreamDecoder ). If the short-read fails,
+           the whole package is decoded with the tar module.
 
+          This is run in a worker process, by indexLocalPackages
 
-        numThreads = self.numThreads
-        allPackageInfos = self.allPackageInfos
-        repoUrls = self.repoUrls
-        resultsRef = self.resultsRef
-        failedPackageInfos = self.failedPackageInfos
-        shortFetchSize = self.shortFetchSize
+          @param packagePath <str> - Path to the package
 
-        timeout = self.timeout
-        longTimeout = self.longTimeout
-        isVerbose = self.isVerbose
-        isSuperVerbose = self.isSuperVerbose
+          @return tuple< list<str>, int/None > - The files, and the compressed offset at which the .MTREE ended
+    '''
+    with open(packagePath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+    try:
+        decoder = MtreeStreamDecoder()
+        mmSize = len(mm)
+        offset = 0
+        try:
+            while offset < mmSize:
+                if decoder.feed( mm[offset : offset + LOCAL_READ_STEP_SIZE] ):
+                    break
+                offset += LOCAL_READ_STEP_SIZE
+        except RetryWithFullTarException:
+            pass
 
-        threads = []
+        if decoder.isDone:
+            compressedData = decoder.mtreeData
+            mtreeOffset = decoder.compressedBytesFed
+        else:
+            (compressedData, mtreeOffset) = getMtreeFromFullTar(mm[:])
+    finally:
+        mm.close()
 
-        if numThreads > 1:
-            numPackages = len(allPackageInfos)
+    return (getFilenamesFromCompressedMtree(compressedData), mtreeOffset)
 
-            if numPackages < numThreads:
-                if isVerbose:
-                    print ( "Less packages than threads! Shrinking number of threads to %d.." %(numThreads, ))
-                numThreads = numPackages
-            # Split up for threads with primary repo being the Nth repo, and any extra repos not
-            #  assigned to a thread get appended as extras. At the bottom we will single-thread
-            #  in error mode with all repos and a super-long timeout.
-            splitPackages = []
-            numPerEach = numPackages // numThreads
-            for i in range(numThreads):
-                if i == numThreads - 1:
-                    splitPackages.append( allPackageInfos[ (numPerEach * i) : ] )
-                else:
-                    splitPackages.append( allPackageInfos[ (numPerEach * (i)) : (numPerEach * (i+1)) ] )
 
-            if numThreads > 1:
-                print ( "Starting %d threads...\n" %(numThreads,))
+def indexLocalPackages(packageInfos, packagePaths, results, failedPackageInfos, numWorkers=None, isVerbose=False):
+    '''
+        indexLocalPackages - Extract the file lists of local packages, spread across a pool of processes
 
-            for i in range(numThreads):
-                packageSet = splitPackages[i]
-                if isVerbose:
-                    print ( "Thread %d primary repo: %s" %(i, repoUrls[i]) )
-                    print ( "Thread %d will handle %d packages." %( i, len(packageSet) ) )
-                myRepoUrls = [ repoUrls[i] ] + repoUrls[numThreads : numThreads + MAX_EXTRA_URLS]
+          @param packageInfos list< tuple<str, str, str> > - Package infos to index ( @see getLocalPackages )
 
-                thisThread = RunnerWorker(packageSet, resultsRef, failedPackageInfos, myRepoUrls, shortFetchSize=shortFetchSize, timeout=timeout, longTimeout=longTimeout, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose)
-                threads.append(thisThread)
-        else:
-            print ( "Starting 1 thread for %d packages...\n" %( len(allPackageInfos), ) )
-            thisThread = RunnerWorker(allPackageInfos, resultsRef, failedPackageInfos, repoUrls, shortFetchSize=shortFetchSize, timeout=timeout, longTimeout=longTimeout, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose)
-            threads.append(thisThread)
+          @param packagePaths dict<str, str> - Map of package name -> package file path
 
+          @param results <dict> - The results dict. A record is added for each package.
 
-        return threads
+          @param failedPackageInfos list - Failed package infos are appended here
 
-    def _startThreads(self, startOffset=.35):
-        '''
-            startThreads - Start a list of threads, with a given offset between starts.
-                The offset is meant to balance out the network bandwidth requirements,
-                 to ensure that we are maxing bandwidth as much as possible.
-                With short reads, threads would otherwise all be doing network I/O followed
-                  by local I/O at the same time.
+          @param numWorkers <None/int> default None - Number of processes, or None for number of cpus
 
-              @param threads list<threading.Thread> - Threads to start
+          @param isVerbose <bool> default False - Print each package as it completes
+    '''
+    numWorkers = max(1, min(numWorkers or os.cpu_count() or 1, len(packageInfos)))
 
-              @param startOffset <float> - Offset between thread starts
+    print ( "Indexing %d local packages with %d processes...\n" %(len(packageInfos), numWorkers) )
 
-        '''
-        for thisThread in self.threads:
-            thisThread.start()
-            time.sleep(startOffset)
+    with concurrent.futures.ProcessPoolExecutor(numWorkers) as executor:
+        futures = { executor.submit(extractFromPackageFile, packagePaths[packageInfo[1]]) : packageInfo for packageInfo in packageInfos }
 
+        for future in concurrent.futures.as_completed(futures):
+            (repoName, packageName, packageVersion) = futures[future]
+            try:
+                (files, mtreeOffset) = future.result()
+            except Exception as e:
+                failedPackageInfos.append( (repoName, packageName, packageVersion) )
+                errStr = 'Error processing %s - %s : < %s >: %s\n\n' %(repoName, packageName, e.__class__.__name__, str(e))
+                sys.stderr.write(errStr)
+                results[packageName] = { 'files' : [], 'version' : packageVersion, 'error' : errStr }
+                continue
 
-    def _joinThreads(self):
-        '''
-            joinThreads - Wait for all threads to complete, 
-                            or shut them down gracefully following control+c
+            results[packageName] = { 'files' : files, 'version' : packageVersion, 'error' : None, 'mtreeOffset' : mtreeOffset }
+            if isVerbose:
+                sys.stdout.write("Got %d files for %s.\n" %(len(files), packageName ))
 
-              @param threads list<threading.Thread> - Threads to join
 
-              @return <bool> - True if threads were joined successfully,
-                                False if KeyboardInterrupt caused them to be
-                                stopped
-              
-              TODO: Handle sigterm as well, same as KeyboardInterrupt
-        '''
-        threads = self.threads
+# ENGINES - Supported values for --engine=
+ENGINES = ('threads', 'asyncio', 'pipeline')
 
-        try:
-            for thread in threads:
-                thread.join()
+def createRunner(engine, numWorkers, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, **kwargs):
+    '''
+        createRunner - Create the runner for the given engine
 
-            return True
-        except KeyboardInterrupt as ke:
-            sys.stderr.write ( "\n\nCAUGHT KEYBOARD INTERRUPT, CLOSING DOWN THREADS...\n\n")
-            sys.stderr.flush()
-            # Raise keyboard interrupt in each thread to make them terminate
-            for thread in threads:
-                thread._stopThread(KeyboardInterrupt)
+          @param engine <str> - One of ENGINES
 
-            # Try real quick to cleanup, they are daemon threads so they will be
-            #   terminated at end of program forcibly if required
-            time.sleep(.1)
+          @param numWorkers <int> - Number of threads (threads engine), in-flight packages (asyncio engine),
+            or fetch threads (pipeline engine)
 
-            for thread in threads:
-                thread.join(.05)
+          Other arguments and #kwargs are passed to the Runner / AsyncRunner / PipelineRunner
 
-            return False
+          @return <Runner/AsyncRunner/PipelineRunner> - The runner. Call .run to begin execution.
+    '''
+    if engine == 'asyncio':
+        return AsyncRunner(numWorkers, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, **kwargs)
+    if engine == 'pipeline':
+        return PipelineRunner(numWorkers, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, **kwargs)
+
+    return Runner(numWorkers, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, **kwargs)
 
 
 def prompt(promptMsg, allowedResults=None, tryAgainMsg=None):
@@ -1414,6 +4206,59 @@ def prompt(promptMsg, allowedResults=None, tryAgainMsg=None):
     return result
 
 
+def trimUnchangedPackages(allPackageInfos, oldResults, results, forceOldUpdate=False, isVerbose=False):
+    '''
+        trimUnchangedPackages - Get the packages which need to be updated, compared to the old database.
+
+          Packages at the same version as in the old database are copied into #results as-is.
+
+          @param allPackageInfos list< tuple<str, str, str> > - All package infos ( repo, name, version )
+
+          @param oldResults <dict> - The packages in the old database ( see readDatabase )
+
+          @param results <dict> - The new results. Unchanged packages are added (without their files).
+
+          @param forceOldUpdate <bool> default False - If True, update packages even if the version is older than in the old database
+
+          @param isVerbose <bool> default False - Print more output
+
+          @return list< tuple<str, str, str> > - The package infos which need to be updated
+    '''
+    newPackagesInfo = []
+    for packageInfo in allPackageInfos:
+        pkgName = packageInfo[1]
+        pkgVersion = packageInfo[2]
+
+        if pkgName not in oldResults:
+            # New package
+            newPackagesInfo.append(packageInfo)
+            continue
+
+        if oldResults[pkgName]['version'] == pkgVersion:
+            results[pkgName] = oldResults[pkgName]
+        else:
+            if not canCompareVersions:
+                newPackagesInfo.append(packageInfo)
+            elif forceOldUpdate:
+                if isVerbose is True:
+                    oldVersion = VersionString(oldResults[pkgName]['version'])
+                    newVersion = VersionString(pkgVersion)
+                    if newVersion < oldVersion:
+                        sys.stderr.write('WARNING: Package %s - %s has an older version!  new = "%s"  < current = "%s" ! Did primary repo change to an older mirror? Doing anyway, because of --force-old-update\n' %(packageInfo[0], pkgName, str(newVersion), str(oldVersion)))
+
+                newPackagesInfo.append(packageInfo)
+            else:
+                oldVersion = VersionString(oldResults[pkgName]['version'])
+                newVersion = VersionString(pkgVersion)
+
+                if newVersion >= oldVersion:
+                    newPackagesInfo.append(packageInfo)
+                else:
+                    sys.stderr.write('WARNING: Package %s - %s has an older version!  new = "%s"  < current = "%s" ! Did primary repo change to an older mirror? Skipping... (use --force-old-update to do anyway)\n' %(packageInfo[0], pkgName, str(newVersion), str(oldVersion)))
+
+    return newPackagesInfo
+
+
 def printUsage():
     sys.stderr.write('''Usage: extractMtree.py (options)
   Downloads and extracts the file list from the repo.
@@ -1421,20 +4266,54 @@ def printUsage():
     Options:
 
        --single-thread           Use one thread.
-       --threads=N               Use N threads (Max at number of repos)
-       --convert                 ONLY convert the old database to the new version
+       --threads=N               Use N threads (Max at number of repos * per-mirror)
+       --per-mirror=N            Allow up to N concurrent fetches from each mirror
+                                  (default %d, or %d with --engine=asyncio)
+
+       --engine=ENGINE           Fetch engine to use. One of: %s  (default threads)
+                                   threads - A pool of threads, each doing one package at a time
+                                   asyncio - Many packages in flight on one event loop, decoding
+                                              on a small thread pool. http(s) mirrors only.
+                                   pipeline - Fetch threads feed a pool of decode processes,
+                                              so decoding uses every core.
+       --tasks=N                 With --engine=asyncio, max packages in flight (default %d)
+       --decode-workers=N        With --engine=asyncio or pipeline (or --from-dir), number of decode threads / processes
+                                  (default number of cpus)
+       --decode-queue=N          With --engine=pipeline, max fetched packages waiting to decode
+                                  (default %d per decode process). Use -v to see queue depths.
+
+       --from-files-db           Build from the local pacman files databases ( pacman -Fy ,
+                                  %s/*.files ) instead of fetching
+                                  from mirrors. Takes seconds, and no mirror traffic.
+
+       --from-dir=DIR            Index the packages in a local directory (e.x. /var/cache/pacman/pkg or
+                                  a repo tree you host), using all cores ( see --decode-workers ).
+                                  The newest version of each package is used.
+       --db-file=PATH            Read and write the providesDB at PATH instead of
+                                  %s
+
+       --compress=CODEC(:LEVEL)  Block-compress the database with CODEC: none, %s (default: the same
+                                  as the existing database, or none). The whole database is written.
+                                  Smaller on disk, but each lookup decompresses a block.
+       --compress-threads=N      Number of threads compressing the database (default number of cpus)
+
+       --convert                 ONLY convert the old database to the new version (or with --compress,
+                                  rewrite it compressed that way)
+       --compact                 ONLY fold the segments of the database (written by each update)
+                                  into the base. Runs in the background automatically after an update
+                                  leaves more than %d segments.
 
        --force-old-update        Force update on different versions, even if older
 
        -v                        Verbose (lots of extra output, default is very little)
        -vv                       Super Verbose - will show super verbose info
-                                  (e.x. progress bars for curl)
+                                  (e.x. each http request, progress bars for curl)
                                  This can get VERY messy if threads > 1
 
       --version                  Print application version, supported database versions, and exit
       --help                     Show this message and exit
 
-''')
+''' %( MAX_PER_MIRROR, ASYNC_MAX_PER_MIRROR, ', '.join(ENGINES), ASYNC_MAX_TASKS, PIPELINE_DECODE_QUEUE_FACTOR, PACMAN_SYNC_DIR, PROVIDES_DB_LOCATION, ', '.join( sorted(pacmanProvidesDB.COMPRESSION_CODECS.keys()) ), pacmanProvidesDB.MAX_SEGMENTS ))
 
 if __name__ == '__main__':
     # NOTE: This uses a LOT of memory, so we delete and garbage collect
@@ -1447,11 +4326,22 @@ if __name__ == '__main__':
     ######## HANDLE ARGUMENTS
     #############################
     convertOnly = False
+    compactOnly = False
+    fromFilesDb = False
+    # localDir - With --from-dir , the directory of packages to index
+    localDir = None
     isVerbose = False
     isSuperVerbose = False
 
     forceOldUpdate = False
 
+    engine = 'threads'
+    numTasks = ASYNC_MAX_TASKS
+    # engineKwargs - Extra arguments for the asyncio / pipeline runners
+    engineKwargs = {}
+    # setPerMirror - If --per-mirror was given. Otherwise the default depends on the engine.
+    setPerMirror = False
+
     args = sys.argv[1:]
 
     if '--help' in args or '-h' in args:
@@ -1489,9 +4379,79 @@ if __name__ == '__main__':
                 sys.stderr.write('Defined both a > 1 number of threads AND --single-thread. Pick one.\n\n')
                 sys.exit(1)
             args.remove(arg)
+        elif arg.startswith('--per-mirror='):
+            try:
+                MAX_PER_MIRROR = int(arg[ len('--per-mirror=') : ])
+                if MAX_PER_MIRROR < 1:
+                    raise ValueError('Must be at least 1')
+            except:
+                sys.stderr.write('Number per mirror must be a positive digit! Problem with arg:   "%s"\n\n' %(arg, ))
+                sys.exit(1)
+            setPerMirror = True
+            args.remove(arg)
+        elif arg.startswith('--engine='):
+            engine = arg[ len('--engine=') : ]
+            if engine not in ENGINES:
+                sys.stderr.write('Unknown engine "%s". Must be one of: %s\n\n' %(engine, ', '.join(ENGINES)))
+                sys.exit(1)
+            args.remove(arg)
+        elif arg.startswith('--tasks='):
+            try:
+                numTasks = int(arg[ len('--tasks=') : ])
+                if numTasks < 1:
+                    raise ValueError('Must be at least 1')
+            except:
+                sys.stderr.write('Number of tasks must be a positive digit! Problem with arg:   "%s"\n\n' %(arg, ))
+                sys.exit(1)
+            args.remove(arg)
+        elif arg.startswith( ('--decode-workers=', '--decode-queue=') ):
+            (argName, argValue) = arg.split('=', 1)
+            try:
+                argValue = int(argValue)
+                if argValue < 1:
+                    raise ValueError('Must be at least 1')
+            except:
+                sys.stderr.write('%s must be a positive digit! Problem with arg:   "%s"\n\n' %(argName, arg))
+                sys.exit(1)
+            if argName == '--decode-workers':
+                engineKwargs['numDecodeWorkers'] = argValue
+            else:
+                engineKwargs['decodeQueueSize'] = argValue
+            args.remove(arg)
         elif arg == '--convert':
             convertOnly = True
             args.remove(arg)
+        elif arg == '--compact':
+            compactOnly = True
+            args.remove(arg)
+        elif arg == '--from-files-db':
+            fromFilesDb = True
+            args.remove(arg)
+        elif arg.startswith('--from-dir='):
+            localDir = arg[ len('--from-dir=') : ]
+            if not os.path.isdir(localDir):
+                sys.stderr.write('--from-dir: "%s" is not a directory.\n\n' %(localDir, ))
+                sys.exit(1)
+            args.remove(arg)
+        elif arg.startswith('--db-file='):
+            PROVIDES_DB_LOCATION = arg[ len('--db-file=') : ]
+            args.remove(arg)
+        elif arg.startswith('--compress='):
+            try:
+                PROVIDES_DB_COMPRESSION = pacmanProvidesDB.parseCompression( arg[ len('--compress=') : ] )
+            except pacmanProvidesDB.ProvidesDBException as e:
+                sys.stderr.write('%s\n\n' %(str(e), ))
+                sys.exit(1)
+            args.remove(arg)
+        elif arg.startswith('--compress-threads='):
+            try:
+                COMPRESS_THREADS = int(arg[ len('--compress-threads=') : ])
+                if COMPRESS_THREADS < 1:
+                    raise ValueError('Must be at least 1')
+            except:
+                sys.stderr.write('Number of compress threads must be a positive digit! Problem with arg:   "%s"\n\n' %(arg, ))
+                sys.exit(1)
+            args.remove(arg)
         elif arg == '--force-old-update':
             forceOldUpdate = True
             args.remove(arg)
@@ -1506,15 +4466,76 @@ if __name__ == '__main__':
         sys.stderr.write('Unknown arguments: %s\n' %(str(args), ))
         sys.exit(1)
 
+    if engine == 'asyncio' and not setPerMirror:
+        MAX_PER_MIRROR = ASYNC_MAX_PER_MIRROR
+
+    if compactOnly:
+        if PROVIDES_DB_COMPRESSION != KEEP_COMPRESSION:
+            sys.stderr.write('--compact keeps the compression of the database. Use --convert with --compress to change it.\n\n')
+            sys.exit(1)
+
+        try:
+            numSegments = pacmanProvidesDB.compactProvidesDB(PROVIDES_DB_LOCATION, compressThreads=COMPRESS_THREADS)
+        except Exception as e:
+            sys.stderr.write('Failed to compact "%s".  %s:  %s\n\n' %(PROVIDES_DB_LOCATION, e.__class__.__name__, str(e)))
+            sys.exit(4)
+
+        sys.stdout.write('Folded %d segments into "%s".\n' %(numSegments, PROVIDES_DB_LOCATION))
+        sys.exit(0)
+
+    if fromFilesDb and localDir:
+        sys.stderr.write('Cannot use both --from-files-db and --from-dir. Pick one.\n\n')
+        sys.exit(1)
+
+    if localDir:
+        if 'decodeQueueSize' in engineKwargs:
+            sys.stderr.write('--decode-queue requires --engine=pipeline\n\n')
+            sys.exit(1)
+    elif engine == 'threads' and engineKwargs:
+        sys.stderr.write('--decode-workers and --decode-queue require --engine=asyncio or --engine=pipeline (or --from-dir)\n\n')
+        sys.exit(1)
+    elif engine == 'asyncio' and 'decodeQueueSize' in engineKwargs:
+        sys.stderr.write('--decode-queue requires --engine=pipeline\n\n')
+        sys.exit(1)
+
     ##############################################
     ######## READ PACKAGE LIST AND OLD DB
     ########################################
 
-    if not convertOnly:
-        refreshPacmanDatabase()
+    if fromFilesDb:
+        if not convertOnly:
+            refreshPacmanFilesDatabase()
+
+        try:
+            (allPackageInfos, filesDbPackageFiles) = getPackagesFromFilesDatabases()
+        except Exception as e:
+            sys.stderr.write('Failed to read files databases from "%s" ( %s: %s ). Try running pacman -Fy\n\n' %(PACMAN_SYNC_DIR, e.__class__.__name__, str(e)))
+            sys.exit(1)
+
+        if not allPackageInfos:
+            sys.stderr.write('No packages found in files databases at "%s/*.files". Try running pacman -Fy\n\n' %(PACMAN_SYNC_DIR, ))
+            sys.exit(1)
+
+        packageFilenames = {}
+    elif localDir:
+        (allPackageInfos, localPackagePaths) = getLocalPackages(localDir)
+        if not allPackageInfos:
+            sys.stderr.write('No packages found in "%s".\n\n' %(localDir, ))
+            sys.exit(1)
+
+        packageFilenames = {}
+    else:
+        if not convertOnly:
+            refreshPacmanDatabase()
+
+#        allPackageInfos = [ ('core', 'binutils', '2.28.0-2') ]
+        allPackageInfos = getAllPackagesInfo()
 
-#    allPackageInfos = [ ('core', 'binutils', '2.28.0-2') ]
-    allPackageInfos = getAllPackagesInfo()
+        try:
+            packageFilenames = getPackageFilenames()
+        except Exception as e:
+            sys.stderr.write('WARNING: Cannot read package filenames from sync databases in "%s" ( %s: %s ). Will guess filenames.\n' %(PACMAN_SYNC_DIR, e.__class__.__name__, str(e)))
+            packageFilenames = {}
 
     results = {}
     resultsRef = RefObj(results)
@@ -1522,44 +4543,39 @@ if __name__ == '__main__':
 
     sys.stdout.write('Read %d total packages.\n' %( len(allPackageInfos), ))
 
-    priorDBContents = None
-    try:
-        with open(PROVIDES_DB_LOCATION, 'rb') as f:
-            priorDBContents = f.read()
-    except:
+    # unchangedPackageNames / oldPackageNames - The packages which are unchanged from (and all those in) the old database,
+    #   so just the changes need to be written, or the unchanged records read from it ( see writeDatabase )
+    unchangedPackageNames = None
+    oldPackageNames = None
+
+    # mtreeOffsets - Where the .MTREE ended in the prior version of each package, to size the short-reads
+    mtreeOffsets = {}
+
+    hasPriorDB = os.access(PROVIDES_DB_LOCATION, os.R_OK) and os.path.getsize(PROVIDES_DB_LOCATION) > 0
+    if not hasPriorDB:
         sys.stderr.write('WARNING: Cannot read old Provides DB at "%s". Will query every package (instead of just updates)\n' %(PROVIDES_DB_LOCATION, ))
 
-    if priorDBContents:
+    if hasPriorDB:
         ####################################################
         ## Figure out which packages actually need update
         ##  and/or convert database format
         #####################################
-        priorDBContents = gzip.decompress(priorDBContents)
-
         try:
-            oldResults = json.loads(priorDBContents)
-            sys.stdout.write('Read %d records from old database. Trimming non-updates...\n' %(len(oldResults) - 1, ))
-
-            if '__vers' in oldResults:
-                oldVersion = oldResults.pop('__vers')
-            else:
-                # TEMP: Assume for now old version is 0.1 because it did not have a __vers marker.
-                #   TODO: In a later version of extractedMtree, remove this assumption
-                oldVersion = '0.1'
+            # oldResults - The packages in the old database, without their files ( see readDatabase )
+            (oldVersion, oldResults) = readDatabase(PROVIDES_DB_LOCATION)
+            sys.stdout.write('Read %d records from old database. Trimming non-updates...\n' %(len(oldResults), ))
 
             if oldVersion not in SUPPORTED_DATABASE_VERSIONS:
                 raise FailedToConvertDatabaseException('Unsupported database version: ' + oldVersion)
 
-            # Try to convert old database to new format
-            convertOldDatabase(oldVersion, oldResults)
-
             if convertOnly:
-                if oldVersion == LATEST_FILE_FORMAT:
+                if oldVersion == LATEST_FILE_FORMAT and PROVIDES_DB_COMPRESSION == KEEP_COMPRESSION:
                     sys.stderr.write('No need to update, already at latest version.\n')
                     sys.exit(0)
 
                 try:
-                    writeDatabase(oldResults)
+                    # Every package is copied from the old database, converting each record as it is read
+                    writeDatabase({}, set(oldResults.keys()))
                 except Exception as e:
                     exc_info = sys.exc_info()
                     sys.stderr.write('Failed to write database.  %s:  %s\n\n' %(e.__class__.__name__, str(e)))
@@ -1570,40 +4586,13 @@ if __name__ == '__main__':
                 sys.exit(0)
 
 
-            # Assmemble new package info list, including only the packages we need to update
-            newPackagesInfo = []
-            for packageInfo in allPackageInfos:
-                pkgName = packageInfo[1]
-                pkgVersion = packageInfo[2]
-
-                if pkgName not in oldResults:
-                    # New package
-                    newPackagesInfo.append(packageInfo)
-                    continue
-
-                if oldResults[pkgName]['version'] == pkgVersion:
-                    results[pkgName] = oldResults[pkgName]
-                else:
-                    if not canCompareVersions:
-                        newPackagesInfo.append(packageInfo)
-                    elif forceOldUpdate:
-                        if isVerbose is True:
-                            oldVersion = VersionString(oldResults[pkgName]['version'])
-                            newVersion = VersionString(pkgVersion)
-                            if newVersion < oldVersion:
-                                sys.stderr.write('WARNING: Package %s - %s has an older version!  new = "%s"  < current = "%s" ! Did primary repo change to an older mirror? Doing anyway, because of --force-old-update\n' %(packageInfo[0], pkgName, str(newVersion), str(oldVersion)))
-
-                        newPackagesInfo.append(packageInfo)
-                    else:
-                        oldVersion = VersionString(oldResults[pkgName]['version'])
-                        newVersion = VersionString(pkgVersion)
-
-                        if newVersion >= oldVersion:
-                            newPackagesInfo.append(packageInfo)
-                        else:
-                            sys.stderr.write('WARNING: Package %s - %s has an older version!  new = "%s"  < current = "%s" ! Did primary repo change to an older mirror? Skipping... (use --force-old-update to do anyway)\n' %(packageInfo[0], pkgName, str(newVersion), str(oldVersion)))
+            mtreeOffsets = { pkgName : pkgRecord['mtreeOffset'] for pkgName, pkgRecord in oldResults.items() if pkgRecord.get('mtreeOffset') }
 
+            # Assmemble new package info list, including only the packages we need to update
+            newPackagesInfo = trimUnchangedPackages(allPackageInfos, oldResults, results, forceOldUpdate, isVerbose)
 
+            unchangedPackageNames = set(results.keys())
+            oldPackageNames = set(oldResults.keys())
 
             allPackageInfos = newPackagesInfo
             sys.stdout.write('\nTrimmed number of updates required to %d\n\n' %(len(allPackageInfos), ))
@@ -1614,11 +4603,10 @@ if __name__ == '__main__':
         except Exception as e:
             sys.stderr.write('Error reading old database (will perform a full update):  %s:  %s\n' %( e.__class__.__name__, str(e)))
         finally:
-            del priorDBContents
             gc.collect()
 
 
-    if convertOnly: # end if priorDBContents
+    if convertOnly: # end if hasPriorDB
         sys.stderr.write('Asked to convert old database, but could not read successfully from "%s"\n' %(PROVIDES_DB_LOCATION, ))
         sys.exit(3)
 
@@ -1628,7 +4616,10 @@ if __name__ == '__main__':
         sys.exit(0)
 
 
-    if not os.access(PROVIDES_DB_LOCATION, os.W_OK):
+    # The new database is written alongside and renamed over the old one, so need to be able to write to the directory
+    canWriteDB = os.access(os.path.dirname(os.path.abspath(PROVIDES_DB_LOCATION)), os.W_OK)
+
+    if not canWriteDB:
         sys.stdout.write('Cannot write to "%s". Will create temp file.\n' %((PROVIDES_DB_LOCATION, )) )
         result = False
         while result not in ('y', 'n'):
@@ -1639,12 +4630,41 @@ if __name__ == '__main__':
         if result == 'n':
             sys.exit(2)
 
+    if fromFilesDb:
+        ##############################################
+        ######## Fill in from the files databases
+        ##########################################
+        for (repoName, packageName, packageVersion) in allPackageInfos:
+            results[packageName] = { 'files' : filesDbPackageFiles[packageName], 'version' : packageVersion, 'error' : None }
+
+        del filesDbPackageFiles
+        results['__vers'] = LATEST_FILE_FORMAT
+
+        writeDatabase(results, unchangedPackageNames, oldPackageNames)
+        print ( "\n\nSuccess.\nDatabase size: %d\n" %(len(results) - 1, ))
+        sys.exit(0)
+
+    if localDir:
+        ##############################################
+        ######## Index the local packages
+        ##########################################
+        failedPackageInfos = []
+        indexLocalPackages(allPackageInfos, localPackagePaths, results, failedPackageInfos, engineKwargs.get('numDecodeWorkers'), isVerbose)
+        if failedPackageInfos:
+            sys.stderr.write('Failed to index %d packages: %s\n\n' %(len(failedPackageInfos), str([failedP[1] for failedP in failedPackageInfos])))
+
+        results['__vers'] = LATEST_FILE_FORMAT
+
+        writeDatabase(results, unchangedPackageNames, oldPackageNames)
+        print ( "\n\nSuccess.\nDatabase size: %d\n" %(len(results) - 1, ))
+        sys.exit(0)
+
 
     if 'REPO_URLS' in locals():
         print ( "USING PREDEFINED REPO")
         repoUrls = REPO_URLS
     else:
-        repoUrls = getRepoUrls()
+        repoUrls = getRepoUrls( max(MAX_REPOS, MAX_THREADS) )
 
     print ( "Using repos from /etc/pacman.d/mirrorlist:\n\t%s\n" %(repoUrls, ))
 
@@ -1665,22 +4685,28 @@ if __name__ == '__main__':
         sys.stderr.write('No uncommented repos in /etc/pacman.d/mirrorlist !\n\n')
         sys.exit(1)
 
-    if numRepos < MAX_THREADS:
-        sys.stdout.write('WARNING: Number of available repos [ %d ] is less than the configured number' %(numRepos, ) +\
+    if engine == 'asyncio':
+        # Concurrency is bounded per mirror by the engine itself, no need to shrink anything
+        numThreads = numTasks
+    elif numRepos * MAX_PER_MIRROR < MAX_THREADS:
+        sys.stdout.write('WARNING: Number of available repos [ %d ] times the number of fetches per mirror [ %d ] is less than the configured number' %(numRepos, MAX_PER_MIRROR ) +\
             ' of threads [%d].\nRecommended to uncomment more repos. See --help for changing nubmer of threads.\n\n' %(MAX_THREADS, ))
 
-        shrinkThreads = prompt("\nLimit threads to %d and continue? (y/n): " %(numRepos, ), ('y', 'Y', 'n', 'N'))
+        shrinkThreads = prompt("\nLimit threads to %d and continue? (y/n): " %(numRepos * MAX_PER_MIRROR, ), ('y', 'Y', 'n', 'N'))
         if shrinkThreads in ('n', 'N'):
             sys.stderr.write('\nAborting based on user input.\n\n')
             sys.exit(1)
 
-        numThreads = numRepos
+        numThreads = numRepos * MAX_PER_MIRROR
     else:
         numThreads = MAX_THREADS
 
     numPackages = len(allPackageInfos)
 
-    runner = Runner(numThreads, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose)
+    # mirrorHealth - Shared by all runs, so mirrors which did badly are avoided on the retries
+    mirrorHealth = MirrorHealth()
+
+    runner = createRunner(engine, numThreads, allPackageInfos, repoUrls, resultsRef, failedPackageInfos, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose, mtreeOffsets=mtreeOffsets, maxPerMirror=MAX_PER_MIRROR, mirrorHealth=mirrorHealth, packageFilenames=packageFilenames, **engineKwargs)
     runner.run()
 
     del allPackageInfos
@@ -1707,7 +4733,7 @@ if __name__ == '__main__':
             #   slow mirror, etc.
             newFailedPackageInfos = []
 
-            runner = Runner(numThreads, failedPackageInfos, repoUrls, resultsRef, newFailedPackageInfos, timeout=LONG_TIMEOUT, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose)
+            runner = createRunner(engine, numThreads, failedPackageInfos, repoUrls, resultsRef, newFailedPackageInfos, timeout=LONG_TIMEOUT, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose, mtreeOffsets=mtreeOffsets, maxPerMirror=MAX_PER_MIRROR, mirrorHealth=mirrorHealth, packageFilenames=packageFilenames, **engineKwargs)
             runner.run()
 
             del failedPackageInfos
@@ -1729,6 +4755,10 @@ if __name__ == '__main__':
                     oldVersions = { packageInfo[1] : packageInfo[2] for packageInfo in newFailedPackageInfos }
 
                     newPackagesInfo = getAllPackagesInfo()
+                    try:
+                        packageFilenames.update( getPackageFilenames() )
+                    except Exception:
+                        pass
 
                     # Get a list of any packages that have updated since we started, and retry them
                     updatedPackages = [packageInfo for packageInfo in newPackagesInfo if packageInfo[1] in oldVersions and oldVersions[packageInfo[1]] != packageInfo[2]]
@@ -1737,7 +4767,7 @@ if __name__ == '__main__':
                     # Will try every mirror
                     stillFailedPackageInfos = []
 
-                    runner = Runner(1, updatedPackages, repoUrls, resultsRef, stillFailedPackageInfos, timeout=LONG_TIMEOUT, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose)
+                    runner = createRunner(engine, 1, updatedPackages, repoUrls, resultsRef, stillFailedPackageInfos, timeout=LONG_TIMEOUT, isVerbose=isVerbose, isSuperVerbose=isSuperVerbose, mtreeOffsets=mtreeOffsets, maxPerMirror=MAX_PER_MIRROR, mirrorHealth=mirrorHealth, packageFilenames=packageFilenames, **engineKwargs)
                     runner.run()
 
                     # Append the failed packages we didn't retry
@@ -1753,13 +4783,16 @@ if __name__ == '__main__':
             # END: if newFailedPackageInfos
 
 
+        if isVerbose:
+            sys.stdout.write('\n' + mirrorHealth.formatReport() + '\n')
+
         ##############################################
         ######## Write resulting database to file
         ########################################
         results['__vers'] = LATEST_FILE_FORMAT
 
 
-        writeDatabase(results)
+        writeDatabase(results, unchangedPackageNames, oldPackageNames)
 
         pass
         #import pdb; pdb.set_trace()
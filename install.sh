@@ -3,7 +3,13 @@
 # Installs all the pacman-utils
 #  use ./install.sh PREFIX=$HOME to install to local home dir.
 
-BIN_FILES="installpackage archsrc-buildpkg whatprovides whatprovides_upstream mkgcdatar getpkgs abs2 archsrc-getpkg pacman-mirrorlist-optimize extractMtree.py aur-getpkg aur-buildpkg findgcda"
+BIN_FILES="installpackage archsrc-buildpkg whatprovides whatprovides_local whatprovides_upstream whatprovides_elf mkgcdatar getpkgs abs2 archsrc-getpkg pacman-mirrorlist-optimize extractMtree.py aur-getpkg aur-buildpkg findgcda"
+
+# PY_LIB_FILES - Python modules shared by the programs, installed to site-packages
+PY_LIB_FILES="pacmanProvidesDB.py"
+
+# ALPM_HOOK_FILES - pacman hooks, installed to share/libalpm/hooks
+ALPM_HOOK_FILES="whatprovides.hook"
 
 process_installdir_args() {
 
@@ -92,6 +98,26 @@ mkdir -p "${BINDIR}"
 
 install -v -m 755 ${BIN_FILES} "${BINDIR}" || failed_install 1 "Install programs to '${BINDIR}'"
 
+PYLIBDIR="$(python -c 'import sys, sysconfig; sys.stdout.write(sysconfig.get_path("purelib", vars={ "base" : sys.argv[1] }))' "/${PREFIX}")"
+[ -z "${PYLIBDIR}" ] && failed_install 1 "Find python site-packages"
+PYLIBDIR="$(echo "${DESTDIR}/${PYLIBDIR}" | sed 's|//*|/|g')"
+
+mkdir -p "${PYLIBDIR}"
+
+install -v -m 644 ${PY_LIB_FILES} "${PYLIBDIR}" || failed_install 1 "Install python modules to '${PYLIBDIR}'"
+
+# pacman only reads hooks from /usr/share/libalpm/hooks (and /etc/pacman.d/hooks), so these are only used with the default PREFIX
+HOOKDIR="$(echo "${DESTDIR}/${PREFIX}/share/libalpm/hooks" | sed 's|//*|/|g')"
+
+mkdir -p "${HOOKDIR}"
+
+for hookFile in ${ALPM_HOOK_FILES};
+do
+    # Point the hook at where the programs were installed
+    sed "s|/usr/bin/|$(echo "/${PREFIX}/bin/" | sed 's|//*|/|g')|g" "${hookFile}" > "${HOOKDIR}/${hookFile}" && chmod 644 "${HOOKDIR}/${hookFile}" || failed_install 1 "Install pacman hook to '${HOOKDIR}'"
+    echo "'${hookFile}' -> '${HOOKDIR}/${hookFile}'"
+done
+
 cd "${BINDIR}"
 rm -f archsrc-buildpkg.sh buildpkg.sh
 
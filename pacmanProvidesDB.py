@@ -0,0 +1,4027 @@
+#!/usr/bin/env python
+#
+# vim: set ts=4 sw=4 expandtab :
+
+# Copyright (c) 2017 Timothy Savannah - All Rights Reserved
+#   This code is licensed under the terms of the APACHE license version 2.0
+#
+#  pacmanProvidesDB.py - Reads and writes the providesDB, the database of
+#    which files each package provides, created by extractMtree.py
+#    and queried by whatprovides_upstream
+#
+#  Format 0.3 is a binary, memory-mappable file. Nothing is parsed up front,
+#   so a query only touches the pages it needs.
+#
+#   All integers are little-endian.
+#
+#     Header:      magic (8 bytes)  version (8 bytes, nul padded)  numChunks <u32>  segmentGeneration <u32>
+#     Chunk table: numChunks * ( tag (4 bytes)  offset <u64>  size <u64> )
+#
+#   A "string table" is:  count <u32> , ( count + 1 ) * offset <u32> , then the utf-8 strings back-to-back.
+#     String N is data[ offset[N] : offset[N+1] ]
+#
+#   A "front-coded string table" stores sorted strings in blocks of blockSize. The first string of each block is stored
+#     whole, and each string after it as just what differs from the string before it.
+#     count <u32>  blockSize <u32> , ( numBlocks + 1 ) * blockOffset <u32> , then the blocks.
+#     In a block, the first string is:  length <varint>  bytes
+#       and the others are:  sharedPrefixLength <varint>  suffixLength <varint>  suffixBytes
+#     varints are LEB128 ( 7 bits per byte, high bit set if more bytes follow ).
+#
+#   An "id list table" (CSR - compressed sparse row) is:  count <u32> , ( count + 1 ) * index <u32> , then ids <u32>.
+#     List N is ids[ index[N] : index[N+1] ]
+#
+#   Chunks:
+#
+#     "STRS" - String pool. Nul-terminated utf-8 strings (package names, versions, errors)
+#
+#     "PKGS" - Package table, sorted by name.
+#                numPackages <u32> , then per package:
+#                  nameOffset <u32>  versionOffset <u32>  errorOffset <u32>  mtreeOffset <u32>
+#                String offsets are into "STRS". errorOffset is NO_STRING if no error,
+#                  mtreeOffset is 0 if unknown.
+#
+#     "FPTH" - Path table. Front-coded string table of every path provided by any package, deduplicated and sorted
+#                (by utf-8 bytes). Paths share long directory prefixes, so this is a fraction of their size.
+#
+#     "PATH" - Path table (older files, instead of "FPTH"). Plain string table of the same.
+#
+#     "PPKG" - Id list table of the packages which provide each path
+#
+#     "PPTH" - (optional) Id list table of the paths each package provides, so records can be read one at a time
+#
+#     "HASH" - (optional) Hash index of the path table, so an exact lookup is a few probes.
+#                numBuckets <u32> (a power of 2, at least twice numPaths) , then per bucket:
+#                  pathHash <u32>  pathId + 1 <u32>   ( pathId + 1 of 0 means empty bucket )
+#                pathHash is crc32 of the utf-8 path. Collisions are resolved by linear probing.
+#
+#     "BASE" - (optional) Basename table. String table of the last component of every path, deduplicated and sorted.
+#
+#     "BPTH" - (optional) Id list table of the paths with each basename
+#
+#     "DIRS" - (optional) Directory name table. String table of the last component of every directory
+#                (every path which has anything under it), deduplicated and sorted.
+#
+#     "DRNG" - (optional) Id list table of the subtrees of the directories with each name. Each subtree
+#                is a pair of path ids ( start, end ) - everything under a directory is one range of the path table.
+#
+#     "SONM" - (optional) Soname table. String table of the basenames of the shared libraries (every path directly
+#                in one of LIBRARY_DIRS whose basename ends in ".so" or ".so.N..." ), deduplicated and sorted.
+#
+#     "SPTH" - (optional) Id list table of the library paths with each soname
+#
+#     "TOMB" - (segments only) String table of the names of packages removed, sorted
+#
+#  Block compression (optional):
+#
+#   The path table and the id list tables ( COMPRESSIBLE_CHUNKS ) may be stored block-compressed. The chunk's tag
+#    is then in lower case (e.x. "fpth"), and it is:
+#      codec <u32>  level <i32>  blockSize <u32>  numBlocks <u32>  size <u64> , ( numBlocks + 1 ) * blockOffset <u64> , then the blocks
+#    The chunk (of #size bytes) is cut into blocks of blockSize bytes (the last may be shorter), each compressed on its own
+#    ( codec is the id in COMPRESSION_CODECS ). Block N is the compressed data[ blockOffset[N] : blockOffset[N+1] ],
+#    so a reader decompresses only the blocks it reads. The hash index is read at random, so is never compressed,
+#    and the other chunks are small.
+#
+#  Segments:
+#
+#   An update which changes just some packages appends a segment, "$providesDB.seg.N" , instead of rewriting
+#    the whole database. A segment is a database file holding just the changed package records, and the names
+#    of packages removed. Readers apply the segments newest-first over the base: a package in (or removed by)
+#    a newer segment hides that package in everything older. compactProvidesDB folds the segments into the base.
+#
+#   Segment numbers are never reused. The segmentGeneration in the header of a base is the number of the newest
+#    segment it holds (which was folded into it, or was removed when it was written), and a new segment is numbered
+#    after both that and the segments there are. It is 0 in a segment.
+#
+#   Every file is written to a tempfile and renamed into place. Writers hold a lock ( "$providesDB.lock" ).
+#    Readers do not lock: they open the segments first, then the base. Compaction renames the new base into
+#    place before removing the segments, so a reader either sees the old base with all of its segments, or
+#    the new base. Any segment it opened which is not newer than the new base's segmentGeneration is already
+#    in that base, so is skipped.
+
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import fcntl
+import gzip
+import heapq
+import itertools
+import json
+import lzma
+import mmap
+import os
+import pickle
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from array import array
+
+# zstd - Use the stdlib module if present (python 3.14+), otherwise the "zstandard" module. Only needed for
+#   a database compressed with zstd.
+try:
+    from compression import zstd as zstd_mod
+except ImportError:
+    try:
+        import zstandard as zstd_mod
+    except ImportError:
+        zstd_mod = None
+
+
+__all__ = ( 'DB_FORMAT_VERSION', 'DB_MAGIC', 'ProvidesDBException', 'ProvidesDB', 'ProvidesDBFile', 'isBinaryProvidesDB',
+    'writeProvidesDB', 'appendProvidesDBSegment', 'compactProvidesDB', 'getSegmentFilenames', 'iterLegacyProvidesDB', 'globToRE', 'planGlob',
+    'COMPRESSION_CODECS', 'parseCompression', 'getProvidesDBCompression', 'PACMAN_LOCAL_DIR', 'iterLocalPackageRecords',
+    'getLocalPackageChanges', 'updateLocalProvidesDB', 'LOCAL_CACHE_LOCATIONS', 'localCacheNeedsUpdate', 'localCacheIsWritable', 'getLocalCacheFilename',
+    'openLocalProvidesDB', 'CombinedProvidesDB', 'PROVIDED_INSTALLED', 'PROVIDED_AVAILABLE', 'PROVIDED_BOTH',
+    'LIBRARY_DIRS',
+    'DEFAULT_SOCKET_PATH', 'ProvidesDBServer', 'ProvidesDBClient', 'connectProvidesDBDaemon', 'getProvidesDBGeneration', )
+
+
+# DB_FORMAT_VERSION - The version written by writeProvidesDB, and read by ProvidesDB
+DB_FORMAT_VERSION = '0.3'
+
+# DB_MAGIC - First bytes of a binary providesDB. The older formats (0.1 and 0.2) are gzip'd json
+DB_MAGIC = b'PVDB\x89\r\n\x1a'
+
+# NO_STRING - Offset into the string pool meaning "None"
+NO_STRING = 0xFFFFFFFF
+
+# MAX_UINT32 - Largest value which can be stored in a column
+MAX_UINT32 = 0xFFFFFFFF
+
+CHUNK_STRINGS = b'STRS'
+CHUNK_PACKAGES = b'PKGS'
+CHUNK_PATHS = b'PATH'
+CHUNK_FRONT_CODED_PATHS = b'FPTH'
+CHUNK_PATH_PACKAGES = b'PPKG'
+CHUNK_PACKAGE_PATHS = b'PPTH'
+CHUNK_PATH_HASH = b'HASH'
+CHUNK_BASENAMES = b'BASE'
+CHUNK_BASENAME_PATHS = b'BPTH'
+CHUNK_DIRNAMES = b'DIRS'
+CHUNK_DIRNAME_RANGES = b'DRNG'
+CHUNK_SONAMES = b'SONM'
+CHUNK_SONAME_PATHS = b'SPTH'
+CHUNK_REMOVED_PACKAGES = b'TOMB'
+
+# LIBRARY_DIRS - The directories the dynamic linker searches for a soname. The "SONM" index holds the libraries in these.
+LIBRARY_DIRS = ( '/usr/lib', '/usr/lib32', '/usr/lib64', '/lib', '/lib64' )
+
+# _LIBRARY_DIRS_BYTES - LIBRARY_DIRS, as compared while writing
+_LIBRARY_DIRS_BYTES = frozenset( libDir.encode('utf-8') for libDir in LIBRARY_DIRS )
+
+# _SONAME_RE - Matches the basename of a shared library ( e.x. "libz.so", "libz.so.1.3" , not "libz.so.conf" )
+_SONAME_RE = re.compile(br'\.so(\.[0-9]+)*$')
+
+# SEGMENT_SUFFIX - Segment N of a providesDB is at providesDB + SEGMENT_SUFFIX + N
+SEGMENT_SUFFIX = '.seg.'
+
+# LOCK_SUFFIX - Writers lock providesDB + LOCK_SUFFIX
+LOCK_SUFFIX = '.lock'
+
+# MAX_SEGMENTS - Recommended max number of segments before compacting ( see compactProvidesDB )
+MAX_SEGMENTS = 8
+
+_HEADER_STRUCT = struct.Struct('<8s8sII')
+_CHUNK_STRUCT = struct.Struct('<4sQQ')
+_UINT32_STRUCT = struct.Struct('<I')
+_UINT32_PAIR_STRUCT = struct.Struct('<II')
+_PACKAGE_STRUCT = struct.Struct('<IIII')
+_HASH_BUCKET_STRUCT = _UINT32_PAIR_STRUCT
+
+# FRONT_CODING_BLOCK_SIZE - Number of strings per block in a front-coded string table. Getting a single string
+#   decodes up to this many, and the block offsets cost 4 bytes per this many.
+FRONT_CODING_BLOCK_SIZE = 16
+
+# SORT_BUFFER_SIZE - Approximate memory each sort may use while writing a database, before it is written out to tempfiles
+SORT_BUFFER_SIZE = 32 * 1024 * 1024
+
+# _SORT_ITEM_OVERHEAD - Approximate memory used by a buffered sort item, besides its key
+_SORT_ITEM_OVERHEAD = 128
+
+# _SORT_RUN_BLOCK_SIZE - Items per pickled block of a sort run written to a tempfile
+_SORT_RUN_BLOCK_SIZE = 4096
+
+_SPILL_BUFFER_SIZE = 1024 * 1024
+_SPILL_BUFFER_COUNT = _SPILL_BUFFER_SIZE // 4
+
+# LEGACY_READ_SIZE - Bytes decompressed at a time when reading an older (gzip'd json) providesDB
+LEGACY_READ_SIZE = 256 * 1024
+
+# COMPRESSION_CODECS - Codecs a database may be block-compressed with ( see writeProvidesDB ) -> the id stored in the file
+COMPRESSION_CODECS = { 'zlib' : 1, 'lzma' : 2, 'zstd' : 3 }
+
+# DEFAULT_COMPRESSION_LEVELS - Level used for each codec, if not given
+DEFAULT_COMPRESSION_LEVELS = { 'zlib' : 6, 'lzma' : 6, 'zstd' : 3 }
+
+# COMPRESSION_LEVEL_RANGES - Levels each codec supports, tuple( min, max )
+COMPRESSION_LEVEL_RANGES = { 'zlib' : (0, 9), 'lzma' : (0, 9), 'zstd' : (1, 22) }
+
+# COMPRESSIBLE_CHUNKS - The chunks which are block-compressed, if the database is compressed
+COMPRESSIBLE_CHUNKS = ( CHUNK_FRONT_CODED_PATHS, CHUNK_PATH_PACKAGES, CHUNK_PACKAGE_PATHS, CHUNK_BASENAME_PATHS, CHUNK_DIRNAME_RANGES )
+
+# COMPRESSION_BLOCK_SIZE - Bytes (before compression) per compressed block. A lookup decompresses at least one block.
+COMPRESSION_BLOCK_SIZE = 64 * 1024
+
+# COMPRESSED_BLOCK_CACHE_SIZE - Number of decompressed blocks kept by each compressed chunk while reading
+COMPRESSED_BLOCK_CACHE_SIZE = 64
+
+# COMPRESSED_SCAN_PREFETCH - Strings at a time for which a scan of a compressed path table decompresses the blocks in parallel
+COMPRESSED_SCAN_PREFETCH = 64 * 1024
+
+_COMPRESSED_CHUNK_STRUCT = struct.Struct('<IiIIQ')
+
+# SUBTREE_SCAN_SIZE - Paths read at a time when finding the packages which provide anything under a directory
+SUBTREE_SCAN_SIZE = 64 * 1024
+
+
+class ProvidesDBException(ValueError):
+    '''
+        ProvidesDBException - Raised when a providesDB is invalid, truncated,
+            or a version we cannot read
+    '''
+    pass
+
+
+def isBinaryProvidesDB(filename):
+    '''
+        isBinaryProvidesDB - Check if a file is a binary (0.3+) providesDB, vs one of the
+            older gzip'd json formats
+
+            @param filename <str> - Path to the providesDB
+
+            @return <bool> - True if binary format
+    '''
+    with open(filename, 'rb') as f:
+        return f.read( len(DB_MAGIC) ) == DB_MAGIC
+
+
+####################
+### Block compression ( see top of file )
+################
+
+# _COMPRESSION_CODEC_NAMES - codec id -> name
+_COMPRESSION_CODEC_NAMES = { codecId : codec for (codec, codecId) in COMPRESSION_CODECS.items() }
+
+
+def _checkCodecAvailable(codec):
+    '''
+        _checkCodecAvailable - Check the module for a codec can be imported
+
+            @param codec <str> - Codec name
+
+            @raises ProvidesDBException - If it cannot
+    '''
+    if codec == 'zstd' and zstd_mod is None:
+        raise ProvidesDBException('zstd compression requires the python module zstandard (or python 3.14+), which is not installed.')
+
+
+def _compressBlock(codec, level, data):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=level)
+
+    return zstd_mod.compress(data, level=level)
+
+
+def _decompressBlock(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'lzma':
+        return lzma.decompress(data)
+
+    return zstd_mod.decompress(data)
+
+
+def parseCompression(compressionStr):
+    '''
+        parseCompression - Parse a compression option
+
+            @param compressionStr <str> - "none", or a codec ( see COMPRESSION_CODECS ) optionally followed
+              by a colon and level, e.x. "zstd" or "zlib:9"
+
+            @return <None/tuple( codec<str>, level<int> )> - The compression ( see writeProvidesDB ), None for "none"
+
+            @raises ProvidesDBException - If the codec or level is not valid, or the codec's module is not installed
+    '''
+    (codec, _, levelStr) = compressionStr.partition(':')
+    if codec == 'none' and not levelStr:
+        return None
+
+    if codec not in COMPRESSION_CODECS:
+        raise ProvidesDBException('Unknown compression "%s". Must be one of: none, %s' %(codec, ', '.join( sorted(COMPRESSION_CODECS.keys()) )))
+
+    _checkCodecAvailable(codec)
+
+    if not levelStr:
+        return ( codec, DEFAULT_COMPRESSION_LEVELS[codec] )
+
+    (minLevel, maxLevel) = COMPRESSION_LEVEL_RANGES[codec]
+    try:
+        level = int(levelStr)
+    except ValueError:
+        level = None
+    if level is None or level < minLevel or level > maxLevel:
+        raise ProvidesDBException('Compression level for %s must be %d to %d, not "%s".' %(codec, minLevel, maxLevel, levelStr))
+
+    return ( codec, level )
+
+
+def getProvidesDBCompression(filename):
+    '''
+        getProvidesDBCompression - Get how the base of a providesDB is compressed
+
+            @param filename <str> - Path to the providesDB
+
+            @return <None/tuple( codec<str>, level<int> )> - The compression, None if not compressed
+              (or not a binary providesDB we can read)
+    '''
+    try:
+        with ProvidesDBFile(filename) as dbFile:
+            return dbFile.compression
+    except (OSError, ProvidesDBException):
+        return None
+
+
+def _iterChunkBlocks(chunkParts, blockSize):
+    '''
+        _iterChunkBlocks - Cut the data of a chunk into blocks
+
+            @param chunkParts list<bytes/_SpillFile> - The parts of the chunk
+
+            @param blockSize <int> - Bytes per block
+
+            @return generator<bytes> - The blocks, each #blockSize bytes except the last
+    '''
+    buf = bytearray()
+    for chunkPart in chunkParts:
+        if isinstance(chunkPart, _SpillFile):
+            partData = chunkPart.iterData(blockSize)
+        else:
+            partData = [ chunkPart ]
+
+        for data in partData:
+            buf += data
+            if len(buf) >= blockSize:
+                bufView = memoryview(buf)
+                blockStart = 0
+                while len(buf) - blockStart >= blockSize:
+                    yield bytes( bufView[ blockStart : blockStart + blockSize ] )
+                    blockStart += blockSize
+                bufView.release()
+                del buf[ : blockStart ]
+
+    if buf:
+        yield bytes(buf)
+
+
+def _compressChunk(chunkParts, compression, spill, executor, numThreads):
+    '''
+        _compressChunk - Block-compress a chunk. numThreads blocks are compressed at a time, in parallel.
+
+            @param chunkParts list<bytes/_SpillFile> - The parts of the chunk
+
+            @param compression tuple( codec<str>, level<int> ) - How to compress
+
+            @param spill <_Spill> - Creates the tempfiles
+
+            @param executor <concurrent.futures.Executor> - Compresses the blocks
+
+            @param numThreads <int> - Number of threads in #executor
+
+            @return list<bytes/_SpillFile> - The parts of the compressed chunk
+    '''
+    (codec, level) = compression
+
+    compressedBlocks = _SpillFile(spill)
+    blockOffsets = [ 0 ]
+    size = 0
+
+    # pending - The blocks being compressed, in order. A few per thread, so each always has the next one to do.
+    pending = collections.deque()
+    for block in _iterChunkBlocks(chunkParts, COMPRESSION_BLOCK_SIZE):
+        size += len(block)
+        pending.append( executor.submit(_compressBlock, codec, level, block) )
+
+        while len(pending) > 2 * numThreads:
+            compressedBlocks.write( pending.popleft().result() )
+            blockOffsets.append( len(compressedBlocks) )
+
+    while pending:
+        compressedBlocks.write( pending.popleft().result() )
+        blockOffsets.append( len(compressedBlocks) )
+
+    header = _COMPRESSED_CHUNK_STRUCT.pack( COMPRESSION_CODECS[codec], level, COMPRESSION_BLOCK_SIZE, len(blockOffsets) - 1, size )
+
+    return [ header, struct.pack('<%dQ' %( len(blockOffsets), ), *blockOffsets), compressedBlocks ]
+
+
+# _decompressExecutor - Threads which decompress blocks ahead of a scan. Created when first needed.
+_decompressExecutor = None
+_decompressExecutorLock = threading.Lock()
+
+
+def _getDecompressExecutor():
+    global _decompressExecutor
+
+    with _decompressExecutorLock:
+        if _decompressExecutor is None:
+            _decompressExecutor = concurrent.futures.ThreadPoolExecutor( max_workers=(os.cpu_count() or 1) )
+
+        return _decompressExecutor
+
+
+class _CompressedChunk(object):
+    '''
+        _CompressedChunk - A block-compressed chunk of a memory-mapped file. Blocks are decompressed when read,
+          and the last COMPRESSED_BLOCK_CACHE_SIZE read are kept.
+    '''
+
+    def __init__(self, mm, start, filename):
+        '''
+            __init__ - Create a _CompressedChunk
+
+                @param mm <mmap.mmap> - The database
+
+                @param start <int> - Offset of the chunk
+
+                @param filename <str> - Path to the database, for errors
+
+                @raises ProvidesDBException - If the codec is unknown, or its module is not installed
+        '''
+        self._mm = mm
+        (codecId, self.level, self.blockSize, numBlocks, self.size) = _COMPRESSED_CHUNK_STRUCT.unpack_from(mm, start)
+
+        self.codec = _COMPRESSION_CODEC_NAMES.get(codecId, None)
+        if self.codec is None:
+            raise ProvidesDBException('providesDB "%s" is compressed with an unknown codec ( %d ).' %(filename, codecId))
+        _checkCodecAvailable(self.codec)
+
+        blockOffsetsStart = start + _COMPRESSED_CHUNK_STRUCT.size
+        self._blockOffsets = struct.unpack_from('<%dQ' %(numBlocks + 1, ), mm, blockOffsetsStart)
+        self._dataStart = blockOffsetsStart + ( 8 * (numBlocks + 1) )
+
+        self._cache = collections.OrderedDict()
+        self._cacheLock = threading.Lock()
+
+    def _decompress(self, blockIdx):
+        return _decompressBlock( self.codec, self._mm[ self._dataStart + self._blockOffsets[blockIdx] : self._dataStart + self._blockOffsets[blockIdx + 1] ] )
+
+    def _addToCache(self, blockIdx, block):
+        with self._cacheLock:
+            self._cache[blockIdx] = block
+            self._cache.move_to_end(blockIdx)
+            while len(self._cache) > COMPRESSED_BLOCK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def getBlock(self, blockIdx):
+        '''
+            getBlock - Get a block, decompressing it if it is not cached
+
+                @param blockIdx <int> - Block index
+
+                @return <bytes> - The decompressed block
+        '''
+        with self._cacheLock:
+            block = self._cache.get(blockIdx, None)
+            if block is not None:
+                self._cache.move_to_end(blockIdx)
+                return block
+
+        block = self._decompress(blockIdx)
+        self._addToCache(blockIdx, block)
+
+        return block
+
+    def read(self, start, end):
+        '''
+            read - Read some of the (decompressed) chunk
+
+                @param start <int> - Offset into the chunk
+
+                @param end <int> - Stop before this offset
+
+                @return <bytes> - The data
+        '''
+        (blockIdx, blockStart) = divmod(start, self.blockSize)
+        block = self.getBlock(blockIdx)
+        if blockStart + (end - start) <= len(block):
+            return block[ blockStart : blockStart + (end - start) ]
+
+        # Spans blocks
+        parts = [ block[ blockStart : ] ]
+        remaining = (end - start) - len(parts[0])
+        while remaining > 0:
+            blockIdx += 1
+            block = self.getBlock(blockIdx)
+            parts.append( block[ : remaining ] )
+            remaining -= len(parts[-1])
+
+        return b''.join(parts)
+
+    def unpackFrom(self, structObj, offset):
+        '''
+            unpackFrom - Unpack a struct from the (decompressed) chunk
+
+                @param structObj <struct.Struct> - The struct
+
+                @param offset <int> - Offset into the chunk
+
+                @return <tuple> - The values
+        '''
+        return structObj.unpack( self.read(offset, offset + structObj.size) )
+
+    def prefetch(self, start, end):
+        '''
+            prefetch - Decompress the blocks of a range which are not cached, in parallel (up to half the cache)
+
+                @param start <int> - Offset into the chunk
+
+                @param end <int> - Stop before this offset
+        '''
+        if end <= start:
+            return
+
+        firstBlockIdx = start // self.blockSize
+        endBlockIdx = min( ( (end - 1) // self.blockSize ) + 1, firstBlockIdx + (COMPRESSED_BLOCK_CACHE_SIZE // 2) )
+
+        with self._cacheLock:
+            blockIdxs = [ blockIdx for blockIdx in range(firstBlockIdx, endBlockIdx) if blockIdx not in self._cache ]
+
+        if len(blockIdxs) < 2:
+            return
+
+        for (blockIdx, block) in zip( blockIdxs, _getDecompressExecutor().map(self._decompress, blockIdxs) ):
+            self._addToCache(blockIdx, block)
+
+
+####################
+### Globs
+################
+
+# GLOB_LITERAL_SPECIAL_CHARS - Characters globToRE passes through to the regex unescaped, so they do not match
+#   themselves. A glob with any of these is not planned, just matched against every path.
+GLOB_LITERAL_SPECIAL_CHARS = '[](){}+|^$\\'
+
+def globToRE(globStr):
+    '''
+        globToRE - Convert a glob expression to a compiled regular expression,
+          which must be matched against the whole path
+
+            @param globStr <str> - Glob. "*" matches anything (including "/"), "?" matches any one character
+
+            @return <re.Pattern> - Compiled regex
+    '''
+    pattern = globStr.replace('.', '[\\.]').replace('*', '.*').replace('?', '.') + '$'
+
+    return re.compile(pattern)
+
+
+# Glob plans, most selective first. See planGlob
+GLOB_PLAN_EXACT = 'exact'
+GLOB_PLAN_PREFIX = 'prefix'
+GLOB_PLAN_BASENAME = 'basename'
+GLOB_PLAN_COMPONENT = 'component'
+GLOB_PLAN_BASENAME_SUFFIX = 'basenameSuffix'
+GLOB_PLAN_BASENAME_PREFIX = 'basenamePrefix'
+GLOB_PLAN_SUBSTRING = 'substring'
+GLOB_PLAN_SCAN = 'scan'
+
+_GLOB_PLAN_RANKS = {
+    GLOB_PLAN_BASENAME        : 5,
+    GLOB_PLAN_COMPONENT       : 4,
+    GLOB_PLAN_BASENAME_SUFFIX : 3,
+    GLOB_PLAN_BASENAME_PREFIX : 2,
+    GLOB_PLAN_SUBSTRING       : 1,
+}
+
+_GLOB_WILDCARDS_RE = re.compile('[*?]+')
+
+def planGlob(globStr):
+    '''
+        planGlob - Pick which index to use to find the candidate paths for a glob.
+          globToRE is then matched against just the candidates.
+
+          Any literal text in the glob must appear in a matching path, so:
+
+            exact          - No wildcards. Just look up the path.
+            prefix         - Starts with literal text. Every match is in one range of the sorted path table.
+            basename       - Ends with literal text containing a "/". The text after the last "/" is the basename.
+            component      - Literal text has a whole component between two "/" ( e.x. "*/share/*" ).
+                               Every match is under a directory with that name.
+            basenameSuffix - Ends with literal text (no "/"). The basename ends with it.
+            basenamePrefix - Literal text after a "/" is the start of a component. Every match has a basename,
+                               or is under a directory with a name, starting with it.
+            substring      - Literal text (no "/") is part of one component. Every match has a basename,
+                               or is under a directory with a name, containing it.
+            scan           - No usable literal text. Match every path.
+
+            @param globStr <str> - The glob
+
+            @return tuple( planType<str>, value<str/None> ) - The plan ( one of the GLOB_PLAN_* ), and the literal text it uses
+    '''
+    for specialChar in GLOB_LITERAL_SPECIAL_CHARS:
+        if specialChar in globStr:
+            return (GLOB_PLAN_SCAN, None)
+
+    literals = _GLOB_WILDCARDS_RE.split(globStr)
+    if len(literals) == 1:
+        return (GLOB_PLAN_EXACT, globStr)
+
+    if literals[0]:
+        return (GLOB_PLAN_PREFIX, literals[0])
+
+    suffix = literals[-1]
+    if '/' in suffix and suffix.rsplit('/', 1)[1]:
+        return (GLOB_PLAN_BASENAME, suffix.rsplit('/', 1)[1])
+
+    candidates = []
+    if suffix and '/' not in suffix:
+        candidates.append( (GLOB_PLAN_BASENAME_SUFFIX, suffix) )
+
+    for (literalIdx, literal) in enumerate(literals[1:], 1):
+        components = literal.split('/')
+        # First is the end of a component, or all of it if there is no "/"
+        candidates.append( (GLOB_PLAN_SUBSTRING, components[0]) )
+        if len(components) > 1:
+            for component in components[1:-1]:
+                candidates.append( (GLOB_PLAN_COMPONENT, component) )
+            if literalIdx != len(literals) - 1:
+                candidates.append( (GLOB_PLAN_BASENAME_PREFIX, components[-1]) )
+
+    candidates = [ candidate for candidate in candidates if candidate[1] ]
+    if not candidates:
+        return (GLOB_PLAN_SCAN, None)
+
+    return max( candidates, key=lambda candidate : ( _GLOB_PLAN_RANKS[candidate[0]], len(candidate[1]) ) )
+
+
+####################
+### Writing
+################
+#
+#  The writer holds about one package record at a time, whatever the size of the database. The paths are sorted
+#   with an external sort ( _ExternalSorter ), and each chunk is written to a tempfile as it is built, which are
+#   then copied into the database. The tempfiles are in the database's directory ( /tmp is often in memory ).
+
+def _packUInt32s(values):
+    '''
+        _packUInt32s - Pack a list of ints as little-endian u32
+
+            @param values <list<int>> - The values
+
+            @return <bytes> - Packed values
+    '''
+    if values and max(values) > MAX_UINT32:
+        raise ProvidesDBException('Value too large for providesDB column: %d' %( max(values), ))
+
+    return struct.pack('<%dI' %( len(values), ), *values)
+
+
+def _packStringTable(sortedStrings):
+    '''
+        _packStringTable - Pack a string table chunk
+
+            @param sortedStrings <list<bytes>> - The strings, in order
+
+            @return list<bytes> - The parts of the chunk
+    '''
+    offsets = [0]
+    curOffset = 0
+    for value in sortedStrings:
+        curOffset += len(value)
+        offsets.append(curOffset)
+
+    return [ _UINT32_STRUCT.pack( len(sortedStrings) ), _packUInt32s(offsets), b''.join(sortedStrings) ]
+
+
+def _encodeVarint(value):
+    '''
+        _encodeVarint - Encode an int as a LEB128 varint
+
+            @param value <int> - Non-negative value
+
+            @return <bytes> - The varint
+    '''
+    if value < 0x80:
+        return bytes( (value, ) )
+
+    ret = bytearray()
+    while value >= 0x80:
+        ret.append( (value & 0x7F) | 0x80 )
+        value >>= 7
+    ret.append(value)
+
+    return bytes(ret)
+
+
+class _Spill(object):
+    '''
+        _Spill - Creates the (unnamed) tempfiles used while writing a database, and closes (removes) them all at the end
+    '''
+
+    def __init__(self, spillDir):
+        '''
+            __init__ - Create a _Spill
+
+                @param spillDir <str> - Directory to create the tempfiles in
+        '''
+        self.spillDir = spillDir
+        self._files = []
+
+    def createFile(self):
+        '''
+            createFile - Create a tempfile
+
+                @return <file> - The tempfile, opened for read and write
+        '''
+        f = tempfile.TemporaryFile(dir=self.spillDir)
+        self._files.append(f)
+        return f
+
+    def close(self):
+        '''
+            close - Close (and so remove) every tempfile
+        '''
+        for f in self._files:
+            f.close()
+        self._files = []
+
+
+class _SpillFile(object):
+    '''
+        _SpillFile - Part of a chunk, written to a tempfile as it is built instead of held in memory
+    '''
+
+    def __init__(self, spill):
+        '''
+            __init__ - Create a _SpillFile
+
+                @param spill <_Spill> - Creates the tempfile
+        '''
+        self._f = spill.createFile()
+        self._size = 0
+        self._buf = bytearray()
+
+    def __len__(self):
+        return self._size + len(self._buf)
+
+    def write(self, data):
+        '''
+            write - Append to the file
+
+                @param data <bytes> - Data to append
+        '''
+        self._buf += data
+        if len(self._buf) >= _SPILL_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._f.write(self._buf)
+        self._size += len(self._buf)
+        self._buf = bytearray()
+
+    def copyTo(self, f):
+        '''
+            copyTo - Copy the contents to another file
+
+                @param f <file> - File to write to
+        '''
+        self._flush()
+        self._f.flush()
+        self._f.seek(0)
+        shutil.copyfileobj(self._f, f, _SPILL_BUFFER_SIZE)
+
+    def iterData(self, readSize):
+        '''
+            iterData - Read back the contents. Nothing can be written after.
+
+                @param readSize <int> - Bytes to read at a time
+
+                @return generator<bytes>
+        '''
+        self._flush()
+        self._f.flush()
+        self._f.seek(0)
+
+        while True:
+            data = self._f.read(readSize)
+            if not data:
+                break
+
+            yield data
+
+    def mapWritable(self, size):
+        '''
+            mapWritable - Make the file #size bytes (of zeros) and memory-map it for writing, instead of appending to it.
+
+                @param size <int> - Size in bytes (more than 0)
+
+                @return <mmap.mmap> - The mapping. Close it before copyTo.
+        '''
+        self._f.truncate(size)
+        self._size = size
+
+        return mmap.mmap(self._f.fileno(), size)
+
+
+class _UInt32Column(_SpillFile):
+    '''
+        _UInt32Column - A _SpillFile of u32 values
+    '''
+
+    def __init__(self, spill):
+        '''
+            __init__ - Create a _UInt32Column
+
+                @param spill <_Spill> - Creates the tempfile
+        '''
+        _SpillFile.__init__(self, spill)
+
+        self._values = array('I')
+        self._numFlushed = 0
+
+    def __len__(self):
+        return self._size + len(self._buf) + ( 4 * len(self._values) )
+
+    @property
+    def count(self):
+        '''
+            count - The number of values
+        '''
+        return self._numFlushed + len(self._values)
+
+    def append(self, value):
+        '''
+            append - Append a value
+
+                @param value <int> - The value
+        '''
+        values = self._values
+        try:
+            values.append(value)
+        except OverflowError:
+            raise ProvidesDBException('Value too large for providesDB column: %d' %( value, ))
+
+        if len(values) >= _SPILL_BUFFER_COUNT:
+            self._flushValues()
+
+    def extend(self, values):
+        '''
+            extend - Append several values
+
+                @param values <list<int>/array> - The values
+        '''
+        try:
+            self._values.extend(values)
+        except OverflowError:
+            raise ProvidesDBException('Value too large for providesDB column: %d' %( max(values), ))
+
+        if len(self._values) >= _SPILL_BUFFER_COUNT:
+            self._flushValues()
+
+    def _flushValues(self):
+        if sys.byteorder != 'little':
+            self._values.byteswap()
+
+        self.write( self._values.tobytes() )
+        self._numFlushed += len(self._values)
+        self._values = array('I')
+
+    def copyTo(self, f):
+        self._flushValues()
+        _SpillFile.copyTo(self, f)
+
+    def iterData(self, readSize):
+        self._flushValues()
+        return _SpillFile.iterData(self, readSize)
+
+    def iterValues(self):
+        '''
+            iterValues - Read back the values, in order. Nothing can be appended after.
+
+                @return generator<int>
+        '''
+        for data in self.iterData( 4 * _SPILL_BUFFER_COUNT ):
+            values = array('I', data)
+            if sys.byteorder != 'little':
+                values.byteswap()
+
+            for value in values:
+                yield value
+
+
+class _StringTableWriter(object):
+    '''
+        _StringTableWriter - Writes a string table chunk, adding the strings one at a time (in order)
+    '''
+
+    def __init__(self, spill):
+        '''
+            __init__ - Create a _StringTableWriter
+
+                @param spill <_Spill> - Creates the tempfiles
+        '''
+        self.count = 0
+        self._offsets = _UInt32Column(spill)
+        self._offsets.append(0)
+        self._data = _SpillFile(spill)
+
+    def add(self, value):
+        '''
+            add - Add the next string
+
+                @param value <bytes> - The string
+        '''
+        self._data.write(value)
+        self._offsets.append( len(self._data) )
+        self.count += 1
+
+    def finish(self):
+        '''
+            finish - Finish the chunk, once every string is added
+
+                @return list<bytes/_SpillFile> - The parts of the chunk
+        '''
+        return [ _UINT32_STRUCT.pack(self.count), self._offsets, self._data ]
+
+
+class _FrontCodedStringTableWriter(object):
+    '''
+        _FrontCodedStringTableWriter - Writes a front-coded string table chunk, adding the strings one at a time (sorted)
+    '''
+
+    def __init__(self, spill, blockSize=FRONT_CODING_BLOCK_SIZE):
+        '''
+            __init__ - Create a _FrontCodedStringTableWriter
+
+                @param spill <_Spill> - Creates the tempfiles
+
+                @param blockSize <int> default FRONT_CODING_BLOCK_SIZE - Strings per block
+        '''
+        self.count = 0
+        self.blockSize = blockSize
+
+        self._blockOffsets = _UInt32Column(spill)
+        self._data = _SpillFile(spill)
+        self._prevValue = b''
+
+    def add(self, value):
+        '''
+            add - Add the next string
+
+                @param value <bytes> - The string
+        '''
+        if self.count % self.blockSize == 0:
+            self._blockOffsets.append( len(self._data) )
+            self._data.write( _encodeVarint( len(value) ) + value )
+        else:
+            prevValue = self._prevValue
+
+            # Length of the common prefix: xor the two as big ints, and the bytes above the highest set bit are the same
+            maxSharedLen = min( len(prevValue), len(value) )
+            diffBits = int.from_bytes(prevValue[ : maxSharedLen ], 'big') ^ int.from_bytes(value[ : maxSharedLen ], 'big')
+            sharedLen = maxSharedLen - ( (diffBits.bit_length() + 7) >> 3 )
+
+            suffixLen = len(value) - sharedLen
+            if sharedLen < 0x80 and suffixLen < 0x80:
+                self._data.write( bytes( ( sharedLen, suffixLen ) ) + value[ sharedLen : ] )
+            else:
+                self._data.write( _encodeVarint(sharedLen) + _encodeVarint(suffixLen) + value[ sharedLen : ] )
+
+        self._prevValue = value
+        self.count += 1
+
+    def finish(self):
+        '''
+            finish - Finish the chunk, once every string is added
+
+                @return list<bytes/_SpillFile> - The parts of the chunk
+        '''
+        self._blockOffsets.append( len(self._data) )
+
+        return [ struct.pack('<II', self.count, self.blockSize), self._blockOffsets, self._data ]
+
+
+class _IdListTableWriter(object):
+    '''
+        _IdListTableWriter - Writes an id list table chunk, adding the lists one at a time (in order)
+    '''
+
+    def __init__(self, spill):
+        '''
+            __init__ - Create an _IdListTableWriter
+
+                @param spill <_Spill> - Creates the tempfiles
+        '''
+        self.count = 0
+        self._indexes = _UInt32Column(spill)
+        self._indexes.append(0)
+        self._ids = _UInt32Column(spill)
+
+    def add(self, ids):
+        '''
+            add - Add the next list
+
+                @param ids <list<int>> - The ids
+        '''
+        self._ids.extend(ids)
+        self._indexes.append(self._ids.count)
+        self.count += 1
+
+    def finish(self):
+        '''
+            finish - Finish the chunk, once every list is added
+
+                @return list<bytes/_SpillFile> - The parts of the chunk
+        '''
+        return [ _UINT32_STRUCT.pack(self.count), self._indexes, self._ids ]
+
+
+class _ExternalSorter(object):
+    '''
+        _ExternalSorter - Sorts more items than fit in memory. Items are buffered, and each time about #bufferSize
+          bytes of them are buffered they are sorted and written to a tempfile (a "run"). The runs are then merged.
+
+          Each item is a tuple of ( key<bytes>, value<int>, ... )
+    '''
+
+    def __init__(self, spill, bufferSize=None):
+        '''
+            __init__ - Create an _ExternalSorter
+
+                @param spill <_Spill> - Creates the tempfiles
+
+                @param bufferSize <None/int> default None - Approximate memory to use for buffered items, None for SORT_BUFFER_SIZE
+        '''
+        self.spill = spill
+        self.bufferSize = bufferSize or SORT_BUFFER_SIZE
+
+        self._items = []
+        self._bufferedSize = 0
+        self._runs = []
+
+    def add(self, item):
+        '''
+            add - Add an item
+
+                @param item tuple( key<bytes>, value<int>, ... ) - The item
+        '''
+        self._items.append(item)
+
+        self._bufferedSize += len(item[0]) + _SORT_ITEM_OVERHEAD
+        if self._bufferedSize >= self.bufferSize:
+            self._writeRun()
+
+    def extend(self, items):
+        '''
+            extend - Add several items
+
+                @param items list< tuple( key<bytes>, value<int>, ... ) > - The items
+        '''
+        self._items += items
+
+        self._bufferedSize += sum( len(item[0]) for item in items ) + ( _SORT_ITEM_OVERHEAD * len(items) )
+        if self._bufferedSize >= self.bufferSize:
+            self._writeRun()
+
+    def _writeRun(self):
+        # A run is a series of pickled blocks of items
+        self._items.sort()
+
+        f = self.spill.createFile()
+        for blockStart in range(0, len(self._items), _SORT_RUN_BLOCK_SIZE):
+            pickle.dump( self._items[ blockStart : blockStart + _SORT_RUN_BLOCK_SIZE ], f, pickle.HIGHEST_PROTOCOL )
+
+        self._runs.append(f)
+        self._items = []
+        self._bufferedSize = 0
+
+    def _iterRun(self, f):
+        f.flush()
+        f.seek(0)
+
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                break
+
+            for item in block:
+                yield item
+
+    def iterSorted(self):
+        '''
+            iterSorted - Iterate over every item added, sorted. Call once, after everything is added.
+
+                @return iter< tuple( key<bytes>, value<int>, ... ) >
+        '''
+        self._items.sort()
+        if not self._runs:
+            return iter(self._items)
+
+        return heapq.merge( *( [ self._iterRun(f) for f in self._runs ] + [ iter(self._items) ] ) )
+
+
+def _iterSortedGroups(sortedItems):
+    '''
+        _iterSortedGroups - Group sorted items by key
+
+            @param sortedItems iter< tuple( key<bytes>, value<int>, ... ) > - The items, sorted
+
+            @return generator< tuple( key<bytes>, values<list<int>> ) > - Each key, and the values of every item with it (in order)
+    '''
+    (curKey, curValues) = (None, None)
+    for item in sortedItems:
+        if item[0] != curKey:
+            if curValues is not None:
+                yield (curKey, curValues)
+            (curKey, curValues) = (item[0], [])
+
+        curValues += item[1 : ]
+
+    if curValues is not None:
+        yield (curKey, curValues)
+
+
+def _buildNameIndex(sortedItems, spill):
+    '''
+        _buildNameIndex - Build a string table of names, and an id list table of the values for each name
+          (e.x. the "BASE" and "BPTH" chunks)
+
+            @param sortedItems iter< tuple( name<bytes>, value<int>, ... ) > - The items, sorted
+
+            @param spill <_Spill> - Creates the tempfiles
+
+            @return tuple( nameChunkParts<list>, idListChunkParts<list> ) - The parts of the two chunks
+    '''
+    names = _StringTableWriter(spill)
+    idLists = _IdListTableWriter(spill)
+    for (name, ids) in _iterSortedGroups(sortedItems):
+        names.add(name)
+        idLists.add(ids)
+
+    return ( names.finish(), idLists.finish() )
+
+
+def _hashPath(pathBytes):
+    '''
+        _hashPath - The hash used by the path hash index
+
+            @param pathBytes <bytes> - utf-8 path
+
+            @return <int> - u32 hash
+    '''
+    return zlib.crc32(pathBytes) & 0xFFFFFFFF
+
+
+def _buildPathHashIndex(pathHashes, numPaths, spill):
+    '''
+        _buildPathHashIndex - Build the "HASH" chunk for a path table. The buckets are
+          built in a memory-mapped tempfile.
+
+            @param pathHashes <_UInt32Column> - The _hashPath of each path, in path id order
+
+            @param numPaths <int> - Number of paths
+
+            @param spill <_Spill> - Creates the tempfile
+
+            @return list<bytes/_SpillFile> - The parts of the chunk
+    '''
+    numBuckets = 2
+    while numBuckets < numPaths * 2:
+        numBuckets *= 2
+    mask = numBuckets - 1
+
+    bucketsFile = _SpillFile(spill)
+    mm = bucketsFile.mapWritable( _HASH_BUCKET_STRUCT.size * numBuckets )
+
+    # buckets - pairs of ( pathHash, pathId + 1 ) , stored native-endian until the end
+    buckets = memoryview(mm).cast('I')
+    try:
+        for (pathId, pathHash) in enumerate( pathHashes.iterValues() ):
+            bucketIdx = pathHash & mask
+            while buckets[ (2 * bucketIdx) + 1 ] != 0:
+                bucketIdx = (bucketIdx + 1) & mask
+
+            buckets[ 2 * bucketIdx ] = pathHash
+            buckets[ (2 * bucketIdx) + 1 ] = pathId + 1
+    finally:
+        buckets.release()
+
+    if sys.byteorder != 'little':
+        for offset in range(0, len(mm), 4 * _SPILL_BUFFER_COUNT):
+            values = array('I', mm[ offset : offset + (4 * _SPILL_BUFFER_COUNT) ])
+            values.byteswap()
+            mm[ offset : offset + len(values) * 4 ] = values.tobytes()
+
+    mm.close()
+
+    return [ _UINT32_STRUCT.pack(numBuckets), bucketsFile ]
+
+
+def _iterResults(results):
+    '''
+        _iterResults - Iterate over results given as a dict, or as pairs
+
+            @param results <dict/iter< tuple( pkgName<str>, pkgRecord<dict> ) >> - The results
+
+            @return iter< tuple( pkgName<str>, pkgRecord<dict> ) >
+    '''
+    if hasattr(results, 'items'):
+        return iter( results.items() )
+
+    return iter(results)
+
+
+def _writeProvidesDBFile(filename, results, removedPackageNames=None, sortBufferSize=None, compression=None, compressThreads=None, segmentGeneration=0, frontCoding=True):
+    '''
+        _writeProvidesDBFile - Write a binary providesDB file (base or segment)
+
+            The file is written to a tempfile in the same directory and then renamed
+              over #filename , so a reader (which may have the old file mapped) never
+              sees a partially written database.
+
+            @param filename <str> - Path to write
+
+            @param results <dict/iter> - Dict of package name -> package record, same as the json
+              formats (0.2), or an iterator of ( package name, package record ) , which are read one at a time.
+              Each record is a dict of:
+
+                'files'       <list<str>> - The files the package provides
+                'version'     <str>       - The package version
+                'error'       <None/str>  - Error string if we failed to get the file list
+                'mtreeOffset' <int>       - (optional) Compressed offset where the .MTREE ended
+
+              A "__vers" key, if present, is ignored.
+
+            @param removedPackageNames <None/list<str>> default None - For a segment, the names of packages removed
+
+            @param sortBufferSize <None/int> default None - Approximate memory to use for each sort, None for SORT_BUFFER_SIZE
+
+            @param compression <None/tuple( codec<str>, level<int> )> default None - Block-compress the COMPRESSIBLE_CHUNKS
+              ( see parseCompression ), None to not compress
+
+            @param compressThreads <None/int> default None - Number of threads compressing, None for the number of cpus
+
+            @param segmentGeneration <int> default 0 - For a base, the number of the newest segment it holds ( see top of file )
+
+            @param frontCoding <bool> default True - Front-code the path table. False writes the plain path table
+              of databases written before front coding (which is never compressed), to test they are still read.
+    '''
+    if compression is not None:
+        _checkCodecAvailable(compression[0])
+
+    fileDir = os.path.dirname( os.path.abspath(filename) )
+    spill = _Spill(fileDir)
+    try:
+        ######## Packages. Just the name, version, etc. of each is kept, the files go into pathSorter
+        # packages - tuple( name, version, error, mtreeOffset, provisionalId ). The provisional id is the order
+        #   read, until they are sorted by name.
+        packages = []
+        # pathSorter - tuple( path (as bytes), provisional id )
+        pathSorter = _ExternalSorter(spill, sortBufferSize)
+
+        for (pkgName, pkgRecord) in _iterResults(results):
+            if pkgName == '__vers':
+                continue
+
+            error = pkgRecord.get('error', None)
+            if error is not None:
+                error = str(error)
+
+            provisionalId = len(packages)
+            packages.append( ( pkgName, pkgRecord.get('version', '') or '', error, pkgRecord.get('mtreeOffset', None) or 0, provisionalId ) )
+
+            pathSorter.extend( [ ( pkgFile.encode('utf-8'), provisionalId ) for pkgFile in pkgRecord.get('files', None) or [] ] )
+
+        packages.sort( key=lambda package : package[0] )
+
+        ######## String pool and package table
+        stringPool = bytearray()
+        stringOffsets = {}
+
+        def _addString(value):
+            if value is None:
+                return NO_STRING
+            try:
+                return stringOffsets[value]
+            except KeyError:
+                pass
+            offset = len(stringPool)
+            stringPool.extend( value.encode('utf-8') + b'\x00' )
+            stringOffsets[value] = offset
+            return offset
+
+        packageTable = bytearray( _UINT32_STRUCT.pack( len(packages) ) )
+
+        # packageIds - provisional id -> package id
+        packageIds = array('I', bytes( 4 * len(packages) ))
+
+        for (pkgId, (pkgName, version, error, mtreeOffset, provisionalId)) in enumerate(packages):
+            packageTable += _PACKAGE_STRUCT.pack( _addString(pkgName), _addString(version), _addString(error), mtreeOffset )
+            packageIds[provisionalId] = pkgId
+
+        numPackages = len(packages)
+        del packages, stringOffsets
+
+        ######## Path table and its indexes, from the sorted paths
+        if frontCoding:
+            pathTable = _FrontCodedStringTableWriter(spill)
+        else:
+            pathTable = _StringTableWriter(spill)
+        pathPackages = _IdListTableWriter(spill)
+        pathHashes = _UInt32Column(spill)
+
+        # packagePaths - package id -> the ids of the paths it provides. 4 bytes per file, rather than the file itself.
+        packagePaths = [ array('I') for pkgId in range(numPackages) ]
+        # basenameSorter - tuple( basename, path id )
+        basenameSorter = _ExternalSorter(spill, sortBufferSize)
+        # dirnameSorter - tuple( dirname, start path id, end path id )
+        dirnameSorter = _ExternalSorter(spill, sortBufferSize)
+        # sonameSorter - tuple( soname, path id ) of each library in LIBRARY_DIRS
+        sonameSorter = _ExternalSorter(spill, sortBufferSize)
+
+        # dirStack - [ dirPath, start path id ] of each directory above the current path. Since the paths are sorted,
+        #   everything under a directory is one range of the path table, even if the directory itself is not in it.
+        dirStack = []
+
+        pathId = 0
+        for (pathBytes, provisionalIds) in _iterSortedGroups( pathSorter.iterSorted() ):
+            pathTable.add(pathBytes)
+            pathHashes.append( _hashPath(pathBytes) )
+
+            if len(provisionalIds) == 1:
+                pkgIds = [ packageIds[ provisionalIds[0] ] ]
+            else:
+                pkgIds = sorted( set( packageIds[provisionalId] for provisionalId in provisionalIds ) )
+            pathPackages.add(pkgIds)
+            for pkgId in pkgIds:
+                packagePaths[pkgId].append(pathId)
+
+            lastSlashIdx = pathBytes.rfind(b'/')
+            basenameSorter.add( ( pathBytes[ lastSlashIdx + 1 : ], pathId ) )
+
+            if pathBytes[ : lastSlashIdx ] in _LIBRARY_DIRS_BYTES and _SONAME_RE.search(pathBytes, lastSlashIdx):
+                sonameSorter.add( ( pathBytes[ lastSlashIdx + 1 : ], pathId ) )
+
+            while dirStack and not pathBytes.startswith( dirStack[-1][0] + b'/' ):
+                (dirPath, startPathId) = dirStack.pop()
+                dirnameSorter.add( ( dirPath[ dirPath.rfind(b'/') + 1 : ], startPathId, pathId ) )
+
+            if dirStack:
+                slashIdx = pathBytes.find(b'/', len(dirStack[-1][0]) + 1)
+            else:
+                slashIdx = pathBytes.find(b'/', 1)
+            while slashIdx != -1:
+                dirStack.append( ( pathBytes[ : slashIdx ], pathId ) )
+                slashIdx = pathBytes.find(b'/', slashIdx + 1)
+
+            pathId += 1
+
+        numPaths = pathId
+        while dirStack:
+            (dirPath, startPathId) = dirStack.pop()
+            dirnameSorter.add( ( dirPath[ dirPath.rfind(b'/') + 1 : ], startPathId, numPaths ) )
+
+        del pathSorter, packageIds
+
+        packagePathsTable = _IdListTableWriter(spill)
+        for pathIds in packagePaths:
+            packagePathsTable.add(pathIds)
+        del packagePaths
+
+        (basenamesParts, basenamePathsParts) = _buildNameIndex( basenameSorter.iterSorted(), spill )
+        (dirnamesParts, dirnameRangesParts) = _buildNameIndex( dirnameSorter.iterSorted(), spill )
+        (sonamesParts, sonamePathsParts) = _buildNameIndex( sonameSorter.iterSorted(), spill )
+
+        chunks = [
+            ( CHUNK_STRINGS, [ bytes(stringPool) ] ),
+            ( CHUNK_PACKAGES, [ bytes(packageTable) ] ),
+            ( CHUNK_FRONT_CODED_PATHS if frontCoding else CHUNK_PATHS, pathTable.finish() ),
+            ( CHUNK_PATH_PACKAGES, pathPackages.finish() ),
+            ( CHUNK_PACKAGE_PATHS, packagePathsTable.finish() ),
+            ( CHUNK_PATH_HASH, _buildPathHashIndex(pathHashes, numPaths, spill) ),
+            ( CHUNK_BASENAMES, basenamesParts ),
+            ( CHUNK_BASENAME_PATHS, basenamePathsParts ),
+            ( CHUNK_DIRNAMES, dirnamesParts ),
+            ( CHUNK_DIRNAME_RANGES, dirnameRangesParts ),
+            ( CHUNK_SONAMES, sonamesParts ),
+            ( CHUNK_SONAME_PATHS, sonamePathsParts ),
+        ]
+
+        if removedPackageNames:
+            chunks.append( ( CHUNK_REMOVED_PACKAGES, _packStringTable( sorted( pkgName.encode('utf-8') for pkgName in removedPackageNames ) ) ) )
+
+        if compression is not None:
+            numThreads = compressThreads or os.cpu_count() or 1
+            with concurrent.futures.ThreadPoolExecutor(max_workers=numThreads) as executor:
+                chunks = [ ( chunkTag.lower(), _compressChunk(chunkParts, compression, spill, executor, numThreads) ) if chunkTag in COMPRESSIBLE_CHUNKS else ( chunkTag, chunkParts )
+                    for (chunkTag, chunkParts) in chunks ]
+
+        ######## Write it out
+        versionBytes = DB_FORMAT_VERSION.encode('ascii')
+
+        curOffset = _HEADER_STRUCT.size + ( _CHUNK_STRUCT.size * len(chunks) )
+        chunkTable = []
+        for (chunkTag, chunkParts) in chunks:
+            chunkSize = sum( len(chunkPart) for chunkPart in chunkParts )
+            chunkTable.append( _CHUNK_STRUCT.pack(chunkTag, curOffset, chunkSize) )
+            curOffset += chunkSize
+
+        (tempFd, tempFilename) = tempfile.mkstemp(prefix='.providesDB.', dir=fileDir)
+        try:
+            with os.fdopen(tempFd, 'wb') as f:
+                f.write( _HEADER_STRUCT.pack(DB_MAGIC, versionBytes, len(chunks), segmentGeneration) )
+                for chunkTableEntry in chunkTable:
+                    f.write(chunkTableEntry)
+                for (chunkTag, chunkParts) in chunks:
+                    for chunkPart in chunkParts:
+                        if isinstance(chunkPart, _SpillFile):
+                            chunkPart.copyTo(f)
+                        else:
+                            f.write(chunkPart)
+
+            os.chmod(tempFilename, 0o644)
+            os.rename(tempFilename, filename)
+        except:
+            try:
+                os.unlink(tempFilename)
+            except:
+                pass
+            raise
+    finally:
+        spill.close()
+
+
+class _ProvidesDBLock(object):
+    '''
+        _ProvidesDBLock - Exclusive lock held while writing to a providesDB (base or segments). Use with "with".
+    '''
+
+    def __init__(self, filename):
+        '''
+            __init__ - Create the lock
+
+                @param filename <str> - Path to the providesDB
+        '''
+        self.lockFilename = filename + LOCK_SUFFIX
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.lockFilename, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+def getSegmentFilenames(filename):
+    '''
+        getSegmentFilenames - Get the segments of a providesDB
+
+            @param filename <str> - Path to the providesDB
+
+            @return list<str> - Paths of the segments, oldest first
+    '''
+    dirName = os.path.dirname( os.path.abspath(filename) )
+    segmentPrefix = os.path.basename(filename) + SEGMENT_SUFFIX
+
+    segmentNumbers = []
+    for dirEntry in os.listdir(dirName):
+        if dirEntry.startswith(segmentPrefix) and dirEntry[ len(segmentPrefix) : ].isdigit():
+            segmentNumbers.append( int( dirEntry[ len(segmentPrefix) : ] ) )
+
+    segmentNumbers.sort()
+
+    return [ filename + SEGMENT_SUFFIX + str(segmentNumber) for segmentNumber in segmentNumbers ]
+
+
+def _getSegmentNumber(filename, segmentFilename):
+    return int( segmentFilename[ len(filename + SEGMENT_SUFFIX) : ] )
+
+
+def _removeSegments(segmentFilenames):
+    for segmentFilename in segmentFilenames:
+        try:
+            os.unlink(segmentFilename)
+        except FileNotFoundError:
+            pass
+
+
+def _getLastSegmentNumber(filename, segmentFilenames):
+    '''
+        _getLastSegmentNumber - Get the newest segment number used so far: that of the newest segment, or the
+          segmentGeneration of the base, whichever is greater ( see top of file )
+
+            @param filename <str> - Path to the providesDB
+
+            @param segmentFilenames list<str> - Its segments ( see getSegmentFilenames )
+
+            @return <int> - The number. 0 if none has been used
+    '''
+    lastSegmentNumber = 0
+    try:
+        with open(filename, 'rb') as f:
+            headerData = f.read(_HEADER_STRUCT.size)
+        if len(headerData) == _HEADER_STRUCT.size and headerData.startswith(DB_MAGIC):
+            lastSegmentNumber = _HEADER_STRUCT.unpack(headerData)[3]
+    except FileNotFoundError:
+        pass
+
+    if segmentFilenames:
+        lastSegmentNumber = max( lastSegmentNumber, _getSegmentNumber(filename, segmentFilenames[-1]) )
+
+    return lastSegmentNumber
+
+
+def _replaceProvidesDBBase(filename, results, sortBufferSize=None, compression=None, compressThreads=None):
+    '''
+        _replaceProvidesDBBase - Write a new base, which holds everything in #results , and remove the segments.
+          The lock must be held.
+
+            @param filename <str> - Path to the providesDB
+
+            @param results <dict/iter> - Package records ( see writeProvidesDB ). This may read the segments, they are removed after.
+
+            @return list<str> - The segments which were removed
+    '''
+    segmentFilenames = getSegmentFilenames(filename)
+
+    # The new base takes the place of the segments, so segments after it are numbered after them
+    segmentGeneration = _getLastSegmentNumber(filename, segmentFilenames)
+
+    _writeProvidesDBFile(filename, results, sortBufferSize=sortBufferSize, compression=compression, compressThreads=compressThreads, segmentGeneration=segmentGeneration)
+
+    _removeSegments(segmentFilenames)
+
+    return segmentFilenames
+
+
+def writeProvidesDB(filename, results, sortBufferSize=None, compression=None, compressThreads=None):
+    '''
+        writeProvidesDB - Write a whole binary providesDB, replacing the base and any segments
+
+            @param filename <str> - Path to write
+
+            @param results <dict/iter> - Dict of package name -> package record, same as the json
+              formats (0.2), or an iterator of ( package name, package record ) . An iterator is read
+              one record at a time, so need not all be in memory ( see ProvidesDB.iterRecords ).
+              Each record is a dict of:
+
+                'files'       <list<str>> - The files the package provides
+                'version'     <str>       - The package version
+                'error'       <None/str>  - Error string if we failed to get the file list
+                'mtreeOffset' <int>       - (optional) Compressed offset where the .MTREE ended
+
+              A "__vers" key, if present, is ignored.
+
+            @param sortBufferSize <None/int> default None - Approximate memory to use for each sort, None for SORT_BUFFER_SIZE
+
+            @param compression <None/tuple( codec<str>, level<int> )> default None - Block-compress the path table and
+              id list tables with this codec and level ( see parseCompression ). None to not compress. Compression
+              makes the file smaller, but each lookup must decompress a block.
+
+            @param compressThreads <None/int> default None - Number of threads compressing blocks, None for the number of cpus
+    '''
+    with _ProvidesDBLock(filename):
+        _replaceProvidesDBBase(filename, results, sortBufferSize=sortBufferSize, compression=compression, compressThreads=compressThreads)
+
+
+def appendProvidesDBSegment(filename, changedResults, removedPackageNames):
+    '''
+        appendProvidesDBSegment - Append a segment to a binary providesDB, holding just the packages
+          which have changed and the names of those removed.
+
+            @param filename <str> - Path to the providesDB (the base, which must exist)
+
+            @param changedResults <dict/iter> - Package records which are new or changed ( see writeProvidesDB )
+
+            @param removedPackageNames <list<str>> - Names of packages removed
+
+            @return <int> - The number of segments, including the new one. See MAX_SEGMENTS
+
+          Segments are small, so are never compressed.
+    '''
+    with _ProvidesDBLock(filename):
+        return _appendProvidesDBSegment(filename, changedResults, removedPackageNames)
+
+
+def _appendProvidesDBSegment(filename, changedResults, removedPackageNames):
+    # appendProvidesDBSegment, with the lock already held
+    if not isBinaryProvidesDB(filename):
+        raise ProvidesDBException('Cannot append a segment to "%s", it is not a binary providesDB.' %(filename, ))
+
+    segmentFilenames = getSegmentFilenames(filename)
+    segmentNumber = _getLastSegmentNumber(filename, segmentFilenames) + 1
+
+    _writeProvidesDBFile(filename + SEGMENT_SUFFIX + str(segmentNumber), changedResults, removedPackageNames)
+
+    return len(segmentFilenames) + 1
+
+
+def compactProvidesDB(filename, compressThreads=None):
+    '''
+        compactProvidesDB - Fold the segments of a providesDB into its base. The base stays compressed the way it was.
+
+            @param filename <str> - Path to the providesDB
+
+            @param compressThreads <None/int> default None - Number of threads compressing blocks, None for the number of cpus
+
+            @return <int> - Number of segments folded in
+    '''
+    with _ProvidesDBLock(filename):
+        segmentFilenames = getSegmentFilenames(filename)
+        if not segmentFilenames:
+            return 0
+
+        with ProvidesDB(filename) as providesDB:
+            _replaceProvidesDBBase( filename, providesDB.iterRecords(), compression=providesDB.base.compression, compressThreads=compressThreads )
+
+        return len(segmentFilenames)
+
+
+####################
+### Reading
+################
+
+class _BaseStringTable(object):
+    '''
+        _BaseStringTable - The interface of the string tables. Subclasses have #count , and implement
+          #get and #lowerBound ( and #prefixRange ).
+    '''
+
+    def __len__(self):
+        return self.count
+
+    def iterRange(self, start, end):
+        '''
+            iterRange - Iterate over a range of strings
+
+                @param start <int> - First index
+
+                @param end <int> - Stop before this index
+
+                @return generator< tuple( idx<int>, value<bytes> ) >
+        '''
+        for idx in range(start, end):
+            yield ( idx, self.get(idx) )
+
+    def find(self, value):
+        '''
+            find - Find a string
+
+                @param value <bytes> - Value
+
+                @return <int/None> - Index, or None if not present
+        '''
+        idx = self.lowerBound(value)
+        if idx < self.count and self.get(idx) == value:
+            return idx
+
+        return None
+
+    def iterContaining(self, value, isSuffix=False):
+        '''
+            iterContaining - Find the strings which contain #value, by reading each one
+
+                @param value <bytes> - Value
+
+                @param isSuffix <bool> default False - If True, only strings which end with #value
+
+                @return generator<int> - Indexes, in order
+        '''
+        for (idx, tableValue) in self.iterRange(0, self.count):
+            if (isSuffix and tableValue.endswith(value)) or (not isSuffix and value in tableValue):
+                yield idx
+
+
+class _StringTable(_BaseStringTable):
+    '''
+        _StringTable - A memory-mapped string table (see top of file). Strings are bytes.
+
+          The offset of each string is stored, so #iterContaining searches the string data directly.
+    '''
+
+    def __init__(self, mm, start):
+        '''
+            __init__ - Create a _StringTable
+
+                @param mm <mmap.mmap> - The database
+
+                @param start <int> - Offset of the chunk
+        '''
+        self._mm = mm
+        self.count = _UINT32_STRUCT.unpack_from(mm, start)[0]
+        self._offsetsStart = start + 4
+        self._dataStart = self._offsetsStart + ( 4 * (self.count + 1) )
+
+    def get(self, idx):
+        '''
+            get - Get a string
+
+                @param idx <int> - Index
+
+                @return <bytes> - The string
+        '''
+        (start, end) = _UINT32_PAIR_STRUCT.unpack_from(self._mm, self._offsetsStart + (4 * idx))
+
+        return self._mm[ self._dataStart + start : self._dataStart + end ]
+
+    def lowerBound(self, value):
+        '''
+            lowerBound - Binary search for the first string >= #value
+
+                @param value <bytes> - Value
+
+                @return <int> - Index (count if all strings are < #value)
+        '''
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def prefixRange(self, prefix):
+        '''
+            prefixRange - Get the range of strings which start with #prefix
+
+                @param prefix <bytes> - The prefix
+
+                @return tuple( start<int>, end<int> ) - Indexes [start, end)
+        '''
+        lo = self.lowerBound(prefix)
+
+        prefixLen = len(prefix)
+        (hi, end) = (lo, self.count)
+        while hi < end:
+            mid = (hi + end) // 2
+            if self.get(mid)[ : prefixLen ] == prefix:
+                hi = mid + 1
+            else:
+                end = mid
+
+        return (lo, hi)
+
+    def getOffsets(self):
+        '''
+            getOffsets - Read the whole offset column
+
+                @return <array.array> - The ( count + 1 ) offsets
+        '''
+        offsets = array('I', self._mm[ self._offsetsStart : self._dataStart ])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        return offsets
+
+    def iterContaining(self, value, isSuffix=False):
+        '''
+            iterContaining - Find the strings which contain #value, by searching the string data directly
+
+                @param value <bytes> - Value
+
+                @param isSuffix <bool> default False - If True, only strings which end with #value
+
+                @return generator<int> - Indexes, in order
+        '''
+        if not value:
+            for idx in range(self.count):
+                yield idx
+            return
+
+        offsets = self.getOffsets()
+
+        mm = self._mm
+        dataStart = self._dataStart
+        dataEnd = dataStart + offsets[-1]
+        valueLen = len(value)
+
+        pos = mm.find(value, dataStart, dataEnd)
+        while pos != -1:
+            relPos = pos - dataStart
+            idx = bisect.bisect_right(offsets, relPos) - 1
+            # Strings are back-to-back, so a hit may span two of them
+            if isSuffix:
+                isMatch = ( relPos + valueLen == offsets[idx + 1] )
+            else:
+                isMatch = ( relPos + valueLen <= offsets[idx + 1] )
+
+            if isMatch:
+                yield idx
+                pos = mm.find(value, dataStart + offsets[idx + 1], dataEnd)
+            else:
+                pos = mm.find(value, pos + 1, dataEnd)
+
+
+class _FrontCodedStringTable(_BaseStringTable):
+    '''
+        _FrontCodedStringTable - A memory-mapped front-coded string table (see top of file). Strings are bytes.
+
+          Same interface as _StringTable, but there is no offset for each string, so #iterContaining reads
+           each string. Reading in order ( iterRange ) decodes each block once.
+    '''
+
+    def __init__(self, mm, start):
+        '''
+            __init__ - Create a _FrontCodedStringTable
+
+                @param mm <mmap.mmap> - The database
+
+                @param start <int> - Offset of the chunk
+        '''
+        self._mm = mm
+        (self.count, self.blockSize) = _UINT32_PAIR_STRUCT.unpack_from(mm, start)
+        self.numBlocks = (self.count + self.blockSize - 1) // self.blockSize
+        self._blockOffsetsStart = start + 8
+        self._dataStart = self._blockOffsetsStart + ( 4 * (self.numBlocks + 1) )
+
+        # _lastBlock - tuple( blockIdx, list<bytes> ) of the last block fully decoded, as lookups are often
+        #   near each other ( e.x. the candidates for a glob )
+        self._lastBlock = (None, None)
+
+    def _getBlockData(self, blockIdx):
+        (start, end) = _UINT32_PAIR_STRUCT.unpack_from(self._mm, self._blockOffsetsStart + (4 * blockIdx))
+
+        return self._mm[ self._dataStart + start : self._dataStart + end ]
+
+    @staticmethod
+    def _decodeBlock(blockData, numStrings):
+        '''
+            _decodeBlock - Decode the strings in a block
+
+                @param blockData <bytes> - The block
+
+                @param numStrings <int> - Max number of strings to decode
+
+                @return generator<bytes> - The strings, in order
+        '''
+        pos = 0
+        value = b''
+        for i in range(numStrings):
+            if i == 0:
+                sharedLen = 0
+            else:
+                sharedLen = blockData[pos]
+                pos += 1
+                if sharedLen >= 0x80:
+                    (sharedLen, pos) = _decodeVarintContinued(blockData, pos, sharedLen)
+
+            suffixLen = blockData[pos]
+            pos += 1
+            if suffixLen >= 0x80:
+                (suffixLen, pos) = _decodeVarintContinued(blockData, pos, suffixLen)
+
+            value = value[ : sharedLen ] + blockData[ pos : pos + suffixLen ]
+            pos += suffixLen
+
+            yield value
+
+    def _getBlock(self, blockIdx):
+        '''
+            _getBlock - Get all the strings in a block
+
+                @param blockIdx <int> - Block index
+
+                @return list<bytes> - The strings
+        '''
+        (lastBlockIdx, lastBlock) = self._lastBlock
+        if lastBlockIdx == blockIdx:
+            return lastBlock
+
+        block = list( self._decodeBlock( self._getBlockData(blockIdx), min(self.blockSize, self.count - (blockIdx * self.blockSize)) ) )
+        self._lastBlock = (blockIdx, block)
+
+        return block
+
+    def _getBlockFirst(self, blockIdx):
+        '''
+            _getBlockFirst - Get the first (whole) string in a block
+        '''
+        return next( self._decodeBlock( self._getBlockData(blockIdx), 1 ) )
+
+    def get(self, idx):
+        '''
+            get - Get a string
+
+                @param idx <int> - Index
+
+                @return <bytes> - The string
+        '''
+        (blockIdx, idxInBlock) = divmod(idx, self.blockSize)
+
+        return self._getBlock(blockIdx)[idxInBlock]
+
+    def iterRange(self, start, end):
+        '''
+            iterRange - Iterate over a range of strings
+
+                @param start <int> - First index
+
+                @param end <int> - Stop before this index
+
+                @return generator< tuple( idx<int>, value<bytes> ) >
+        '''
+        end = min(end, self.count)
+        if start >= end:
+            return
+
+        blockSize = self.blockSize
+        (blockIdx, idxInBlock) = divmod(start, blockSize)
+        idx = start
+        while idx < end:
+            for value in self._getBlock(blockIdx)[ idxInBlock : idxInBlock + (end - idx) ]:
+                yield (idx, value)
+                idx += 1
+
+            blockIdx += 1
+            idxInBlock = 0
+
+    def lowerBound(self, value):
+        '''
+            lowerBound - Binary search for the first string >= #value
+
+                @param value <bytes> - Value
+
+                @return <int> - Index (count if all strings are < #value)
+        '''
+        if self.count == 0:
+            return 0
+
+        # Find the last block whose first string is < #value , then search within it
+        (lo, hi) = (0, self.numBlocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._getBlockFirst(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return 0
+
+        blockIdx = lo - 1
+        block = self._getBlock(blockIdx)
+
+        return ( blockIdx * self.blockSize ) + bisect.bisect_left(block, value)
+
+    def prefixRange(self, prefix):
+        '''
+            prefixRange - Get the range of strings which start with #prefix
+
+                @param prefix <bytes> - The prefix
+
+                @return tuple( start<int>, end<int> ) - Indexes [start, end)
+        '''
+        lo = self.lowerBound(prefix)
+
+        # The first string after the range is the lower bound of the next possible prefix
+        #   (the prefix with its last byte incremented, after dropping any trailing 0xFF bytes)
+        nextPrefix = prefix.rstrip(b'\xff')
+        if not nextPrefix:
+            return (lo, self.count)
+
+        nextPrefix = nextPrefix[ : -1 ] + bytes( (nextPrefix[-1] + 1, ) )
+
+        return (lo, self.lowerBound(nextPrefix))
+
+
+class _CompressedFrontCodedStringTable(_FrontCodedStringTable):
+    '''
+        _CompressedFrontCodedStringTable - A front-coded string table in a block-compressed chunk
+    '''
+
+    def __init__(self, chunk):
+        '''
+            __init__ - Create a _CompressedFrontCodedStringTable
+
+                @param chunk <_CompressedChunk> - The chunk
+        '''
+        self._chunk = chunk
+        (self.count, self.blockSize) = chunk.unpackFrom(_UINT32_PAIR_STRUCT, 0)
+        self.numBlocks = (self.count + self.blockSize - 1) // self.blockSize
+        self._blockOffsetsStart = 8
+        self._dataStart = self._blockOffsetsStart + ( 4 * (self.numBlocks + 1) )
+
+        self._lastBlock = (None, None)
+
+    def _getBlockOffset(self, blockIdx):
+        return self._dataStart + self._chunk.unpackFrom(_UINT32_STRUCT, self._blockOffsetsStart + (4 * blockIdx))[0]
+
+    def _getBlockData(self, blockIdx):
+        (start, end) = self._chunk.unpackFrom(_UINT32_PAIR_STRUCT, self._blockOffsetsStart + (4 * blockIdx))
+
+        return self._chunk.read(self._dataStart + start, self._dataStart + end)
+
+    def iterRange(self, start, end):
+        end = min(end, self.count)
+
+        # Decompress the blocks ahead of the scan in parallel, COMPRESSED_SCAN_PREFETCH strings at a time
+        for windowStart in range(start, end, COMPRESSED_SCAN_PREFETCH):
+            windowEnd = min(windowStart + COMPRESSED_SCAN_PREFETCH, end)
+            self._chunk.prefetch( self._getBlockOffset(windowStart // self.blockSize), self._getBlockOffset( ( (windowEnd - 1) // self.blockSize ) + 1 ) )
+
+            for (idx, value) in _FrontCodedStringTable.iterRange(self, windowStart, windowEnd):
+                yield (idx, value)
+
+
+def _decodeVarintContinued(data, pos, firstByte):
+    '''
+        _decodeVarintContinued - Finish decoding a varint whose first byte had the high bit set
+
+            @param data <bytes> - The data
+
+            @param pos <int> - Position after the first byte
+
+            @param firstByte <int> - The first byte
+
+            @return tuple( value<int>, pos<int> ) - The value, and the position after the varint
+    '''
+    value = firstByte & 0x7F
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+
+class _IdListTable(object):
+    '''
+        _IdListTable - A memory-mapped id list table (see top of file)
+    '''
+
+    def __init__(self, mm, start):
+        '''
+            __init__ - Create an _IdListTable
+
+                @param mm <mmap.mmap> - The database
+
+                @param start <int> - Offset of the chunk
+        '''
+        self._mm = mm
+        self.count = _UINT32_STRUCT.unpack_from(mm, start)[0]
+        self._indexesStart = start + 4
+        self._idsStart = self._indexesStart + ( 4 * (self.count + 1) )
+
+    def __len__(self):
+        return self.count
+
+    def get(self, idx):
+        '''
+            get - Get a list of ids
+
+                @param idx <int> - Index
+
+                @return list<int> - The ids
+        '''
+        (start, end) = _UINT32_PAIR_STRUCT.unpack_from(self._mm, self._indexesStart + (4 * idx))
+
+        return list( struct.unpack_from('<%dI' %(end - start, ), self._mm, self._idsStart + (4 * start)) )
+
+    def getAll(self, startIdx, endIdx):
+        '''
+            getAll - Get every id in a range of lists. The lists are stored one after another, so this is one read.
+
+                @param startIdx <int> - First index
+
+                @param endIdx <int> - Stop before this index
+
+                @return tuple<int> - The ids of each list, one list after another
+        '''
+        start = _UINT32_STRUCT.unpack_from(self._mm, self._indexesStart + (4 * startIdx))[0]
+        end = _UINT32_STRUCT.unpack_from(self._mm, self._indexesStart + (4 * endIdx))[0]
+
+        return struct.unpack_from('<%dI' %(end - start, ), self._mm, self._idsStart + (4 * start))
+
+
+class _CompressedIdListTable(_IdListTable):
+    '''
+        _CompressedIdListTable - An id list table in a block-compressed chunk
+    '''
+
+    def __init__(self, chunk):
+        '''
+            __init__ - Create a _CompressedIdListTable
+
+                @param chunk <_CompressedChunk> - The chunk
+        '''
+        self._chunk = chunk
+        self.count = chunk.unpackFrom(_UINT32_STRUCT, 0)[0]
+        self._indexesStart = 4
+        self._idsStart = self._indexesStart + ( 4 * (self.count + 1) )
+
+    def get(self, idx):
+        (start, end) = self._chunk.unpackFrom(_UINT32_PAIR_STRUCT, self._indexesStart + (4 * idx))
+
+        return list( struct.unpack( '<%dI' %(end - start, ), self._chunk.read(self._idsStart + (4 * start), self._idsStart + (4 * end)) ) )
+
+    def getAll(self, startIdx, endIdx):
+        start = self._chunk.unpackFrom(_UINT32_STRUCT, self._indexesStart + (4 * startIdx))[0]
+        end = self._chunk.unpackFrom(_UINT32_STRUCT, self._indexesStart + (4 * endIdx))[0]
+
+        self._chunk.prefetch( self._idsStart + (4 * start), self._idsStart + (4 * end) )
+
+        return struct.unpack( '<%dI' %(end - start, ), self._chunk.read(self._idsStart + (4 * start), self._idsStart + (4 * end)) )
+
+
+def _getSubtreePrefix(dirPath):
+    '''
+        _getSubtreePrefix - Get the prefix of every path under a directory
+
+            @param dirPath <str> - The directory, with or without a trailing "/"
+
+            @return <str> - #dirPath ending in "/"
+    '''
+    if not dirPath.endswith('/'):
+        dirPath += '/'
+
+    return dirPath
+
+
+def _makePackageRecord(files, version, error, mtreeOffset):
+    '''
+        _makePackageRecord - Make a package record, in the same form as the json (0.2) format
+
+            @return <dict> - { 'files' : #files , 'version' : #version , 'error' : #error [, 'mtreeOffset' : #mtreeOffset ] }
+    '''
+    pkgRecord = { 'files' : files, 'version' : version, 'error' : error }
+    if mtreeOffset:
+        pkgRecord['mtreeOffset'] = mtreeOffset
+
+    return pkgRecord
+
+
+class ProvidesDBFile(object):
+    '''
+        ProvidesDBFile - A memory-mapped, read-only, binary providesDB file (a base, or one segment).
+          Use ProvidesDB to read a providesDB with its segments applied.
+
+          Nothing is parsed when opened. Each lookup reads just the pages it needs.
+
+          Package ids and path ids are indexes into the (sorted) package and path tables.
+    '''
+
+    def __init__(self, filename):
+        '''
+            __init__ - Open a providesDB file
+
+                @param filename <str> - Path to the providesDB
+
+                @raises ProvidesDBException - If not a binary providesDB, or an unsupported version
+        '''
+        self.filename = filename
+
+        with open(filename, 'rb') as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                raise ProvidesDBException('providesDB "%s" is empty.' %(filename, ))
+
+        try:
+            self._readChunkTable()
+        except:
+            self.close()
+            raise
+
+    def _readChunkTable(self):
+        '''
+            _readChunkTable - Read the header and the location of each chunk
+        '''
+        mm = self._mm
+
+        if len(mm) < _HEADER_STRUCT.size:
+            raise ProvidesDBException('providesDB "%s" is truncated.' %(self.filename, ))
+
+        (magic, versionBytes, numChunks, self.segmentGeneration) = _HEADER_STRUCT.unpack_from(mm, 0)
+        if magic != DB_MAGIC:
+            raise ProvidesDBException('"%s" is not a binary providesDB.' %(self.filename, ))
+
+        self.version = versionBytes.rstrip(b'\x00').decode('ascii')
+        if self.version != DB_FORMAT_VERSION:
+            raise ProvidesDBException('providesDB version %s is not the supported version, %s.' %(self.version, DB_FORMAT_VERSION))
+
+        self._chunks = {}
+        # _compressedChunkTags - The chunks which are block-compressed (their tag in the file is lower case)
+        self._compressedChunkTags = set()
+        for i in range(numChunks):
+            (chunkTag, chunkOffset, chunkSize) = _CHUNK_STRUCT.unpack_from(mm, _HEADER_STRUCT.size + (_CHUNK_STRUCT.size * i))
+            if chunkOffset + chunkSize > len(mm):
+                raise ProvidesDBException('providesDB "%s" is truncated.' %(self.filename, ))
+            if chunkTag.upper() in COMPRESSIBLE_CHUNKS and chunkTag != chunkTag.upper():
+                chunkTag = chunkTag.upper()
+                self._compressedChunkTags.add(chunkTag)
+            self._chunks[chunkTag] = (chunkOffset, chunkSize)
+
+        for chunkTag in (CHUNK_STRINGS, CHUNK_PACKAGES, CHUNK_PATH_PACKAGES):
+            if chunkTag not in self._chunks:
+                raise ProvidesDBException('providesDB "%s" is missing the "%s" table.' %(self.filename, chunkTag.decode('ascii')))
+        if CHUNK_FRONT_CODED_PATHS not in self._chunks and CHUNK_PATHS not in self._chunks:
+            raise ProvidesDBException('providesDB "%s" is missing the path table.' %(self.filename, ))
+
+        self._stringsStart = self._chunks[CHUNK_STRINGS][0]
+
+        packagesStart = self._chunks[CHUNK_PACKAGES][0]
+        self.numPackages = _UINT32_STRUCT.unpack_from(mm, packagesStart)[0]
+        self._packagesStart = packagesStart + 4
+
+        # compression - tuple( codec, level ) of the compressed chunks, or None
+        self.compression = None
+        self._openCompressedChunks = {}
+        for chunkTag in self._compressedChunkTags:
+            compressedChunk = _CompressedChunk(mm, self._chunks[chunkTag][0], self.filename)
+            self._openCompressedChunks[chunkTag] = compressedChunk
+            self.compression = ( compressedChunk.codec, compressedChunk.level )
+
+        if CHUNK_FRONT_CODED_PATHS in self._openCompressedChunks:
+            self._paths = _CompressedFrontCodedStringTable( self._openCompressedChunks[CHUNK_FRONT_CODED_PATHS] )
+        elif CHUNK_FRONT_CODED_PATHS in self._chunks:
+            self._paths = _FrontCodedStringTable(mm, self._chunks[CHUNK_FRONT_CODED_PATHS][0])
+        else:
+            self._paths = _StringTable(mm, self._chunks[CHUNK_PATHS][0])
+        self.numPaths = len(self._paths)
+
+        self._pathPackages = self._openIdListTable(CHUNK_PATH_PACKAGES)
+
+        if CHUNK_PACKAGE_PATHS in self._chunks:
+            self._packagePaths = self._openIdListTable(CHUNK_PACKAGE_PATHS)
+        else:
+            self._packagePaths = None
+
+        if CHUNK_PATH_HASH in self._chunks:
+            hashStart = self._chunks[CHUNK_PATH_HASH][0]
+            self._hashMask = _UINT32_STRUCT.unpack_from(mm, hashStart)[0] - 1
+            self._hashBucketsStart = hashStart + 4
+        else:
+            self._hashMask = None
+
+        if all( chunkTag in self._chunks for chunkTag in (CHUNK_BASENAMES, CHUNK_BASENAME_PATHS, CHUNK_DIRNAMES, CHUNK_DIRNAME_RANGES) ):
+            self._basenames = _StringTable(mm, self._chunks[CHUNK_BASENAMES][0])
+            self._basenamePaths = self._openIdListTable(CHUNK_BASENAME_PATHS)
+            self._dirnames = _StringTable(mm, self._chunks[CHUNK_DIRNAMES][0])
+            self._dirnameRanges = self._openIdListTable(CHUNK_DIRNAME_RANGES)
+        else:
+            self._basenames = None
+
+        if CHUNK_SONAMES in self._chunks and CHUNK_SONAME_PATHS in self._chunks:
+            self._sonames = _StringTable(mm, self._chunks[CHUNK_SONAMES][0])
+            self._sonamePaths = self._openIdListTable(CHUNK_SONAME_PATHS)
+        else:
+            self._sonames = None
+
+        if CHUNK_REMOVED_PACKAGES in self._chunks:
+            removedPackages = _StringTable(mm, self._chunks[CHUNK_REMOVED_PACKAGES][0])
+            self.removedPackageNames = [ value.decode('utf-8') for (idx, value) in removedPackages.iterRange(0, len(removedPackages)) ]
+        else:
+            self.removedPackageNames = []
+
+    def _openIdListTable(self, chunkTag):
+        if chunkTag in self._openCompressedChunks:
+            return _CompressedIdListTable( self._openCompressedChunks[chunkTag] )
+
+        return _IdListTable(self._mm, self._chunks[chunkTag][0])
+
+    def close(self):
+        '''
+            close - Unmap the database
+        '''
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def preload(self):
+        '''
+            preload - Have the kernel read the whole file into the page cache now, rather than
+              as each page is first needed
+        '''
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self._mm.madvise(mmap.MADV_WILLNEED)
+        else:
+            for offset in range(0, len(self._mm), mmap.PAGESIZE):
+                self._mm[offset]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def __len__(self):
+        return self.numPackages
+
+    ######## Packages
+
+    def _getString(self, offset):
+        '''
+            _getString - Get a string from the string pool
+
+                @param offset <int> - Offset into the pool, or NO_STRING
+
+                @return <str/None> - The string
+        '''
+        if offset == NO_STRING:
+            return None
+
+        start = self._stringsStart + offset
+        end = self._mm.find(b'\x00', start)
+
+        return self._mm[start : end].decode('utf-8')
+
+    def getPackage(self, pkgId):
+        '''
+            getPackage - Get a package's info (not including files)
+
+                @param pkgId <int> - Package id
+
+                @return tuple( name<str>, version<str>, error<str/None>, mtreeOffset<int/None> )
+        '''
+        (nameOffset, versionOffset, errorOffset, mtreeOffset) = _PACKAGE_STRUCT.unpack_from(self._mm, self._packagesStart + (_PACKAGE_STRUCT.size * pkgId))
+
+        return ( self._getString(nameOffset), self._getString(versionOffset), self._getString(errorOffset), mtreeOffset or None )
+
+    def getPackageName(self, pkgId):
+        '''
+            getPackageName - Get a package's name
+
+                @param pkgId <int> - Package id
+
+                @return <str> - Package name
+        '''
+        return self._getString( _UINT32_STRUCT.unpack_from(self._mm, self._packagesStart + (_PACKAGE_STRUCT.size * pkgId))[0] )
+
+    def iterPackages(self):
+        '''
+            iterPackages - Iterate over all packages, in name order
+
+                @return generator< tuple( pkgId<int>, name<str>, version<str>, error<str/None>, mtreeOffset<int/None> ) >
+        '''
+        for pkgId in range(self.numPackages):
+            yield (pkgId, ) + self.getPackage(pkgId)
+
+    def getPackageNames(self):
+        '''
+            getPackageNames - Get the names of all packages
+
+                @return list<str> - Names, sorted
+        '''
+        return [ self.getPackageName(pkgId) for pkgId in range(self.numPackages) ]
+
+    def findPackageId(self, name):
+        '''
+            findPackageId - Find a package by name (a binary search of the package table)
+
+                @param name <str> - Package name
+
+                @return <int/None> - Package id, or None if not in this file
+        '''
+        (low, high) = (0, self.numPackages)
+        while low < high:
+            mid = (low + high) // 2
+            if self.getPackageName(mid) < name:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low < self.numPackages and self.getPackageName(low) == name:
+            return low
+
+        return None
+
+    def getPackagePathIds(self, pkgId):
+        '''
+            getPackagePathIds - Get the ids of the paths a package provides
+
+                @param pkgId <int> - Package id
+
+                @return list<int> - Path ids, sorted
+
+                @raises ProvidesDBException - If the file has no "PPTH" table (written before it was added)
+        '''
+        if self._packagePaths is None:
+            raise ProvidesDBException('providesDB "%s" has no table of the paths each package provides. Rewrite it with extractMtree.py --compact or a full update.' %(self.filename, ))
+
+        return self._packagePaths.get(pkgId)
+
+    def iterPackageFiles(self, pkgName):
+        '''
+            iterPackageFiles - Iterate over the paths a package provides, reading each as it is needed.
+
+              Uses the table of the paths each package provides. A file written before it was added is scanned instead.
+
+                @param pkgName <str> - Package name
+
+                @return generator<str> - Paths, in sorted order. Nothing if the package is not in this file.
+        '''
+        pkgId = self.findPackageId(pkgName)
+        if pkgId is None:
+            return
+
+        if self._packagePaths is None:
+            for pathId in range(self.numPaths):
+                if pkgId in self._pathPackages.get(pathId):
+                    yield self.getPath(pathId)
+            return
+
+        for pathId in self._packagePaths.get(pkgId):
+            yield self.getPath(pathId)
+
+    def iterRecords(self, skipPackageNames=None):
+        '''
+            iterRecords - Iterate over the package records one at a time, in name order, in the same form as toDict
+
+              Only the current record is in memory. A file without a "PPTH" table is read with toDict.
+
+                @param skipPackageNames <None/set<str>> default None - Names of packages to skip
+
+                @return generator< tuple( name<str>, record<dict> ) >
+        '''
+        if self._packagePaths is None:
+            for (name, pkgRecord) in self.toDict().items():
+                if not skipPackageNames or name not in skipPackageNames:
+                    yield (name, pkgRecord)
+            return
+
+        for (pkgId, name, version, error, mtreeOffset) in self.iterPackages():
+            if skipPackageNames and name in skipPackageNames:
+                continue
+
+            files = [ self.getPath(pathId) for pathId in self._packagePaths.get(pkgId) ]
+
+            yield ( name, _makePackageRecord(files, version, error, mtreeOffset) )
+
+    ######## Paths
+
+    def getPathBytes(self, pathId):
+        '''
+            getPathBytes - Get a path, as utf-8 bytes
+
+                @param pathId <int> - Path id
+
+                @return <bytes> - The path
+        '''
+        return self._paths.get(pathId)
+
+    def getPath(self, pathId):
+        '''
+            getPath - Get a path
+
+                @param pathId <int> - Path id
+
+                @return <str> - The path
+        '''
+        return self._paths.get(pathId).decode('utf-8')
+
+    def findPathId(self, path):
+        '''
+            findPathId - Find a path in the path table.
+
+              Uses the hash index (a few probes), or a binary search if the database does not have one.
+
+                @param path <str> - The path
+
+                @return <int/None> - Path id, or None if no package provides #path
+        '''
+        pathBytes = path.encode('utf-8')
+
+        if self._hashMask is not None:
+            return self._findPathIdByHash(pathBytes)
+
+        return self._paths.find(pathBytes)
+
+    def _findPathIdByHash(self, pathBytes):
+        '''
+            _findPathIdByHash - Find a path using the hash index
+
+                @param pathBytes <bytes> - utf-8 path
+
+                @return <int/None> - Path id, or None if not present
+        '''
+        mm = self._mm
+        mask = self._hashMask
+        bucketsStart = self._hashBucketsStart
+
+        pathHash = _hashPath(pathBytes)
+        bucketIdx = pathHash & mask
+        while True:
+            (bucketHash, pathIdPlusOne) = _HASH_BUCKET_STRUCT.unpack_from(mm, bucketsStart + (8 * bucketIdx))
+            if pathIdPlusOne == 0:
+                return None
+            if bucketHash == pathHash and self._paths.get(pathIdPlusOne - 1) == pathBytes:
+                return pathIdPlusOne - 1
+
+            bucketIdx = (bucketIdx + 1) & mask
+
+    def getPathPackageIds(self, pathId):
+        '''
+            getPathPackageIds - Get the ids of the packages which provide a path
+
+                @param pathId <int> - Path id
+
+                @return list<int> - Package ids
+        '''
+        return self._pathPackages.get(pathId)
+
+    def getPrefixRange(self, prefix):
+        '''
+            getPrefixRange - Get the range of path ids of every path starting with #prefix
+
+                @param prefix <str> - The prefix
+
+                @return tuple( start<int>, end<int> ) - Path ids [start, end)
+        '''
+        return self._paths.prefixRange( prefix.encode('utf-8') )
+
+    def iterPaths(self, start=0, end=None):
+        '''
+            iterPaths - Iterate over the paths, in sorted order
+
+                @param start <int> default 0 - First path id
+
+                @param end <int/None> default None - Stop before this path id, None for all
+
+                @return generator< tuple( pathId<int>, path<str> ) >
+        '''
+        if end is None:
+            end = self.numPaths
+
+        for (pathId, pathBytes) in self._paths.iterRange(start, end):
+            yield ( pathId, pathBytes.decode('utf-8') )
+
+    ######## Queries
+
+    def whatProvides(self, path):
+        '''
+            whatProvides - Get the names of the packages which provide a path
+
+                @param path <str> - Absolute path (directories end in "/")
+
+                @return list<str> - Package names, sorted
+        '''
+        pathId = self.findPathId(path)
+        if pathId is None:
+            return []
+
+        return sorted( self.getPackageName(pkgId) for pkgId in self.getPathPackageIds(pathId) )
+
+    def whatProvidesMany(self, paths):
+        '''
+            whatProvidesMany - Get the names of the packages which provide each of many paths.
+
+              The lookups are grouped, so each page is read once: the paths are found in hash index order
+                (or in sorted order, for a binary search), then their packages read in path table order.
+
+                @param paths <iter<str>> - Absolute paths (directories end in "/")
+
+                @return dict< str : list<str> > - path -> Package names, sorted. Paths no package provides are not included.
+        '''
+        pathBytesList = sorted( set( path.encode('utf-8') for path in paths ) )
+
+        if self._hashMask is not None:
+            mask = self._hashMask
+            pathBytesList.sort( key=lambda pathBytes : _hashPath(pathBytes) & mask )
+            findPathId = self._findPathIdByHash
+        else:
+            findPathId = self._paths.find
+
+        foundPaths = []
+        for pathBytes in pathBytesList:
+            pathId = findPathId(pathBytes)
+            if pathId is not None:
+                foundPaths.append( (pathId, pathBytes) )
+
+        foundPaths.sort()
+
+        # Most paths are provided by a few packages (glibc, etc), so only read each name once
+        pkgNamesById = {}
+
+        results = {}
+        for (pathId, pathBytes) in foundPaths:
+            pkgNames = []
+            for pkgId in self.getPathPackageIds(pathId):
+                pkgName = pkgNamesById.get(pkgId)
+                if pkgName is None:
+                    pkgName = pkgNamesById[pkgId] = self.getPackageName(pkgId)
+                pkgNames.append(pkgName)
+
+            results[ pathBytes.decode('utf-8') ] = sorted(pkgNames)
+
+        return results
+
+    def _getGlobCandidateRanges(self, globStr):
+        '''
+            _getGlobCandidateRanges - Use planGlob to find the path ids which may match a glob
+
+                @param globStr <str> - The glob
+
+                @return list< tuple(start<int>, end<int>) > - Sorted, non-overlapping ranges of path ids
+        '''
+        (planType, value) = planGlob(globStr)
+
+        if planType == GLOB_PLAN_EXACT:
+            pathId = self.findPathId(value)
+            return [] if pathId is None else [ (pathId, pathId + 1) ]
+
+        if planType == GLOB_PLAN_PREFIX:
+            return [ self.getPrefixRange(value) ]
+
+        if planType == GLOB_PLAN_SCAN or self._basenames is None:
+            return [ (0, self.numPaths) ]
+
+        valueBytes = value.encode('utf-8')
+
+        def _findNames(stringTable):
+            if planType in (GLOB_PLAN_BASENAME, GLOB_PLAN_COMPONENT):
+                nameId = stringTable.find(valueBytes)
+                return [] if nameId is None else [ nameId ]
+            elif planType == GLOB_PLAN_BASENAME_PREFIX:
+                return range( *stringTable.prefixRange(valueBytes) )
+            else:
+                return stringTable.iterContaining(valueBytes, isSuffix=(planType == GLOB_PLAN_BASENAME_SUFFIX) )
+
+        ranges = []
+
+        # A whole component must be a directory, otherwise the match may be the basename
+        if planType != GLOB_PLAN_COMPONENT:
+            for basenameId in _findNames(self._basenames):
+                ranges += [ (pathId, pathId + 1) for pathId in self._basenamePaths.get(basenameId) ]
+
+        # Unless the match must be the basename itself, it may also be anything under a directory with that name
+        if planType not in (GLOB_PLAN_BASENAME, GLOB_PLAN_BASENAME_SUFFIX):
+            for dirnameId in _findNames(self._dirnames):
+                subtrees = self._dirnameRanges.get(dirnameId)
+                ranges += zip(subtrees[0::2], subtrees[1::2])
+
+        ranges.sort()
+
+        mergedRanges = []
+        for (start, end) in ranges:
+            if mergedRanges and start <= mergedRanges[-1][1]:
+                if end > mergedRanges[-1][1]:
+                    mergedRanges[-1] = (mergedRanges[-1][0], end)
+            else:
+                mergedRanges.append( (start, end) )
+
+        return mergedRanges
+
+    def whatProvidesSonames(self, sonames):
+        '''
+            whatProvidesSonames - Find the shared libraries with each of many sonames ( e.x. the DT_NEEDED of some binaries ),
+              and the packages which provide them. Only libraries directly in LIBRARY_DIRS are found, as the dynamic linker would.
+
+              Each soname is looked up in the "SONM" index. Files written without it look up the soname in each of LIBRARY_DIRS.
+
+                @param sonames <iter<str>> - The sonames ( e.x. "libz.so.1" )
+
+                @return dict< soname<str> : list< tuple( path<str>, pkgNames<list<str>> ) > > - The libraries with each soname,
+                  sorted by path. Sonames not found are not included.
+        '''
+        results = {}
+
+        if self._sonames is None:
+            candidatePaths = { libDir + '/' + soname : soname for soname in set(sonames) for libDir in LIBRARY_DIRS }
+            for (path, pkgNames) in sorted( self.whatProvidesMany(candidatePaths).items() ):
+                results.setdefault( candidatePaths[path], [] ).append( (path, pkgNames) )
+
+            return results
+
+        pkgNamesById = {}
+        for soname in set(sonames):
+            sonameId = self._sonames.find( soname.encode('utf-8') )
+            if sonameId is None:
+                continue
+
+            for pathId in self._sonamePaths.get(sonameId):
+                pkgNames = []
+                for pkgId in self.getPathPackageIds(pathId):
+                    pkgName = pkgNamesById.get(pkgId)
+                    if pkgName is None:
+                        pkgName = pkgNamesById[pkgId] = self.getPackageName(pkgId)
+                    pkgNames.append(pkgName)
+
+                results.setdefault(soname, []).append( (self.getPath(pathId), sorted(pkgNames)) )
+
+        return results
+
+    def iterGlob(self, globStr):
+        '''
+            iterGlob - Find the paths which match a glob. The glob is planned (see planGlob)
+              so that only candidate paths are matched against the regex.
+
+                @param globStr <str> - The glob ( see globToRE )
+
+                @return generator< tuple( pathId<int>, path<str> ) > - Matching paths, in sorted order
+        '''
+        globRE = globToRE(globStr)
+
+        for (start, end) in self._getGlobCandidateRanges(globStr):
+            for (pathId, path) in self.iterPaths(start, end):
+                if globRE.match(path):
+                    yield (pathId, path)
+
+    def iterGlobProviders(self, globStr):
+        '''
+            iterGlobProviders - Find the paths which match a glob, and the packages which provide them
+
+                @param globStr <str> - The glob ( see globToRE )
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - Matching paths, in sorted order
+        '''
+        for (pathId, path) in self.iterGlob(globStr):
+            yield ( path, [ self.getPackageName(pkgId) for pkgId in self.getPathPackageIds(pathId) ] )
+
+    def iterSubtreeProviders(self, dirPath):
+        '''
+            iterSubtreeProviders - Iterate over every path under a directory (including the directory itself),
+              and the packages which provide them. This is a scan of one range of the sorted path table.
+
+                @param dirPath <str> - The directory
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - Paths, in sorted order
+        '''
+        (start, end) = self.getPrefixRange( _getSubtreePrefix(dirPath) )
+
+        pkgNamesById = {}
+        for (pathId, path) in self.iterPaths(start, end):
+            pkgNames = []
+            for pkgId in self.getPathPackageIds(pathId):
+                pkgName = pkgNamesById.get(pkgId)
+                if pkgName is None:
+                    pkgName = pkgNamesById[pkgId] = self.getPackageName(pkgId)
+                pkgNames.append(pkgName)
+
+            yield (path, pkgNames)
+
+    def getSubtreePackages(self, dirPath):
+        '''
+            getSubtreePackages - Get the names of the packages which provide anything under a directory (including the directory itself).
+
+              Only the package ids of the range of paths are read (SUBTREE_SCAN_SIZE paths at a time), not the paths themselves.
+
+                @param dirPath <str> - The directory
+
+                @return list<str> - Package names, sorted
+        '''
+        (start, end) = self.getPrefixRange( _getSubtreePrefix(dirPath) )
+
+        pkgIds = set()
+        for scanStart in range(start, end, SUBTREE_SCAN_SIZE):
+            pkgIds.update( self._pathPackages.getAll(scanStart, min(scanStart + SUBTREE_SCAN_SIZE, end)) )
+
+        return sorted( self.getPackageName(pkgId) for pkgId in pkgIds )
+
+    def toDict(self):
+        '''
+            toDict - Load the whole file into a dict, in the same form as the json (0.2) format
+              and as accepted by writeProvidesDB
+
+                @return <dict> - package name -> { 'files' : [...], 'version' : ..., 'error' : ..., 'mtreeOffset' : ... }
+        '''
+        results = {}
+        packageFiles = []
+        for (pkgId, name, version, error, mtreeOffset) in self.iterPackages():
+            files = []
+            packageFiles.append(files)
+
+            results[name] = _makePackageRecord(files, version, error, mtreeOffset)
+
+        for (pathId, path) in self.iterPaths():
+            for pkgId in self.getPathPackageIds(pathId):
+                packageFiles[pkgId].append(path)
+
+        return results
+
+
+class ProvidesDB(object):
+    '''
+        ProvidesDB - A read-only, binary providesDB: the base with any segments applied (newest-first).
+
+          Each file is memory-mapped ( see ProvidesDBFile ). Segments are small, so the only thing
+            read up front is the names of the packages each one replaces.
+    '''
+
+    def __init__(self, filename):
+        '''
+            __init__ - Open a providesDB and its segments
+
+                @param filename <str> - Path to the providesDB
+
+                @raises ProvidesDBException - If not a binary providesDB, or an unsupported version
+        '''
+        self.filename = filename
+
+        # Segments are opened before the base. See top of file.
+        segmentFiles = []
+        try:
+            for segmentFilename in reversed( getSegmentFilenames(filename) ):
+                try:
+                    segmentFiles.append( ( _getSegmentNumber(filename, segmentFilename), ProvidesDBFile(segmentFilename) ) )
+                except FileNotFoundError:
+                    # Removed by a compaction since we listed them, so the base we open will have it
+                    pass
+
+            self.base = ProvidesDBFile(filename)
+        except:
+            for (segmentNumber, segmentFile) in segmentFiles:
+                segmentFile.close()
+            raise
+
+        # A compaction since we listed the segments wrote a base which already holds these
+        for (segmentNumber, segmentFile) in segmentFiles:
+            if segmentNumber <= self.base.segmentGeneration:
+                segmentFile.close()
+        segmentFiles = [ segmentFile for (segmentNumber, segmentFile) in segmentFiles if segmentNumber > self.base.segmentGeneration ]
+
+        self.version = self.base.version
+
+        # layers - tuple( ProvidesDBFile, hiddenPackageNames<set<str>> ) newest first. hiddenPackageNames are
+        #   the packages in, or removed by, a newer segment
+        self.layers = []
+        hiddenPackageNames = set()
+        for dbFile in segmentFiles + [ self.base ]:
+            self.layers.append( (dbFile, hiddenPackageNames) )
+            if dbFile is not self.base:
+                hiddenPackageNames = hiddenPackageNames.union( dbFile.getPackageNames(), dbFile.removedPackageNames )
+
+        self.numSegments = len(segmentFiles)
+
+    def close(self):
+        '''
+            close - Unmap the database
+        '''
+        for (dbFile, hiddenPackageNames) in self.layers:
+            dbFile.close()
+        self.layers = []
+
+    def preload(self):
+        '''
+            preload - Have the kernel read the whole database into the page cache now ( see ProvidesDBFile.preload )
+        '''
+        for (dbFile, hiddenPackageNames) in self.layers:
+            dbFile.preload()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def iterPackages(self):
+        '''
+            iterPackages - Iterate over all packages
+
+                @return generator< tuple( name<str>, version<str>, error<str/None>, mtreeOffset<int/None> ) >
+        '''
+        for (dbFile, hiddenPackageNames) in self.layers:
+            for (pkgId, name, version, error, mtreeOffset) in dbFile.iterPackages():
+                if name not in hiddenPackageNames:
+                    yield (name, version, error, mtreeOffset)
+
+    def findPackage(self, name):
+        '''
+            findPackage - Find a package by name
+
+                @param name <str> - Package name
+
+                @return <None/tuple( name<str>, version<str>, error<str/None>, mtreeOffset<int/None> )> - None if there is no such package
+        '''
+        for (dbFile, hiddenPackageNames) in self.layers:
+            # Hidden here means it is in, or was removed by, a newer layer
+            if name in hiddenPackageNames:
+                return None
+
+            pkgId = dbFile.findPackageId(name)
+            if pkgId is not None:
+                return dbFile.getPackage(pkgId)
+
+        return None
+
+    def iterRecords(self):
+        '''
+            iterRecords - Iterate over the package records one at a time, in the same form as toDict.
+              Pass to writeProvidesDB to rewrite the database without loading it all.
+
+                @return generator< tuple( name<str>, record<dict> ) >
+        '''
+        for (dbFile, hiddenPackageNames) in self.layers:
+            for (name, pkgRecord) in dbFile.iterRecords(hiddenPackageNames):
+                yield (name, pkgRecord)
+
+    def whatProvides(self, path):
+        '''
+            whatProvides - Get the names of the packages which provide a path
+
+                @param path <str> - Absolute path (directories end in "/")
+
+                @return list<str> - Package names, sorted
+        '''
+        if len(self.layers) == 1:
+            return self.base.whatProvides(path)
+
+        pkgNames = []
+        for (dbFile, hiddenPackageNames) in self.layers:
+            pkgNames += [ pkgName for pkgName in dbFile.whatProvides(path) if pkgName not in hiddenPackageNames ]
+
+        return sorted(pkgNames)
+
+    def whatProvidesMany(self, paths):
+        '''
+            whatProvidesMany - Get the names of the packages which provide each of many paths ( see ProvidesDBFile.whatProvidesMany )
+
+                @param paths <iter<str>> - Absolute paths (directories end in "/")
+
+                @return dict< str : list<str> > - path -> Package names, sorted. Paths no package provides are not included.
+        '''
+        if len(self.layers) == 1:
+            return self.base.whatProvidesMany(paths)
+
+        paths = set(paths)
+
+        results = {}
+        for (dbFile, hiddenPackageNames) in self.layers:
+            for (path, pkgNames) in dbFile.whatProvidesMany(paths).items():
+                pkgNames = [ pkgName for pkgName in pkgNames if pkgName not in hiddenPackageNames ]
+                if pkgNames:
+                    results.setdefault(path, []).extend(pkgNames)
+
+        for pkgNames in results.values():
+            pkgNames.sort()
+
+        return results
+
+    def whatProvidesSonames(self, sonames):
+        '''
+            whatProvidesSonames - Find the shared libraries with each of many sonames, and the packages which provide them
+              ( see ProvidesDBFile.whatProvidesSonames )
+
+                @param sonames <iter<str>> - The sonames ( e.x. "libz.so.1" )
+
+                @return dict< soname<str> : list< tuple( path<str>, pkgNames<list<str>> ) > > - The libraries with each soname,
+                  sorted by path. Sonames not found are not included.
+        '''
+        if len(self.layers) == 1:
+            return self.base.whatProvidesSonames(sonames)
+
+        sonames = set(sonames)
+
+        # sonamePaths - soname -> path -> package names
+        sonamePaths = {}
+        for (dbFile, hiddenPackageNames) in self.layers:
+            for (soname, libraries) in dbFile.whatProvidesSonames(sonames).items():
+                for (path, pkgNames) in libraries:
+                    pkgNames = [ pkgName for pkgName in pkgNames if pkgName not in hiddenPackageNames ]
+                    if pkgNames:
+                        sonamePaths.setdefault(soname, {}).setdefault(path, []).extend(pkgNames)
+
+        return { soname : [ (path, sorted(pkgNames)) for (path, pkgNames) in sorted( pathPkgNames.items() ) ] for (soname, pathPkgNames) in sonamePaths.items() }
+
+    def _iterMergedProviders(self, iterLayerProviders):
+        '''
+            _iterMergedProviders - Merge the paths and packages found in each layer
+
+                @param iterLayerProviders <function> - Called with each ProvidesDBFile, returns a generator of
+                  tuple( path<str>, pkgNames<list<str>> ) in sorted order
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - In sorted order
+        '''
+        if len(self.layers) == 1:
+            for (path, pkgNames) in iterLayerProviders(self.base):
+                yield (path, pkgNames)
+            return
+
+        def _iterLayer(dbFile, hiddenPackageNames):
+            for (path, pkgNames) in iterLayerProviders(dbFile):
+                pkgNames = [ pkgName for pkgName in pkgNames if pkgName not in hiddenPackageNames ]
+                if pkgNames:
+                    yield ( path.encode('utf-8'), path, pkgNames )
+
+        # Each layer is in sorted order, so merge them and combine the same path from multiple layers
+        (curPathBytes, curPath, curPkgNames) = (None, None, [])
+        for (pathBytes, path, pkgNames) in heapq.merge( *[ _iterLayer(dbFile, hiddenPackageNames) for (dbFile, hiddenPackageNames) in self.layers ], key=lambda layerMatch : layerMatch[0] ):
+            if pathBytes != curPathBytes:
+                if curPkgNames:
+                    yield (curPath, curPkgNames)
+                (curPathBytes, curPath, curPkgNames) = (pathBytes, path, [])
+
+            curPkgNames += pkgNames
+
+        if curPkgNames:
+            yield (curPath, curPkgNames)
+
+    def iterGlobProviders(self, globStr):
+        '''
+            iterGlobProviders - Find the paths which match a glob, and the packages which provide them
+
+                @param globStr <str> - The glob ( see globToRE )
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - Matching paths, in sorted order
+        '''
+        return self._iterMergedProviders( lambda dbFile : dbFile.iterGlobProviders(globStr) )
+
+    def iterSubtreeProviders(self, dirPath):
+        '''
+            iterSubtreeProviders - Iterate over every path under a directory, and the packages which provide them ( see ProvidesDBFile.iterSubtreeProviders )
+
+                @param dirPath <str> - The directory
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - Paths, in sorted order
+        '''
+        return self._iterMergedProviders( lambda dbFile : dbFile.iterSubtreeProviders(dirPath) )
+
+    def getSubtreePackages(self, dirPath):
+        '''
+            getSubtreePackages - Get the names of the packages which provide anything under a directory ( see ProvidesDBFile.getSubtreePackages )
+
+                @param dirPath <str> - The directory
+
+                @return list<str> - Package names, sorted
+        '''
+        pkgNames = set()
+        for (dbFile, hiddenPackageNames) in self.layers:
+            pkgNames.update( pkgName for pkgName in dbFile.getSubtreePackages(dirPath) if pkgName not in hiddenPackageNames )
+
+        return sorted(pkgNames)
+
+    def iterPackageFiles(self, pkgName):
+        '''
+            iterPackageFiles - Iterate over the paths a package provides ( see ProvidesDBFile.iterPackageFiles )
+
+                @param pkgName <str> - Package name
+
+                @return generator<str> - Paths, in sorted order. Nothing if there is no such package.
+        '''
+        for (dbFile, hiddenPackageNames) in self.layers:
+            # Hidden here means it is in, or was removed by, a newer layer
+            if pkgName in hiddenPackageNames:
+                return
+
+            if dbFile.findPackageId(pkgName) is not None:
+                for path in dbFile.iterPackageFiles(pkgName):
+                    yield path
+                return
+
+    def toDict(self):
+        '''
+            toDict - Load the whole database into a dict, in the same form as the json (0.2) format
+              and as accepted by writeProvidesDB
+
+                @return <dict> - package name -> { 'files' : [...], 'version' : ..., 'error' : ..., 'mtreeOffset' : ... }
+        '''
+        results = self.base.toDict()
+
+        for (dbFile, hiddenPackageNames) in reversed(self.layers[ : -1 ]):
+            for pkgName in dbFile.removedPackageNames:
+                results.pop(pkgName, None)
+            results.update( dbFile.toDict() )
+
+        return results
+
+
+
+####################
+### Older (json) formats
+################
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+
+class _JsonStreamReader(object):
+    '''
+        _JsonStreamReader - Reads json values one at a time from a stream, holding only
+          what has been read but not yet decoded
+    '''
+
+    def __init__(self, f, readSize=LEGACY_READ_SIZE):
+        '''
+            __init__ - Create a _JsonStreamReader
+
+                @param f <file> - Stream of utf-8 json, opened in binary mode
+
+                @param readSize <int> default LEGACY_READ_SIZE - Bytes to read at a time
+        '''
+        self._f = f
+        self.readSize = readSize
+
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._isEOF = False
+
+    def _readMore(self):
+        # Drop what has been decoded. Read at least as much as is already buffered, so
+        #  a value much larger than readSize is retried a few times, not once per read.
+        self._buf = self._buf[ self._pos : ]
+        self._pos = 0
+
+        data = self._f.read( max(self.readSize, len(self._buf)) )
+        if not data:
+            self._isEOF = True
+        self._buf += self._decoder.decode(data, final=self._isEOF)
+
+    def _skipWhitespace(self):
+        while True:
+            self._pos = _JSON_WHITESPACE_RE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or self._isEOF:
+                return
+            self._readMore()
+
+    def peekChar(self):
+        '''
+            peekChar - Get the next character which is not whitespace, without reading it
+
+                @return <str> - The character, or empty string at the end
+        '''
+        self._skipWhitespace()
+
+        return self._buf[ self._pos : self._pos + 1 ]
+
+    def readChar(self):
+        '''
+            readChar - Read the next character which is not whitespace (e.x. a "," or ":" )
+
+                @return <str> - The character
+        '''
+        self._skipWhitespace()
+        if self._pos >= len(self._buf):
+            raise ProvidesDBException('Unexpected end of json.')
+
+        self._pos += 1
+        return self._buf[ self._pos - 1 ]
+
+    def readValue(self):
+        '''
+            readValue - Read the next json value
+
+                @return <object> - The value
+        '''
+        self._skipWhitespace()
+        while True:
+            try:
+                (value, endPos) = _JSON_DECODER.raw_decode(self._buf, self._pos)
+                # A number at the end of the buffer may continue in the next read
+                if endPos < len(self._buf) or self._isEOF:
+                    self._pos = endPos
+                    return value
+            except ValueError as e:
+                if self._isEOF:
+                    raise ProvidesDBException('Invalid json: %s' %(str(e), ))
+
+            self._readMore()
+
+
+def iterLegacyProvidesDB(filename, readSize=LEGACY_READ_SIZE):
+    '''
+        iterLegacyProvidesDB - Iterate over the entries of an older ( 0.1 or 0.2 ) gzip'd json providesDB, decompressing
+          and decoding one at a time, so only the current record is in memory.
+
+            @param filename <str> - Path to the providesDB
+
+            @param readSize <int> default LEGACY_READ_SIZE - Bytes to decompress at a time
+
+            @return generator< tuple( key<str>, value<object> ) > - Each package name and its record in the
+              format of that version, in the order stored. The version is the value of a "__vers" key, if present.
+
+            @raises ProvidesDBException - If the json is invalid
+    '''
+    with gzip.open(filename, 'rb') as f:
+        reader = _JsonStreamReader(f, readSize)
+
+        if reader.readChar() != '{':
+            raise ProvidesDBException('"%s" is not a providesDB, expected a json object.' %(filename, ))
+
+        if reader.peekChar() == '}':
+            return
+
+        while True:
+            key = reader.readValue()
+            if reader.readChar() != ':':
+                raise ProvidesDBException('Invalid json in "%s", expected ":".' %(filename, ))
+
+            yield ( key, reader.readValue() )
+
+            nextChar = reader.readChar()
+            if nextChar == '}':
+                break
+            if nextChar != ',':
+                raise ProvidesDBException('Invalid json in "%s", expected "," or "}".' %(filename, ))
+
+
+
+####################
+### Installed packages
+################
+#
+#  The pacman local database has a directory for each installed package ( "$name-$version" ), holding
+#   "desc" ( %NAME% , %VERSION% , ... ) and "files" ( %FILES% , paths relative to / , directories ending in "/" ).
+#   whatprovides_local keeps a providesDB of the installed packages, built from it.
+#
+#  The package table of that providesDB doubles as a manifest of what it was built from: each package's
+#   entry is "$name-$version", so comparing those with the entries now in the local database gives the packages
+#   installed, upgraded or removed since. updateLocalProvidesDB appends just those as a segment.
+
+# PACMAN_LOCAL_DIR - The pacman local database
+PACMAN_LOCAL_DIR = '/var/lib/pacman/local'
+
+
+def _parsePacmanDbEntry(contents):
+    '''
+        _parsePacmanDbEntry - Parse an entry (desc, files) of a pacman database
+
+            @param contents <str> - The entry, "%KEY%\nvalue\nvalue\n\n%KEY2%\n..."
+
+            @return dict< str, list<str> > - Map of key (e.x. "%NAME%") -> list of values
+    '''
+    sections = {}
+
+    for section in contents.split('\n\n'):
+        sectionLines = section.strip('\n').split('\n')
+        if sectionLines[0].startswith('%'):
+            sections[sectionLines[0]] = [ line for line in sectionLines[1:] if line ]
+
+    return sections
+
+
+def _readPacmanDbEntry(filename):
+    with open(filename, 'rt', encoding='utf-8', errors='replace') as f:
+        return _parsePacmanDbEntry( f.read() )
+
+
+def iterLocalPackageRecords(localDir=PACMAN_LOCAL_DIR, entryNames=None):
+    '''
+        iterLocalPackageRecords - Read the installed packages from the pacman local database, one at a time
+
+            @param localDir <str> default PACMAN_LOCAL_DIR - The pacman local database
+
+            @param entryNames <None/list<str>> default None - Only read these entries ( "$name-$version" ), None for all
+
+            @return generator< tuple( name<str>, record<dict> ) > - Package records, as accepted by writeProvidesDB.
+              Paths are absolute, and directories end in "/" (as printed by pacman -Ql )
+    '''
+    if entryNames is None:
+        entryNames = os.listdir(localDir)
+
+    for entryName in sorted(entryNames):
+        entryDir = os.path.join(localDir, entryName)
+        try:
+            desc = _readPacmanDbEntry( os.path.join(entryDir, 'desc') )
+        except (FileNotFoundError, NotADirectoryError):
+            # Not a package ( e.x. ALPM_DB_VERSION ), or removed since we listed the directory
+            continue
+
+        if not desc.get('%NAME%'):
+            continue
+
+        try:
+            files = _readPacmanDbEntry( os.path.join(entryDir, 'files') ).get('%FILES%', [])
+        except FileNotFoundError:
+            files = []
+
+        yield ( desc['%NAME%'][0], _makePackageRecord( [ '/' + filename for filename in files ], desc.get('%VERSION%', [''])[0], None, None ) )
+
+
+def _getLocalEntryPackageName(entryName):
+    # A version is "$pkgver-$pkgrel" and neither part may contain a "-", so the name is everything before those
+    return entryName.rsplit('-', 2)[0]
+
+
+def getLocalPackageChanges(providesDB, localDir=PACMAN_LOCAL_DIR, packageNames=None):
+    '''
+        getLocalPackageChanges - Compare a providesDB of the installed packages with the pacman local database.
+          Only the directory listing is read.
+
+            @param providesDB <ProvidesDB> - The providesDB, built by iterLocalPackageRecords
+
+            @param localDir <str> default PACMAN_LOCAL_DIR - The pacman local database
+
+            @param packageNames <None/list<str>> default None - Only compare these packages ( e.x. the targets of a
+              pacman transaction ), None for all
+
+            @return tuple( changedEntryNames<list<str>>, removedPackageNames<list<str>> ) - The entries ( "$name-$version" )
+              installed or upgraded since the providesDB was written, and the names of the packages removed since
+    '''
+    knownEntryNames = { name + '-' + version : name for (name, version, error, mtreeOffset) in providesDB.iterPackages() }
+
+    with os.scandir(localDir) as dirEntries:
+        localEntryNames = set( dirEntry.name for dirEntry in dirEntries if dirEntry.is_dir() )
+
+    if packageNames is not None:
+        packageNames = set(packageNames)
+        knownEntryNames = { entryName : name for (entryName, name) in knownEntryNames.items() if name in packageNames }
+        localEntryNames = set( entryName for entryName in localEntryNames if _getLocalEntryPackageName(entryName) in packageNames )
+
+    changedEntryNames = sorted( localEntryNames.difference(knownEntryNames) )
+
+    changedPackageNames = set( _getLocalEntryPackageName(entryName) for entryName in changedEntryNames )
+
+    removedPackageNames = sorted( name for (entryName, name) in knownEntryNames.items() if entryName not in localEntryNames and name not in changedPackageNames )
+
+    return (changedEntryNames, removedPackageNames)
+
+
+def updateLocalProvidesDB(filename, localDir=PACMAN_LOCAL_DIR):
+    '''
+        updateLocalProvidesDB - Bring a providesDB of the installed packages up to date with the pacman local database.
+          Only the packages installed, upgraded or removed since it was last updated are read, and appended as a segment.
+          If it does not exist (or is not a binary providesDB), the whole thing is written.
+
+          The comparison is made holding the providesDB's lock, so if two updates run at once the second finds nothing to do.
+
+          Every package is compared (only the directory listing is read, see getLocalPackageChanges), so the providesDB
+           is then current, and the base's mtime is set to now. It is compared with the local database's to tell if an
+           update is needed ( see localCacheNeedsUpdate ).
+
+            @param filename <str> - Path to the providesDB
+
+            @param localDir <str> default PACMAN_LOCAL_DIR - The pacman local database
+
+            @return tuple( numChanged<int>, numRemoved<int>, numSegments<int> ) - The number of packages updated and removed,
+              and the number of segments now ( see MAX_SEGMENTS ). If the whole database was written, numChanged is the
+              number of packages and numSegments is 0.
+    '''
+    with _ProvidesDBLock(filename):
+        if not os.path.exists(filename) or not isBinaryProvidesDB(filename):
+            records = list( iterLocalPackageRecords(localDir) )
+            _replaceProvidesDBBase(filename, records)
+
+            return ( len(records), 0, 0 )
+
+        with ProvidesDB(filename) as providesDB:
+            (changedEntryNames, removedPackageNames) = getLocalPackageChanges(providesDB, localDir)
+            numSegments = providesDB.numSegments
+
+        if changedEntryNames or removedPackageNames:
+            numSegments = _appendProvidesDBSegment(filename, iterLocalPackageRecords(localDir, changedEntryNames), removedPackageNames)
+
+        os.utime(filename)
+
+    return ( len(changedEntryNames), len(removedPackageNames), numSegments )
+
+
+# LOCAL_CACHE_LOCATIONS - Where whatprovides keeps the providesDB of the installed packages. The first usable one is used.
+LOCAL_CACHE_LOCATIONS = ( '/var/cache/pacman/whatprovides.idx', os.path.join( os.environ.get('HOME', '/'), '.whatprovides.idx' ) )
+
+
+def localCacheNeedsUpdate(cacheFilename, localDir=PACMAN_LOCAL_DIR):
+    '''
+        localCacheNeedsUpdate - Check if a providesDB of the installed packages is missing, or a package was
+          installed/removed/updated since it was last updated. Each package is a directory in the local database,
+          so installing, upgrading or removing one changes its mtime.
+
+            @param cacheFilename <str> - The providesDB
+
+            @param localDir <str> default PACMAN_LOCAL_DIR - The pacman local database
+
+            @return <bool> - True if it must be built or updated ( see updateLocalProvidesDB )
+    '''
+    try:
+        cacheMtime = os.stat(cacheFilename).st_mtime_ns
+    except OSError:
+        return True
+
+    try:
+        return os.stat(localDir).st_mtime_ns > cacheMtime
+    except OSError:
+        return False
+
+
+def localCacheIsWritable(cacheFilename):
+    '''
+        localCacheIsWritable - Check if we can build or update a providesDB of the installed packages
+
+            @param cacheFilename <str> - The providesDB
+
+            @return <bool> - True if we can write it
+    '''
+    # It is written to a temp file in the same directory and renamed over, see writeProvidesDB
+    return os.access( os.path.dirname( os.path.abspath(cacheFilename) ), os.W_OK | os.X_OK )
+
+
+def getLocalCacheFilename(cacheLocations=LOCAL_CACHE_LOCATIONS, localDir=PACMAN_LOCAL_DIR, allowStale=False):
+    '''
+        getLocalCacheFilename - Find a providesDB of the installed packages we can use: one we can write
+          (to build or update it), or which is up to date
+
+            @param cacheLocations list<str> default LOCAL_CACHE_LOCATIONS - Candidates, in order of preference
+
+            @param localDir <str> default PACMAN_LOCAL_DIR - The pacman local database
+
+            @param allowStale <bool> default False - For queries. If a cache we can read is out of date and we can't
+              update it, use it (read-only) rather than build a later candidate which does not exist yet. This is the
+              system cache while the pacman hook ( whatprovides.hook ) is still updating it.
+
+            @return <str/None> - The one to use, or None if none can be used. If #allowStale , check localCacheIsWritable
+              before updating it.
+    '''
+    staleFilename = None
+    for cacheFilename in cacheLocations:
+        if localCacheIsWritable(cacheFilename):
+            if staleFilename is not None and not os.path.exists(cacheFilename):
+                # Would have to be built from scratch
+                break
+            return cacheFilename
+        if os.access(cacheFilename, os.R_OK):
+            if not localCacheNeedsUpdate(cacheFilename, localDir):
+                return cacheFilename
+            if allowStale and staleFilename is None:
+                staleFilename = cacheFilename
+
+    return staleFilename
+
+
+def openLocalProvidesDB(cacheLocations=LOCAL_CACHE_LOCATIONS, localDir=PACMAN_LOCAL_DIR):
+    '''
+        openLocalProvidesDB - Open the providesDB of the installed packages, updating it first if needed
+
+            @param cacheLocations list<str> default LOCAL_CACHE_LOCATIONS - Candidates, in order of preference ( see getLocalCacheFilename )
+
+            @param localDir <str> default PACMAN_LOCAL_DIR - The pacman local database
+
+            @return <ProvidesDB>
+
+            @raises ProvidesDBException - If none of #cacheLocations can be used
+    '''
+    cacheFilename = getLocalCacheFilename(cacheLocations, localDir, allowStale=True)
+    if cacheFilename is None:
+        raise ProvidesDBException("Can't access %s (or needs regenerated), and cannot create/update it." %(' or '.join(cacheLocations), ))
+
+    if localCacheNeedsUpdate(cacheFilename, localDir):
+        if localCacheIsWritable(cacheFilename):
+            updateLocalProvidesDB(cacheFilename, localDir)
+        else:
+            sys.stderr.write('Warning: "%s" is out of date, and cannot be updated by this user. Using it as it is (the pacman hook updates it).\n' %(cacheFilename, ))
+
+    return ProvidesDB(cacheFilename)
+
+
+####################
+### Installed and upstream together
+################
+#
+#  The installed packages ( see above ) and the upstream (repo) packages are both providesDBs, so one query
+#   engine serves both, and CombinedProvidesDB runs a query against each and tags every package found as installed,
+#   available, or both.
+#
+#  The installed packages' paths keep pacman's trailing "/" on directories, the upstream ones (from the .MTREE) do not.
+#   CombinedProvidesDB looks up both forms, and returns paths without it.
+
+# Where a package which provides a path is from. See CombinedProvidesDB
+PROVIDED_INSTALLED = 'installed'    # Installed, but not in the upstream database (e.x. from the AUR, or dropped from the repos)
+PROVIDED_AVAILABLE = 'available'    # In the upstream database, not installed
+PROVIDED_BOTH = 'both'              # Installed, and in the upstream database
+
+
+def _stripDirSlash(path):
+    if len(path) > 1 and path[-1] == '/':
+        return path[ : -1 ]
+    return path
+
+
+class CombinedProvidesDB(object):
+    '''
+        CombinedProvidesDB - Query the installed packages and the upstream packages together.
+
+          Each provider is returned as tuple( pkgName<str>, provided<str>, installedVersion<str/None>, upstreamVersion<str/None> ),
+            where provided is one of PROVIDED_INSTALLED, PROVIDED_AVAILABLE, or PROVIDED_BOTH: whether the installed package,
+            the upstream package, or both provide the path. The versions are of the package, even if that one does not provide it
+            ( e.x. a file added in a newer upstream version is PROVIDED_AVAILABLE, with the installed version too ).
+    '''
+
+    def __init__(self, installedDB, upstreamDB):
+        '''
+            __init__ - Create a CombinedProvidesDB. It takes ownership of (and closes) both.
+
+                @param installedDB <ProvidesDB> - The installed packages ( see openLocalProvidesDB )
+
+                @param upstreamDB <ProvidesDB> - The upstream packages ( e.x. /var/lib/pacman/.providesDB )
+        '''
+        self.installedDB = installedDB
+        self.upstreamDB = upstreamDB
+
+        # _versions - package name -> tuple( installedVersion, upstreamVersion )
+        self._versions = {}
+
+    def close(self):
+        '''
+            close - Close both databases
+        '''
+        self.installedDB.close()
+        self.upstreamDB.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def getPackageVersions(self, pkgName):
+        '''
+            getPackageVersions - Get the installed and upstream versions of a package
+
+                @param pkgName <str> - Package name
+
+                @return tuple( installedVersion<str/None>, upstreamVersion<str/None> ) - None where it is not installed / not upstream
+        '''
+        try:
+            return self._versions[pkgName]
+        except KeyError:
+            pass
+
+        versions = []
+        for providesDB in (self.installedDB, self.upstreamDB):
+            pkgInfo = providesDB.findPackage(pkgName)
+            versions.append( pkgInfo[1] if pkgInfo is not None else None )
+
+        self._versions[pkgName] = versions = tuple(versions)
+        return versions
+
+    def _getProviders(self, installedPkgNames, upstreamPkgNames):
+        # Tag each package found, sorted by name
+        providers = []
+        for pkgName in sorted( set(installedPkgNames).union(upstreamPkgNames) ):
+            if pkgName not in upstreamPkgNames:
+                provided = PROVIDED_INSTALLED
+            elif pkgName not in installedPkgNames:
+                provided = PROVIDED_AVAILABLE
+            else:
+                provided = PROVIDED_BOTH
+
+            (installedVersion, upstreamVersion) = self.getPackageVersions(pkgName)
+            providers.append( (pkgName, provided, installedVersion, upstreamVersion) )
+
+        return providers
+
+    def whatProvides(self, path):
+        '''
+            whatProvides - Get the packages which provide a path, installed or upstream
+
+                @param path <str> - Absolute path (a trailing "/" is optional)
+
+                @return list< tuple( pkgName, provided, installedVersion, upstreamVersion ) > - Sorted by package name
+        '''
+        path = _stripDirSlash(path)
+
+        installedPkgNames = set()
+        for pkgNames in self.installedDB.whatProvidesMany( [ path, path + '/' ] ).values():
+            installedPkgNames.update(pkgNames)
+
+        return self._getProviders( installedPkgNames, set( self.upstreamDB.whatProvides(path) ) )
+
+    def _getMergedProviders(self, installedMatches, upstreamMatches):
+        # Combine ( path, pkgNames ) from each, returning ( path, providers ) sorted by path
+        pathPkgNames = {}
+        for (isUpstream, matches) in ( (False, installedMatches), (True, upstreamMatches) ):
+            for (path, pkgNames) in matches:
+                pathPkgNames.setdefault( _stripDirSlash(path), (set(), set()) )[ isUpstream ].update(pkgNames)
+
+        return [ (path, self._getProviders(installedPkgNames, upstreamPkgNames)) for (path, (installedPkgNames, upstreamPkgNames)) in sorted( pathPkgNames.items() ) ]
+
+    def getGlobProviders(self, globStr):
+        '''
+            getGlobProviders - Find the paths which match a glob, installed or upstream, and the packages which provide them
+
+                @param globStr <str> - The glob ( see globToRE ). A trailing "/" is ignored.
+
+                @return list< tuple( path<str>, providers<list< tuple( pkgName, provided, installedVersion, upstreamVersion ) >> ) > - Sorted by path
+        '''
+        globStr = _stripDirSlash(globStr)
+
+        installedMatches = itertools.chain( self.installedDB.iterGlobProviders(globStr), self.installedDB.iterGlobProviders(globStr + '/') ) if globStr[-1] != '*' \
+            else self.installedDB.iterGlobProviders(globStr)
+
+        # The glob is matched against the paths without the "/", same as upstream. Otherwise "/usr/bin/*" would match
+        #   the installed "/usr/bin/" (but not the upstream "/usr/bin"), and the directory would be tagged installed.
+        globRE = globToRE(globStr)
+        installedMatches = ( (path, pkgNames) for (path, pkgNames) in installedMatches if globRE.match( _stripDirSlash(path) ) )
+
+        return self._getMergedProviders( installedMatches, self.upstreamDB.iterGlobProviders(globStr) )
+
+    def whatProvidesSonames(self, sonames):
+        '''
+            whatProvidesSonames - Find the shared libraries with each of many sonames, installed or upstream, and the packages
+              which provide them ( see ProvidesDBFile.whatProvidesSonames )
+
+                @param sonames <iter<str>> - The sonames ( e.x. "libz.so.1" )
+
+                @return dict< soname<str> : list< tuple( path<str>, providers<list< tuple( pkgName, provided, installedVersion, upstreamVersion ) >> ) > > -
+                  The libraries with each soname, sorted by path. Sonames not found are not included.
+        '''
+        sonames = set(sonames)
+
+        installedResults = self.installedDB.whatProvidesSonames(sonames)
+        upstreamResults = self.upstreamDB.whatProvidesSonames(sonames)
+
+        return { soname : self._getMergedProviders( installedResults.get(soname, []), upstreamResults.get(soname, []) )
+            for soname in set(installedResults).union(upstreamResults) }
+
+    def getSubtreePackages(self, dirPath):
+        '''
+            getSubtreePackages - Get the packages which provide anything under a directory (including the directory itself), installed or upstream
+
+                @param dirPath <str> - The directory
+
+                @return list< tuple( pkgName, provided, installedVersion, upstreamVersion ) > - Sorted by package name
+        '''
+        dirPath = _stripDirSlash(dirPath)
+
+        # The installed directory itself ( "dirPath/" ) is in the subtree's range, the upstream one ( "dirPath" ) is not
+        upstreamPkgNames = set( self.upstreamDB.getSubtreePackages(dirPath) ).union( self.upstreamDB.whatProvides(dirPath) )
+
+        return self._getProviders( set( self.installedDB.getSubtreePackages(dirPath) ), upstreamPkgNames )
+
+
+####################
+### Query daemon
+################
+#
+#  whatprovides_upstream --daemon keeps the providesDB open and answers queries over a unix socket,
+#   so a query does not pay for starting python and opening the database.
+#
+#  The protocol is lines of utf-8. A request is:  command  space  argument  newline
+#
+#     "exact PATH" - Packages which provide PATH. One package name per line.
+#     "glob GLOB"  - Paths matching GLOB. One per line: the path, then a tab before each package name.
+#     "subtree DIR"  - Every path under DIR. Same lines as "glob".
+#     "subtree-packages DIR"  - Packages which provide anything under DIR. One package name per line.
+#     "files PACKAGE"  - Paths PACKAGE provides. One per line.
+#
+#   The response is the result lines, then an empty line. Results are sent as they are found. An error is a
+#     line starting with "!", and ends the response (after any results sent before it).
+#   Any number of requests may be sent on one connection, and may be sent before reading the responses.
+
+# DEFAULT_SOCKET_PATH - Where the daemon listens, by default
+DEFAULT_SOCKET_PATH = '/run/whatprovides_upstream.sock'
+
+# RELOAD_CHECK_INTERVAL - Seconds between the daemon checking if the providesDB has been written
+RELOAD_CHECK_INTERVAL = 1.0
+
+# DAEMON_TIMEOUT - Seconds a client waits on the daemon before giving up
+DAEMON_TIMEOUT = 30.0
+
+# DAEMON_PIPELINE_SIZE - Most queries a client sends before reading the responses. Bounded so that
+#   neither side blocks writing while the other is also writing.
+DAEMON_PIPELINE_SIZE = 256
+
+DAEMON_COMMAND_EXACT = 'exact'
+DAEMON_COMMAND_GLOB = 'glob'
+DAEMON_COMMAND_SUBTREE = 'subtree'
+DAEMON_COMMAND_SUBTREE_PACKAGES = 'subtree-packages'
+DAEMON_COMMAND_FILES = 'files'
+
+# DAEMON_WRITE_LINES - Result lines the daemon sends at a time
+DAEMON_WRITE_LINES = 1024
+
+
+def getProvidesDBGeneration(filename):
+    '''
+        getProvidesDBGeneration - Get a value which changes whenever a providesDB is written. Every write
+          renames a new file into place, so the base's inode changes or the list of segments does.
+
+            @param filename <str> - Path to the providesDB
+
+            @return tuple - Compare to a previous value to tell if the database has changed
+    '''
+    try:
+        baseStat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+
+    return ( baseStat.st_ino, baseStat.st_mtime_ns, tuple( getSegmentFilenames(filename) ) )
+
+
+class _ProvidesDBRequestHandler(socketserver.StreamRequestHandler):
+    '''
+        _ProvidesDBRequestHandler - Handles one connection to a ProvidesDBServer
+    '''
+
+    def _iterResponseLines(self, command, argument):
+        try:
+            for resultLine in self.server.query(command, argument):
+                yield resultLine + '\n'
+        except Exception as e:
+            yield '!%s: %s\n' %(e.__class__.__name__, str(e).replace('\n', ' '))
+
+        yield '\n'
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                (command, _, argument) = line.decode('utf-8').rstrip('\n').partition(' ')
+
+                toWrite = []
+                for responseLine in self._iterResponseLines(command, argument):
+                    toWrite.append(responseLine)
+                    if len(toWrite) >= DAEMON_WRITE_LINES:
+                        self.wfile.write( ''.join(toWrite).encode('utf-8') )
+                        toWrite = []
+
+                self.wfile.write( ''.join(toWrite).encode('utf-8') )
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the connection without reading the whole response
+            pass
+
+
+class ProvidesDBServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+        ProvidesDBServer - Answers queries on a providesDB over a unix socket (see protocol above). Use serve_forever.
+
+          The database stays open (and is read into the page cache up front), and is reopened when it is written.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, filename, socketPath=DEFAULT_SOCKET_PATH):
+        '''
+            __init__ - Open the database, and listen on the socket
+
+                @param filename <str> - Path to the providesDB
+
+                @param socketPath <str> default DEFAULT_SOCKET_PATH - Path of the unix socket
+
+                @raises ProvidesDBException - If the database cannot be read, or a daemon is already listening on #socketPath
+        '''
+        self.filename = filename
+        self.socketPath = socketPath
+
+        self._reloadLock = threading.Lock()
+        self._nextReloadCheck = time.monotonic() + RELOAD_CHECK_INTERVAL
+        self._reload()
+
+        if os.path.exists(socketPath):
+            otherDaemon = connectProvidesDBDaemon(socketPath)
+            if otherDaemon is not None:
+                otherDaemon.close()
+                raise ProvidesDBException('A daemon is already listening on "%s".' %(socketPath, ))
+            # Left behind by a daemon which did not exit cleanly
+            os.unlink(socketPath)
+
+        socketserver.UnixStreamServer.__init__(self, socketPath, _ProvidesDBRequestHandler)
+        os.chmod(socketPath, 0o666)
+
+    def _reload(self):
+        generation = getProvidesDBGeneration(self.filename)
+
+        providesDB = ProvidesDB(self.filename)
+        providesDB.preload()
+
+        # The old database is not closed, as a query in another thread may be using it. It is unmapped once nothing references it.
+        (self.providesDB, self.generation) = (providesDB, generation)
+
+    def getProvidesDB(self):
+        '''
+            getProvidesDB - Get the database, reopening it first if it has been written since it was opened
+              (checked at most every RELOAD_CHECK_INTERVAL seconds)
+
+                @return <ProvidesDB> - The database
+        '''
+        now = time.monotonic()
+        if now >= self._nextReloadCheck:
+            with self._reloadLock:
+                if now >= self._nextReloadCheck:
+                    if getProvidesDBGeneration(self.filename) != self.generation:
+                        try:
+                            self._reload()
+                            sys.stderr.write('Reopened "%s" (%d segments).\n' %(self.filename, self.providesDB.numSegments))
+                        except Exception as e:
+                            sys.stderr.write('WARNING: Cannot reopen "%s", still using the database opened before. %s: %s\n' %(self.filename, e.__class__.__name__, str(e)))
+
+                    self._nextReloadCheck = time.monotonic() + RELOAD_CHECK_INTERVAL
+
+        return self.providesDB
+
+    def query(self, command, argument):
+        '''
+            query - Run a query
+
+                @param command <str> - One of the DAEMON_COMMAND_* (see protocol above)
+
+                @param argument <str> - The path, glob, directory or package name
+
+                @return iter<str> - The response lines
+        '''
+        providesDB = self.getProvidesDB()
+
+        if command == DAEMON_COMMAND_EXACT:
+            return providesDB.whatProvides(argument)
+        elif command == DAEMON_COMMAND_GLOB:
+            return ( '\t'.join( [ path ] + pkgNames ) for (path, pkgNames) in providesDB.iterGlobProviders(argument) )
+        elif command == DAEMON_COMMAND_SUBTREE:
+            return ( '\t'.join( [ path ] + pkgNames ) for (path, pkgNames) in providesDB.iterSubtreeProviders(argument) )
+        elif command == DAEMON_COMMAND_SUBTREE_PACKAGES:
+            return providesDB.getSubtreePackages(argument)
+        elif command == DAEMON_COMMAND_FILES:
+            return providesDB.iterPackageFiles(argument)
+
+        raise ProvidesDBException('Unknown command "%s"' %(command, ))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socketPath)
+        except OSError:
+            pass
+
+
+class ProvidesDBClient(object):
+    '''
+        ProvidesDBClient - A connection to a ProvidesDBServer. Has the same query methods as ProvidesDB.
+    '''
+
+    def __init__(self, socketPath=DEFAULT_SOCKET_PATH, timeout=DAEMON_TIMEOUT):
+        '''
+            __init__ - Connect to the daemon
+
+                @param socketPath <str> default DEFAULT_SOCKET_PATH - Path of the unix socket
+
+                @param timeout <float/None> default DAEMON_TIMEOUT - Seconds to wait on the daemon, None to wait forever
+
+                @raises OSError - If cannot connect
+        '''
+        self.socketPath = socketPath
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.settimeout(timeout)
+            self._sock.connect(socketPath)
+        except:
+            self._sock.close()
+            raise
+
+        self._rfile = self._sock.makefile('rb')
+
+    def close(self):
+        '''
+            close - Close the connection
+        '''
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def _sendQueries(self, command, arguments):
+        if self._sock is None:
+            raise ProvidesDBException('The connection to the providesDB daemon is closed.')
+
+        for argument in arguments:
+            if '\n' in argument:
+                raise ProvidesDBException('A query cannot contain a newline.')
+
+        self._sock.sendall( ''.join( [ '%s %s\n' %(command, argument) for argument in arguments ] ).encode('utf-8') )
+
+    def _iterResponse(self):
+        isComplete = False
+        try:
+            while True:
+                line = self._rfile.readline()
+                if not line.endswith(b'\n'):
+                    raise ProvidesDBException('providesDB daemon closed the connection.')
+                if line == b'\n':
+                    isComplete = True
+                    return
+                if line.startswith(b'!'):
+                    # Followed by the empty line which ends the response
+                    self._rfile.readline()
+                    isComplete = True
+                    raise ProvidesDBException( line[ 1 : -1 ].decode('utf-8') )
+
+                yield line[ : -1 ].decode('utf-8')
+        finally:
+            if not isComplete:
+                # The rest of the response was not read (e.x. the caller stopped early), so the connection cannot be used again
+                self.close()
+
+    def _readResponse(self):
+        return list( self._iterResponse() )
+
+    def _query(self, command, argument):
+        self._sendQueries(command, [ argument ])
+
+        return self._readResponse()
+
+    def _iterQuery(self, command, argument):
+        self._sendQueries(command, [ argument ])
+
+        for resultLine in self._iterResponse():
+            yield resultLine
+
+    def whatProvides(self, path):
+        '''
+            whatProvides - Get the names of the packages which provide a path
+
+                @param path <str> - Absolute path (directories end in "/")
+
+                @return list<str> - Package names, sorted
+        '''
+        return self._query(DAEMON_COMMAND_EXACT, path)
+
+    def whatProvidesMany(self, paths):
+        '''
+            whatProvidesMany - Get the names of the packages which provide each of many paths.
+              The queries are pipelined, DAEMON_PIPELINE_SIZE at a time.
+
+                @param paths <iter<str>> - Absolute paths (directories end in "/")
+
+                @return dict< str : list<str> > - path -> Package names, sorted. Paths no package provides are not included.
+        '''
+        paths = sorted( set(paths) )
+
+        results = {}
+        for i in range(0, len(paths), DAEMON_PIPELINE_SIZE):
+            pipelinedPaths = paths[ i : i + DAEMON_PIPELINE_SIZE ]
+            self._sendQueries(DAEMON_COMMAND_EXACT, pipelinedPaths)
+
+            for path in pipelinedPaths:
+                pkgNames = self._readResponse()
+                if pkgNames:
+                    results[path] = pkgNames
+
+        return results
+
+    def iterGlobProviders(self, globStr):
+        '''
+            iterGlobProviders - Find the paths which match a glob, and the packages which provide them
+
+                @param globStr <str> - The glob ( see globToRE )
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - Matching paths, in sorted order
+        '''
+        for resultLine in self._iterQuery(DAEMON_COMMAND_GLOB, globStr):
+            fields = resultLine.split('\t')
+            yield ( fields[0], fields[1 : ] )
+
+    def iterSubtreeProviders(self, dirPath):
+        '''
+            iterSubtreeProviders - Iterate over every path under a directory, and the packages which provide them
+
+                @param dirPath <str> - The directory
+
+                @return generator< tuple( path<str>, pkgNames<list<str>> ) > - Paths, in sorted order
+        '''
+        for resultLine in self._iterQuery(DAEMON_COMMAND_SUBTREE, dirPath):
+            fields = resultLine.split('\t')
+            yield ( fields[0], fields[1 : ] )
+
+    def getSubtreePackages(self, dirPath):
+        '''
+            getSubtreePackages - Get the names of the packages which provide anything under a directory
+
+                @param dirPath <str> - The directory
+
+                @return list<str> - Package names, sorted
+        '''
+        return self._query(DAEMON_COMMAND_SUBTREE_PACKAGES, dirPath)
+
+    def iterPackageFiles(self, pkgName):
+        '''
+            iterPackageFiles - Iterate over the paths a package provides
+
+                @param pkgName <str> - Package name
+
+                @return generator<str> - Paths, in sorted order. Nothing if there is no such package.
+        '''
+        return self._iterQuery(DAEMON_COMMAND_FILES, pkgName)
+
+
+def connectProvidesDBDaemon(socketPath=DEFAULT_SOCKET_PATH, timeout=DAEMON_TIMEOUT):
+    '''
+        connectProvidesDBDaemon - Connect to the daemon, if one is running
+
+            @param socketPath <str> default DEFAULT_SOCKET_PATH - Path of the unix socket
+
+            @param timeout <float/None> default DAEMON_TIMEOUT - Seconds to wait on the daemon, None to wait forever
+
+            @return <ProvidesDBClient/None> - The connection, or None if no daemon is listening
+    '''
+    if not os.path.exists(socketPath):
+        return None
+
+    try:
+        return ProvidesDBClient(socketPath, timeout)
+    except OSError:
+        return None
+
+
+# vim: set ts=4 sw=4 expandtab :
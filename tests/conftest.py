@@ -0,0 +1,7 @@
+# vim: set ts=4 sw=4 expandtab :
+
+import os
+import sys
+
+# The modules under test are scripts at the top of the tree, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,136 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for querying the installed and upstream packages together ( CombinedProvidesDB ), with two small
+#   providesDBs which share some files and directories and differ on others.
+
+import pytest
+
+import pacmanProvidesDB
+
+from pacmanProvidesDB import PROVIDED_INSTALLED, PROVIDED_AVAILABLE, PROVIDED_BOTH
+
+# INSTALLED - As read from the pacman local database: directories end in "/"
+INSTALLED = {
+    'bash'   : { 'files' : [ '/usr/', '/usr/bin/', '/usr/bin/bash', '/usr/bin/sh' ], 'version' : '5.0-1', 'error' : None },
+    'aurpkg' : { 'files' : [ '/usr/', '/usr/bin/', '/usr/bin/aurtool', '/opt/', '/opt/aur/', '/opt/aur/data' ], 'version' : '1-1', 'error' : None },
+    'zlib'   : { 'files' : [ '/usr/', '/usr/lib/', '/usr/lib/libz.so.1' ], 'version' : '1:1.2.11-4', 'error' : None },
+}
+
+# UPSTREAM - As read from each package's .MTREE: directories do not end in "/"
+UPSTREAM = {
+    # A newer version, which adds a file
+    'bash' : { 'files' : [ '/usr', '/usr/bin', '/usr/bin/bash', '/usr/bin/sh', '/usr/bin/rbash' ], 'version' : '5.1-1', 'error' : None },
+    'zlib' : { 'files' : [ '/usr', '/usr/lib', '/usr/lib/libz.so', '/usr/lib/libz.so.1' ], 'version' : '1:1.2.11-4', 'error' : None },
+    'vim'  : { 'files' : [ '/usr', '/usr/bin', '/usr/bin/vim', '/usr/share', '/usr/share/vim', '/usr/share/vim/vimrc' ], 'version' : '8.2-1', 'error' : None },
+}
+
+
+@pytest.fixture
+def combinedDB(tmpdir):
+    installedFilename = str(tmpdir.join('installed.idx'))
+    upstreamFilename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(installedFilename, INSTALLED)
+    pacmanProvidesDB.writeProvidesDB(upstreamFilename, UPSTREAM)
+
+    with pacmanProvidesDB.CombinedProvidesDB( pacmanProvidesDB.ProvidesDB(installedFilename), pacmanProvidesDB.ProvidesDB(upstreamFilename) ) as combinedDB:
+        yield combinedDB
+
+
+def _getVersions(pkgName):
+    return ( INSTALLED[pkgName]['version'] if pkgName in INSTALLED else None, UPSTREAM[pkgName]['version'] if pkgName in UPSTREAM else None )
+
+
+def getExpectedProviders(path):
+    '''
+        getExpectedProviders - Scan the records for the packages which provide #path , with or without a trailing "/"
+    '''
+    path = path.rstrip('/')
+
+    installedPkgNames = set( pkgName for (pkgName, pkgRecord) in INSTALLED.items() if path in [ pkgFile.rstrip('/') for pkgFile in pkgRecord['files'] ] )
+    upstreamPkgNames = set( pkgName for (pkgName, pkgRecord) in UPSTREAM.items() if path in pkgRecord['files'] )
+
+    providers = []
+    for pkgName in sorted( installedPkgNames.union(upstreamPkgNames) ):
+        if pkgName not in upstreamPkgNames:
+            provided = PROVIDED_INSTALLED
+        elif pkgName not in installedPkgNames:
+            provided = PROVIDED_AVAILABLE
+        else:
+            provided = PROVIDED_BOTH
+        providers.append( (pkgName, provided) + _getVersions(pkgName) )
+
+    return providers
+
+
+def _getAllPaths():
+    return sorted( set( pkgFile.rstrip('/') for records in (INSTALLED, UPSTREAM) for pkgRecord in records.values() for pkgFile in pkgRecord['files'] ) )
+
+
+def test_whatProvides(combinedDB):
+    assert combinedDB.whatProvides('/usr/bin/bash') == [ ('bash', PROVIDED_BOTH, '5.0-1', '5.1-1') ]
+    # Only in the newer upstream version, so available, though an older version is installed
+    assert combinedDB.whatProvides('/usr/bin/rbash') == [ ('bash', PROVIDED_AVAILABLE, '5.0-1', '5.1-1') ]
+    assert combinedDB.whatProvides('/usr/bin/aurtool') == [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None) ]
+    assert combinedDB.whatProvides('/usr/bin/vim') == [ ('vim', PROVIDED_AVAILABLE, None, '8.2-1') ]
+    assert combinedDB.whatProvides('/usr/lib/libz.so') == [ ('zlib', PROVIDED_AVAILABLE, '1:1.2.11-4', '1:1.2.11-4') ]
+    assert combinedDB.whatProvides('/nothere') == []
+
+    # Installed directories end in "/", upstream ones do not. Found either way.
+    expected = [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None), ('bash', PROVIDED_BOTH, '5.0-1', '5.1-1'), ('vim', PROVIDED_AVAILABLE, None, '8.2-1') ]
+    assert combinedDB.whatProvides('/usr/bin') == expected
+    assert combinedDB.whatProvides('/usr/bin/') == expected
+    assert combinedDB.whatProvides('/opt/aur/') == [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None) ]
+
+    for path in _getAllPaths():
+        assert combinedDB.whatProvides(path) == getExpectedProviders(path), path
+        assert combinedDB.whatProvides(path + '/') == getExpectedProviders(path), path
+
+
+def test_getGlobProviders(combinedDB):
+    assert combinedDB.getGlobProviders('/usr/bin/*') == [
+        ( '/usr/bin/aurtool', [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None) ] ),
+        ( '/usr/bin/bash', [ ('bash', PROVIDED_BOTH, '5.0-1', '5.1-1') ] ),
+        ( '/usr/bin/rbash', [ ('bash', PROVIDED_AVAILABLE, '5.0-1', '5.1-1') ] ),
+        ( '/usr/bin/sh', [ ('bash', PROVIDED_BOTH, '5.0-1', '5.1-1') ] ),
+        ( '/usr/bin/vim', [ ('vim', PROVIDED_AVAILABLE, None, '8.2-1') ] ),
+    ]
+
+    # A directory matched in both is one path, without the "/"
+    assert combinedDB.getGlobProviders('/usr/b?n') == [ ( '/usr/bin', getExpectedProviders('/usr/bin') ) ]
+    assert combinedDB.getGlobProviders('/usr/b?n/') == [ ( '/usr/bin', getExpectedProviders('/usr/bin') ) ]
+    assert combinedDB.getGlobProviders('*/aur') == [ ( '/opt/aur', [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None) ] ) ]
+
+    allPaths = _getAllPaths()
+    for globStr in ( '*', '/usr/*', '*/lib*', '*sh', '/opt/*', '*/share/*', '/usr/?i?' ):
+        globRE = pacmanProvidesDB.globToRE(globStr)
+        assert combinedDB.getGlobProviders(globStr) == [ (path, getExpectedProviders(path)) for path in allPaths if globRE.match(path) ], globStr
+
+
+def test_getSubtreePackages(combinedDB):
+    assert combinedDB.getSubtreePackages('/usr/share/vim') == [ ('vim', PROVIDED_AVAILABLE, None, '8.2-1') ]
+    # The directory itself counts, whichever form it is in
+    assert combinedDB.getSubtreePackages('/opt/aur') == [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None) ]
+    assert combinedDB.getSubtreePackages('/opt/aur/') == [ ('aurpkg', PROVIDED_INSTALLED, '1-1', None) ]
+    assert combinedDB.getSubtreePackages('/usr/lib') == [ ('zlib', PROVIDED_BOTH, '1:1.2.11-4', '1:1.2.11-4') ]
+    assert combinedDB.getSubtreePackages('/nothere') == []
+
+    for dirPath in [ '/', '/usr', '/usr/bin', '/usr/bin/', '/opt', '/usr/share' ]:
+        prefix = dirPath.rstrip('/') + '/'
+        subtreePaths = [ path for path in _getAllPaths() if path == dirPath.rstrip('/') or path.startswith(prefix) ]
+
+        expected = {}
+        for path in subtreePaths:
+            for (pkgName, provided, installedVersion, upstreamVersion) in getExpectedProviders(path):
+                # Both, if both provide something under it
+                if expected.get(pkgName, (None, provided))[1] != provided:
+                    provided = PROVIDED_BOTH
+                expected[pkgName] = (pkgName, provided, installedVersion, upstreamVersion)
+
+        assert combinedDB.getSubtreePackages(dirPath) == [ expected[pkgName] for pkgName in sorted(expected) ], dirPath
+
+
+def test_whatProvidesSonames(combinedDB):
+    assert combinedDB.whatProvidesSonames( [ 'libz.so.1', 'libz.so', 'libnothere.so.1' ] ) == {
+        'libz.so.1' : [ ( '/usr/lib/libz.so.1', [ ('zlib', PROVIDED_BOTH, '1:1.2.11-4', '1:1.2.11-4') ] ) ],
+        'libz.so' : [ ( '/usr/lib/libz.so', [ ('zlib', PROVIDED_AVAILABLE, '1:1.2.11-4', '1:1.2.11-4') ] ) ],
+    }
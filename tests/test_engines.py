@@ -0,0 +1,571 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for the extraction engines of extractMtree.py ( Runner, AsyncRunner, PipelineRunner ) and the
+#   mirror routing they share ( MirrorPool ), against a local http.server serving synthetic packages
+#   on several "mirrors", some of which are broken.
+
+import asyncio
+import gzip
+import io
+import lzma
+import random
+import re
+import socket
+import tarfile
+import threading
+import time
+import types
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import extractMtree
+import pacmanProvidesDB
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+def makeMtree(files):
+    '''
+        makeMtree - Make the .MTREE text (as written by bsdtar) of a package containing #files
+
+            @param files list<str> - The paths, directories ending in "/"
+    '''
+    lines = [ '#mtree', '/set type=file uid=0 gid=0 mode=644' ]
+    for metadataFile in ( '.BUILDINFO', '.PKGINFO' ):
+        lines.append( './%s time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e' %(metadataFile, ) )
+    for path in files:
+        if path.endswith('/'):
+            lines.append( '.%s time=1600000000.0 mode=755 type=dir' %(path.rstrip('/'), ) )
+        else:
+            lines.append( '.%s time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e' %(path, ) )
+
+    return '\n'.join(lines) + '\n'
+
+
+def _addMember(tf, name, data):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    tf.addfile(member, io.BytesIO(data))
+
+
+def makePackage(files, compression, paddingSize=0, seed=0):
+    '''
+        makePackage - Make a package file, as makepkg does: the metadata files (with the .MTREE) first, then the files.
+
+            @param files list<str> - The paths, directories ending in "/"
+
+            @param compression <str> - "xz" or "zst"
+
+            @param paddingSize <int> default 0 - Size of the .BUILDINFO, which comes before the .MTREE .
+              It is random, so does not compress, and the .MTREE starts about this far into the package.
+
+            @param seed <int> default 0 - Seed for the contents
+    '''
+    rand = random.Random(seed)
+
+    tarData = io.BytesIO()
+    with tarfile.open(fileobj=tarData, mode='w') as tf:
+        _addMember(tf, '.BUILDINFO', bytes( rand.getrandbits(8) for i in range(paddingSize) ))
+        _addMember(tf, '.MTREE', gzip.compress( makeMtree(files).encode('utf-8') ))
+        _addMember(tf, '.PKGINFO', b'pkgname = x\n')
+        for path in files:
+            if not path.endswith('/'):
+                _addMember(tf, path.lstrip('/'), bytes( rand.getrandbits(8) for i in range(2048) ))
+
+    if compression == 'xz':
+        return lzma.compress(tarData.getvalue(), format=lzma.FORMAT_XZ)
+
+    zstandard = pytest.importorskip('zstandard')
+    return zstandard.ZstdCompressor().compress(tarData.getvalue())
+
+
+def makePackages(numPackages=24):
+    '''
+        makePackages - Make a set of packages, a mix of xz and zst, x86_64 and any, and some with the .MTREE
+          far enough in to need more than one short-read (pkg05 the furthest).
+
+            @return tuple( packageInfos list< tuple(repo, name, version) >, packageFiles dict< str : bytes >, expectedFiles dict< str : list<str> > )
+              where #packageFiles is filename -> contents, all in the "core" repo
+    '''
+    packageInfos = []
+    packageFiles = {}
+    expectedFiles = {}
+
+    rand = random.Random(1)
+    for i in range(numPackages):
+        packageName = 'pkg%02d' %(i, )
+        packageVersion = '1.%d-1' %(i, )
+
+        files = [ '/usr/', '/usr/bin/', '/usr/bin/%s' %(packageName, ), '/usr/share/', '/usr/share/%s/' %(packageName, ) ]
+        files += [ '/usr/share/%s/file%d' %(packageName, j) for j in range( rand.randint(0, 6) ) ]
+
+        compression = ( i % 3 == 2 ) and 'xz' or 'zst'
+        arch = ( i % 4 == 3 ) and 'any' or 'x86_64'
+        paddingSize = ( i % 5 == 4 ) and 1024 * 24 or 0
+        if packageName == 'pkg05':
+            paddingSize = 1024 * 96
+
+        filename = '%s-%s-%s.pkg.tar.%s' %(packageName, packageVersion, arch, compression)
+        packageFiles[filename] = makePackage(files, compression, paddingSize, seed=i)
+        packageInfos.append( ('core', packageName, packageVersion) )
+        expectedFiles[packageName] = [ path.rstrip('/') for path in files ]
+
+    return (packageInfos, packageFiles, expectedFiles)
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    '''
+        MirrorRequestHandler - Serves server.packageFiles at /$mirror/$repo/$filename , with Range and keep-alive.
+
+          What each mirror does is set in server.mirrorModes :
+
+            "ok" - Serves the packages
+            "missing" - 404 for everything
+            "error" - 500 for everything
+            "drop" - Closes the connection without a response
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        (mirrorName, repoName, filename) = ( self.path.lstrip('/').split('/', 2) + [ '', '' ] )[ : 3 ]
+        with self.server.lock:
+            self.server.requests.append( (mirrorName, filename) )
+
+        mode = self.server.mirrorModes.get(mirrorName, 'missing')
+        if mode == 'drop':
+            self.close_connection = True
+            return
+
+        data = self.server.packageFiles.get(filename)
+        if mode == 'error':
+            self._sendEmpty(500)
+            return
+        if mode != 'ok' or repoName != 'core' or data is None:
+            self._sendEmpty(404)
+            return
+
+        (start, end) = (0, len(data) - 1)
+        rangeMatch = _RANGE_RE.match( self.headers.get('Range') or '' )
+        if rangeMatch:
+            start = int(rangeMatch.group(1))
+            if rangeMatch.group(2):
+                end = min( int(rangeMatch.group(2)), end )
+            if start >= len(data):
+                self._sendEmpty(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %(start, end, len(data)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        try:
+            self.wfile.write( data[ start : end + 1 ] )
+        except (ConnectionError, OSError):
+            self.close_connection = True
+
+    def _sendEmpty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@pytest.fixture(scope='module')
+def packages():
+    return makePackages()
+
+
+@pytest.fixture
+def server(packages):
+    (packageInfos, packageFiles, expectedFiles) = packages
+
+    httpServer = ThreadingHTTPServer( ('127.0.0.1', 0), MirrorRequestHandler )
+    httpServer.daemon_threads = True
+    httpServer.packageFiles = packageFiles
+    httpServer.mirrorModes = {}
+    httpServer.requests = []
+    httpServer.lock = threading.Lock()
+
+    serverThread = threading.Thread(target=httpServer.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+
+    httpServer.baseUrl = 'http://127.0.0.1:%d' %(httpServer.server_address[1], )
+    try:
+        yield httpServer
+    finally:
+        httpServer.shutdown()
+        httpServer.server_close()
+        extractMtree.getHttpFetcher().pool.closeAll()
+
+
+def getMirrorUrl(server, mirrorName, mode='ok'):
+    '''
+        getMirrorUrl - Add a mirror to #server , and get its repo url (as from getRepoUrls )
+    '''
+    server.mirrorModes[mirrorName] = mode
+    return server.baseUrl + '/' + mirrorName + '/%s/%s'
+
+
+def getRefusedMirrorUrl():
+    '''
+        getRefusedMirrorUrl - Get a repo url on a port nothing is listening on
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind( ('127.0.0.1', 0) )
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return 'http://127.0.0.1:%d/refused/%%s/%%s' %(port, )
+
+
+def getMirrorRequests(server, mirrorName):
+    with server.lock:
+        return [ filename for (thisMirrorName, filename) in server.requests if thisMirrorName == mirrorName ]
+
+
+ENGINE_KWARGS = {
+    'threads' : {},
+    'asyncio' : { 'numDecodeWorkers' : 2 },
+    'pipeline' : { 'numDecodeWorkers' : 2 },
+}
+
+
+def runEngine(engine, packageInfos, repoUrls, numWorkers=3, **kwargs):
+    '''
+        runEngine - Run #packageInfos through #engine , as extractMtree.main does
+
+            @return tuple( results dict, failedPackageInfos list )
+    '''
+    results = {}
+    failedPackageInfos = []
+
+    runnerKwargs = dict(ENGINE_KWARGS[engine])
+    runnerKwargs.setdefault('shortFetchSize', 1024 * 8)
+    runnerKwargs.setdefault('timeout', 10)
+    runnerKwargs.setdefault('longTimeout', 20)
+    runnerKwargs.update(kwargs)
+
+    runner = extractMtree.createRunner(engine, numWorkers, packageInfos, repoUrls, extractMtree.RefObj(results), failedPackageInfos, **runnerKwargs)
+    runner.run()
+
+    return (results, failedPackageInfos)
+
+
+def checkResults(results, failedPackageInfos, packages):
+    (packageInfos, packageFiles, expectedFiles) = packages
+
+    assert failedPackageInfos == []
+    assert sorted(results) == sorted(expectedFiles)
+    for (repoName, packageName, packageVersion) in packageInfos:
+        assert results[packageName]['error'] is None, packageName
+        assert results[packageName]['version'] == packageVersion
+        assert results[packageName]['files'] == expectedFiles[packageName], packageName
+
+
+@pytest.fixture(params=[ 'threads', 'asyncio', 'pipeline' ])
+def engine(request):
+    return request.param
+
+
+def test_mirrorPool():
+    mirrorPool = extractMtree.MirrorPool( [ 'a', 'b' ], maxPerMirror=1 )
+
+    # Neither used yet, so in mirrorlist order
+    assert mirrorPool.acquire() == 'a'
+    assert mirrorPool.acquire() == 'b'
+    assert mirrorPool.numActive == { 'a' : 1, 'b' : 1 }
+    assert mirrorPool.acquire( set([ 'a', 'b' ]) ) is None
+
+    # Both are full, so waits for one to be released
+    acquired = []
+    waitingThread = threading.Thread( target=lambda : acquired.append( mirrorPool.acquire( set([ 'b' ]) ) ) )
+    waitingThread.start()
+    time.sleep(0.2)
+    assert acquired == []
+
+    mirrorPool.release('b')
+    time.sleep(0.2)
+    # Released, but excluded
+    assert acquired == []
+
+    mirrorPool.release('a')
+    waitingThread.join(5)
+    assert acquired == [ 'a' ]
+
+    assert mirrorPool.acquire( set([ 'a' ]) ) == 'b'
+    mirrorPool.release('a')
+    mirrorPool.release('b')
+    assert mirrorPool.numActive == { 'a' : 0, 'b' : 0 }
+
+
+def test_asyncMirrorPool():
+
+    async def runTest():
+        mirrorPool = extractMtree.AsyncMirrorPool( [ 'a', 'b' ], maxPerMirror=1 )
+
+        assert await mirrorPool.acquire() == 'a'
+        assert await mirrorPool.acquire() == 'b'
+        assert await mirrorPool.acquire( set([ 'a', 'b' ]) ) is None
+
+        # Both are full, so waits for one to be released
+        waitingTask = asyncio.ensure_future( mirrorPool.acquire( set([ 'b' ]) ) )
+        await asyncio.sleep(0.1)
+        assert not waitingTask.done()
+
+        await mirrorPool.release('b')
+        await asyncio.sleep(0.1)
+        # Released, but excluded
+        assert not waitingTask.done()
+
+        await mirrorPool.release('a')
+        assert await asyncio.wait_for(waitingTask, 5) == 'a'
+        assert mirrorPool.numActive == { 'a' : 1, 'b' : 0 }
+
+    asyncio.run( runTest() )
+
+
+def test_engineResults(engine, server, packages):
+    repoUrls = [ getMirrorUrl(server, 'mirror1'), getMirrorUrl(server, 'mirror2') ]
+
+    (results, failedPackageInfos) = runEngine(engine, packages[0], repoUrls)
+    checkResults(results, failedPackageInfos, packages)
+
+    # Each package once (plus the alternate urls, for those not x86_64 .zst), spread over both mirrors
+    requestedFilenames = getMirrorRequests(server, 'mirror1') + getMirrorRequests(server, 'mirror2')
+    for filename in packages[1]:
+        assert filename in requestedFilenames
+    assert getMirrorRequests(server, 'mirror1') and getMirrorRequests(server, 'mirror2')
+
+
+def test_engineRetriesOnNextMirror(engine, server, packages):
+    # Every package fails on all but one mirror, in a different way on each
+    repoUrls = [ getMirrorUrl(server, 'missing', 'missing'), getMirrorUrl(server, 'error', 'error'), getMirrorUrl(server, 'drop', 'drop'), getRefusedMirrorUrl(), getMirrorUrl(server, 'good') ]
+    mirrorHealth = extractMtree.MirrorHealth()
+
+    (results, failedPackageInfos) = runEngine(engine, packages[0], repoUrls, mirrorHealth=mirrorHealth)
+    checkResults(results, failedPackageInfos, packages)
+
+    for mirrorName in ( 'missing', 'error', 'drop' ):
+        assert getMirrorRequests(server, mirrorName), mirrorName
+
+    stats = mirrorHealth._stats
+    # ( The pipeline engine records each fetch, rather than each package )
+    assert stats[repoUrls[-1]]['numSuccess'] >= len(packages[0])
+    # 404 and 500 are no data ( "missing" ), a dropped or refused connection is a network error
+    for (repoUrl, failureType) in zip( repoUrls[ : -1 ], ( 'numMissing', 'numMissing', 'numError', 'numError' ) ):
+        assert stats[repoUrl]['numSuccess'] == 0, repoUrl
+        assert stats[repoUrl][failureType] > 0, repoUrl
+
+
+def test_engineFullFetch(engine, server, packages, monkeypatch):
+    # pkg05's .MTREE is too far in for a short-read, so it is fetched whole
+    monkeypatch.setattr(extractMtree, 'MAX_SHORT_FETCH_SIZE', 1024 * 32)
+
+    (results, failedPackageInfos) = runEngine(engine, packages[0], [ getMirrorUrl(server, 'mirror1') ])
+    checkResults(results, failedPackageInfos, packages)
+
+    pkg05Filename = [ filename for filename in packages[1] if filename.startswith('pkg05-') ][0]
+    assert getMirrorRequests(server, 'mirror1').count(pkg05Filename) > 1
+    # Still records where the .MTREE ended, so the next run can size its short-read
+    assert results['pkg05']['mtreeOffset'] > 1024 * 96
+
+
+def test_engineNotOnAnyMirror(engine, server, packages):
+    packageInfos = packages[0][ : 3 ] + [ ('core', 'nothere', '1-1') ]
+    repoUrls = [ getMirrorUrl(server, 'mirror1'), getMirrorUrl(server, 'mirror2') ]
+
+    (results, failedPackageInfos) = runEngine(engine, packageInfos, repoUrls)
+
+    assert failedPackageInfos == [ ('core', 'nothere', '1-1') ]
+    assert results['nothere']['files'] == [] and results['nothere']['error']
+    for (repoName, packageName, packageVersion) in packageInfos[ : 3 ]:
+        assert results[packageName]['files'] == packages[2][packageName]
+
+    # Tried on each mirror, with each of the alternate urls
+    expectedFilenames = [ 'nothere-1-1-x86_64.pkg.tar.zst', 'nothere-1-1-any.pkg.tar.zst', 'nothere-1-1-x86_64.pkg.tar.xz', 'nothere-1-1-any.pkg.tar.xz' ]
+    for mirrorName in ( 'mirror1', 'mirror2' ):
+        assert sorted( filename for filename in getMirrorRequests(server, mirrorName) if filename.startswith('nothere-') ) == sorted(expectedFilenames)
+
+
+def _writeDB(filename, results):
+    pacmanProvidesDB.writeProvidesDB(filename, results)
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('otherEngine', [ 'asyncio', 'pipeline' ])
+def test_sameDBAsThreads(otherEngine, server, packages, tmpdir):
+    repoUrls = [ getMirrorUrl(server, 'mirror1'), getMirrorUrl(server, 'mirror2') ]
+
+    (threadsResults, failedPackageInfos) = runEngine('threads', packages[0], repoUrls)
+    checkResults(threadsResults, failedPackageInfos, packages)
+
+    (otherResults, failedPackageInfos) = runEngine(otherEngine, packages[0], repoUrls)
+    checkResults(otherResults, failedPackageInfos, packages)
+
+    # Including where each .MTREE ended
+    assert otherResults == threadsResults
+    assert _writeDB(str(tmpdir.join('threads.db')), threadsResults) == _writeDB(str(tmpdir.join('other.db')), otherResults)
+
+    # And again, with the short-reads sized from those offsets
+    mtreeOffsets = { packageName : result['mtreeOffset'] for (packageName, result) in threadsResults.items() }
+    del server.requests[:]
+    (otherResults, failedPackageInfos) = runEngine(otherEngine, packages[0], repoUrls, mtreeOffsets=mtreeOffsets)
+    assert otherResults == threadsResults
+
+    # pkg05 needed several short-reads the first time, but now just one
+    pkg05Filename = [ filename for filename in packages[1] if filename.startswith('pkg05-') ][0]
+    assert ( getMirrorRequests(server, 'mirror1') + getMirrorRequests(server, 'mirror2') ).count(pkg05Filename) == 1
+
+
+def test_decodePackageData(packages):
+    (packageInfos, packageFiles, expectedFiles) = packages
+    pkg05Data = [ data for (filename, data) in packageFiles.items() if filename.startswith('pkg05-') ][0]
+
+    (status, files, mtreeOffset) = extractMtree.decodePackageData(pkg05Data)
+    assert (status, files) == ('ok', expectedFiles['pkg05'])
+
+    assert extractMtree.decodePackageData(pkg05Data[ : mtreeOffset ], mtreeOffset) == ('ok', files, mtreeOffset)
+    # Not far enough in yet
+    assert extractMtree.decodePackageData(pkg05Data[ : 1024 * 32 ], 1024 * 32) == ('more', None, None)
+    # Stopped short of what was asked for, so there is no more
+    assert extractMtree.decodePackageData(pkg05Data[ : 1024 * 32 ], 1024 * 64)[0] == 'fullTar'
+
+    assert extractMtree.decodePackageData(b'', None)[0] == 'nextMirror'
+
+
+def test_pipelineDecodeQueueBounded(server, packages):
+    mirrorHealth = extractMtree.MirrorHealth()
+    repoUrls = [ getMirrorUrl(server, 'mirror1'), getMirrorUrl(server, 'mirror2') ]
+
+    runner = extractMtree.PipelineRunner(4, packages[0], repoUrls, extractMtree.RefObj({}), [], shortFetchSize=1024 * 8, maxPerMirror=2, numDecodeWorkers=1, decodeQueueSize=1, mirrorHealth=mirrorHealth)
+    runner.run()
+    checkResults(runner.resultsRef(), runner.failedPackageInfos, packages)
+
+    # The fetch threads waited on the decode stage rather than queueing more
+    assert runner.maxDepths['decode'] <= 1
+    assert runner.numFetching == 0 and runner.numDecoding == 0
+
+
+def test_mirrorHealthRouting():
+    mirrorHealth = extractMtree.MirrorHealth()
+    numActive = { 'a' : 0, 'b' : 0 }
+
+    # Not used yet, so each gets tried, in mirrorlist order
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 1 ) == 'a'
+    mirrorHealth.recordSuccess('a', 0.5, 1024 * 100)
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 1 ) == 'b'
+
+    # Then the faster one, unless it is busy
+    mirrorHealth.recordSuccess('b', 0.1, 1024 * 100)
+    assert mirrorHealth.getScore('b') < mirrorHealth.getScore('a')
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 2 ) == 'b'
+    numActive['b'] = 1
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 2 ) == 'b'
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 1 ) == 'a'
+    numActive['b'] = 5
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 10 ) == 'a'
+    numActive['a'] = 1
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 1 ) is None
+
+    # Failures (and the time spent on a timeout) make it worse than a slower mirror
+    numActive = { 'a' : 0, 'b' : 0 }
+    mirrorHealth.recordFailure('b', 'missing')
+    mirrorHealth.recordFailure('b', 'error')
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 1 ) == 'b'
+    mirrorHealth.recordFailure('b', 'timeout', 1.0)
+    assert mirrorHealth.chooseMirror( [ 'a', 'b' ], numActive, 1 ) == 'a'
+
+    report = mirrorHealth.formatReport()
+    assert '1 ok  1 timeouts  1 missing  1 errors' in report
+
+
+def test_mirrorHealthBreaker(monkeypatch):
+    clock = [ 1000.0 ]
+    monkeypatch.setattr(extractMtree, 'time', types.SimpleNamespace( time=lambda : clock[0] ))
+
+    mirrorHealth = extractMtree.MirrorHealth(breakerThreshold=3, breakerCooldown=10, maxBreakerCooldown=25)
+    numActive = { 'a' : 0, 'b' : 0 }
+    mirrorHealth.recordSuccess('a', 1.0, 1024)
+
+    def failTimes(numFailures):
+        for i in range(numFailures):
+            mirrorHealth.recordFailure('b', 'timeout', 1.0)
+
+    # Only failures in a row count
+    failTimes(2)
+    mirrorHealth.recordSuccess('b', 0.1, 1024)
+    failTimes(2)
+    assert not mirrorHealth.isTripped('b')
+
+    failTimes(1)
+    assert mirrorHealth.isTripped('b')
+    # Not used while tripped, unless it is all that is left
+    mirrorHealth.recordSuccess('a', 5.0, 1024)
+    assert mirrorHealth.chooseMirror( [ 'b', 'a' ], numActive, 1 ) == 'a'
+    assert mirrorHealth.chooseMirror( [ 'b' ], numActive, 1 ) == 'b'
+
+    # The cool-down doubles each time it trips again, up to the max
+    for cooldown in ( 10, 20, 25, 25 ):
+        clock[0] += cooldown - 0.1
+        assert mirrorHealth.isTripped('b')
+        clock[0] += 0.1
+        assert not mirrorHealth.isTripped('b')
+
+        # One more failure trips it again
+        failTimes(1)
+        assert mirrorHealth.isTripped('b')
+
+    # Recovers after a success, back to the first cool-down
+    clock[0] += 25
+    mirrorHealth.recordSuccess('b', 0.1, 1024)
+    failTimes(3)
+    clock[0] += 10
+    assert not mirrorHealth.isTripped('b')
+
+    assert 'tripped 6 times' in mirrorHealth.formatReport()
+
+
+def test_engineBreaker(engine, server, packages):
+    mirrorHealth = extractMtree.MirrorHealth(breakerThreshold=2, breakerCooldown=2)
+    flakyRepoUrl = getMirrorUrl(server, 'flaky', 'error')
+    goodRepoUrl = getMirrorUrl(server, 'good')
+    runKwargs = { 'mirrorHealth' : mirrorHealth, 'maxPerMirror' : 1, 'numWorkers' : 1 }
+
+    # Fails every package, which trips it
+    (results, failedPackageInfos) = runEngine(engine, packages[0][ : 3 ], [ flakyRepoUrl ], **runKwargs)
+    assert len(failedPackageInfos) == 3
+    assert mirrorHealth.isTripped(flakyRepoUrl)
+
+    # So is not used, though it is first
+    numFlakyRequests = len( getMirrorRequests(server, 'flaky') )
+    (results, failedPackageInfos) = runEngine(engine, packages[0][ 3 : 7 ], [ flakyRepoUrl, goodRepoUrl ], **runKwargs)
+    assert failedPackageInfos == []
+    assert len( getMirrorRequests(server, 'flaky') ) == numFlakyRequests
+
+    # Once the cool-down has passed, it is used again, and recovers
+    for i in range(50):
+        if not mirrorHealth.isTripped(flakyRepoUrl):
+            break
+        time.sleep(0.1)
+    assert not mirrorHealth.isTripped(flakyRepoUrl)
+
+    server.mirrorModes['flaky'] = 'ok'
+    server.mirrorModes['good'] = 'error'
+    (results, failedPackageInfos) = runEngine(engine, packages[0][ 7 : 11 ], [ flakyRepoUrl, goodRepoUrl ], **runKwargs)
+    assert failedPackageInfos == []
+    for (repoName, packageName, packageVersion) in packages[0][ 7 : 11 ]:
+        assert results[packageName]['files'] == packages[2][packageName]
+
+    stats = mirrorHealth._stats[flakyRepoUrl]
+    assert stats['numSuccess'] > 0 and stats['consecutiveFailures'] == 0
+    assert stats['cooldown'] == mirrorHealth.breakerCooldown
+    assert not mirrorHealth.isTripped(flakyRepoUrl)
@@ -0,0 +1,105 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for reading the pacman files databases ( $repo.files ) in extractMtree.py ( --from-files-db ),
+#   against small synthetic databases.
+
+import io
+import os
+import tarfile
+
+import pytest
+
+import extractMtree
+
+# MTREE - The .MTREE (as written by bsdtar) of the package "foo" in the databases below
+MTREE = r'''#mtree
+/set type=file uid=0 gid=0 mode=644
+./.BUILDINFO time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e
+./.INSTALL time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e
+./.PKGINFO time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e
+/set mode=755
+./usr time=1600000000.0 type=dir
+./usr/bin time=1600000000.0 type=dir
+./usr/bin/foo time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e
+./usr/share time=1600000000.0 type=dir
+/set mode=644
+./usr/share/a\040b time=1600000000.0 mode=755 type=dir
+./usr/share/a\040b/x\043y\075z\134w time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e
+./usr/share/a\040b/\303\251~ time=1600000000.0 size=0 md5digest=d41d8cd98f00b204e9800998ecf8427e
+'''
+
+FOO_FILES = [ 'usr/', 'usr/bin/', 'usr/bin/foo', 'usr/share/', 'usr/share/a b/', 'usr/share/a b/x#y=z\\w', 'usr/share/a b/é~' ]
+
+
+def _addEntry(tf, name, contents):
+    data = contents.encode('utf-8')
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    tf.addfile(member, io.BytesIO(data))
+
+
+def writeFilesDatabase(filename, packages, compression):
+    '''
+        writeFilesDatabase - Write a files database, as repo-add does
+
+            @param packages list< tuple( name<str>, version<str>, files<list<str>> ) > - The packages
+
+            @param compression <str> - "gz" or "zst"
+    '''
+    tarData = io.BytesIO()
+    with tarfile.open(fileobj=tarData, mode='w') as tf:
+        for (packageName, packageVersion, files) in packages:
+            packageDir = '%s-%s/' %(packageName, packageVersion)
+            _addEntry(tf, packageDir + 'desc', '%%FILENAME%%\n%s-%s-x86_64.pkg.tar.zst\n\n%%NAME%%\n%s\n\n%%VERSION%%\n%s\n\n' %(packageName, packageVersion, packageName, packageVersion))
+            _addEntry(tf, packageDir + 'files', '%FILES%\n' + ''.join( [ filename + '\n' for filename in files ] ) + '\n')
+
+    if compression == 'gz':
+        import gzip
+        data = gzip.compress(tarData.getvalue())
+    else:
+        zstandard = pytest.importorskip('zstandard')
+        data = zstandard.ZstdCompressor().compress(tarData.getvalue())
+
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize('compression', ['gz', 'zst'])
+def test_filesDatabasePaths(tmpdir, compression):
+    syncDir = str(tmpdir)
+    writeFilesDatabase(os.path.join(syncDir, 'extra.files'), [ ('foo', '1.0-1', FOO_FILES), ('bar', '2.0-1', [ 'etc/', 'etc/bar.conf' ]) ], compression)
+    # A package in a later repo (in pacman.conf order, not by name) is ignored, like pacman -Sl
+    writeFilesDatabase(os.path.join(syncDir, 'core.files'), [ ('foo', '0.9-1', [ 'opt/' ]), ('baz', '3.0-1', []) ], compression)
+    # A database of a repo which is no longer in pacman.conf is ignored
+    writeFilesDatabase(os.path.join(syncDir, 'old.files'), [ ('qux', '1.0-1', []) ], compression)
+
+    (packageInfos, packageFiles) = extractMtree.getPackagesFromFilesDatabases(syncDir, repoNames=['extra', 'core'])
+
+    assert sorted(packageInfos) == [ ('core', 'baz', '3.0-1'), ('extra', 'bar', '2.0-1'), ('extra', 'foo', '1.0-1') ]
+
+    # The same paths as from the package's .MTREE (without the metadata files, which are not installed)
+    assert sorted(packageFiles['foo']) == sorted( extractMtree.getFilenamesFromMtree(MTREE) )
+
+    assert '/.INSTALL' not in packageFiles['foo']
+
+    assert sorted(packageFiles['bar']) == [ '/etc', '/etc/bar.conf' ]
+    assert packageFiles['baz'] == []
+
+
+def test_pacmanRepoNames(tmpdir):
+    pacmanConf = str(tmpdir.join('pacman.conf'))
+    with open(pacmanConf, 'wt') as f:
+        f.write('[options]\nArchitecture = auto\n\n#[testing]\n#Include = /etc/pacman.d/mirrorlist\n\n[extra]\nInclude = /etc/pacman.d/mirrorlist\n\n[core] # comment\nInclude = /etc/pacman.d/mirrorlist\n')
+
+    assert extractMtree.getPacmanRepoNames(pacmanConf) == [ 'extra', 'core' ]
+    assert extractMtree.getPacmanRepoNames(str(tmpdir.join('missing.conf'))) == []
+
+
+def test_syncDatabaseFilenamesOrder(tmpdir):
+    syncDir = str(tmpdir)
+    for repoName in ('core', 'extra', 'old'):
+        open(os.path.join(syncDir, repoName + '.db'), 'wb').close()
+
+    assert extractMtree.getSyncDatabaseFilenames(syncDir, '.db', ['extra', 'core', 'missing']) == [ ('extra', os.path.join(syncDir, 'extra.db')), ('core', os.path.join(syncDir, 'core.db')) ]
+    # Unknown repos (no pacman.conf), every database by name
+    assert [ repoName for (repoName, dbFilename) in extractMtree.getSyncDatabaseFilenames(syncDir, '.db', []) ] == [ 'core', 'extra', 'old' ]
@@ -0,0 +1,310 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for the native http fetcher of extractMtree.py ( HttpFetcher ), against a local
+#   http.server which supports Range and keep-alive (or, on /norange/, ignores Range).
+
+import re
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import extractMtree
+
+# FILE_DATA - The file served at every path. Much larger than HTTP_MAX_DRAIN_SIZE , so
+#   reading all of it (rather than dropping the connection) shows up in the bytes sent.
+FILE_DATA = bytes( bytearray( (i * 7) % 251 for i in range(1024 * 1024 * 8) ) )
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    '''
+        RangeRequestHandler - Serves FILE_DATA with keep-alive. Paths:
+
+          /pkg - Honors Range
+          /repo/*.pkg.tar.xz - Honors Range
+          /norange/pkg - Ignores Range, always sends the whole file
+          /redirect - 302 to /pkg
+          anything else - 404
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Keep the kernel from buffering much of the file ahead of what the client reads
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 16)
+        self.server.stats['connections'] += 1
+        self.server.stats['sockets'].append(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stats = self.server.stats
+        stats['requests'].append( (self.path, self.headers.get('Range')) )
+
+        if self.path == '/redirect':
+            self._sendEmpty(302, { 'Location' : '/pkg' })
+            return
+
+        isRangePath = self.path == '/pkg' or ( self.path.startswith('/repo/') and self.path.endswith('.pkg.tar.xz') )
+        if not isRangePath and self.path != '/norange/pkg':
+            self._sendEmpty(404)
+            return
+
+        (start, end) = (0, len(FILE_DATA) - 1)
+        rangeMatch = _RANGE_RE.match( self.headers.get('Range') or '' )
+        if rangeMatch and isRangePath:
+            start = int(rangeMatch.group(1))
+            if rangeMatch.group(2):
+                end = min( int(rangeMatch.group(2)), end )
+            if start >= len(FILE_DATA):
+                self._sendEmpty(416, { 'Content-Range' : 'bytes */%d' %(len(FILE_DATA), ) })
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %(start, end, len(FILE_DATA)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        offset = start
+        try:
+            while offset <= end:
+                data = FILE_DATA[ offset : min(offset + 1024 * 16, end + 1) ]
+                self.wfile.write(data)
+                offset += len(data)
+                stats['bytesSent'] += len(data)
+        except (ConnectionError, OSError):
+            self.close_connection = True
+
+    def _sendEmpty(self, status, headers=None):
+        self.send_response(status)
+        for (headerName, headerValue) in (headers or {}).items():
+            self.send_header(headerName, headerValue)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@pytest.fixture
+def server():
+    httpServer = ThreadingHTTPServer( ('127.0.0.1', 0), RangeRequestHandler )
+    httpServer.daemon_threads = True
+    httpServer.stats = { 'connections' : 0, 'requests' : [], 'bytesSent' : 0, 'sockets' : [] }
+
+    serverThread = threading.Thread(target=httpServer.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+
+    httpServer.baseUrl = 'http://127.0.0.1:%d' %(httpServer.server_address[1], )
+    try:
+        yield httpServer
+    finally:
+        httpServer.shutdown()
+        httpServer.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = extractMtree.HttpFetcher( extractMtree.HttpConnectionPool() )
+    try:
+        yield fetcher
+    finally:
+        fetcher.pool.closeAll()
+
+
+def _fetch(fetcher, url, numBytes, startByte=0):
+    return b''.join( fetcher.iterFetch(url, numBytes, startByte) )
+
+
+def test_rangeFetch(server, fetcher):
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 1000) == FILE_DATA[ : 1000 ]
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 1000, startByte=5000) == FILE_DATA[ 5000 : 6000 ]
+    assert _fetch(fetcher, server.baseUrl + '/pkg', None, startByte=len(FILE_DATA) - 10) == FILE_DATA[ -10 : ]
+
+    assert [ rangeHeader for (path, rangeHeader) in server.stats['requests'] ] == [ 'bytes=0-999', 'bytes=5000-5999', 'bytes=%d-' %(len(FILE_DATA) - 10, ) ]
+
+
+def test_connectionReused(server, fetcher):
+    for i in range(5):
+        assert _fetch(fetcher, server.baseUrl + '/pkg', 1024, startByte=i * 1024) == FILE_DATA[ i * 1024 : (i + 1) * 1024 ]
+
+    assert len(server.stats['requests']) == 5
+    assert server.stats['connections'] == 1
+
+
+def test_notFound(server, fetcher):
+    assert _fetch(fetcher, server.baseUrl + '/missing', 1000) == b''
+    assert fetcher.fetchToConsumer(server.baseUrl + '/missing', lambda data : False, 1000) == 0
+
+    # 416 - Range not satisfiable
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 1000, startByte=len(FILE_DATA) + 1) == b''
+
+    # The connection is still good after each
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 10) == FILE_DATA[ : 10 ]
+    assert server.stats['connections'] == 1
+
+
+def test_redirect(server, fetcher):
+    assert _fetch(fetcher, server.baseUrl + '/redirect', 1000, startByte=100) == FILE_DATA[ 100 : 1100 ]
+    assert [ path for (path, rangeHeader) in server.stats['requests'] ] == [ '/redirect', '/pkg' ]
+    assert server.stats['connections'] == 1
+
+
+def test_earlyAbortSmallRemainder(server, fetcher):
+    # Stopping with little left to read drains the rest, and keeps the connection
+    chunks = []
+    def consumer(data):
+        chunks.append(data)
+        return True
+
+    numFed = fetcher.fetchToConsumer(server.baseUrl + '/pkg', consumer, extractMtree.DEFAULT_FETCH_CHUNK_SIZE * 2)
+    assert numFed == len(chunks[0]) and b''.join(chunks) == FILE_DATA[ : numFed ]
+
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 10) == FILE_DATA[ : 10 ]
+    assert server.stats['connections'] == 1
+
+
+def test_earlyAbortCloses(server, fetcher):
+    # Stopping with a lot left drops the connection, rather than reading the rest
+    fetchIter = fetcher.iterFetch(server.baseUrl + '/pkg', None)
+    firstChunk = next(fetchIter)
+    assert firstChunk and firstChunk == FILE_DATA[ : len(firstChunk) ]
+    fetchIter.close()
+
+    assert server.stats['bytesSent'] < len(FILE_DATA) // 2
+
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 10) == FILE_DATA[ : 10 ]
+    assert server.stats['connections'] == 2
+
+
+def test_serverIgnoresRange(server, fetcher):
+    url = server.baseUrl + '/norange/pkg'
+
+    assert _fetch(fetcher, url, 1000) == FILE_DATA[ : 1000 ]
+    assert _fetch(fetcher, url, 1000, startByte=5000) == FILE_DATA[ 5000 : 6000 ]
+
+    numFed = fetcher.fetchToConsumer(url, lambda data : True, 1000 * 1000)
+    assert 0 < numFed <= extractMtree.DEFAULT_FETCH_CHUNK_SIZE
+
+    # Each was stopped once it had what was asked for, rather than reading the whole file
+    assert len(server.stats['requests']) == 3
+    assert server.stats['bytesSent'] < len(FILE_DATA) // 2
+
+
+def test_iterFetchFromUrlSingleRequest(server):
+    url = server.baseUrl + '/pkg'
+    fetchIter = extractMtree.iterFetchFromUrl(url, extractMtree.DEFAULT_SHORT_FETCH_SIZE)
+    assert b''.join(fetchIter) == FILE_DATA[ : extractMtree.DEFAULT_SHORT_FETCH_SIZE ]
+
+    assert server.stats['requests'] == [ ('/pkg', 'bytes=0-%d' %(extractMtree.DEFAULT_SHORT_FETCH_SIZE - 1, )) ]
+
+
+def test_iterFetchFromUrlAlternates(server):
+    # Only the .xz is on the mirror
+    url = server.baseUrl + '/repo/foo-1-1-x86_64.pkg.tar.zst'
+    assert b''.join( extractMtree.iterFetchFromUrl(url, 1000) ) == FILE_DATA[ : 1000 ]
+    assert server.stats['requests'][-1][0] == '/repo/foo-1-1-x86_64.pkg.tar.xz'
+
+    # Resuming, the alternates are different files, so must not be continued from
+    del server.stats['requests'][:]
+    assert b''.join( extractMtree.iterFetchFromUrl(url, 1000, startByte=1000) ) == b''
+    assert server.stats['requests'] == [ ('/repo/foo-1-1-x86_64.pkg.tar.zst', 'bytes=1000-1999') ]
+
+
+def test_sharedPoolAcrossThreads(server, fetcher):
+    # One fetcher for every thread
+    sharedFetchers = []
+    fetcherThreads = [ threading.Thread( target=lambda : sharedFetchers.append( extractMtree.getHttpFetcher() ) ) for i in range(4) ]
+    for fetcherThread in fetcherThreads:
+        fetcherThread.start()
+    for fetcherThread in fetcherThreads:
+        fetcherThread.join()
+    assert len(sharedFetchers) == 4 and all( sharedFetcher is extractMtree.getHttpFetcher() for sharedFetcher in sharedFetchers )
+
+    # A connection opened by one thread is used by the next
+    for i in range(3):
+        fetchThread = threading.Thread( target=_fetch, args=(fetcher, server.baseUrl + '/pkg', 1024) )
+        fetchThread.start()
+        fetchThread.join()
+    assert len(server.stats['requests']) == 3
+    assert server.stats['connections'] == 1
+
+    # At once, each gets a connection of its own, and the data is not mixed up between them
+    errors = []
+    barrier = threading.Barrier(4)
+    def fetchMany(threadNum):
+        try:
+            barrier.wait(5)
+            for i in range(5):
+                startByte = (threadNum * 5 + i) * 4096
+                assert _fetch(fetcher, server.baseUrl + '/pkg', 4096, startByte=startByte) == FILE_DATA[ startByte : startByte + 4096 ]
+        except Exception as e:
+            errors.append(e)
+
+    fetchThreads = [ threading.Thread( target=fetchMany, args=(threadNum, ) ) for threadNum in range(4) ]
+    for fetchThread in fetchThreads:
+        fetchThread.start()
+    for fetchThread in fetchThreads:
+        fetchThread.join()
+
+    assert errors == []
+    assert len(server.stats['requests']) == 3 + 4 * 5
+    assert server.stats['connections'] <= 4
+
+
+def test_staleIdleConnectionRetried(server, fetcher):
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 1000) == FILE_DATA[ : 1000 ]
+
+    # The server closes the connection while it is idle in the pool
+    for sock in server.stats['sockets']:
+        sock.shutdown(socket.SHUT_RDWR)
+
+    # Found to be closed when used, so retried once on a new connection
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 1000, startByte=1000) == FILE_DATA[ 1000 : 2000 ]
+    assert server.stats['connections'] == 2
+    assert [ rangeHeader for (path, rangeHeader) in server.stats['requests'] ] == [ 'bytes=0-999', 'bytes=1000-1999' ]
+
+    # And that one is kept
+    assert _fetch(fetcher, server.baseUrl + '/pkg', 10) == FILE_DATA[ : 10 ]
+    assert server.stats['connections'] == 2
+
+
+def test_newConnectionErrorNotRetried(fetcher):
+    # Only a reused connection is retried. A new one failing is the mirror's problem.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind( ('127.0.0.1', 0) )
+    port = sock.getsockname()[1]
+    sock.close()
+
+    with pytest.raises(OSError):
+        _fetch(fetcher, 'http://127.0.0.1:%d/pkg' %(port, ), 1000)
+
+
+def test_maxIdlePerMirror(server):
+    fetcher = extractMtree.HttpFetcher( extractMtree.HttpConnectionPool(maxIdlePerMirror=2) )
+    try:
+        # 4 fetches in progress at once, each on its own connection
+        fetchIters = [ fetcher.iterFetch(server.baseUrl + '/pkg', 1000, startByte=i * 1000) for i in range(4) ]
+        for (i, fetchIter) in enumerate(fetchIters):
+            assert next(fetchIter) == FILE_DATA[ i * 1000 : (i + 1) * 1000 ]
+        assert server.stats['connections'] == 4
+
+        # When done, only 2 are kept, and the others are closed
+        for fetchIter in fetchIters:
+            assert list(fetchIter) == []
+        idleConns = list( fetcher.pool._idle.values() )
+        assert len(idleConns) == 1 and len(idleConns[0]) == 2
+
+        for i in range(4):
+            assert _fetch(fetcher, server.baseUrl + '/pkg', 10) == FILE_DATA[ : 10 ]
+        assert server.stats['connections'] == 4
+    finally:
+        fetcher.pool.closeAll()
+
+    assert fetcher.pool._idle == {}
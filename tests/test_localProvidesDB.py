@@ -0,0 +1,253 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for the providesDB of the installed packages (the whatprovides cache), built from a
+#   synthetic pacman local database ( /var/lib/pacman/local ).
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pacmanProvidesDB
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+
+SCRIPT = os.path.join(REPO_DIR, 'whatprovides_local')
+
+# QUERIES - Run with whatprovides_local , with and without the cache
+QUERIES = [ '/usr/bin/bash', '/usr/bin/', '/usr/bin', '/usr/lib/libz.so.1', '/nothere', '*/bin/*', '/usr/lib/libz.so*', '*sh', '/usr/share/*', '*é*', '*' ]
+
+
+def writeLocalPackage(localDir, name, version, files):
+    '''
+        writeLocalPackage - Install a package into a pacman local database, as pacman records it
+
+            @param files list<str> - The files, relative, with directories ending in "/"
+    '''
+    entryDir = os.path.join(localDir, '%s-%s' %(name, version))
+    os.makedirs(entryDir)
+    with open(os.path.join(entryDir, 'desc'), 'wt') as f:
+        f.write('%%NAME%%\n%s\n\n%%VERSION%%\n%s\n\n' %(name, version))
+    with open(os.path.join(entryDir, 'files'), 'wt') as f:
+        f.write('%FILES%\n' + ''.join( [ filename + '\n' for filename in files ] ) + '\n')
+
+
+def removeLocalPackage(localDir, name, version):
+    shutil.rmtree( os.path.join(localDir, '%s-%s' %(name, version)) )
+
+
+def makeLocalDir(tmpdir):
+    localDir = os.path.join(str(tmpdir), 'local')
+    os.makedirs(localDir)
+    with open(os.path.join(localDir, 'ALPM_DB_VERSION'), 'wt') as f:
+        f.write('9\n')
+
+    writeLocalPackage(localDir, 'bash', '5.0-1', [ 'usr/', 'usr/bin/', 'usr/bin/bash', 'usr/bin/sh' ])
+    writeLocalPackage(localDir, 'zlib', '1:1.2.11-4', [ 'usr/', 'usr/lib/', 'usr/lib/libz.so', 'usr/lib/libz.so.1' ])
+
+    return localDir
+
+
+def test_updateComparesEveryPackage(tmpdir):
+    localDir = makeLocalDir(tmpdir)
+    cacheFilename = os.path.join(str(tmpdir), 'cache.idx')
+
+    assert pacmanProvidesDB.updateLocalProvidesDB(cacheFilename, localDir) == (2, 0, 0)
+    assert not pacmanProvidesDB.localCacheNeedsUpdate(cacheFilename, localDir)
+
+    # Two changes, though a transaction (the hook) may only have been for one of them. The update
+    #   still finds both, so the cache is current once it is marked as such.
+    writeLocalPackage(localDir, 'vim', '8.2-1', [ 'usr/', 'usr/bin/', 'usr/bin/vim' ])
+    removeLocalPackage(localDir, 'zlib', '1:1.2.11-4')
+    # As if the cache was last updated a while ago
+    os.utime(cacheFilename, ns=( os.stat(localDir).st_mtime_ns - 10 ** 9, ) * 2)
+    assert pacmanProvidesDB.localCacheNeedsUpdate(cacheFilename, localDir)
+
+    assert pacmanProvidesDB.updateLocalProvidesDB(cacheFilename, localDir) == (1, 1, 1)
+    assert not pacmanProvidesDB.localCacheNeedsUpdate(cacheFilename, localDir)
+
+    with pacmanProvidesDB.ProvidesDB(cacheFilename) as providesDB:
+        assert sorted( name for (name, version, error, mtreeOffset) in providesDB.iterPackages() ) == [ 'bash', 'vim' ]
+        assert providesDB.whatProvides('/usr/bin/vim') == [ 'vim' ]
+        assert providesDB.whatProvides('/usr/lib/libz.so') == []
+
+
+def test_iterLocalPackageRecords(tmpdir):
+    localDir = makeLocalDir(tmpdir)
+    writeLocalPackage(localDir, 'lib32-foo', '1:2.0-3', [ 'usr/', 'usr/lib32/', 'usr/lib32/libfoo.so.2', 'usr/share/a b/é.txt' ])
+    # A package which installs no files has no files list
+    writeLocalPackage(localDir, 'meta', '1-1', [])
+    os.unlink( os.path.join(localDir, 'meta-1-1', 'files') )
+    # Not packages
+    os.makedirs( os.path.join(localDir, 'nodesc-1-1') )
+
+    records = list( pacmanProvidesDB.iterLocalPackageRecords(localDir) )
+
+    assert records == [
+        ( 'bash', { 'files' : [ '/usr/', '/usr/bin/', '/usr/bin/bash', '/usr/bin/sh' ], 'version' : '5.0-1', 'error' : None } ),
+        ( 'lib32-foo', { 'files' : [ '/usr/', '/usr/lib32/', '/usr/lib32/libfoo.so.2', '/usr/share/a b/é.txt' ], 'version' : '1:2.0-3', 'error' : None } ),
+        ( 'meta', { 'files' : [], 'version' : '1-1', 'error' : None } ),
+        ( 'zlib', { 'files' : [ '/usr/', '/usr/lib/', '/usr/lib/libz.so', '/usr/lib/libz.so.1' ], 'version' : '1:1.2.11-4', 'error' : None } ),
+    ]
+
+    assert [ name for (name, record) in pacmanProvidesDB.iterLocalPackageRecords(localDir, [ 'zlib-1:1.2.11-4', 'lib32-foo-1:2.0-3', 'gone-1-1' ]) ] == [ 'lib32-foo', 'zlib' ]
+
+    # Written as a providesDB, it reads back the same
+    cacheFilename = os.path.join(str(tmpdir), 'cache.idx')
+    pacmanProvidesDB.writeProvidesDB( cacheFilename, pacmanProvidesDB.iterLocalPackageRecords(localDir) )
+    with pacmanProvidesDB.ProvidesDB(cacheFilename) as providesDB:
+        assert dict( providesDB.iterRecords() ) == dict(records)
+        assert providesDB.whatProvides('/usr/') == [ 'bash', 'lib32-foo', 'zlib' ]
+        assert providesDB.whatProvides('/usr') == []
+
+
+def runScript(args):
+    '''
+        runScript - Run whatprovides_local
+
+            @return tuple( returnCode<int>, stdout<str>, stderr<str> )
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+
+    pipe = subprocess.Popen( [ sys.executable, SCRIPT ] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env )
+    (stdoutData, stderrData) = pipe.communicate(timeout=60)
+
+    return ( pipe.returncode, stdoutData.decode('utf-8'), stderrData.decode('utf-8') )
+
+
+def checkSameAsNoCache(localDir, cacheFilename):
+    '''
+        checkSameAsNoCache - Check whatprovides_local gives the same output using the cache as reading the local database
+    '''
+    dbArgs = [ '--dbpath=' + os.path.dirname(localDir), '--db=' + cacheFilename ]
+
+    for query in QUERIES:
+        (returnCode, output, errorOutput) = runScript( dbArgs + [ query ] )
+        assert returnCode == 0, errorOutput
+        assert errorOutput == ''
+
+        (noCacheReturnCode, noCacheOutput, noCacheErrorOutput) = runScript( dbArgs + [ '--no-cache', query ] )
+        assert noCacheReturnCode == 0, noCacheErrorOutput
+
+        assert output == noCacheOutput, query
+
+
+def test_scriptMatchesNoCache(tmpdir):
+    localDir = makeLocalDir(tmpdir)
+    writeLocalPackage(localDir, 'lib32-foo', '1:2.0-3', [ 'usr/', 'usr/bin/', 'usr/bin/bash', 'usr/share/', 'usr/share/a b/', 'usr/share/a b/é.txt' ])
+    cacheFilename = os.path.join(str(tmpdir), 'cache.idx')
+
+    # Built by the first query
+    checkSameAsNoCache(localDir, cacheFilename)
+    assert os.path.exists(cacheFilename)
+
+    (returnCode, output, errorOutput) = runScript( [ '--dbpath=' + os.path.dirname(localDir), '--db=' + cacheFilename, '/usr/bin/bash' ] )
+    assert output == 'bash\nlib32-foo\n'
+
+    (returnCode, output, errorOutput) = runScript( [ '--dbpath=' + os.path.dirname(localDir), '--db=' + cacheFilename, '--rebuild' ] )
+    assert returnCode == 0, errorOutput
+    checkSameAsNoCache(localDir, cacheFilename)
+
+
+def _markCacheOld(cacheFilename, localDir):
+    # As if the cache was last updated a while before the local database changes which follow
+    os.utime(cacheFilename, ns=( os.stat(localDir).st_mtime_ns - 10 ** 9, ) * 2)
+
+
+def test_getLocalPackageChanges(tmpdir):
+    localDir = makeLocalDir(tmpdir)
+    cacheFilename = os.path.join(str(tmpdir), 'cache.idx')
+    pacmanProvidesDB.updateLocalProvidesDB(cacheFilename, localDir)
+
+    with pacmanProvidesDB.ProvidesDB(cacheFilename) as providesDB:
+        assert pacmanProvidesDB.getLocalPackageChanges(providesDB, localDir) == ( [], [] )
+
+    # Install, upgrade and remove
+    writeLocalPackage(localDir, 'lib32-zlib', '1.2.11-4', [ 'usr/', 'usr/lib32/', 'usr/lib32/libz.so.1' ])
+    removeLocalPackage(localDir, 'bash', '5.0-1')
+    writeLocalPackage(localDir, 'bash', '5.1-1', [ 'usr/', 'usr/bin/', 'usr/bin/bash', 'usr/bin/rbash' ])
+    removeLocalPackage(localDir, 'zlib', '1:1.2.11-4')
+
+    with pacmanProvidesDB.ProvidesDB(cacheFilename) as providesDB:
+        assert pacmanProvidesDB.getLocalPackageChanges(providesDB, localDir) == ( [ 'bash-5.1-1', 'lib32-zlib-1.2.11-4' ], [ 'zlib' ] )
+        # Just some packages. The name is told apart from the version, even with dashes in it
+        assert pacmanProvidesDB.getLocalPackageChanges(providesDB, localDir, [ 'bash' ]) == ( [ 'bash-5.1-1' ], [] )
+        assert pacmanProvidesDB.getLocalPackageChanges(providesDB, localDir, [ 'zlib' ]) == ( [], [ 'zlib' ] )
+        assert pacmanProvidesDB.getLocalPackageChanges(providesDB, localDir, [ 'lib32-zlib', 'nothere' ]) == ( [ 'lib32-zlib-1.2.11-4' ], [] )
+
+
+def test_incrementalUpdates(tmpdir):
+    localDir = makeLocalDir(tmpdir)
+    cacheFilename = os.path.join(str(tmpdir), 'cache.idx')
+
+    assert pacmanProvidesDB.updateLocalProvidesDB(cacheFilename, localDir) == (2, 0, 0)
+
+    def _checkCache():
+        with pacmanProvidesDB.ProvidesDB(cacheFilename) as providesDB:
+            assert dict( providesDB.iterRecords() ) == dict( pacmanProvidesDB.iterLocalPackageRecords(localDir) )
+            assert pacmanProvidesDB.getLocalPackageChanges(providesDB, localDir) == ( [], [] )
+            return providesDB.numSegments
+
+    changes = [
+        # Installed
+        ( lambda : writeLocalPackage(localDir, 'vim', '8.2-1', [ 'usr/', 'usr/bin/', 'usr/bin/vi', 'usr/bin/vim' ]), (1, 0, 1) ),
+        # Upgraded, with a file moved to another package
+        ( lambda : ( removeLocalPackage(localDir, 'vim', '8.2-1'), writeLocalPackage(localDir, 'vim', '8.2-2', [ 'usr/', 'usr/bin/', 'usr/bin/vim' ]),
+            writeLocalPackage(localDir, 'vi', '1-1', [ 'usr/', 'usr/bin/', 'usr/bin/vi' ]) ), (2, 0, 2) ),
+        # Removed
+        ( lambda : removeLocalPackage(localDir, 'bash', '5.0-1'), (0, 1, 3) ),
+        # Installed again, after it was removed in a segment
+        ( lambda : writeLocalPackage(localDir, 'bash', '5.1-1', [ 'usr/', 'usr/bin/', 'usr/bin/bash' ]), (1, 0, 4) ),
+    ]
+
+    for (makeChange, expected) in changes:
+        _markCacheOld(cacheFilename, localDir)
+        makeChange()
+        assert pacmanProvidesDB.localCacheNeedsUpdate(cacheFilename, localDir)
+
+        assert pacmanProvidesDB.updateLocalProvidesDB(cacheFilename, localDir) == expected
+        assert not pacmanProvidesDB.localCacheNeedsUpdate(cacheFilename, localDir)
+        assert _checkCache() == expected[2]
+
+    # Nothing changed, nothing appended
+    assert pacmanProvidesDB.updateLocalProvidesDB(cacheFilename, localDir) == (0, 0, 4)
+
+    with pacmanProvidesDB.ProvidesDB(cacheFilename) as providesDB:
+        assert providesDB.whatProvides('/usr/bin/vi') == [ 'vi' ]
+        assert providesDB.whatProvides('/usr/bin/bash') == [ 'bash' ]
+        assert providesDB.whatProvides('/usr/bin/') == [ 'bash', 'vi', 'vim' ]
+
+    pacmanProvidesDB.compactProvidesDB(cacheFilename)
+    assert _checkCache() == 0
+
+
+def test_scriptIncrementalMatchesNoCache(tmpdir):
+    localDir = makeLocalDir(tmpdir)
+    cacheFilename = os.path.join(str(tmpdir), 'cache.idx')
+    dbArgs = [ '--dbpath=' + os.path.dirname(localDir), '--db=' + cacheFilename ]
+
+    checkSameAsNoCache(localDir, cacheFilename)
+
+    _markCacheOld(cacheFilename, localDir)
+    writeLocalPackage(localDir, 'vim', '8.2-1', [ 'usr/', 'usr/bin/', 'usr/bin/vim', 'usr/share/', 'usr/share/vim/', 'usr/share/vim/é' ])
+    removeLocalPackage(localDir, 'bash', '5.0-1')
+    writeLocalPackage(localDir, 'bash', '5.1-1', [ 'usr/', 'usr/bin/', 'usr/bin/bash' ])
+
+    # The first query updates the cache with a segment
+    checkSameAsNoCache(localDir, cacheFilename)
+    assert pacmanProvidesDB.getSegmentFilenames(cacheFilename) == [ cacheFilename + '.seg.1' ]
+
+    # --update , as run in the background by the hook
+    _markCacheOld(cacheFilename, localDir)
+    removeLocalPackage(localDir, 'zlib', '1:1.2.11-4')
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--update' ] )
+    assert returnCode == 0, errorOutput
+    assert pacmanProvidesDB.getSegmentFilenames(cacheFilename) == [ cacheFilename + '.seg.1', cacheFilename + '.seg.2' ]
+    checkSameAsNoCache(localDir, cacheFilename)
+
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--compact' ] )
+    assert returnCode == 0, errorOutput
+    assert pacmanProvidesDB.getSegmentFilenames(cacheFilename) == []
+    assert not pacmanProvidesDB.localCacheNeedsUpdate(cacheFilename, localDir)
+    checkSameAsNoCache(localDir, cacheFilename)
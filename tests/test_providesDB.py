@@ -0,0 +1,251 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for the binary providesDB format: write a database of synthetic packages, read it back, and check
+#   each query against a brute-force scan of the records which were written.
+
+import random
+
+import pytest
+
+import pacmanProvidesDB
+
+
+GLOBS = [ '/usr/lib/*.so', '/usr/lib/lib?.so.*', '*/libc.so*', '*/share/*', '*bin/f?o*', '*/doc/*/README', '*é*',
+    '*.conf', '/opt/*', '*', '/usr/bin/foo', '/nonexistent/*', '*x?z' ]
+
+SUBTREES = [ '/usr', '/usr/', '/usr/lib', '/usr/share/doc', '/opt/long', '/etc', '/nonexistent', '/' ]
+
+
+def makeResults(seed=1, numPackages=120):
+    '''
+        makeResults - Make the records of some synthetic packages. Many paths are shared between packages
+          (directories and conflicting files), and some have long directory prefixes.
+
+            @return dict<str, dict> - package name -> record, as passed to writeProvidesDB
+    '''
+    rand = random.Random(seed)
+
+    dirs = [ '/usr/bin', '/usr/lib', '/usr/lib32', '/usr/share/doc', '/usr/share/man/man1', '/etc', '/opt/long/' + '/'.join( [ 'deep%d' %(i, ) for i in range(40) ] ) ]
+    results = {}
+    for pkgIdx in range(numPackages):
+        pkgName = 'pkg%03d' %(pkgIdx, )
+        files = []
+        for fileIdx in range( rand.randint(0, 40) ):
+            dirPath = rand.choice(dirs)
+            files.append( '%s/f%d_%d%s' %(dirPath, rand.randint(0, 300), fileIdx % 3, rand.choice( ('', '.so', '.so.1', '.conf', 'oo', 'é', 'xyz') )) )
+        if files:
+            files += [ '/usr', '/usr/share' ]
+
+        results[pkgName] = { 'files' : files, 'version' : '%d.%d-1' %(pkgIdx, rand.randint(0, 9)), 'error' : None }
+
+    # Names the globs look for
+    results['foo'] = { 'files' : [ '/usr', '/usr/bin', '/usr/bin/foo', '/usr/share/doc/foo/README', '/etc/foo.conf' ], 'version' : '1.0-1', 'error' : None, 'mtreeOffset' : 12345 }
+    results['glibc'] = { 'files' : [ '/usr', '/usr/lib', '/usr/lib/libc.so', '/usr/lib/libc.so.6', '/usr/lib/libm.so.6', '/usr/bin/ldd' ], 'version' : '2.33-4', 'error' : None }
+    results['lib32-glibc'] = { 'files' : [ '/usr', '/usr/lib32', '/usr/lib32/libc.so.6' ], 'version' : '2.33-4', 'error' : None }
+    results['broken'] = { 'files' : [], 'version' : '0.1-1', 'error' : 'Timed out' }
+
+    return results
+
+
+def _getPathProviders(results):
+    # path -> sorted package names
+    pathProviders = {}
+    for (pkgName, pkgRecord) in results.items():
+        for path in set( pkgRecord['files'] ):
+            pathProviders.setdefault(path, []).append(pkgName)
+
+    return { path : sorted(pkgNames) for (path, pkgNames) in pathProviders.items() }
+
+
+def _sortedProviders(matches):
+    return [ (path, sorted(pkgNames)) for (path, pkgNames) in matches ]
+
+
+def checkQueries(providesDB, results):
+    '''
+        checkQueries - Check the queries of #providesDB against a scan of #results
+    '''
+    pathProviders = _getPathProviders(results)
+    allPaths = sorted(pathProviders)
+
+    for path in allPaths:
+        assert providesDB.whatProvides(path) == pathProviders[path]
+    for path in ( '/usr/bin/nothere', '/usr/bi', '/usr/bin/', '' ):
+        assert providesDB.whatProvides(path) == []
+
+    assert providesDB.whatProvidesMany( allPaths[ : 50 ] + [ '/nothere' ] ) == { path : pathProviders[path] for path in allPaths[ : 50 ] }
+
+    for globStr in GLOBS:
+        globRE = pacmanProvidesDB.globToRE(globStr)
+        expected = [ (path, pathProviders[path]) for path in allPaths if globRE.match(path) ]
+        assert _sortedProviders( providesDB.iterGlobProviders(globStr) ) == expected, globStr
+
+    for dirPath in SUBTREES:
+        prefix = dirPath.rstrip('/') + '/'
+        expected = [ (path, pathProviders[path]) for path in allPaths if path.startswith(prefix) ]
+        assert _sortedProviders( providesDB.iterSubtreeProviders(dirPath) ) == expected, dirPath
+        assert providesDB.getSubtreePackages(dirPath) == sorted( set( pkgName for (path, pkgNames) in expected for pkgName in pkgNames ) ), dirPath
+
+    for (pkgName, pkgRecord) in results.items():
+        assert list( providesDB.iterPackageFiles(pkgName) ) == sorted( set(pkgRecord['files']) ), pkgName
+    assert list( providesDB.iterPackageFiles('nothere') ) == []
+
+    for (pkgName, pkgRecord) in results.items():
+        assert providesDB.findPackage(pkgName) == ( pkgName, pkgRecord['version'], pkgRecord['error'], pkgRecord.get('mtreeOffset') or None )
+    assert providesDB.findPackage('nothere') is None
+
+
+def _normalizeResults(results):
+    # As read back: files sorted and deduplicated, no mtreeOffset when 0
+    return { pkgName : pacmanProvidesDB._makePackageRecord( sorted( set(pkgRecord['files']) ), pkgRecord['version'], pkgRecord['error'], pkgRecord.get('mtreeOffset') )
+        for (pkgName, pkgRecord) in results.items() }
+
+
+def _getCompression(codec):
+    if codec is None:
+        return None
+    try:
+        return pacmanProvidesDB.parseCompression(codec)
+    except pacmanProvidesDB.ProvidesDBException as e:
+        pytest.skip(str(e))
+
+
+@pytest.mark.parametrize('frontCoding', [ True, False ], ids=[ 'frontCoded', 'plainPaths' ])
+@pytest.mark.parametrize('codec', [ None, 'zlib', 'lzma', 'zstd' ])
+def test_roundTrip(tmpdir, monkeypatch, codec, frontCoding):
+    compression = _getCompression(codec)
+    # Small blocks, so a query reads from many of them
+    monkeypatch.setattr(pacmanProvidesDB, 'COMPRESSION_BLOCK_SIZE', 4096)
+
+    filename = str(tmpdir.join('providesDB'))
+    results = makeResults()
+
+    if frontCoding:
+        pacmanProvidesDB.writeProvidesDB(filename, results, compression=compression)
+    else:
+        # Databases written before front coding only had the plain path table. It is never compressed.
+        pacmanProvidesDB._writeProvidesDBFile(filename, results, compression=compression, frontCoding=False)
+
+    assert pacmanProvidesDB.isBinaryProvidesDB(filename)
+    assert pacmanProvidesDB.getProvidesDBCompression(filename) == compression
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        checkQueries(providesDB, results)
+        assert providesDB.toDict() == _normalizeResults(results)
+        assert dict( providesDB.iterRecords() ) == _normalizeResults(results)
+
+
+def test_smallSortBuffer(tmpdir):
+    # The paths are sorted in many runs, which are then merged
+    filename = str(tmpdir.join('providesDB'))
+    results = makeResults(seed=2)
+
+    pacmanProvidesDB.writeProvidesDB( filename, iter( results.items() ), sortBufferSize=4096 )
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        checkQueries(providesDB, results)
+
+
+def test_emptyDB(tmpdir):
+    filename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(filename, {})
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        checkQueries(providesDB, {})
+        assert providesDB.toDict() == {}
+
+
+def _applySegment(results, changedResults, removedPackageNames):
+    results = dict(results)
+    for pkgName in removedPackageNames:
+        results.pop(pkgName, None)
+    results.update(changedResults)
+
+    return results
+
+
+def test_segments(tmpdir):
+    filename = str(tmpdir.join('providesDB'))
+    compression = _getCompression('zlib')
+
+    results = makeResults(numPackages=40)
+    pacmanProvidesDB.writeProvidesDB(filename, results, compression=compression)
+    assert pacmanProvidesDB.getSegmentFilenames(filename) == []
+
+    # Replace a package, add one, and remove one
+    changed = { 'pkg001' : { 'files' : [ '/usr', '/usr/bin', '/usr/bin/foo', '/usr/bin/new1' ], 'version' : '9.0-1', 'error' : None },
+        'newpkg' : { 'files' : [ '/usr', '/usr/lib', '/usr/lib/libnew.so.1' ], 'version' : '1.0-1', 'error' : None } }
+    assert pacmanProvidesDB.appendProvidesDBSegment(filename, changed, [ 'pkg002' ]) == 1
+    results = _applySegment(results, changed, [ 'pkg002' ])
+    assert pacmanProvidesDB.getSegmentFilenames(filename) == [ filename + '.seg.1' ]
+
+    # Replace the same package again, and remove the one which is only in the first segment
+    changed = { 'pkg001' : { 'files' : [ '/usr', '/usr/bin', '/usr/bin/new2' ], 'version' : '10.0-1', 'error' : None } }
+    assert pacmanProvidesDB.appendProvidesDBSegment(filename, changed, [ 'newpkg' ]) == 2
+    results = _applySegment(results, changed, [ 'newpkg' ])
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.numSegments == 2
+        checkQueries(providesDB, results)
+        assert providesDB.toDict() == _normalizeResults(results)
+        assert dict( providesDB.iterRecords() ) == _normalizeResults(results)
+        assert providesDB.findPackage('pkg002') is None
+        assert providesDB.whatProvides('/usr/bin/new1') == []
+
+    assert pacmanProvidesDB.compactProvidesDB(filename) == 2
+    assert pacmanProvidesDB.getSegmentFilenames(filename) == []
+    # Stays compressed the way it was
+    assert pacmanProvidesDB.getProvidesDBCompression(filename) == compression
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.numSegments == 0
+        assert providesDB.base.segmentGeneration == 2
+        checkQueries(providesDB, results)
+
+    # Numbered after those folded in, never reused
+    changed = { 'pkg003' : { 'files' : [ '/etc', '/etc/pkg003.conf' ], 'version' : '3.0-2', 'error' : None } }
+    assert pacmanProvidesDB.appendProvidesDBSegment(filename, changed, [ 'pkg004' ]) == 1
+    results = _applySegment(results, changed, [ 'pkg004' ])
+    assert pacmanProvidesDB.getSegmentFilenames(filename) == [ filename + '.seg.3' ]
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.numSegments == 1
+        checkQueries(providesDB, results)
+
+
+def test_staleSegmentIgnored(tmpdir):
+    filename = str(tmpdir.join('providesDB'))
+
+    results = makeResults(numPackages=20)
+    pacmanProvidesDB.writeProvidesDB(filename, results)
+    for segmentIdx in range(3):
+        changed = { 'pkg%03d' %(segmentIdx, ) : { 'files' : [ '/usr', '/usr/bin', '/usr/bin/seg%d' %(segmentIdx, ) ], 'version' : '1.0-%d' %(segmentIdx, ), 'error' : None } }
+        pacmanProvidesDB.appendProvidesDBSegment(filename, changed, [])
+        results = _applySegment(results, changed, [])
+
+    pacmanProvidesDB.compactProvidesDB(filename)
+
+    # As if left behind by a compaction which did not get to remove it (it is already folded into the base)
+    pacmanProvidesDB._writeProvidesDBFile( filename + '.seg.2', { 'foo' : { 'files' : [ '/stale' ], 'version' : '0-0', 'error' : None } }, [ 'glibc' ] )
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.numSegments == 0
+        checkQueries(providesDB, results)
+        assert providesDB.whatProvides('/stale') == []
+
+    # And the next segment is still numbered after the base
+    assert pacmanProvidesDB.appendProvidesDBSegment(filename, {}, [ 'pkg010' ]) == 2
+    results = _applySegment(results, {}, [ 'pkg010' ])
+    assert pacmanProvidesDB.getSegmentFilenames(filename) == [ filename + '.seg.2', filename + '.seg.4' ]
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.numSegments == 1
+        checkQueries(providesDB, results)
+
+    # Compacting removes it too
+    assert pacmanProvidesDB.compactProvidesDB(filename) == 2
+    assert pacmanProvidesDB.getSegmentFilenames(filename) == []
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.base.segmentGeneration == 4
+        checkQueries(providesDB, results)
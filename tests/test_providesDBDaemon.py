@@ -0,0 +1,183 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for the providesDB daemon ( ProvidesDBServer ) and its client, on a socket and database in a temp dir.
+
+import os
+import socket
+import threading
+
+import pytest
+
+import pacmanProvidesDB
+
+from test_providesDB import GLOBS, SUBTREES, makeResults
+
+
+@pytest.fixture
+def daemon(tmpdir, monkeypatch):
+    '''
+        daemon - A ProvidesDBServer running in a thread, on a database of synthetic packages.
+          Checks for a new database on every query.
+    '''
+    monkeypatch.setattr(pacmanProvidesDB, 'RELOAD_CHECK_INTERVAL', 0)
+
+    filename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(filename, makeResults(numPackages=40))
+
+    server = pacmanProvidesDB.ProvidesDBServer(filename, str(tmpdir.join('whatprovides.sock')))
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+    serverThread.join()
+
+
+def _connect(server):
+    client = pacmanProvidesDB.connectProvidesDBDaemon(server.socketPath, timeout=10)
+    assert client is not None
+
+    return client
+
+
+def checkSameAsDB(client, filename):
+    '''
+        checkSameAsDB - Check the answers of #client are the same as reading #filename directly
+    '''
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        allPaths = [ path for (path, pkgNames) in providesDB.iterGlobProviders('*') ]
+        assert allPaths
+
+        for path in allPaths[ : 100 ]:
+            assert client.whatProvides(path) == providesDB.whatProvides(path)
+        assert client.whatProvides('/nothere') == []
+
+        for globStr in GLOBS:
+            assert list( client.iterGlobProviders(globStr) ) == list( providesDB.iterGlobProviders(globStr) ), globStr
+
+        for dirPath in SUBTREES:
+            assert list( client.iterSubtreeProviders(dirPath) ) == list( providesDB.iterSubtreeProviders(dirPath) ), dirPath
+            assert client.getSubtreePackages(dirPath) == providesDB.getSubtreePackages(dirPath), dirPath
+
+        for (name, version, error, mtreeOffset) in providesDB.iterPackages():
+            assert list( client.iterPackageFiles(name) ) == list( providesDB.iterPackageFiles(name) ), name
+        assert list( client.iterPackageFiles('nothere') ) == []
+
+
+def test_queries(daemon):
+    with _connect(daemon) as client:
+        checkSameAsDB(client, daemon.filename)
+
+
+def test_pipelined(daemon, monkeypatch):
+    # Many more queries than are sent at once
+    monkeypatch.setattr(pacmanProvidesDB, 'DAEMON_PIPELINE_SIZE', 8)
+
+    with pacmanProvidesDB.ProvidesDB(daemon.filename) as providesDB:
+        allPaths = [ path for (path, pkgNames) in providesDB.iterGlobProviders('*') ]
+        paths = allPaths + [ path + '.missing' for path in allPaths[ : 20 ] ]
+
+        with _connect(daemon) as client:
+            assert client.whatProvidesMany(paths) == providesDB.whatProvidesMany(paths)
+
+    # Every request written before any response is read
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    try:
+        sock.connect(daemon.socketPath)
+        sock.sendall( b'exact /usr/bin/foo\nsubtree-packages /usr/share/doc/foo\nbogus x\nfiles glibc\nexact /nothere\n' )
+        rfile = sock.makefile('rb')
+
+        responses = []
+        for i in range(5):
+            response = []
+            while True:
+                line = rfile.readline()
+                assert line.endswith(b'\n')
+                if line == b'\n':
+                    break
+                response.append( line[ : -1 ].decode('utf-8') )
+            responses.append(response)
+        rfile.close()
+    finally:
+        sock.close()
+
+    assert responses[0] == [ 'foo' ]
+    assert responses[1] == [ 'foo' ]
+    assert len(responses[2]) == 1 and responses[2][0].startswith('!')
+    assert responses[3] == [ '/usr', '/usr/bin/ldd', '/usr/lib', '/usr/lib/libc.so', '/usr/lib/libc.so.6', '/usr/lib/libm.so.6' ]
+    assert responses[4] == []
+
+
+def test_reload(daemon):
+    with _connect(daemon) as client:
+        assert client.whatProvides('/usr/bin/foo') == [ 'foo' ]
+        oldGeneration = daemon.generation
+
+        # Rewritten (renamed into place)
+        results = makeResults(seed=5, numPackages=30)
+        results['foo']['files'].append('/usr/bin/foo2')
+        pacmanProvidesDB.writeProvidesDB(daemon.filename, results)
+        assert pacmanProvidesDB.getProvidesDBGeneration(daemon.filename) != oldGeneration
+
+        assert client.whatProvides('/usr/bin/foo2') == [ 'foo' ]
+        assert daemon.generation == pacmanProvidesDB.getProvidesDBGeneration(daemon.filename)
+        checkSameAsDB(client, daemon.filename)
+
+        # A segment appended
+        pacmanProvidesDB.appendProvidesDBSegment(daemon.filename, { 'bar' : { 'files' : [ '/usr/bin/bar' ], 'version' : '1-1', 'error' : None } }, [ 'foo' ])
+        assert client.whatProvides('/usr/bin/foo2') == []
+        assert client.whatProvides('/usr/bin/bar') == [ 'bar' ]
+        assert daemon.generation == pacmanProvidesDB.getProvidesDBGeneration(daemon.filename)
+        assert daemon.providesDB.numSegments == 1
+
+        # Can't be read, so keeps the one it has
+        generation = daemon.generation
+        with open(daemon.filename + '.seg.9', 'wb') as f:
+            f.write(b'garbage')
+        assert client.whatProvides('/usr/bin/bar') == [ 'bar' ]
+        assert daemon.generation == generation
+
+
+def test_errorKeepsConnection(daemon):
+    with _connect(daemon) as client:
+        with pytest.raises(pacmanProvidesDB.ProvidesDBException) as excInfo:
+            client._query('bogus', 'x')
+        assert 'Unknown command' in str(excInfo.value)
+
+        assert client.whatProvides('/usr/bin/foo') == [ 'foo' ]
+
+        # An error after the response has started (the glob is only compiled once the results are read)
+        with pytest.raises(pacmanProvidesDB.ProvidesDBException):
+            list( client.iterGlobProviders('/usr/lib/[*') )
+
+        assert client.whatProvides('/usr/bin/foo') == [ 'foo' ]
+        checkSameAsDB(client, daemon.filename)
+
+
+def test_secondDaemonRefused(daemon):
+    with pytest.raises(pacmanProvidesDB.ProvidesDBException):
+        pacmanProvidesDB.ProvidesDBServer(daemon.filename, daemon.socketPath)
+
+    # The first is still serving
+    with _connect(daemon) as client:
+        assert client.whatProvides('/usr/bin/foo') == [ 'foo' ]
+
+
+def test_staleSocketReplaced(tmpdir):
+    filename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(filename, makeResults(numPackages=5))
+
+    # Left behind by a daemon which did not exit cleanly
+    socketPath = str(tmpdir.join('whatprovides.sock'))
+    staleSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    staleSock.bind(socketPath)
+    staleSock.close()
+    assert os.path.exists(socketPath)
+
+    server = pacmanProvidesDB.ProvidesDBServer(filename, socketPath)
+    server.server_close()
+    assert not os.path.exists(socketPath)
@@ -0,0 +1,265 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for whatprovides_elf: the ELF reader (on ELF files written here, and compiled here if a compiler
+#   is installed), the soname index of the providesDB, and resolving the sonames of some binaries.
+
+import importlib.machinery
+import importlib.util
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+
+import pytest
+
+import pacmanProvidesDB
+
+from test_localProvidesDB import makeLocalDir, writeLocalPackage
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+
+SCRIPT = os.path.join(REPO_DIR, 'whatprovides_elf')
+
+
+def _loadScript():
+    loader = importlib.machinery.SourceFileLoader('whatprovides_elf', SCRIPT)
+    spec = importlib.util.spec_from_loader('whatprovides_elf', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+
+    return module
+
+whatprovides_elf = _loadScript()
+
+
+def writeElf(filename, elfClass, isLittleEndian, soname, needed):
+    '''
+        writeElf - Write a minimal dynamically linked ELF file: the header, a PT_LOAD of the whole file,
+          and a PT_DYNAMIC with the string table after it
+
+            @param elfClass <int> - ELFCLASS32 or ELFCLASS64
+
+            @param soname <str/None> - DT_SONAME
+
+            @param needed list<str> - DT_NEEDED
+    '''
+    is64 = elfClass == whatprovides_elf.ELFCLASS64
+    endian = '<' if isLittleEndian else '>'
+    (headerFormat, programHeaderFormat, dynamicFormat) = ( 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ' ) if is64 else ( 'HHIIIIIHHHHHH', 'IIIIIIII', 'iI' )
+    (headerSize, programHeaderSize, dynamicSize) = [ struct.calcsize(endian + structFormat) for structFormat in (headerFormat, programHeaderFormat, dynamicFormat) ]
+
+    baseAddr = 0x400000
+
+    strtab = b'\x00'
+    stringOffsets = {}
+    for value in ( [ soname ] if soname else [] ) + needed:
+        stringOffsets[value] = len(strtab)
+        strtab += value.encode('utf-8') + b'\x00'
+
+    numDynamic = len(needed) + ( 1 if soname else 0 ) + 3
+    programHeadersOffset = 16 + headerSize
+    dynamicOffset = programHeadersOffset + 2 * programHeaderSize
+    strtabOffset = dynamicOffset + numDynamic * dynamicSize
+    fileSize = strtabOffset + len(strtab)
+
+    dynamicEntries = [ (whatprovides_elf.DT_NEEDED, stringOffsets[value]) for value in needed ]
+    if soname:
+        dynamicEntries.append( (whatprovides_elf.DT_SONAME, stringOffsets[soname]) )
+    dynamicEntries += [ (whatprovides_elf.DT_STRTAB, baseAddr + strtabOffset), (whatprovides_elf.DT_STRSZ, len(strtab)), (whatprovides_elf.DT_NULL, 0) ]
+
+    def _programHeader(pType, pOffset, pSize):
+        if is64:
+            return struct.pack(endian + programHeaderFormat, pType, 4, pOffset, baseAddr + pOffset, baseAddr + pOffset, pSize, pSize, 0x1000)
+        return struct.pack(endian + programHeaderFormat, pType, pOffset, baseAddr + pOffset, baseAddr + pOffset, pSize, pSize, 4, 0x1000)
+
+    data = b'\x7fELF' + bytes( ( elfClass, 1 if isLittleEndian else 2, 1 ) ) + bytes(9)
+    # ET_DYN, x86_64 or i386
+    data += struct.pack(endian + headerFormat, 3, 62 if is64 else 3, 1, 0, programHeadersOffset, 0, 0, 16 + headerSize, programHeaderSize, 2, 0, 0, 0)
+    data += _programHeader(whatprovides_elf.PT_LOAD, 0, fileSize)
+    data += _programHeader(whatprovides_elf.PT_DYNAMIC, dynamicOffset, numDynamic * dynamicSize)
+    data += b''.join( [ struct.pack(endian + dynamicFormat, dTag, dVal) for (dTag, dVal) in dynamicEntries ] )
+    data += strtab
+    assert len(data) == fileSize
+
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize('isLittleEndian', [ True, False ], ids=[ 'lsb', 'msb' ])
+@pytest.mark.parametrize('elfClass', [ whatprovides_elf.ELFCLASS32, whatprovides_elf.ELFCLASS64 ], ids=[ 'elf32', 'elf64' ])
+def test_readElfDependencies(tmpdir, elfClass, isLittleEndian):
+    filename = str(tmpdir.join('libfoo.so.1'))
+
+    writeElf(filename, elfClass, isLittleEndian, 'libfoo.so.1', [ 'libz.so.1', 'libc.so.6' ])
+    assert whatprovides_elf.readElfDependencies(filename) == ( elfClass, 'libfoo.so.1', [ 'libz.so.1', 'libc.so.6' ] )
+
+    writeElf(filename, elfClass, isLittleEndian, None, [])
+    assert whatprovides_elf.readElfDependencies(filename) == ( elfClass, None, [] )
+
+
+def test_readElfDependenciesNotElf(tmpdir):
+    filename = str(tmpdir.join('file'))
+
+    for data in ( b'', b'#!/bin/sh\necho hi\n', b'\x7fELF', b'\x7fELF\x09\x01\x01' + bytes(200) ):
+        with open(filename, 'wb') as f:
+            f.write(data)
+        assert whatprovides_elf.readElfDependencies(filename) is None
+
+    # Truncated before the dynamic section
+    writeElf(filename, whatprovides_elf.ELFCLASS64, True, None, [ 'libz.so.1' ])
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(filename, 'wb') as f:
+        f.write(data[ : 64 + 2 * 56 ])
+    assert whatprovides_elf.readElfDependencies(filename) is None
+
+
+def test_readCompiledElf(tmpdir):
+    compiler = shutil.which('cc') or shutil.which('gcc')
+    if not compiler:
+        pytest.skip('No C compiler')
+
+    with open(str(tmpdir.join('foo.c')), 'wt') as f:
+        f.write('int foo(void) { return 1; }\n')
+    with open(str(tmpdir.join('main.c')), 'wt') as f:
+        f.write('int foo(void);\nint main(void) { return foo(); }\n')
+
+    libFilename = str(tmpdir.join('libfoo.so.1'))
+    programFilename = str(tmpdir.join('main'))
+    try:
+        subprocess.check_call( [ compiler, '-shared', '-fPIC', '-Wl,-soname,libfoo.so.1', '-o', libFilename, str(tmpdir.join('foo.c')) ] )
+        subprocess.check_call( [ compiler, '-o', programFilename, str(tmpdir.join('main.c')), libFilename ] )
+    except (OSError, subprocess.CalledProcessError) as e:
+        pytest.skip('Cannot compile: %s' %(str(e), ))
+
+    (elfClass, soname, needed) = whatprovides_elf.readElfDependencies(libFilename)
+    assert soname == 'libfoo.so.1'
+
+    (programElfClass, programSoname, programNeeded) = whatprovides_elf.readElfDependencies(programFilename)
+    assert programElfClass == elfClass
+    assert programSoname is None
+    assert 'libfoo.so.1' in programNeeded
+    assert any( neededSoname.startswith('libc.so') for neededSoname in programNeeded )
+
+    # Only the program headers are read, so stripping makes no difference
+    strip = shutil.which('strip')
+    if strip:
+        subprocess.check_call( [ strip, programFilename ] )
+        assert whatprovides_elf.readElfDependencies(programFilename) == (programElfClass, programSoname, programNeeded)
+
+
+# UPSTREAM - Libraries in and out of the library directories, which the soname index should and should not hold
+UPSTREAM = {
+    'zlib' : { 'files' : [ '/usr', '/usr/lib', '/usr/lib/libz.so', '/usr/lib/libz.so.1', '/usr/lib/libz.so.1.2.11', '/usr/lib/libz.a', '/usr/lib/pkgconfig/zlib.pc' ], 'version' : '1.2.11-4', 'error' : None },
+    'lib32-zlib' : { 'files' : [ '/usr', '/usr/lib32', '/usr/lib32/libz.so.1' ], 'version' : '1.2.11-4', 'error' : None },
+    'glibc' : { 'files' : [ '/usr', '/usr/lib', '/usr/lib/libc.so.6', '/usr/lib/libm.so.6' ], 'version' : '2.33-4', 'error' : None },
+    'lib32-glibc' : { 'files' : [ '/usr', '/usr/lib32', '/usr/lib32/libc.so.6' ], 'version' : '2.33-4', 'error' : None },
+    # Not in a library directory, so not found by the dynamic linker
+    'plugins' : { 'files' : [ '/usr/lib/plugins/libplug.so.1', '/opt/lib/libz.so.1', '/usr/share/libfake.so.1' ], 'version' : '1-1', 'error' : None },
+    # Also provides a library another package does
+    'zlib-ng-compat' : { 'files' : [ '/usr/lib/libz.so.1' ], 'version' : '2.0-1', 'error' : None },
+    'notlib' : { 'files' : [ '/usr/lib/libfoo.so.1.conf', '/usr/lib/libfoo.sox' ], 'version' : '1-1', 'error' : None },
+}
+
+SONAMES = [ 'libz.so.1', 'libz.so', 'libz.so.1.2.11', 'libc.so.6', 'libm.so.6', 'libplug.so.1', 'libfake.so.1', 'libfoo.so.1.conf', 'libfoo.sox', 'libnothere.so.1' ]
+
+
+def getExpectedSonames(results, sonames):
+    # Scan for the libraries (named *.so or *.so.N...) directly in the library directories
+    expected = {}
+    for soname in sonames:
+        if not re.search(r'\.so(\.[0-9]+)*$', soname):
+            continue
+        for libDir in pacmanProvidesDB.LIBRARY_DIRS:
+            path = libDir + '/' + soname
+            pkgNames = sorted( pkgName for (pkgName, pkgRecord) in results.items() if path in pkgRecord['files'] )
+            if pkgNames:
+                expected.setdefault(soname, []).append( (path, pkgNames) )
+
+    return { soname : sorted(libraries) for (soname, libraries) in expected.items() }
+
+
+def test_sonameIndex(tmpdir):
+    filename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(filename, UPSTREAM)
+
+    expected = getExpectedSonames(UPSTREAM, SONAMES)
+    assert expected['libz.so.1'] == [ ('/usr/lib/libz.so.1', [ 'zlib', 'zlib-ng-compat' ]), ('/usr/lib32/libz.so.1', [ 'lib32-zlib' ]) ]
+    assert 'libplug.so.1' not in expected and 'libfoo.sox' not in expected
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.base._sonames is not None
+        assert providesDB.whatProvidesSonames(SONAMES) == expected
+
+        # A database written before the soname index: each soname is looked up in the library directories instead
+        providesDB.base._sonames = None
+        assert providesDB.whatProvidesSonames( [ soname for soname in SONAMES if soname not in ('libfoo.so.1.conf', 'libfoo.sox') ] ) == expected
+
+    # And through a segment, which replaces one package and removes another
+    pacmanProvidesDB.appendProvidesDBSegment(filename, { 'zlib' : { 'files' : [ '/usr/lib/libz.so.1', '/usr/lib/libz.so.1.3' ], 'version' : '1.3-1', 'error' : None } }, [ 'zlib-ng-compat' ])
+    results = dict(UPSTREAM)
+    results['zlib'] = { 'files' : [ '/usr/lib/libz.so.1', '/usr/lib/libz.so.1.3' ], 'version' : '1.3-1', 'error' : None }
+    del results['zlib-ng-compat']
+
+    with pacmanProvidesDB.ProvidesDB(filename) as providesDB:
+        assert providesDB.whatProvidesSonames(SONAMES + [ 'libz.so.1.3' ]) == getExpectedSonames(results, SONAMES + [ 'libz.so.1.3' ])
+
+
+def runScript(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+
+    pipe = subprocess.Popen( [ sys.executable, SCRIPT ] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env )
+    (stdoutData, stderrData) = pipe.communicate(timeout=60)
+
+    return ( pipe.returncode, stdoutData.decode('utf-8'), stderrData.decode('utf-8') )
+
+
+def test_resolve(tmpdir):
+    upstreamFilename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(upstreamFilename, UPSTREAM)
+
+    # zlib and glibc are installed, the lib32 ones are not. An AUR package provides libaur.so.1
+    localDir = makeLocalDir(tmpdir)
+    writeLocalPackage(localDir, 'glibc', '2.33-4', [ 'usr/', 'usr/lib/', 'usr/lib/libc.so.6', 'usr/lib/libm.so.6' ])
+    writeLocalPackage(localDir, 'aurpkg', '1-1', [ 'usr/', 'usr/lib/', 'usr/lib/libaur.so.1' ])
+    cacheFilename = str(tmpdir.join('cache.idx'))
+
+    binDir = str(tmpdir.join('tree'))
+    os.makedirs( os.path.join(binDir, 'lib32') )
+    writeElf( os.path.join(binDir, 'prog'), whatprovides_elf.ELFCLASS64, True, None, [ 'libz.so.1', 'libc.so.6', 'libaur.so.1', 'libintree.so.1', 'libnothere.so.2' ] )
+    writeElf( os.path.join(binDir, 'libintree.so.1'), whatprovides_elf.ELFCLASS64, True, 'libintree.so.1', [ 'libm.so.6' ] )
+    writeElf( os.path.join(binDir, 'lib32', 'prog32'), whatprovides_elf.ELFCLASS32, True, None, [ 'libz.so.1', 'libc.so.6' ] )
+    with open(os.path.join(binDir, 'README'), 'wt') as f:
+        f.write('Not an ELF file\n')
+    # Skipped under a directory
+    os.symlink( os.path.join(binDir, 'prog'), os.path.join(binDir, 'prog-link') )
+
+    dbArgs = [ '--db-file=' + upstreamFilename, '--dbpath=' + os.path.dirname(localDir), '--cache=' + cacheFilename ]
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--needed-by', binDir ] )
+
+    prog = os.path.join(binDir, 'prog')
+    prog32 = os.path.join(binDir, 'lib32', 'prog32')
+    libintree = os.path.join(binDir, 'libintree.so.1')
+
+    assert output == ''.join( [ '\t'.join(columns) + '\n' for columns in [
+        ( 'libaur.so.1', 'aurpkg', 'installed', '/usr/lib/libaur.so.1', prog ),
+        ( 'libc.so.6', 'lib32-glibc', 'not-installed', '/usr/lib32/libc.so.6', prog32 ),
+        ( 'libc.so.6', 'glibc', 'installed', '/usr/lib/libc.so.6', prog ),
+        ( 'libintree.so.1', '-', 'in-tree', libintree, prog ),
+        ( 'libm.so.6', 'glibc', 'installed', '/usr/lib/libm.so.6', libintree ),
+        ( 'libnothere.so.2', '-', 'not-found', '-', prog ),
+        ( 'libz.so.1', 'lib32-zlib', 'not-installed', '/usr/lib32/libz.so.1', prog32 ),
+        ( 'libz.so.1', 'zlib', 'installed', '/usr/lib/libz.so.1', prog ),
+        ( 'libz.so.1', 'zlib-ng-compat', 'not-installed', '/usr/lib/libz.so.1', prog ),
+    ] ] )
+
+    assert returnCode == 1
+    assert '1 of 8 sonames needed by 3 binaries were not found' in errorOutput
+
+    # All found
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ prog32 ] )
+    assert returnCode == 0, errorOutput
+    assert output == 'libc.so.6\tlib32-glibc\tnot-installed\t/usr/lib32/libc.so.6\nlibz.so.1\tlib32-zlib\tnot-installed\t/usr/lib32/libz.so.1\n'
@@ -0,0 +1,248 @@
+# vim: set ts=4 sw=4 expandtab :
+#
+#  Tests for the whatprovides_upstream script, run against a database in a temp dir, reading it
+#   directly and through a daemon ( --daemon ) on a temp socket.
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import pacmanProvidesDB
+
+from test_providesDB import makeResults
+
+REPO_DIR = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+
+SCRIPT = os.path.join(REPO_DIR, 'whatprovides_upstream')
+
+BATCH_QUERIES = [ '/usr/bin/foo', '/usr/lib/libc.so.6', '/usr/lib/*.so', '*/libc.so*', '/usr/bin/nothere', '*/share/doc/*', '/usr/bin/foo' ]
+
+
+def runScript(args, stdinData=None):
+    '''
+        runScript - Run whatprovides_upstream
+
+            @return tuple( returnCode<int>, stdout<str>, stderr<str> )
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+
+    pipe = subprocess.Popen( [ sys.executable, SCRIPT ] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env )
+    (stdoutData, stderrData) = pipe.communicate(stdinData.encode('utf-8') if stdinData is not None else b'', timeout=60)
+
+    return ( pipe.returncode, stdoutData.decode('utf-8'), stderrData.decode('utf-8') )
+
+
+def _waitForSocket(socketPath, pipe):
+    for i in range(300):
+        client = pacmanProvidesDB.connectProvidesDBDaemon(socketPath, timeout=10)
+        if client is not None:
+            client.close()
+            return
+        assert pipe.poll() is None, pipe.communicate()
+        time.sleep(0.05)
+
+    raise AssertionError('Daemon did not start listening on "%s"' %(socketPath, ))
+
+
+@pytest.fixture
+def providesDBFile(tmpdir):
+    filename = str(tmpdir.join('providesDB'))
+    pacmanProvidesDB.writeProvidesDB(filename, makeResults(numPackages=40))
+
+    return filename
+
+
+@pytest.fixture(params=[ 'direct', 'daemon' ])
+def dbArgs(request, tmpdir, providesDBFile):
+    '''
+        dbArgs - The args to query #providesDBFile . For "direct" there is no daemon (nothing listening on
+          the socket), for "daemon" a whatprovides_upstream --daemon is running on it.
+    '''
+    socketPath = str(tmpdir.join('whatprovides.sock'))
+    args = [ '--db-file=' + providesDBFile, '--socket=' + socketPath ]
+
+    if request.param == 'direct':
+        yield args
+        return
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+    pipe = subprocess.Popen( [ sys.executable, SCRIPT, '--daemon' ] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env )
+    try:
+        _waitForSocket(socketPath, pipe)
+        yield args
+    finally:
+        pipe.terminate()
+        pipe.communicate(timeout=30)
+
+    # Removes its socket on exit
+    assert not os.path.exists(socketPath)
+
+
+def getExpectedBatch(providesDBFile, queries):
+    toPrint = []
+    numNotFound = 0
+    with pacmanProvidesDB.ProvidesDB(providesDBFile) as providesDB:
+        for query in queries:
+            if '*' in query:
+                providedBy = sorted( (pkgName, path) for (path, pkgNames) in providesDB.iterGlobProviders(query) for pkgName in pkgNames )
+            else:
+                providedBy = [ (pkgName, query) for pkgName in providesDB.whatProvides(query) ]
+
+            if not providedBy:
+                numNotFound += 1
+            toPrint += [ '%s\t%s\t%s\n' %(query, pkgName, path) for (pkgName, path) in providedBy ]
+
+    return ( ''.join(toPrint), numNotFound )
+
+
+def test_batch(dbArgs, providesDBFile, tmpdir):
+    (expectedOutput, numNotFound) = getExpectedBatch(providesDBFile, BATCH_QUERIES)
+    assert numNotFound == 1
+
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--batch' ], '\n'.join(BATCH_QUERIES) + '\n\n' )
+    assert returnCode == 0, errorOutput
+    assert output == expectedOutput
+    assert '1 of %d queries matched nothing' %( len(BATCH_QUERIES), ) in errorOutput
+    assert 'WARNING' not in errorOutput
+
+    batchFilename = str(tmpdir.join('queries'))
+    with open(batchFilename, 'wt') as f:
+        f.write( '\n'.join(BATCH_QUERIES) )
+
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--batch=' + batchFilename ] )
+    assert returnCode == 0, errorOutput
+    assert output == expectedOutput
+
+
+def test_query(dbArgs):
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '/usr/lib/libc.so.6' ] )
+    assert returnCode == 0, errorOutput
+    assert output == 'glibc\n'
+
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '/usr/lib/libc.so*' ] )
+    assert returnCode == 0, errorOutput
+    assert output == 'glibc\t/usr/lib/libc.so\nglibc\t/usr/lib/libc.so.6\n'
+
+
+def test_subtree(dbArgs, providesDBFile):
+    with pacmanProvidesDB.ProvidesDB(providesDBFile) as providesDB:
+        for dirPath in ( '/usr/share/doc', '/usr/share/doc/foo/', '/etc', '/nonexistent' ):
+            expectedOutput = ''.join( [ pkgName + '\n' for pkgName in providesDB.getSubtreePackages(dirPath) ] ) or '\n'
+
+            (returnCode, output, errorOutput) = runScript( dbArgs + [ '--subtree', dirPath ] )
+            assert returnCode == 0, errorOutput
+            assert output == expectedOutput, dirPath
+
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--subtree', '/usr/share/doc/foo' ] )
+    assert output == 'foo\n'
+
+
+def test_files(dbArgs, providesDBFile):
+    with pacmanProvidesDB.ProvidesDB(providesDBFile) as providesDB:
+        for pkgName in ( 'foo', 'glibc', 'pkg001' ):
+            (returnCode, output, errorOutput) = runScript( dbArgs + [ '--files', pkgName ] )
+            assert returnCode == 0, errorOutput
+            assert output == ''.join( [ path + '\n' for path in providesDB.iterPackageFiles(pkgName) ] )
+
+    (returnCode, output, errorOutput) = runScript( dbArgs + [ '--files', 'nothere' ] )
+    assert returnCode == 1
+    assert output == ''
+    assert 'No package named "nothere"' in errorOutput
+
+
+class FailingDaemon(object):
+    '''
+        FailingDaemon - Listens on a unix socket like the daemon, but answers every request with #responseData
+          and then closes the connection
+    '''
+
+    def __init__(self, socketPath, responseData):
+        self.requests = []
+        self._responseData = responseData
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(socketPath)
+        self._sock.listen(8)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                (conn, addr) = self._sock.accept()
+            except OSError:
+                return
+
+            with conn:
+                rfile = conn.makefile('rb')
+                request = rfile.readline()
+                if request:
+                    self.requests.append(request)
+                    conn.sendall(self._responseData)
+                rfile.close()
+
+    def close(self):
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._sock.close()
+        self._thread.join()
+
+
+def test_filesDaemonFailsPartway(tmpdir, providesDBFile):
+    # The daemon sends some of the files, then the connection drops
+    socketPath = str(tmpdir.join('whatprovides.sock'))
+    failingDaemon = FailingDaemon(socketPath, b'/usr\n/usr/bin\n')
+    try:
+        (returnCode, output, errorOutput) = runScript( [ '--db-file=' + providesDBFile, '--socket=' + socketPath, '--files', 'foo' ] )
+    finally:
+        failingDaemon.close()
+
+    assert failingDaemon.requests == [ b'files foo\n' ]
+
+    # Not run again on the database, which would print these twice
+    assert returnCode == 2
+    assert output == '/usr\n/usr/bin\n'
+    assert 'failed partway through' in errorOutput
+
+
+def test_filesDaemonFailsBeforePrinting(tmpdir, providesDBFile):
+    # An error before anything is printed, so the database is read directly instead
+    socketPath = str(tmpdir.join('whatprovides.sock'))
+    failingDaemon = FailingDaemon(socketPath, b'!OSError: Something went wrong\n\n')
+    try:
+        (returnCode, output, errorOutput) = runScript( [ '--db-file=' + providesDBFile, '--socket=' + socketPath, '--files', 'foo' ] )
+    finally:
+        failingDaemon.close()
+
+    assert returnCode == 0
+    with pacmanProvidesDB.ProvidesDB(providesDBFile) as providesDB:
+        assert output == ''.join( [ path + '\n' for path in providesDB.iterPackageFiles('foo') ] )
+    assert 'Reading the database directly' in errorOutput
+
+
+def test_batchDaemonFails(tmpdir, providesDBFile):
+    # Batch results are printed once all are read, so a failure at any point falls back to the database
+    socketPath = str(tmpdir.join('whatprovides.sock'))
+    failingDaemon = FailingDaemon(socketPath, b'foo\n')
+    try:
+        (returnCode, output, errorOutput) = runScript( [ '--db-file=' + providesDBFile, '--socket=' + socketPath, '--batch' ], '\n'.join(BATCH_QUERIES) + '\n' )
+    finally:
+        failingDaemon.close()
+
+    assert returnCode == 0
+    assert output == getExpectedBatch(providesDBFile, BATCH_QUERIES)[0]
+    assert 'Reading the database directly' in errorOutput
+
+
+def test_missingDB(tmpdir):
+    (returnCode, output, errorOutput) = runScript( [ '--db-file=' + str(tmpdir.join('nothere')), '--socket=' + str(tmpdir.join('whatprovides.sock')), '/usr/bin/foo' ] )
+    assert returnCode == 2
+    assert "No database or can't read database" in errorOutput